@@ -1,4 +1,5 @@
 import os
+import hashlib
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -7,9 +8,25 @@ load_dotenv()
 # Database configuration
 DATABASE_URL = os.getenv("DATABASE_URL")
 USE_SQL_DATABASE = bool(DATABASE_URL)
+# Бэкенд пользователей, подписок, ключей и платежей: sql, mongo или memory
+DATABASE_BACKEND = os.getenv("DATABASE_BACKEND") or ("sql" if USE_SQL_DATABASE else "mongo")
+
+# Пул соединений MongoDB на процесс (Motor)
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))  # соединений максимум
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "5"))  # соединений держатся открытыми
+MONGO_MAX_IDLE_TIME_MS = 60000  # простаивающее соединение закрывается через минуту
+MONGO_WAIT_QUEUE_TIMEOUT_MS = 5000  # ожидание свободного соединения до ошибки
+MONGO_CURSOR_BATCH_SIZE = 500  # документов за один ответ курсора
 
 # Outline API configuration
 OUTLINE_API_URL = os.getenv("OUTLINE_API_URL")
+# Дополнительные серверы Outline для переноса ключей: "nl=https://...,de=https://..."
+OUTLINE_SERVERS = {
+    name.strip(): url.strip()
+    for name, _, url in (
+        item.partition("=") for item in os.getenv("OUTLINE_SERVERS", "").split(",") if "=" in item
+    )
+}
 
 # ЮKassa configuration (может использоваться в будущем)
 YUKASSA_SHOP_ID = os.getenv("YUKASSA_SHOP_ID")
@@ -68,5 +85,85 @@ VPN_PLANS = {
     }
 }
 
+# Тарифы хранятся в базе, VPN_PLANS - начальное содержимое каталога
+PLAN_CATALOG_REFRESH_INTERVAL = 30  # секунд между проверками версии каталога
+
+# Данные inline-кнопок: большие значения хранятся в памяти, в кнопке только токен
+CALLBACK_PAYLOAD_TTL = int(os.getenv("CALLBACK_PAYLOAD_TTL", "86400"))  # секунд жизни записи
+CALLBACK_PAYLOAD_MAX_ENTRIES = 100000  # записей на процесс
+
+# Хранение context.user_data в базе
+USER_STATE_FLUSH_INTERVAL = 10  # секунд между передачей изменений на запись
+USER_STATE_IDLE_TTL = 1800  # секунд без обновлений до выгрузки состояния из памяти
+USER_STATE_EVICT_INTERVAL = 300  # секунд между проходами выгрузки
+
 # Notification settings
-EXPIRY_NOTIFICATION_DAYS = 1  # За сколько дней до окончания подписки отправлять уведомление
+# Уведомления об окончании подписки: окна в днях до окончания, от раннего к позднему;
+# 0 - подписка уже истекла (не раньше суток назад)
+EXPIRY_NOTICE_WINDOWS = (3, 1, 0)
+EXPIRY_NOTICE_PAGE_SIZE = 200  # подписок на страницу при проходе после запуска
+EXPIRY_SCHEDULER_HORIZON = 86400  # секунд вперед, на которые события окончания держатся в памяти
+EXPIRY_SCHEDULER_RELOAD_INTERVAL = 3600  # секунд между перечитываниями горизонта
+EXPIRY_REVOKE_CONCURRENCY = 5  # одновременных удалений ключей в Outline при окончании подписок
+
+# Payment reconciliation settings
+PAYMENT_RECONCILE_INTERVAL = int(os.getenv("PAYMENT_RECONCILE_INTERVAL", "600"))  # секунд между проходами сверки
+PAYMENT_RECONCILE_MIN_AGE = int(os.getenv("PAYMENT_RECONCILE_MIN_AGE", "300"))  # свежие платежи ждут вебхук
+PAYMENT_PENDING_TIMEOUT = int(os.getenv("PAYMENT_PENDING_TIMEOUT", "86400"))  # после этого платеж считается брошенным
+PAYMENT_RECONCILE_PAGE_SIZE = 100  # платежей на страницу
+PAYMENT_RECONCILE_CONCURRENCY = 5  # одновременных запросов к ЮKassa
+
+# Notification outbox settings
+NOTIFICATION_BATCH_SIZE = 50  # уведомлений за одну выборку
+NOTIFICATION_POLL_INTERVAL = 5  # секунд между проверками outbox
+NOTIFICATION_MAX_ATTEMPTS = 5  # попыток доставки до отказа
+
+# Broadcast settings
+BROADCAST_CONCURRENCY = 10  # одновременных отправок
+BROADCAST_PAGE_SIZE = 200  # получателей на страницу
+BROADCAST_PROGRESS_INTERVAL = 5  # секунд между обновлениями прогресса
+
+# Исходящие запросы к Telegram: общий лимит процесса с приоритетами
+# (ответы пользователям > уведомления > рассылки)
+# Лимит Telegram считается на бота, поэтому делится между воркерами (BOT_WORKERS)
+BOT_WORKERS = max(1, int(os.getenv("BOT_WORKERS", "1")))  # сколько процессов бота работает одновременно
+OUTBOUND_RATE = int(os.getenv("OUTBOUND_RATE", "30")) / BOT_WORKERS  # сообщений в секунду на процесс (лимит Telegram - около 30 на бота)
+OUTBOUND_BUFFER_SIZES = (1000, 200, 50)  # запросов в ожидании по приоритетам, дальше отправители ждут
+OUTBOUND_MAX_RETRIES = 3  # повторов после RetryAfter
+
+# Админская панель
+ADMIN_USERS_PAGE_SIZE = 10  # пользователей на страницу списка
+ADMIN_SEARCH_LIMIT = 20  # результатов /find
+OUTLINE_METRICS_TTL = 60  # секунд, пока снимок трафика Outline считается свежим
+
+# Массовые операции администратора (/bulk)
+ADMIN_JOB_PAGE_SIZE = 200  # пользователей на страницу
+ADMIN_JOB_OUTLINE_CONCURRENCY = 10  # одновременных запросов к Outline
+ADMIN_JOB_PROGRESS_INTERVAL = 5  # секунд между обновлениями прогресса
+
+# Сообщения с прогрессом долгих операций
+PROGRESS_EDIT_INTERVAL = 3  # секунд между правками одного сообщения
+
+# Bot update delivery
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # webhook для продакшена, polling для разработки
+BOT_WORKER_ID = int(os.getenv("BOT_WORKER_ID", "0"))  # воркер 0 регистрирует вебхук и запускает фоновые задачи
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "64"))  # обновлений в работе одновременно, включая ждущие своей очереди
+WEB_SERVER_HOST = os.getenv("WEB_SERVER_HOST", "127.0.0.1")
+WEB_SERVER_PORT = int(os.getenv("WEB_SERVER_PORT", "8080"))
+WEB_SERVER_REUSE_PORT = os.getenv("WEB_SERVER_REUSE_PORT", "false").lower() == "true"  # несколько воркеров на одном порту
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес сервера, например https://yourdomain.com
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # параллельных запросов от Telegram (1-100)
+
+# Секретный путь и токен вебхука по умолчанию выводятся из токена бота
+_webhook_seed = hashlib.sha256((BOT_TOKEN or "").encode()).hexdigest()
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", f"/telegram/{_webhook_seed[:32]}")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", _webhook_seed[32:])
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # Bearer-токен /api/metrics; без него метрики доступны только локально
+
+# Anti-flood settings: (запас запросов, пополнение в секунду) для каждого класса действий
+THROTTLE_LIMITS = {
+    "buy": (3, 0.2),
+    "status": (3, 0.5),
+    "key": (5, 0.5),
+    "default": (10, 1.0),
+}
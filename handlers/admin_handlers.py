@@ -1,24 +1,23 @@
+import functools
+import html
 import logging
+import re
+import time
 from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from bson import ObjectId
 
-from config import ADMIN_IDS, VPN_PLANS
-from services.outline_service import OutlineService
+from config import ADMIN_IDS, ADMIN_USERS_PAGE_SIZE, ADMIN_SEARCH_LIMIT, OUTLINE_SERVERS
+from services.outline_service import OutlineService, service_for_key
 from utils.helpers import format_bytes
-from services.database_service import (
-    get_user,
-    get_all_users,
-    update_user,
-    create_user,
-    create_subscription,
-    update_subscription,
-    get_user_subscriptions,
-    get_active_subscription,
-    get_user_access_keys,
-    create_access_key
-)
+from services.repository import repository as db
+from services.broadcast_service import create_broadcast
+from services.bulk_service import create_admin_job
+from services.plan_catalog import get_catalog, update_plan
+from utils import metrics
+from utils.callback_data import build
+from utils.progress import ProgressReporter
 from utils.helpers import format_bytes, format_expiry_date
 
 logger = logging.getLogger(__name__)
@@ -52,6 +51,7 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("➕ Добавить пользователя", callback_data="admin_add_user")],
         [InlineKeyboardButton("🗑️ Удалить пользователя", callback_data="admin_delete_user")],
         [InlineKeyboardButton("📢 Рассылка", callback_data="admin_broadcast")],
+        [InlineKeyboardButton("🏷️ Тарифы", callback_data="admin_plans")],
         [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -63,310 +63,323 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="HTML"
     )
 
-async def admin_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handler for admin panel buttons"""
-    query = update.callback_query
-    await query.answer()
+def admin_callback(handler):
+    """Answer the callback query and check admin rights before calling `handler`"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args):
+        query = update.callback_query
+        await query.answer()
+        
+        if not await is_admin(update):
+            await query.edit_message_text("⛔ У вас нет доступа к этой команде.")
+            return
+        
+        return await handler(update, context, *args)
+    return wrapper
+
+async def _users_page(after_id=None, before_id=None):
+    """
+    Текст и клавиатура одной страницы списка пользователей.
     
-    if not await is_admin(update):
-        await query.edit_message_text("⛔ У вас нет доступа к этой команде.")
-        return
+    Returns:
+        tuple: (текст, InlineKeyboardMarkup)
+    """
+    users, has_more = await db.get_admin_users_page(after_id, before_id, ADMIN_USERS_PAGE_SIZE)
+    back_row = [InlineKeyboardButton("↩️ Назад", callback_data="admin_back")]
     
-    data = query.data
+    if not users:
+        return "📊 Пользователи не найдены.", InlineKeyboardMarkup([back_row])
     
-    if data == "admin_list_users":
-        # Get all users from database
-        try:
-            all_users = await get_all_users()
-            
-            if not all_users:
-                await query.edit_message_text(
-                    "📊 Пользователи не найдены.",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("↩️ Назад", callback_data="admin_back")
-                    ]])
-                )
-                return
-            
-            # Get all keys from Outline API to get usage data
-            outline_keys = await outline_service.get_keys()
-            
-            users_text = "📊 <b>Список пользователей:</b>\n\n"
-            
-            # Process first 10 users to avoid message too long
-            for user in all_users[:10]:
-                telegram_id = user.get("telegram_id")
-                username = user.get("username", "Unknown")
-                first_name = user.get("first_name", "")
-                has_active = user.get("has_active_subscription", False)
-                
-                display_name = f"{first_name} (@{username})" if first_name else f"@{username}"
-                status = "✅ Active" if has_active else "❌ Inactive"
-                
-                # Get user subscriptions
-                subscriptions = await get_user_subscriptions(telegram_id, status="active")
-                
-                # Get user keys
-                access_keys = await get_user_access_keys(telegram_id)
-                
-                # Calculate traffic usage from Outline API
-                total_traffic = 0
-                for key in access_keys:
-                    key_id = key.get("key_id")
-                    # Check if key exists in outline_keys (metrics data)
-                    for outline_key in outline_keys.get("keys", []):
-                        if str(outline_key.get("id")) == str(key_id):
-                            # Add usage data
-                            total_traffic += outline_key.get("metrics", {}).get("bytesTransferred", 0)
-                
-                # Build user information
-                users_text += f"👤 <code>{display_name}</code> - {status}\n"
-                
-                if subscriptions:
-                    # Get the latest subscription
-                    latest_sub = max(subscriptions, key=lambda x: x.get("expires_at", 0))
-                    plan_id = latest_sub.get("plan_id", "unknown")
-                    expires_at = latest_sub.get("expires_at", 0)
-                    
-                    plan_name = VPN_PLANS.get(plan_id, {}).get("name", "Unknown")
-                    users_text += f"🔑 План: {plan_name}\n"
-                    users_text += f"📈 Трафик: {format_bytes(total_traffic)}\n"
-                    users_text += f"⏳ До: {format_expiry_date(expires_at)}\n\n"
-                else:
-                    users_text += "\n"
-            
-            if len(all_users) > 10:
-                users_text += f"...и еще {len(all_users) - 10} пользователей"
-            
-            await query.edit_message_text(
-                users_text,
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("↩️ Назад", callback_data="admin_back")
-                ]]),
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            logger.error(f"Error listing users: {e}")
-            await query.edit_message_text(
-                f"❌ Ошибка при получении списка пользователей: {str(e)}",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("↩️ Назад", callback_data="admin_back")
-                ]])
-            )
+    # Трафик по ключам - один снимок на все страницы, пока он свежий
+    traffic = await outline_service.get_traffic_by_key()
     
-    elif data == "admin_add_user":
-        # Show plans for adding user
-        keyboard = []
-        for plan_id, plan in VPN_PLANS.items():
-            keyboard.append([InlineKeyboardButton(
-                f"{plan['name']} - {plan['price']} ₽", 
-                callback_data=f"admin_create_user_{plan_id}"
-            )])
-        keyboard.append([InlineKeyboardButton("↩️ Назад", callback_data="admin_back")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        # Store state in context
-        context.user_data["admin_state"] = "waiting_for_username"
-        
-        await query.edit_message_text(
-            "➕ <b>Добавление нового пользователя</b>\n\n"
-            "Выберите тарифный план для нового пользователя:",
-            reply_markup=reply_markup,
-            parse_mode="HTML"
-        )
+    users_text = "📊 <b>Список пользователей:</b>\n\n"
+    for user in users:
+        username = user["username"] or "Unknown"
+        first_name = user["first_name"] or ""
+        display_name = f"{first_name} (@{username})" if first_name else f"@{username}"
+        status = "✅ Active" if user["plan_id"] else "❌ Inactive"
+        
+        users_text += f"👤 <code>{html.escape(display_name)}</code> - {status}\n"
+        
+        if user["plan_id"]:
+            total_traffic = sum(traffic.get(str(key_id), 0) for key_id in user["key_ids"])
+            plan_name = (get_catalog().get(user["plan_id"]) or {}).get("name", "Unknown")
+            users_text += f"🔑 План: {plan_name} (ключей: {len(user['key_ids'])})\n"
+            users_text += f"📈 Трафик: {format_bytes(total_traffic)}\n"
+            users_text += f"⏳ До: {format_expiry_date(user['expires_at'])}\n\n"
+        else:
+            users_text += "\n"
     
-    elif data.startswith("admin_create_user_"):
-        plan_id = data.replace("admin_create_user_", "")
-        
-        # Store the plan in context
-        context.user_data["admin_plan_id"] = plan_id
-        
+    if before_id is not None:
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = after_id is not None, has_more
+    
+    nav_row = []
+    if has_prev:
+        nav_row.append(InlineKeyboardButton(
+            "⬅️ Назад", callback_data=build("admin_users_", 0, users[0]["id"])
+        ))
+    if has_next:
+        nav_row.append(InlineKeyboardButton(
+            "Далее ➡️", callback_data=build("admin_users_", 1, users[-1]["id"])
+        ))
+    
+    keyboard = [nav_row, back_row] if nav_row else [back_row]
+    return users_text, InlineKeyboardMarkup(keyboard)
+
+async def _show_users_page(query, after_id=None, before_id=None):
+    try:
+        text, reply_markup = await _users_page(after_id, before_id)
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode="HTML")
+    except Exception as e:
+        logger.error(f"Error listing users: {e}")
         await query.edit_message_text(
-            "👤 Введите имя пользователя для нового аккаунта:\n\n"
-            "Отправьте сообщение с именем пользователя или введите /cancel для отмены.",
+            f"❌ Ошибка при получении списка пользователей: {str(e)}",
             reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("↩️ Отмена", callback_data="admin_back")
+                InlineKeyboardButton("↩️ Назад", callback_data="admin_back")
             ]])
         )
-        
-        # Set state to wait for username
-        context.user_data["admin_state"] = "waiting_for_username"
+
+@admin_callback
+async def admin_list_users_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Users list, first page"""
+    await _show_users_page(update.callback_query)
+
+@admin_callback
+async def admin_users_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, forward: int, cursor_id):
+    """Users list, page after (forward) or before the cursor user"""
+    if forward:
+        await _show_users_page(update.callback_query, after_id=cursor_id)
+    else:
+        await _show_users_page(update.callback_query, before_id=cursor_id)
+
+@admin_callback
+async def admin_add_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Add user: choose a plan"""
+    query = update.callback_query
+    
+    # Show plans for adding user
+    keyboard = []
+    for plan_id, plan in get_catalog().plans.items():
+        keyboard.append([InlineKeyboardButton(
+            f"{plan['name']} - {plan['price']} ₽", 
+            callback_data=f"admin_create_user_{plan_id}"
+        )])
+    keyboard.append([InlineKeyboardButton("↩️ Назад", callback_data="admin_back")])
+    
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    # Store state in context
+    context.user_data["admin_state"] = "waiting_for_username"
+    
+    await query.edit_message_text(
+        "➕ <b>Добавление нового пользователя</b>\n\n"
+        "Выберите тарифный план для нового пользователя:",
+        reply_markup=reply_markup,
+        parse_mode="HTML"
+    )
+
+@admin_callback
+async def admin_create_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, plan_id: str):
+    """Add user: plan chosen, ask for the username"""
+    query = update.callback_query
+    
+    # Store the plan in context
+    context.user_data["admin_plan_id"] = plan_id
     
-    elif data == "admin_delete_user":
-        # Show prompt for username to delete
+    await query.edit_message_text(
+        "👤 Введите имя пользователя для нового аккаунта:\n\n"
+        "Отправьте сообщение с именем пользователя или введите /cancel для отмены.",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("↩️ Отмена", callback_data="admin_back")
+        ]])
+    )
+    
+    # Set state to wait for username
+    context.user_data["admin_state"] = "waiting_for_username"
+
+@admin_callback
+async def admin_delete_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Delete user: ask for the username"""
+    query = update.callback_query
+    
+    # Show prompt for username to delete
+    await query.edit_message_text(
+        "🗑️ Введите имя пользователя для удаления:\n\n"
+        "Отправьте сообщение с именем пользователя или введите /cancel для отмены.",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("↩️ Отмена", callback_data="admin_back")
+        ]])
+    )
+    
+    # Set state to wait for username to delete
+    context.user_data["admin_state"] = "waiting_for_delete_username"
+
+@admin_callback
+async def admin_broadcast_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Broadcast: ask for the message"""
+    query = update.callback_query
+    
+    # Show prompt for broadcast message
+    await query.edit_message_text(
+        "📢 Введите сообщение для рассылки всем пользователям:\n\n"
+        "Отправьте сообщение с текстом рассылки или введите /cancel для отмены.",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("↩️ Отмена", callback_data="admin_back")
+        ]])
+    )
+    
+    # Set state to wait for broadcast message
+    context.user_data["admin_state"] = "waiting_for_broadcast"
+
+@admin_callback
+async def admin_stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Server statistics"""
+    query = update.callback_query
+    
+    # Show server statistics
+    try:
+        # Используем сервис синхронизации для получения статистики
+        from services.sync_service import get_server_stats
+        from utils.helpers import format_bytes
+        
+        stats = await get_server_stats()
+        
+        # Получаем основные данные из статистики
+        users_count = stats.get("users_count", 0)
+        active_keys_count = stats.get("active_keys_count", 0)
+        total_keys_count = stats.get("total_keys_count", 0)
+        
+        # Получаем информацию о сервере
+        server_info = stats.get("server_info", {})
+        server_name = server_info.get("name", "Unknown")
+        server_version = server_info.get("version", "Unknown")
+        
+        # Подсчитываем общее использование данных
+        data_usage = stats.get("data_usage", {})
+        total_bytes = sum(data_usage.values()) if data_usage else 0
+        
+        # Форматируем статистику
+        stats_text = "📊 <b>Статистика сервера</b>\n\n"
+        stats_text += f"👥 Пользователей: {users_count}\n"
+        stats_text += f"👤 Активных подписок: {stats.get('active_subscriptions_count', 0)}\n"
+        stats_text += f"🔑 Активных ключей: {active_keys_count}\n"
+        stats_text += f"🔐 Всего ключей в Outline: {total_keys_count}\n"
+        stats_text += f"📊 Использовано данных: {format_bytes(total_bytes)}\n"
+        stats_text += f"📝 Имя сервера: {server_name}\n"
+        stats_text += f"📌 Версия: {server_version}\n"
+        
+        # Добавляем кнопку синхронизации ключей
+        keyboard = [
+            [InlineKeyboardButton("🔄 Синхронизировать ключи", callback_data="admin_sync_keys")],
+            [InlineKeyboardButton("↩️ Назад", callback_data="admin_back")]
+        ]
+        
         await query.edit_message_text(
-            "🗑️ Введите имя пользователя для удаления:\n\n"
-            "Отправьте сообщение с именем пользователя или введите /cancel для отмены.",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("↩️ Отмена", callback_data="admin_back")
-            ]])
+            stats_text,
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            parse_mode="HTML"
         )
-        
-        # Set state to wait for username to delete
-        context.user_data["admin_state"] = "waiting_for_delete_username"
-    
-    elif data == "admin_broadcast":
-        # Show prompt for broadcast message
+    except Exception as e:
+        logger.error(f"Error getting stats: {e}")
         await query.edit_message_text(
-            "📢 Введите сообщение для рассылки всем пользователям:\n\n"
-            "Отправьте сообщение с текстом рассылки или введите /cancel для отмены.",
+            f"❌ Ошибка при получении статистики: {str(e)}",
             reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("↩️ Отмена", callback_data="admin_back")
+                InlineKeyboardButton("↩️ Назад", callback_data="admin_back")
             ]])
         )
-        
-        # Set state to wait for broadcast message
-        context.user_data["admin_state"] = "waiting_for_broadcast"
+
+@admin_callback
+async def admin_sync_keys_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Synchronize keys with the Outline server"""
+    query = update.callback_query
     
-    elif data == "admin_stats":
-        # Show server statistics
-        try:
-            # Используем сервис синхронизации для получения статистики
-            from services.sync_service import get_server_stats
-            from utils.helpers import format_bytes
-            
-            stats = await get_server_stats()
-            
-            # Получаем основные данные из статистики
-            users_count = stats.get("users_count", 0)
-            active_keys_count = stats.get("active_keys_count", 0)
-            total_keys_count = stats.get("total_keys_count", 0)
-            
-            # Получаем информацию о сервере
-            server_info = stats.get("server_info", {})
-            server_name = server_info.get("name", "Unknown")
-            server_version = server_info.get("version", "Unknown")
-            
-            # Подсчитываем общее использование данных
-            data_usage = stats.get("data_usage", {})
-            total_bytes = sum(data_usage.values()) if data_usage else 0
-            
-            # Count active users (users with active subscriptions)
-            all_users = await get_all_users()
-            active_users = 0
-            
-            if all_users:
-                for user in all_users:
-                    if hasattr(user, 'has_active_subscription'):
-                        if user.has_active_subscription:
-                            active_users += 1
-                    elif user.get("has_active_subscription", False):
-                        active_users += 1
-            
-            # Форматируем статистику
-            stats_text = "📊 <b>Статистика сервера</b>\n\n"
-            stats_text += f"👥 Пользователей: {users_count}\n"
-            stats_text += f"👤 Активных подписок: {active_users}\n"
-            stats_text += f"🔑 Активных ключей: {active_keys_count}\n"
-            stats_text += f"🔐 Всего ключей в Outline: {total_keys_count}\n"
-            stats_text += f"📊 Использовано данных: {format_bytes(total_bytes)}\n"
-            stats_text += f"📝 Имя сервера: {server_name}\n"
-            stats_text += f"📌 Версия: {server_version}\n"
-            
-            # Добавляем кнопку синхронизации ключей
-            keyboard = [
-                [InlineKeyboardButton("🔄 Синхронизировать ключи", callback_data="admin_sync_keys")],
-                [InlineKeyboardButton("↩️ Назад", callback_data="admin_back")]
-            ]
-            
-            await query.edit_message_text(
-                stats_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            logger.error(f"Error getting stats: {e}")
-            await query.edit_message_text(
-                f"❌ Ошибка при получении статистики: {str(e)}",
+    progress = ProgressReporter.for_message(query.message, parse_mode="HTML")
+    
+    # Синхронизация ключей
+    try:
+        # Отображаем сообщение о начале синхронизации
+        progress.update(
+            "🔄 <b>Синхронизация ключей...</b>\n\n"
+            "Пожалуйста, подождите."
+        )
+        
+        # Импортируем функцию синхронизации
+        from services.sync_service import sync_outline_keys
+        
+        # Запускаем синхронизацию
+        result = await sync_outline_keys()
+        
+        # Проверяем результат
+        if result:
+            # Синхронизация успешна, показываем сообщение об успехе
+            progress.finish(
+                "✅ <b>Синхронизация успешно завершена!</b>",
                 reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("📊 Обновить статистику", callback_data="admin_stats"),
                     InlineKeyboardButton("↩️ Назад", callback_data="admin_back")
                 ]])
             )
-    
-    elif data == "admin_sync_keys":
-        # Синхронизация ключей
-        try:
-            # Сначала отвечаем на callback запрос, чтобы избежать timeout
-            await query.answer("Начинаем синхронизацию...")
-            
-            # Отображаем сообщение о начале синхронизации
-            await query.edit_message_text(
-                "🔄 <b>Синхронизация ключей...</b>\n\n"
-                "Пожалуйста, подождите.",
-                parse_mode="HTML"
+        else:
+            # Ошибка синхронизации
+            progress.finish(
+                "❌ <b>Ошибка синхронизации ключей.</b>\n\n"
+                "Проверьте журнал ошибок для получения дополнительной информации.",
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("↩️ Назад к статистике", callback_data="admin_stats")
+                ]])
             )
-            
-            # Импортируем функцию синхронизации
-            from services.sync_service import sync_outline_keys
-            
-            # Запускаем синхронизацию
-            result = await sync_outline_keys()
-            
-            # Проверяем результат
-            if result:
-                # Синхронизация успешна, показываем сообщение об успехе
-                await query.edit_message_text(
-                    "✅ <b>Синхронизация успешно завершена!</b>",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("📊 Обновить статистику", callback_data="admin_stats"),
-                        InlineKeyboardButton("↩️ Назад", callback_data="admin_back")
-                    ]]),
-                    parse_mode="HTML"
-                )
-            else:
-                # Ошибка синхронизации
-                await query.edit_message_text(
-                    "❌ <b>Ошибка синхронизации ключей.</b>\n\n"
-                    "Проверьте журнал ошибок для получения дополнительной информации.",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("↩️ Назад к статистике", callback_data="admin_stats")
-                    ]]),
-                    parse_mode="HTML"
-                )
-        except Exception as e:
-            logger.error(f"Error synchronizing keys: {e}")
-            try:
-                # Пытаемся отредактировать сообщение
-                await query.edit_message_text(
-                    f"❌ <b>Ошибка при синхронизации ключей:</b>\n\n{str(e)}",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("↩️ Назад к статистике", callback_data="admin_stats")
-                    ]]),
-                    parse_mode="HTML"
-                )
-            except Exception as edit_error:
-                # Если не можем отредактировать сообщение, отправляем новое
-                logger.error(f"Error editing message: {edit_error}")
-                await update.effective_chat.send_message(
-                    f"❌ <b>Ошибка при синхронизации ключей:</b>\n\n{str(e)}",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("↩️ Назад к статистике", callback_data="admin_stats")
-                    ]]),
-                    parse_mode="HTML"
-                )
-            
-    elif data == "admin_back":
-        # Return to admin panel
-        keyboard = [
-            [InlineKeyboardButton("👥 Список пользователей", callback_data="admin_list_users")],
-            [InlineKeyboardButton("➕ Добавить пользователя", callback_data="admin_add_user")],
-            [InlineKeyboardButton("🗑️ Удалить пользователя", callback_data="admin_delete_user")],
-            [InlineKeyboardButton("📢 Рассылка", callback_data="admin_broadcast")],
-            [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            "🛠️ <b>Панель администратора</b>\n\n"
-            "Выберите действие из списка ниже:",
-            reply_markup=reply_markup,
-            parse_mode="HTML"
+    except Exception as e:
+        logger.error(f"Error synchronizing keys: {e}")
+        progress.finish(
+            f"❌ <b>Ошибка при синхронизации ключей:</b>\n\n{str(e)}",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("↩️ Назад к статистике", callback_data="admin_stats")
+            ]])
         )
-        
-        # Clear admin state
-        if "admin_state" in context.user_data:
-            del context.user_data["admin_state"]
+
+@admin_callback
+async def admin_plans_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Plan catalog"""
+    query = update.callback_query
+    
+    # Show plan catalog with edit instructions
+    await query.edit_message_text(
+        _plans_admin_text(),
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("↩️ Назад", callback_data="admin_back")
+        ]]),
+        parse_mode="HTML"
+    )
+
+@admin_callback
+async def admin_back_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Back to the admin panel"""
+    query = update.callback_query
+    
+    # Return to admin panel
+    keyboard = [
+        [InlineKeyboardButton("👥 Список пользователей", callback_data="admin_list_users")],
+        [InlineKeyboardButton("➕ Добавить пользователя", callback_data="admin_add_user")],
+        [InlineKeyboardButton("🗑️ Удалить пользователя", callback_data="admin_delete_user")],
+        [InlineKeyboardButton("📢 Рассылка", callback_data="admin_broadcast")],
+        [InlineKeyboardButton("🏷️ Тарифы", callback_data="admin_plans")],
+        [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await query.edit_message_text(
+        "🛠️ <b>Панель администратора</b>\n\n"
+        "Выберите действие из списка ниже:",
+        reply_markup=reply_markup,
+        parse_mode="HTML"
+    )
+    
+    # Clear admin state
+    if "admin_state" in context.user_data:
+        del context.user_data["admin_state"]
 
 async def add_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for the /add_user command"""
@@ -387,14 +400,15 @@ async def add_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = args[0]
     plan_id = args[1]
     
-    if plan_id not in VPN_PLANS:
+    catalog = get_catalog()
+    if plan_id not in catalog:
         await update.message.reply_text(
             f"❌ Неверный тарифный план: {plan_id}\n\n"
-            f"Доступные планы: {', '.join(VPN_PLANS.keys())}"
+            f"Доступные планы: {', '.join(catalog.plans.keys())}"
         )
         return
     
-    plan = VPN_PLANS[plan_id]
+    plan = catalog.get(plan_id)
     
     try:
         # Create user in Marzban
@@ -412,7 +426,7 @@ async def add_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "created_at": datetime.now().timestamp(),
             "expires_at": datetime.now().timestamp() + days * 86400,
         }
-        await create_subscription(subscription_data)
+        await db.create_subscription(subscription_data)
         
         # Create access key via Outline API
         try:
@@ -430,10 +444,10 @@ async def add_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "access_url": key_info["accessUrl"],
                 "created_at": datetime.now().timestamp(),
             }
-            await create_access_key(key_data)
+            await db.create_access_key(key_data)
             
             # Update user data
-            await update_user(telegram_id, {"has_active_subscription": True})
+            await db.update_user(telegram_id, {"has_active_subscription": True})
         except Exception as e:
             logger.error(f"Error creating Outline key for user {username}: {e}")
         
@@ -468,91 +482,66 @@ async def delete_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     username = args[0]
     
     try:
-        # Find user by username
-        user = None
-        all_users = await get_all_users()
-        
-        # Отправляем сообщение о поиске пользователя
+        # Отправляем сообщение о поиске пользователя, дальше оно показывает прогресс
         status_msg = await update.message.reply_text(
             f"🔍 Ищем пользователя {username}..."
         )
+        progress = ProgressReporter.for_message(status_msg)
         
-        for u in all_users:
-            # Проверяем тип объекта
-            if hasattr(u, 'username'):
-                if u.username == username:
-                    user = u
-                    break
-            elif u.get("username") == username:
-                user = u
-                break
-        
+        # Точное совпадение username без учета регистра: поиск мог бы поставить
+        # первым пользователя, чей telegram_id совпал с цифровым именем
+        user = await db.get_user_by_username(username)
         if not user:
-            await status_msg.edit_text(f"❌ Пользователь с именем {username} не найден.")
+            progress.finish(f"❌ Пользователь с именем {username} не найден.")
             return
         
-        # Получаем telegram_id пользователя
-        if hasattr(user, 'telegram_id'):
-            user_id = user.telegram_id
-        else:
-            user_id = user.get("telegram_id")
+        user_id = user.telegram_id
         
-        await status_msg.edit_text(
+        progress.update(
             f"✅ Пользователь {username} найден. Получаем информацию о подписках и ключах..."
         )
         
         # Get all active subscriptions and keys
-        subscriptions = await get_user_subscriptions(user_id)
-        access_keys = await get_user_access_keys(user_id)
+        subscriptions = await db.get_user_subscriptions(user_id)
+        access_keys = await db.get_user_access_keys(user_id)
         
         # Delete all keys in Outline
         deleted_keys = 0
         total_keys = len(access_keys) if access_keys else 0
         
         if access_keys:
-            await status_msg.edit_text(
+            progress.update(
                 f"🗑️ Удаляем ключи доступа пользователя {username}..."
             )
             
             for key in access_keys:
                 try:
-                    # Получаем key_id в зависимости от типа объекта
-                    if hasattr(key, 'key_id'):
-                        key_id = key.key_id
-                    else:
-                        key_id = key.get("key_id")
-                        
-                    await outline_service.delete_key(key_id)
+                    key_service, outline_id = service_for_key(key.key_id)
+                    await key_service.delete_key(outline_id)
                     deleted_keys += 1
                 except Exception as e:
                     logger.error(f"Error deleting key for user {username}: {e}")
         
         # Update user data
-        await status_msg.edit_text(
+        progress.update(
             f"💾 Обновляем информацию о пользователе {username}..."
         )
         
         # Обновляем статус подписки пользователя
-        await update_user(user_id, {"is_premium": False})
+        await db.update_user(user_id, {"is_premium": False})
         
         # Set all subscriptions to inactive
         sub_count = 0
         if subscriptions:
             for sub in subscriptions:
                 try:
-                    # Получаем subscription_id в зависимости от типа объекта
-                    if hasattr(sub, 'subscription_id'):
-                        sub_id = sub.subscription_id
-                    else:
-                        sub_id = sub.get("subscription_id")
-                        
-                    await update_subscription(sub_id, {"status": "inactive"})
+                    await db.update_subscription(sub.subscription_id, {"status": "inactive"})
                     sub_count += 1
                 except Exception as e:
                     logger.error(f"Error updating subscription for user {username}: {e}")
         
         # Отправляем сообщение об успешном удалении
-        await status_msg.edit_text(
+        progress.finish(
             f"✅ Пользователь {username} успешно удален.\n\n"
             f"📊 Результаты:\n"
             f"- Удалено ключей: {deleted_keys}/{total_keys}\n"
@@ -569,122 +558,47 @@ async def list_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     
     try:
-        # Get all users from database
-        all_users = await get_all_users()
+        text, reply_markup = await _users_page()
+        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode="HTML")
+    except Exception as e:
+        logger.error(f"Error listing users: {e}")
+        await update.message.reply_text(f"❌ Ошибка при получении списка пользователей: {str(e)}")
+
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handler for the /find command"""
+    if not await is_admin(update):
+        await update.message.reply_text("⛔ У вас нет доступа к этой команде.")
+        return
+    
+    if not context.args:
+        await update.message.reply_text(
+            "❌ Недостаточно аргументов.\n\n"
+            "Использование: /find <username, имя или Telegram ID>\n"
+            "Например: /find ivan"
+        )
+        return
+    
+    query = " ".join(context.args)
+    try:
+        started = time.monotonic()
+        users = await db.search_users(query, limit=ADMIN_SEARCH_LIMIT)
+        metrics.observe("admin.find", time.monotonic() - started)
         
-        if not all_users:
-            await update.message.reply_text("📊 Пользователи не найдены.")
+        if not users:
+            await update.message.reply_text(f"🔍 По запросу «{query}» ничего не найдено.")
             return
         
-        # Отправляем сообщение о начале загрузки
-        status_msg = await update.message.reply_text(
-            f"⏳ Загружаем список пользователей...\n"
-            f"Всего пользователей: {len(all_users)}"
-        )
+        text = f"🔍 <b>Найдено по запросу «{html.escape(query)}»:</b>\n\n"
+        for user in users:
+            name = " ".join(filter(None, [user.get("first_name"), user.get("last_name")]))
+            username = f"@{user['username']}" if user.get("username") else "без username"
+            display_name = f"{name} ({username})" if name else username
+            text += f"👤 <code>{html.escape(display_name)}</code> - ID: <code>{user['telegram_id']}</code>\n"
         
-        # Get all keys from Outline API to get usage data
-        outline_keys = await outline_service.get_keys()
-        
-        users_text = "📊 <b>Список пользователей:</b>\n\n"
-        
-        # Process first 10 users to avoid message too long
-        user_count = min(10, len(all_users))
-        for i, user in enumerate(all_users[:user_count]):
-            try:
-                # Получаем данные пользователя - поддержка как объектов SQLAlchemy, так и словарей
-                if hasattr(user, 'telegram_id'):
-                    telegram_id = user.telegram_id
-                    username = user.username or "Unknown"
-                    first_name = user.first_name or ""
-                    has_active = user.is_premium  # предполагаем, что is_premium означает активную подписку
-                else:
-                    telegram_id = user.get("telegram_id")
-                    username = user.get("username", "Unknown")
-                    first_name = user.get("first_name", "")
-                    has_active = user.get("has_active_subscription", False)
-                
-                status = "✅" if has_active else "❌"
-                display_name = f"{first_name} ({username})" if first_name else username
-                
-                # Обновляем статус загрузки
-                if i % 3 == 0:  # каждые 3 пользователя
-                    await status_msg.edit_text(
-                        f"⏳ Загружаем информацию о пользователях... ({i+1}/{user_count})"
-                    )
-                
-                # Get user subscriptions
-                subscriptions = await get_user_subscriptions(telegram_id, status="active")
-                
-                # Get user keys
-                access_keys = await get_user_access_keys(telegram_id)
-                
-                # Calculate traffic usage
-                total_traffic = 0
-                
-                # Проверяем, что access_keys не None
-                if access_keys and outline_keys and "accessKeys" in outline_keys:
-                    for key in access_keys:
-                        # Получаем key_id в зависимости от типа объекта
-                        if hasattr(key, 'key_id'):
-                            key_id = key.key_id
-                        else:
-                            key_id = key.get("key_id")
-                            
-                        # Check if key exists in outline_keys (metrics data)
-                        for outline_key in outline_keys["accessKeys"]:
-                            if str(outline_key["id"]) == str(key_id):
-                                # Add usage data
-                                total_traffic += outline_key.get("metrics", {}).get("bytesTransferred", 0)
-                
-                # Format user information
-                users_text += f"👤 <code>{display_name}</code> - {status}\n"
-                users_text += f"📈 Трафик: {format_bytes(total_traffic)}\n"
-                
-                # Show subscription expiry if available
-                if subscriptions:
-                    try:
-                        # Определяем, как получить expires_at в зависимости от типа объекта
-                        if all(hasattr(sub, 'expires_at') for sub in subscriptions):
-                            # Get the latest subscription
-                            latest_sub = max(subscriptions, key=lambda x: x.expires_at or datetime.min)
-                            expires_at = latest_sub.expires_at
-                        else:
-                            # Get the latest subscription
-                            latest_sub = max(subscriptions, key=lambda x: x.get("expires_at", 0))
-                            expires_at = latest_sub.get("expires_at", 0)
-                            
-                        if expires_at:
-                            # Проверяем, если format_expiry_date определена, используем её, иначе форматируем вручную
-                            try:
-                                from utils.helpers import format_expiry_date
-                                expiry_text = format_expiry_date(expires_at)
-                            except (ImportError, NameError):
-                                # Если функция недоступна, используем базовое форматирование
-                                if isinstance(expires_at, datetime):
-                                    expiry_text = expires_at.strftime("%d.%m.%Y")
-                                else:
-                                    expiry_text = "Unknown"
-                                
-                            users_text += f"⏳ До: {expiry_text}\n\n"
-                        else:
-                            users_text += "\n"
-                    except Exception as e:
-                        logger.error(f"Error formatting subscription expiry: {e}")
-                        users_text += "\n"
-                else:
-                    users_text += "\n"
-            except Exception as e:
-                logger.error(f"Error processing user for list: {e}")
-                users_text += f"⚠️ Ошибка при обработке пользователя\n\n"
-        
-        if len(all_users) > 10:
-            users_text += f"...и еще {len(all_users) - 10} пользователей"
-        
-        # Обновляем статусное сообщение с окончательным результатом
-        await status_msg.edit_text(users_text, parse_mode="HTML")
+        await update.message.reply_text(text, parse_mode="HTML")
     except Exception as e:
-        logger.error(f"Error listing users: {e}")
-        await update.message.reply_text(f"❌ Ошибка при получении списка пользователей: {str(e)}")
+        logger.error(f"Error searching users: {e}")
+        await update.message.reply_text(f"❌ Ошибка при поиске пользователей: {str(e)}")
 
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for the /broadcast command"""
@@ -705,61 +619,187 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = " ".join(args)
     
     try:
-        # Get all users from database
-        users = await get_all_users()
+        total_users = await db.count_users()
         
-        if not users:
+        if not total_users:
             await update.message.reply_text("❌ Пользователи не найдены.")
             return
         
-        sent_count = 0
-        failed_count = 0
-        total_users = len(users)
-        
-        # Отправляем сообщение о начале рассылки
+        # Сообщение о начале рассылки, в нём же показывается прогресс
         status_msg = await update.message.reply_text(
             f"📤 Начинаем рассылку сообщения {total_users} пользователям...\n"
             f"Отправлено: 0 из {total_users}"
         )
         
-        for user in users:
-            try:
-                # Получаем telegram_id в зависимости от типа объекта
-                if hasattr(user, 'telegram_id'):
-                    telegram_id = user.telegram_id
-                else:
-                    telegram_id = user.get("telegram_id")
-                
-                if telegram_id:
-                    try:
-                        await context.bot.send_message(
-                            chat_id=telegram_id,
-                            text=f"📢 <b>Объявление:</b>\n\n{message}",
-                            parse_mode="HTML"
-                        )
-                        sent_count += 1
-                        
-                        # Обновляем статус каждые 10 отправленных сообщений
-                        if sent_count % 10 == 0:
-                            await status_msg.edit_text(
-                                f"📤 Рассылка сообщения...\n"
-                                f"Отправлено: {sent_count} из {total_users}"
-                            )
-                    except Exception as e:
-                        logger.error(f"Error sending broadcast to {telegram_id}: {e}")
-                        failed_count += 1
-            except Exception as e:
-                logger.error(f"Error processing user for broadcast: {e}")
-                failed_count += 1
-        
-        # Отправляем итоговое сообщение
-        await status_msg.edit_text(
-            f"✅ Рассылка завершена!\n\n"
-            f"📊 Статистика:\n"
-            f"- Всего пользователей: {total_users}\n"
-            f"- Успешно отправлено: {sent_count}\n"
-            f"- Не удалось отправить: {failed_count}"
+        # Рассылка идёт в фоне и переживает перезапуск бота
+        job_id = await create_broadcast(
+            context.bot,
+            f"📢 <b>Объявление:</b>\n\n{message}",
+            created_by=update.effective_user.id,
+            status_message=status_msg
         )
+        if not job_id:
+            await status_msg.edit_text("❌ Не удалось создать задачу рассылки.")
     except Exception as e:
         logger.error(f"Error broadcasting: {e}")
         await update.message.reply_text(f"❌ Ошибка при отправке рассылки: {str(e)}")
+
+BULK_USAGE = (
+    "Использование:\n"
+    "/bulk extend <дней> <кому> - продлить активные подписки\n"
+    "/bulk revoke <кому> - удалить ключи и закрыть подписки\n"
+    "/bulk migrate <сервер|main> <кому> - перенести ключи на другой сервер\n\n"
+    "<кому>: all, active, inactive, plan:<id> или Telegram ID через запятую. "
+    "Можно ответить командой на файл или сообщение со списком ID."
+)
+
+async def _bulk_target_ids(message):
+    """Telegram ID из файла или текста сообщения, на которое ответил администратор"""
+    replied = message.reply_to_message
+    if not replied:
+        return None
+    if replied.document:
+        file = await replied.document.get_file()
+        text = (await file.download_as_bytearray()).decode("utf-8", errors="ignore")
+    else:
+        text = replied.text or ""
+    return [int(value) for value in re.findall(r"\d+", text)]
+
+async def bulk_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handler for the /bulk command: extend, revoke or migrate many users in a background job"""
+    if not await is_admin(update):
+        await update.message.reply_text("⛔ У вас нет доступа к этой команде.")
+        return
+    
+    args = list(context.args or [])
+    action = args.pop(0).lower() if args else None
+    
+    try:
+        params = {}
+        if action == "extend":
+            params["days"] = int(args.pop(0))
+            if params["days"] <= 0:
+                raise ValueError("days")
+        elif action == "migrate":
+            server = args.pop(0)
+            params["server"] = None if server == "main" else server
+            if params["server"] is not None and params["server"] not in OUTLINE_SERVERS:
+                await update.message.reply_text(
+                    f"❌ Неизвестный сервер {server}. Доступны: main"
+                    + "".join(f", {name}" for name in OUTLINE_SERVERS)
+                )
+                return
+        elif action != "revoke":
+            raise ValueError("action")
+    except (IndexError, ValueError):
+        await update.message.reply_text(f"❌ Неверные аргументы.\n\n{BULK_USAGE}")
+        return
+    
+    target = " ".join(args)
+    telegram_ids = await _bulk_target_ids(update.message)
+    user_filter = "all"
+    if telegram_ids is None:
+        if re.fullmatch(r"[\d,\s]+", target):
+            telegram_ids = [int(value) for value in re.findall(r"\d+", target)]
+        elif target in ("all", "active", "inactive") or target.startswith("plan:"):
+            user_filter = target
+        else:
+            await update.message.reply_text(f"❌ Не указано, к кому применить операцию.\n\n{BULK_USAGE}")
+            return
+    
+    try:
+        # Сообщение о запуске, в нём же показывается прогресс
+        status_msg = await update.message.reply_text("⚙️ Выбираем пользователей...")
+        job = await create_admin_job(
+            context.bot,
+            action,
+            params,
+            user_filter=user_filter,
+            telegram_ids=telegram_ids,
+            created_by=update.effective_user.id,
+            status_message=status_msg
+        )
+        if not job:
+            await status_msg.edit_text("❌ Не удалось создать задачу.")
+        elif not job.total:
+            await status_msg.edit_text("❌ Пользователи не найдены.")
+    except Exception as e:
+        logger.error(f"Error starting bulk job: {e}")
+        await update.message.reply_text(f"❌ Ошибка при запуске операции: {str(e)}")
+
+# Поля плана, которые можно менять командой /plan, и преобразование значений
+PLAN_EDIT_FIELDS = {
+    "name": str,
+    "price": float,
+    "duration": int,
+    "devices": int,
+    "discount": lambda value: None if value == "-" else value,
+    "description": str,
+    "active": lambda value: value.lower() in ("on", "yes", "true", "1"),
+}
+
+def _plans_admin_text():
+    """Список тарифов для администратора"""
+    catalog = get_catalog()
+    text = f"🏷️ <b>Тарифы</b> (версия каталога {catalog.version})\n\n"
+    for plan in catalog.plans.values():
+        state = "✅" if plan.active else "⛔"
+        discount = f", скидка {plan.discount}" if plan.discount else ""
+        text += (
+            f"{state} <code>{plan.id}</code> - {plan.name}\n"
+            f"    {plan.price} ₽, {plan.duration} дн., устройств: {plan.devices}{discount}\n"
+        )
+    text += (
+        "\nИзменение: <code>/plan &lt;id&gt; &lt;поле&gt; &lt;значение&gt;</code>\n"
+        f"Поля: {', '.join(PLAN_EDIT_FIELDS)}\n"
+        "Например: <code>/plan monthly price 199</code>, <code>/plan weekly active off</code>"
+    )
+    return text
+
+async def plan_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handler for the /plan command: view and edit the plan catalog"""
+    if not await is_admin(update):
+        await update.message.reply_text("⛔ У вас нет доступа к этой команде.")
+        return
+    
+    args = context.args
+    if not args:
+        await update.message.reply_text(_plans_admin_text(), parse_mode="HTML")
+        return
+    
+    if len(args) < 3:
+        await update.message.reply_text(
+            "❌ Недостаточно аргументов.\n\n"
+            "Использование: /plan <id> <поле> <значение>\n"
+            "Например: /plan monthly price 199"
+        )
+        return
+    
+    plan_id, field, value = args[0], args[1], " ".join(args[2:])
+    if get_catalog().get(plan_id) is None:
+        await update.message.reply_text(f"❌ Тариф {plan_id} не найден.")
+        return
+    if field not in PLAN_EDIT_FIELDS:
+        await update.message.reply_text(f"❌ Неизвестное поле: {field}\n\nПоля: {', '.join(PLAN_EDIT_FIELDS)}")
+        return
+    
+    try:
+        parsed = PLAN_EDIT_FIELDS[field](value)
+    except ValueError:
+        await update.message.reply_text(f"❌ Неверное значение для поля {field}: {value}")
+        return
+    if field in ("price", "duration", "devices") and parsed < 0:
+        await update.message.reply_text(f"❌ Значение поля {field} не может быть отрицательным.")
+        return
+    
+    version = await update_plan(plan_id, {field: parsed})
+    if version is None:
+        await update.message.reply_text("❌ Не удалось сохранить тариф.")
+        return
+    
+    logger.info(f"Admin {update.effective_user.id} set {plan_id}.{field} = {parsed!r}, catalog version {version}")
+    await update.message.reply_text(
+        f"✅ Тариф <code>{plan_id}</code> обновлён, версия каталога {version}.\n"
+        "Остальные процессы бота применят изменение в течение минуты.",
+        parse_mode="HTML"
+    )
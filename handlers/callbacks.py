@@ -0,0 +1,70 @@
+"""
+Таблица маршрутов inline-кнопок.
+
+Все кнопки бота регистрируются здесь один раз; main.py подключает
+callback_router.dispatch единственным CallbackQueryHandler.
+"""
+
+from utils.callback_router import CallbackRouter
+from handlers.user_handlers import (
+    back_to_main_callback,
+    info_callback,
+    help_callback,
+    buy_callback,
+    status_callback,
+    copy_key_callback,
+    test_period_callback,
+    buy_handler,
+    payment_handler
+)
+from handlers.outline_handlers import get_key_callback, plans_callback
+from handlers.admin_handlers import (
+    admin_list_users_callback,
+    admin_users_page_callback,
+    admin_add_user_callback,
+    admin_create_user_callback,
+    admin_delete_user_callback,
+    admin_broadcast_callback,
+    admin_stats_callback,
+    admin_sync_keys_callback,
+    admin_plans_callback,
+    admin_back_callback
+)
+
+
+def build_callback_router():
+    """Create the router with all bot buttons"""
+    router = CallbackRouter()
+
+    # Меню пользователя
+    router.add("back_to_main", back_to_main_callback)
+    router.add("info", info_callback)
+    router.add("help", help_callback)
+    router.add("status", status_callback)
+    router.add("my_keys", status_callback)
+    router.add("plans", plans_callback)
+    router.add("get_key", get_key_callback)
+    router.add("test_period", test_period_callback)
+    router.add_packed("copy_key_", copy_key_callback)
+
+    # Покупка: выбор тарифа, подтверждение, оплата
+    router.add("buy", buy_callback)
+    router.add_prefix("buy_", buy_handler)
+    router.add_prefix("pay_", payment_handler)
+
+    # Панель администратора
+    router.add("admin", admin_back_callback)
+    router.add("admin_back", admin_back_callback)
+    router.add("admin_list_users", admin_list_users_callback)
+    router.add_packed("admin_users_", admin_users_page_callback)
+    router.add("admin_add_user", admin_add_user_callback)
+    router.add_prefix("admin_create_user_", admin_create_user_callback)
+    router.add("admin_delete_user", admin_delete_user_callback)
+    router.add("admin_broadcast", admin_broadcast_callback)
+    router.add("admin_stats", admin_stats_callback)
+    router.add("admin_sync_keys", admin_sync_keys_callback)
+    router.add("admin_plans", admin_plans_callback)
+    return router
+
+
+callback_router = build_callback_router()
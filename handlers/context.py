@@ -0,0 +1,160 @@
+"""
+Данные пользователя в пределах одного обновления.
+
+UserContext загружает пользователя, его активную подписку и активные ключи
+одним запросом при первом обращении и отдаёт их всем обработчикам и
+вспомогательным функциям этого обновления. После изменений (новый пользователь,
+новые ключи) контекст сбрасывается через invalidate().
+
+Пользователи, уже известные процессу, не проверяются в базе при каждой команде:
+их telegram_id хранятся в ограниченном LRU-наборе. Пользователи не удаляются,
+поэтому набор не устаревает.
+"""
+
+import logging
+from collections import OrderedDict
+from datetime import datetime
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+from services.repository import repository as db
+
+logger = logging.getLogger(__name__)
+
+KNOWN_USERS_MAX_SIZE = 100000
+
+
+class KnownUsers:
+    """Bounded LRU set of telegram IDs known to be registered"""
+
+    def __init__(self, max_size=KNOWN_USERS_MAX_SIZE):
+        self.max_size = max_size
+        self._ids = OrderedDict()
+
+    def __contains__(self, telegram_id):
+        if telegram_id in self._ids:
+            self._ids.move_to_end(telegram_id)
+            return True
+        return False
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, telegram_id):
+        self._ids[telegram_id] = None
+        self._ids.move_to_end(telegram_id)
+        if len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+
+
+known_users = KnownUsers()
+
+
+class UserContext:
+    """Lazily loaded and memoized data of the Telegram user behind an update"""
+
+    def __init__(self, telegram_user):
+        self.telegram_user = telegram_user
+        self.telegram_id = telegram_user.id
+        self._loaded = False
+        self._user = None
+        self._subscription = None
+        self._keys = []
+
+    async def _load(self):
+        if not self._loaded:
+            self._user, self._subscription, self._keys = await db.get_user_context(self.telegram_id)
+            self._loaded = True
+
+    def invalidate(self):
+        """Drop loaded data so the next access reads it again"""
+        self._loaded = False
+
+    async def get_user(self):
+        """Get the user record or None"""
+        await self._load()
+        return self._user
+
+    async def get_active_subscription(self):
+        """Get the active subscription or None"""
+        await self._load()
+        return self._subscription
+
+    async def get_active_keys(self):
+        """Get the list of non-deleted access keys"""
+        await self._load()
+        return self._keys
+
+    async def ensure_registered(self):
+        """
+        Register the user if needed without loading their data.
+
+        Returns:
+            bool: True if the user has just been registered
+        """
+        if self.telegram_id in known_users:
+            return False
+        if self._loaded and self._user:
+            known_users.add(self.telegram_id)
+            return False
+
+        telegram_user = self.telegram_user
+        created = await db.upsert_user({
+            "telegram_id": telegram_user.id,
+            "username": telegram_user.username or f"user_{telegram_user.id}",
+            "first_name": telegram_user.first_name,
+            "last_name": telegram_user.last_name,
+            "created_at": datetime.now(),
+            "is_premium": False,
+            "test_used": False
+        })
+        if created is None:
+            return False
+
+        known_users.add(self.telegram_id)
+        if created:
+            logger.info(f"Новый пользователь зарегистрирован: {telegram_user.id}, username: {telegram_user.username}")
+            self.invalidate()
+        return created
+
+    async def ensure_user(self):
+        """
+        Get the user record, registering the user first if needed.
+
+        Returns:
+            tuple: (user, is_new_user)
+        """
+        is_new_user = await self.ensure_registered()
+        return await self.get_user(), is_new_user
+
+
+class BotContext(CallbackContext):
+    """CallbackContext carrying the UserContext of the current update.
+
+    PTB builds one context per update and passes it to every handler, so the
+    user data is loaded at most once per update.
+    """
+
+    __slots__ = ("user_context",)
+
+    def __init__(self, application, chat_id=None, user_id=None):
+        super().__init__(application, chat_id=chat_id, user_id=user_id)
+        self.user_context = None
+
+    @classmethod
+    def from_update(cls, update, application):
+        context = super().from_update(update, application)
+        if isinstance(update, Update) and update.effective_user:
+            context.user_context = UserContext(update.effective_user)
+        return context
+
+
+def get_user_context(context, update):
+    """Get the UserContext of an update, creating one if the context has none"""
+    user_context = getattr(context, "user_context", None)
+    if user_context is None:
+        user_context = UserContext(update.effective_user)
+        if isinstance(context, BotContext):
+            context.user_context = user_context
+    return user_context
@@ -1,45 +1,28 @@
 import os
-import uuid
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 
-from config import VPN_PLANS, ADMIN_IDS
-from services.database_service_sql import (
-    get_user, create_user, update_user, get_all_users,
-    get_subscription, create_subscription, update_subscription, get_user_subscriptions,
-    get_active_subscription, get_expiring_subscriptions,
-    get_user_access_keys, create_access_key, get_access_key, update_access_key,
-    get_payment, create_payment, update_payment
-)
-from services.outline_service import OutlineService
+from config import ADMIN_IDS
+from services.repository import repository as db
+from services.outline_service import OutlineService, service_for_key
+from handlers.context import UserContext, get_user_context
+from services.plan_catalog import get_catalog
 from utils.helpers import format_bytes, format_expiry_date, calculate_expiry
 
 # Initialize Outline service
 outline_service = OutlineService()
 
-async def ensure_user_exists(user):
+async def ensure_user_exists(user, user_context=None):
     """Ensure user exists in database, create if not"""
     if not user:
         return
     
-    # Check if user exists
-    db_user = await get_user(user.id)
-    
-    if not db_user:
-        # Create new user
-        user_data = {
-            "telegram_id": user.id,
-            "username": user.username,
-            "first_name": user.first_name,
-            "last_name": user.last_name,
-            "created_at": datetime.now()
-        }
-        await create_user(user_data)
+    await (user_context or UserContext(user)).ensure_registered()
 
-async def create_vpn_access(user_id, subscription_id, plan_id, days, name=None):
+async def create_vpn_access(user_id, subscription_id, plan_id, days, name=None, user_context=None):
     """Create VPN access key and save to database"""
     # Проверка типов данных и преобразование subscription_id при необходимости
     if isinstance(subscription_id, str) and subscription_id.isdigit():
@@ -47,22 +30,17 @@ async def create_vpn_access(user_id, subscription_id, plan_id, days, name=None):
         subscription_id = int(subscription_id)
     
     # Сначала проверяем, есть ли у пользователя уже активные ключи
-    active_keys = await get_user_active_keys(user_id)
+    active_keys = await get_user_active_keys(user_id, user_context)
     logging.info(f"Checking existing keys for user {user_id}. Found {len(active_keys)} active keys.")
     
     # Если есть активные ключи, используем первый из них вместо создания нового
     if active_keys:
-        existing_key = active_keys[0]
-        
-        # Получаем key_id в зависимости от типа объекта
-        if isinstance(existing_key, dict):
-            key_id = existing_key.get("key_id")
-        else:
-            key_id = getattr(existing_key, "key_id", None)
-            
+        key_id = active_keys[0].key_id
         if key_id:
             logging.info(f"Re-using existing key {key_id} for user {user_id} instead of creating new one")
             # Продлеваем существующий ключ
+            if user_context:
+                user_context.invalidate()
             return await extend_vpn_access(key_id, user_id, subscription_id, plan_id, days, name)
     
     # Если нет активных ключей, создаем новый
@@ -85,7 +63,9 @@ async def create_vpn_access(user_id, subscription_id, plan_id, days, name=None):
         "created_at": datetime.now()
     }
     
-    new_key = await create_access_key(key_data)
+    new_key = await db.create_access_key(key_data)
+    if user_context:
+        user_context.invalidate()
     if not new_key:
         logging.error(f"Failed to save access key in database for user {user_id}")
     else:
@@ -96,13 +76,14 @@ async def create_vpn_access(user_id, subscription_id, plan_id, days, name=None):
 async def extend_vpn_access(key_id, user_id, subscription_id, plan_id, days, name=None):
     """Extend existing VPN key instead of creating a new one"""
     # Get access key from database
-    key = await get_access_key(key_id)
+    key = await db.get_access_key(key_id)
     if not key:
         logging.error(f"Key {key_id} not found for extension")
         return None
     
     # Extend key with Outline API
-    outline_key = await outline_service.extend_key_expiration(key_id, days, name)
+    key_service, outline_id = service_for_key(key_id)
+    outline_key = await key_service.extend_key_expiration(outline_id, days, name)
     
     if not outline_key or "error" in outline_key:
         logging.error(f"Failed to extend key {key_id}: {outline_key.get('error', 'Unknown error')}")
@@ -126,7 +107,7 @@ async def extend_vpn_access(key_id, user_id, subscription_id, plan_id, days, nam
     }
     
     # Update the key and return the updated record
-    success = await update_access_key(key_id, update_data)
+    success = await db.update_access_key(key_id, update_data)
     
     if not success:
         logging.error(f"Failed to update key {key_id} with new subscription")
@@ -135,39 +116,29 @@ async def extend_vpn_access(key_id, user_id, subscription_id, plan_id, days, nam
         logging.info(f"Successfully extended VPN access key: {key_id}")
     
     # Get the updated key
-    updated_key = await get_access_key(key_id)
+    updated_key = await db.get_access_key(key_id)
     return updated_key
 
-async def get_user_active_keys(user_id):
+async def get_user_active_keys(user_id, user_context=None):
     """Get all active (non-deleted) keys for a user"""
+    if user_context:
+        return await user_context.get_active_keys()
+    
     try:
         # Get all keys for the user
-        all_keys = await get_user_access_keys(user_id)
-        
-        # Filter out deleted keys (для SQLAlchemy используем прямой доступ к атрибуту)
-        active_keys = [k for k in all_keys if not (getattr(k, 'deleted', False))]
+        all_keys = await db.get_user_access_keys(user_id)
         
-        return active_keys
+        # Filter out deleted keys
+        return [key for key in all_keys if not key.deleted]
     except Exception as e:
         logging.error(f"Error getting user active keys: {e}")
         return []
 
-async def check_subscription_expiry():
-    """Check for expiring subscriptions and notify users"""
-    # Get subscriptions expiring in 1 day
-    expiring_subscriptions = await get_expiring_subscriptions(1)
-    
-    if not expiring_subscriptions:
-        return
-    
-    # Process each expiring subscription
-    logging.info(f"Found {len(expiring_subscriptions)} expiring subscriptions")
-    # Implementation depends on notification mechanism
-
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for the /start command"""
     user = update.effective_user
-    await ensure_user_exists(user)
+    user_context = get_user_context(context, update)
+    await ensure_user_exists(user, user_context)
     
     # Welcome message
     welcome_message = (
@@ -182,7 +153,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     # Get active subscription
-    subscription = await get_active_subscription(user.id)
+    subscription = await user_context.get_active_subscription()
     
     # Prepare keyboard based on subscription status
     keyboard = []
@@ -196,15 +167,8 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ]
     else:
         # User hasn't used test period yet
-        db_user = await get_user(user.id)
-        test_used = False
-        if db_user:
-            if isinstance(db_user, dict):
-                test_used = db_user.get("test_used", False)
-            else:
-                test_used = getattr(db_user, "test_used", False)
-            
-        if not test_used:
+        db_user = await user_context.get_user()
+        if not (db_user and db_user.test_used):
             keyboard = [
                 [InlineKeyboardButton("🔍 Попробовать бесплатно", callback_data="test_period")],
                 [InlineKeyboardButton("💳 Тарифные планы", callback_data="plans")],
@@ -231,10 +195,11 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for the /status command"""
     user = update.effective_user
-    await ensure_user_exists(user)
+    user_context = get_user_context(context, update)
+    await ensure_user_exists(user, user_context)
     
     # Get active subscription
-    subscription = await get_active_subscription(user.id)
+    subscription = await user_context.get_active_subscription()
     
     if not subscription:
         # No active subscription
@@ -257,18 +222,16 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Get plan details
-    plan_id = subscription.get("plan_id")
-    plan = VPN_PLANS.get(plan_id, {})
+    plan = get_catalog().get(subscription.plan_id) or {}
     
     # Get access keys for this subscription
-    subscription_id = subscription.get("_id")
-    access_keys = await get_user_access_keys(user.id)
+    access_keys = await db.get_user_access_keys(user.id)
     
     # Filter keys for current subscription
-    valid_keys = [key for key in access_keys if str(key.get("subscription_id")) == str(subscription_id)]
+    valid_keys = [key for key in access_keys if str(key.subscription_id) == str(subscription.id)]
     
     # Format expiry date
-    expires_at = subscription.get("expires_at")
+    expires_at = subscription.expires_at
     expiry_str = format_expiry_date(expires_at) if expires_at else "Неизвестно"
     
     message = (
@@ -297,126 +260,31 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def plans_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for the /plans command"""
     user = update.effective_user
-    await ensure_user_exists(user)
+    user_context = get_user_context(context, update)
+    await ensure_user_exists(user, user_context)
     
-    message = "*Доступные тарифные планы:*\n\n"
-    
-    # Get test plan
-    test_plan = VPN_PLANS.get("test", {})
-    
-    # Display test plan first (if available)
-    if test_plan:
-        message += (
-            f"*{test_plan.get('name', 'Тестовый период')}*\n"
-            f"Стоимость: *Бесплатно*\n"
-            f"Срок действия: {test_plan.get('duration', 3)} дня\n"
-            f"Устройств: до {test_plan.get('devices', 1)}\n"
-            f"Пробный доступ ко всем функциям VPN. По истечении тестового периода требуется оплата.\n\n"
-        )
-    
-    # Add regular plans
-    regular_plans = {k: v for k, v in VPN_PLANS.items() if k != "test"}
-    
-    for plan_id, plan in regular_plans.items():
-        discount = f" (скидка {plan.get('discount')})" if plan.get('discount') else ""
-        message += (
-            f"*{plan['name']}*{discount}\n"
-            f"Стоимость: *{plan['price']} руб.*\n"
-            f"Срок действия: {plan['duration']} дней\n"
-            f"Устройств: до {plan.get('devices', 1)}\n"
-            f"{plan.get('description', '')}\n\n"
-        )
-    
-    # Create keyboard with plan options
-    keyboard = []
-    
-    # Check if user already used test period
-    db_user = await get_user(user.id)
-    test_used = False
-    if db_user:
-        if isinstance(db_user, dict):
-            test_used = db_user.get("test_used", False)
-        else:
-            test_used = getattr(db_user, "test_used", False)
-            
-    # Add test plan button if not used yet
-    if test_plan and not test_used:
-        keyboard.append([InlineKeyboardButton(
-            "🔍 Попробовать бесплатно", 
-            callback_data="test_period"
-        )])
-        
-    # Add regular plans
-    for plan_id, plan in regular_plans.items():
-        keyboard.append([InlineKeyboardButton(
-            f"{plan['name']} - {plan['price']} руб.", 
-            callback_data=f"buy_{plan_id}"
-        )])
-    
-    keyboard.append([InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_main")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(
-        message,
-        reply_markup=reply_markup,
-        parse_mode="Markdown"
-    )
+    # Готовое представление: с кнопкой тестового периода или без неё
+    catalog = get_catalog()
+    view = catalog.plans_views[catalog.test_available(await user_context.get_user())]
+    await update.message.reply_text(**view.as_kwargs())
 
 async def keys_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for the /keys command - redirects to plans"""
     user = update.effective_user
-    await ensure_user_exists(user)
+    user_context = get_user_context(context, update)
+    await ensure_user_exists(user, user_context)
     
     # Always redirect to plans
-    message = (
-        "Для получения ключа VPN выберите тарифный план:\n\n"
-        "После выбора тарифа и оплаты вы получите доступ к VPN."
-    )
-    
-    # Get test plan
-    test_plan = VPN_PLANS.get("test", {})
-    
-    # Check if user already used test period
-    db_user = await get_user(user.id)
-    test_used = False
-    if db_user:
-        if isinstance(db_user, dict):
-            test_used = db_user.get("test_used", False)
-        else:
-            test_used = getattr(db_user, "test_used", False)
-    
-    # Create keyboard with plan options
-    keyboard = []
-    
-    # Add test plan button if not used yet
-    if test_plan and not test_used:
-        keyboard.append([InlineKeyboardButton(
-            "🔍 Попробовать бесплатно", 
-            callback_data="test_period"
-        )])
-        
-    # Add regular plans
-    regular_plans = {k: v for k, v in VPN_PLANS.items() if k != "test"}
-    for plan_id, plan in regular_plans.items():
-        keyboard.append([InlineKeyboardButton(
-            f"{plan['name']} - {plan['price']} руб.", 
-            callback_data=f"buy_{plan_id}"
-        )])
-    
-    keyboard.append([InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_main")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(
-        message,
-        reply_markup=reply_markup
-    )
+    catalog = get_catalog()
+    view = catalog.keys_views[catalog.test_available(await user_context.get_user())]
+    await update.message.reply_text(**view.as_kwargs())
     return
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for the /help command"""
     user = update.effective_user
-    await ensure_user_exists(user)
+    user_context = get_user_context(context, update)
+    await ensure_user_exists(user, user_context)
     
     message = (
         "*Инструкция по настройке VPN:*\n\n"
@@ -449,603 +317,94 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handler for button callbacks"""
+    """Handler for button callbacks, dispatched through the callback router"""
+    from handlers.callbacks import callback_router
+    await callback_router.dispatch(update, context)
+
+async def get_key_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Get key button: creates an access key for the active subscription"""
     query = update.callback_query
     await query.answer()
     
     user = update.effective_user
-    data = query.data
+    user_context = get_user_context(context, update)
     
-    # Обработка кнопки "Скопировать ключ"
-    if data.startswith("copy_key_"):
-        callback_id = data
-        access_url = None
-        
-        # Получаем ключ из контекста, если он там сохранен
-        if hasattr(context, 'user_data') and callback_id in context.user_data:
-            access_url = context.user_data[callback_id]
+    try:
+        # Получаем активную подписку пользователя
+        subscription = await user_context.get_active_subscription()
         
-        # Если ключ найден, отправляем его отдельным сообщением для копирования
-        if access_url:
-            # Подтверждаем действие кнопки
-            await query.answer("Ключ готов для копирования")
-            
-            # Отправляем ключ в отдельном сообщении для удобного копирования
-            await context.bot.send_message(
-                chat_id=user.id,
-                text=f"`{access_url}`",
-                parse_mode="Markdown"
-            )
-            return
-        else:
-            await query.answer("Ключ не найден. Пожалуйста, получите новый ключ.")
-            return
-    
-    # Обработка кнопки "Получить ключ"
-    if data == "get_key":
-        try:
-            # Получаем активную подписку пользователя
-            subscription = await get_active_subscription(user.id)
-            
-            # Если нет активной подписки, сообщаем об ошибке
-            if not subscription:
-                await query.edit_message_text(
-                    "❌ У вас нет активной подписки.\n\n"
-                    "Для использования VPN сервиса необходимо приобрести подписку "
-                    "или активировать пробный период.",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("💰 Купить доступ", callback_data="buy"),
-                        InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_main")
-                    ]])
-                )
-                return
-            
-            # Получаем информацию о подписке
-            if isinstance(subscription, dict):
-                # MongoDB возвращает словарь
-                subscription_id = subscription.get("_id")
-                plan_id = subscription.get("plan_id")
-            else:
-                # SQLAlchemy возвращает объект
-                subscription_id = subscription.id
-                plan_id = subscription.plan_id
-            
-            # Получаем план
-            plan = VPN_PLANS.get(plan_id, {"name": "Базовый", "devices": 1, "duration": 30})
-            
-            # Создаем ключ доступа
-            key = await create_vpn_access(
-                user_id=user.id,
-                subscription_id=subscription_id,
-                plan_id=plan_id,
-                days=plan.get("duration", 30),
-                name=f"{plan.get('name', 'VPN')} key"
-            )
-            
-            if key:
-                # Создаем клавиатуру с кнопками для доступа к ключу
-                keyboard = [
-                    [InlineKeyboardButton(f"🔑 Скачать ключ", url=key.access_url)],
-                    [InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_main")]
-                ]
-                
-                await query.edit_message_text(
-                    f"✅ <b>Ключ доступа успешно создан!</b>\n\n"
-                    f"📱 <b>Как использовать:</b>\n"
-                    f"1. Установите приложение <a href='https://getoutline.org/get-started/'>Outline VPN</a>\n"
-                    f"2. Нажмите на кнопку ниже для загрузки ключа\n"
-                    f"3. Установите соединение в приложении\n\n"
-                    f"Ваш ключ также доступен в разделе <b>Личный кабинет</b>.",
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                    parse_mode="HTML",
-                    disable_web_page_preview=True
-                )
-            else:
-                await query.edit_message_text(
-                    "❌ Произошла ошибка при создании ключа доступа.\n"
-                    "Пожалуйста, обратитесь к администратору.",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_main")
-                    ]])
-                )
-        except Exception as e:
-            logging.error(f"Error creating VPN key: {e}")
+        # Если нет активной подписки, сообщаем об ошибке
+        if not subscription:
             await query.edit_message_text(
-                "❌ Произошла ошибка при создании ключа доступа.\n"
-                "Пожалуйста, обратитесь к администратору.",
+                "❌ У вас нет активной подписки.\n\n"
+                "Для использования VPN сервиса необходимо приобрести подписку "
+                "или активировать пробный период.",
                 reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("💰 Купить доступ", callback_data="buy"),
                     InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_main")
                 ]])
             )
-        return
-        
-    # Admin panel button
-    if data == "admin":
-        # Check if user is admin
-        if user.id not in ADMIN_IDS:
-            await query.edit_message_text("⛔ У вас нет доступа к этой команде.")
-            return
-        
-        keyboard = [
-            [InlineKeyboardButton("👥 Список пользователей", callback_data="admin_list_users")],
-            [InlineKeyboardButton("➕ Добавить пользователя", callback_data="admin_add_user")],
-            [InlineKeyboardButton("🗑️ Удалить пользователя", callback_data="admin_delete_user")],
-            [InlineKeyboardButton("📢 Рассылка", callback_data="admin_broadcast")],
-            [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
-            [InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            "🛠️ <b>Панель администратора</b>\n\n"
-            "Выберите действие из списка ниже:",
-            reply_markup=reply_markup,
-            parse_mode="HTML"
-        )
-        return
-    
-    # Main menu navigation
-    elif data == "back_to_main":
-        # Simulate /start command but edit message instead of sending new one
-        welcome_message = (
-            f"Привет, {user.first_name}! 👋\n\n"
-            f"Я бот для управления VPN-подключением. С моей помощью вы можете получить "
-            f"доступ к стабильному и быстрому VPN сервису.\n\n"
-            f"*Что я умею:*\n"
-            f"• Предоставлять защищенный доступ к сети интернет\n"
-            f"• Поддерживать несколько устройств на одном аккаунте\n"
-            f"• Предоставлять информацию о состоянии вашей подписки\n\n"
-            f"Выберите действие из меню ниже:"
-        )
-        
-        # Check if user has active subscription
-        subscription = await get_active_subscription(user.id)
-        
-        # Prepare keyboard based on subscription status
-        keyboard = []
-        
-        if subscription:
-            # User has active subscription
-            keyboard = [
-                [InlineKeyboardButton("🔑 Получить ключ", callback_data="plans")],
-                [InlineKeyboardButton("📊 Статус подписки", callback_data="status")],
-                [InlineKeyboardButton("📱 Как настроить", callback_data="help")]
-            ]
-        else:
-            # User hasn't used test period yet
-            db_user = await get_user(user.id)
-            test_used = False
-            if db_user:
-                if isinstance(db_user, dict):
-                    # MongoDB возвращает словарь
-                    test_used = db_user.get("test_used", False)
-                else:
-                    # SQLAlchemy возвращает объект модели
-                    test_used = getattr(db_user, "test_used", False)
-            
-            if not test_used:
-                keyboard = [
-                    [InlineKeyboardButton("🔍 Попробовать бесплатно", callback_data="test_period")],
-                    [InlineKeyboardButton("💳 Тарифные планы", callback_data="plans")],
-                    [InlineKeyboardButton("📱 Как настроить", callback_data="help")]
-                ]
-            else:
-                keyboard = [
-                    [InlineKeyboardButton("💳 Тарифные планы", callback_data="plans")],
-                    [InlineKeyboardButton("📱 Как настроить", callback_data="help")]
-                ]
-        
-        # Add admin button if user is admin
-        logging.info(f"Checking admin status for user_id: {user.id}, ADMIN_IDS: {ADMIN_IDS}")
-        user_id = int(user.id) if isinstance(user.id, str) else user.id
-        
-        if user_id in ADMIN_IDS:
-            logging.info(f"User {user_id} IS an admin! Adding admin button.")
-            keyboard.append([InlineKeyboardButton("🔐 Админ-панель", callback_data="admin")])
-        else:
-            logging.info(f"User {user_id} is NOT an admin. Admin IDs: {ADMIN_IDS}")
-            
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            welcome_message,
-            reply_markup=reply_markup,
-            parse_mode="Markdown"
-        )
-        return
-        
-    # Status callback
-    elif data == "status":
-        # Get active subscription
-        subscription = await get_active_subscription(user.id)
-        
-        if not subscription:
-            # No active subscription
-            message = (
-                "У вас нет активной подписки.\n\n"
-                "Для начала использования VPN выберите тарифный план:"
-            )
-            
-            keyboard = [
-                [InlineKeyboardButton("💳 Тарифные планы", callback_data="plans")],
-                [InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_main")]
-            ]
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                message,
-                reply_markup=reply_markup
-            )
             return
         
-        # Get plan details
-        plan_id = ""
-        subscription_id = ""
-        
-        # Обработка разных типов данных в зависимости от используемой БД
-        if isinstance(subscription, dict):
-            # MongoDB
-            plan_id = subscription.get("plan_id", "")
-            subscription_id = subscription.get("_id", "")
-        else:
-            # SQLAlchemy
-            plan_id = getattr(subscription, "plan_id", "")
-            subscription_id = getattr(subscription, "id", "")
-            
-        plan = VPN_PLANS.get(plan_id, {})
-        
-        # Get access keys for this user
-        access_keys = await get_user_access_keys(user.id)
-        
-        # Filter keys for current subscription
-        valid_keys = []
-        for key in access_keys:
-            key_subscription_id = ""
-            if isinstance(key, dict):
-                key_subscription_id = str(key.get("subscription_id", ""))
-            else:
-                key_subscription_id = str(getattr(key, "subscription_id", ""))
-                
-            if key_subscription_id == str(subscription_id):
-                valid_keys.append(key)
-        
-        # Format expiry date
-        expires_at = None
-        if isinstance(subscription, dict):
-            expires_at = subscription.get("expires_at")
-        else:
-            expires_at = getattr(subscription, "expires_at", None)
-            
-        expiry_str = format_expiry_date(expires_at) if expires_at else "Неизвестно"
-        
-        message = (
-            f"*Информация о подписке:*\n\n"
-            f"*План:* {plan.get('name', 'Неизвестно')}\n"
-            f"*Статус:* Активна\n"
-            f"*Действует до:* {expiry_str}\n"
-            f"*Доступно устройств:* {plan.get('devices', 1)}\n"
-            f"*Используется устройств:* {len(valid_keys)}\n\n"
+        # Получаем информацию о подписке
+        subscription_id = subscription.id
+        plan_id = subscription.plan_id
+        
+        # Получаем план
+        plan = get_catalog().get(plan_id) or {"name": "Базовый", "devices": 1, "duration": 30}
+        
+        # Создаем ключ доступа
+        key = await create_vpn_access(
+            user_id=user.id,
+            subscription_id=subscription_id,
+            plan_id=plan_id,
+            days=plan.get("duration", 30),
+            name=f"{plan.get('name', 'VPN')} key",
+            user_context=user_context
         )
         
-        keyboard = [
-            [InlineKeyboardButton("🔑 Получить ключ", callback_data="plans")],
-            [InlineKeyboardButton("🔄 Продлить подписку", callback_data="plans")],
-            [InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_main")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            message,
-            reply_markup=reply_markup,
-            parse_mode="Markdown"
-        )
-        return
-
-    # Test period
-    elif data == "test_period":
-        # Make sure user exists in database
-        db_user = await get_user(user.id)
-        
-        # Create user if not exists
-        if not db_user:
-            user_data = {
-                "telegram_id": user.id,
-                "username": user.username,
-                "first_name": user.first_name,
-                "last_name": user.last_name,
-                "created_at": datetime.now(),
-                "test_used": False
-            }
-            db_user = await create_user(user_data)
-        
-        # Обработка результатов из разных баз данных
-        test_used = False
-        if db_user:
-            if isinstance(db_user, dict):
-                # MongoDB возвращает словарь
-                test_used = db_user.get("test_used", False)
-            else:
-                # SQLAlchemy возвращает объект модели
-                test_used = getattr(db_user, "test_used", False)
-        
-        if test_used:
-            message = (
-                "Вы уже использовали бесплатный тестовый период.\n\n"
-                "Выберите тарифный план для продолжения использования VPN:"
-            )
-            
+        if key:
+            # Создаем клавиатуру с кнопками для доступа к ключу
             keyboard = [
-                [InlineKeyboardButton("💳 Тарифные планы", callback_data="plans")],
+                [InlineKeyboardButton(f"🔑 Скачать ключ", url=key.access_url)],
                 [InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_main")]
             ]
             
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
             await query.edit_message_text(
-                message,
-                reply_markup=reply_markup
+                f"✅ <b>Ключ доступа успешно создан!</b>\n\n"
+                f"📱 <b>Как использовать:</b>\n"
+                f"1. Установите приложение <a href='https://getoutline.org/get-started/'>Outline VPN</a>\n"
+                f"2. Нажмите на кнопку ниже для загрузки ключа\n"
+                f"3. Установите соединение в приложении\n\n"
+                f"Ваш ключ также доступен в разделе <b>Личный кабинет</b>.",
+                reply_markup=InlineKeyboardMarkup(keyboard),
+                parse_mode="HTML",
+                disable_web_page_preview=True
             )
-            return
-        
-        # Get test plan
-        test_plan = VPN_PLANS.get("test")
-        if not test_plan:
-            await query.edit_message_text(
-                "Тестовый период временно недоступен. Пожалуйста, выберите один из наших тарифных планов.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("💳 Тарифные планы", callback_data="plans")
-                ]])
-            )
-            return
-            
-        # Получаем реальный ID пользователя из базы данных
-        user_db_id = None
-        if isinstance(db_user, dict):
-            # MongoDB
-            user_db_id = db_user.get("_id", user.id)
         else:
-            # SQLAlchemy
-            user_db_id = getattr(db_user, "id", None)
-            
-        if not user_db_id:
-            logging.error(f"Failed to get internal user_id for test period. User Telegram ID: {user.id}")
             await query.edit_message_text(
-                "Произошла ошибка при активации тестового периода. Пожалуйста, попробуйте позже.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_main")
-                ]])
-            )
-            return
-        
-        # Используем payment_service для создания "платежа" для тестового периода
-        # Это гарантирует, что у нас будет запись платежа для тестового периода
-        from services.payment_service import create_payment
-        
-        try:
-            # Создать запись о "платеже" для тестового периода
-            logging.info(f"Creating test period payment record for user {user.id}")
-            payment_result = await create_payment(user.id, "test")
-            
-            if not payment_result:
-                logging.error(f"Failed to create payment record for test period. User ID: {user.id}")
-                await query.edit_message_text(
-                    "Произошла ошибка при активации тестового периода. Пожалуйста, попробуйте позже.",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_main")
-                    ]])
-                )
-                return
-                
-            subscription_id = payment_result.get('subscription_id')
-            logging.info(f"Test payment created, subscription_id={subscription_id}")
-            
-            # Получаем объект подписки
-            subscription = await get_subscription(subscription_id)
-            if not subscription:
-                logging.error(f"Failed to get subscription with ID {subscription_id}")
-                await query.edit_message_text(
-                    "Произошла ошибка при активации тестового периода. Пожалуйста, попробуйте позже.",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_main")
-                    ]])
-                )
-                return
-            
-            # Получаем внутренний ID подписки
-            subscription_internal_id = None
-            if isinstance(subscription, dict):
-                # MongoDB возвращает словарь
-                subscription_internal_id = subscription.get("_id")
-            else:
-                # SQLAlchemy возвращает объект
-                subscription_internal_id = getattr(subscription, "id", None)
-            
-            if not subscription_internal_id:
-                logging.error(f"Failed to get internal subscription_id for test period. User ID: {user.id}")
-                await query.edit_message_text(
-                    "Произошла ошибка при активации тестового периода. Пожалуйста, попробуйте позже.",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_main")
-                    ]])
-                )
-                return
-            
-            # Create VPN access key
-            # Убедимся, что duration - это число
-            duration_days = test_plan["duration"]
-            if not isinstance(duration_days, int):
-                duration_days = 3  # Значение по умолчанию, если не удалось получить число
-                
-            logging.info(f"Creating VPN access key for test period. user_id={user_db_id}, subscription_id={subscription_internal_id}")
-            key = await create_vpn_access(
-                user_db_id,  # Используем ID из базы данных, а не из Telegram 
-                subscription_internal_id,  # Важно! Используем ВНУТРЕННИЙ ID подписки
-                "test", 
-                duration_days, 
-                f"Test - {user.first_name}"
-            )
-            
-            if not key:
-                await query.edit_message_text(
-                    "Произошла ошибка при создании ключа доступа. Пожалуйста, попробуйте позже.",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_main")
-                    ]])
-                )
-                return
-            
-            # Mark test period as used
-            logging.info(f"Marking test period as used for user {user.id}")
-            result = await update_user(user.id, {"test_used": True})
-            if result:
-                logging.info(f"Successfully marked test period as used for user {user.id}")
-            else:
-                logging.error(f"Failed to mark test period as used for user {user.id}")
-            
-            # Обновляем пользователя в локальной переменной только если он существует
-            if db_user:
-                if isinstance(db_user, dict):
-                    db_user["test_used"] = True
-                else:
-                    db_user.test_used = True
-                    
-        except Exception as e:
-            logging.error(f"Error processing test period: {e}")
-            await query.edit_message_text(
-                "Произошла ошибка при активации тестового периода. Пожалуйста, попробуйте позже.",
+                "❌ Произошла ошибка при создании ключа доступа.\n"
+                "Пожалуйста, обратитесь к администратору.",
                 reply_markup=InlineKeyboardMarkup([[
                     InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_main")
                 ]])
             )
-            return
-        
-        # Получаем дату истечения срока действия
-        expiry_date = datetime.now() + timedelta(days=test_plan["duration"])
-        if isinstance(new_subscription, dict):
-            expiry_date = new_subscription.get("expires_at", expiry_date)
-        else:
-            # SQLAlchemy объект
-            expiry_date = getattr(new_subscription, "expires_at", expiry_date)
-            
-        # Форматируем дату для отображения
-        expiry_str = format_expiry_date(expiry_date)
-        
-        # Форматируем URL ключа
-        access_url = ""
-        if isinstance(key, dict):
-            access_url = key.get("access_url", "")
-        else:
-            access_url = getattr(key, "access_url", "")
-        
-        # Генерируем уникальный ID для callback копирования ключа
-        copy_key_callback = f"copy_key_{uuid.uuid4().hex[:8]}"
-        
-        # Сохраняем URL-ключ в контексте, чтобы потом его можно было быстро отправить
-        if not hasattr(context, 'user_data'):
-            context.user_data = {}
-        
-        context.user_data[copy_key_callback] = access_url
-        
-        # Send success message with access key
-        message = (
-            f"*Тестовый период активирован!*\n\n"
-            f"Вы получили бесплатный доступ к VPN на {test_plan['duration']} дня.\n\n"
-            f"*Ваш ключ доступа:*\n"
-            f"`{access_url}`\n\n"
-            f"Используйте этот ключ для подключения к VPN через приложение Outline.\n\n"
-            f"*Важно:* По истечении тестового периода ключ будет деактивирован. "
-            f"Для продолжения использования необходимо приобрести один из платных тарифов.\n\n"
-            f"*Срок действия:* до {expiry_str}"
-        )
-        
-        keyboard = [
-            [InlineKeyboardButton("💾 Скопировать ключ", callback_data=copy_key_callback)],
-            [InlineKeyboardButton("💳 Тарифные планы", callback_data="plans")],
-            [InlineKeyboardButton("📱 Как подключиться", callback_data="help")],
-            [InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_main")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
+    except Exception as e:
+        logging.error(f"Error creating VPN key: {e}")
         await query.edit_message_text(
-            message,
-            reply_markup=reply_markup,
-            parse_mode="Markdown"
+            "❌ Произошла ошибка при создании ключа доступа.\n"
+            "Пожалуйста, обратитесь к администратору.",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_main")
+            ]])
         )
-        return
+
+async def plans_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Plans button"""
+    query = update.callback_query
+    await query.answer()
     
-    # Plans callback
-    elif data == "plans":
-        message = "*Доступные тарифные планы:*\n\n"
-        
-        # Get test plan
-        test_plan = VPN_PLANS.get("test", {})
-        
-        # Display test plan first (if available)
-        if test_plan:
-            message += (
-                f"*{test_plan.get('name', 'Тестовый период')}*\n"
-                f"Стоимость: *Бесплатно*\n"
-                f"Срок действия: {test_plan.get('duration', 3)} дня\n"
-                f"Устройств: до {test_plan.get('devices', 1)}\n"
-                f"Пробный доступ ко всем функциям VPN. По истечении тестового периода требуется оплата.\n\n"
-            )
-        
-        # Add regular plans in order of duration (shortest to longest)
-        regular_plans = {k: v for k, v in VPN_PLANS.items() if k != "test"}
-        
-        # Sort by duration
-        sorted_plans = sorted(regular_plans.items(), key=lambda x: x[1]['duration'])
-        
-        for plan_id, plan in sorted_plans:
-            discount = f" (скидка {plan.get('discount')})" if plan.get('discount') else ""
-            message += (
-                f"*{plan['name']}*{discount}\n"
-                f"Стоимость: *{plan['price']} руб.*\n"
-                f"Срок действия: {plan['duration']} дней\n"
-                f"Устройств: до {plan.get('devices', 1)}\n"
-                f"{plan.get('description', '')}\n\n"
-            )
-        
-        # Create keyboard with plan options
-        keyboard = []
-        
-        # Check if user already used test period
-        db_user = await get_user(user.id)
-        test_used = False
-        if db_user:
-            if isinstance(db_user, dict):
-                test_used = db_user.get("test_used", False)
-            else:
-                test_used = getattr(db_user, "test_used", False)
-                
-        # Add test plan button if not used yet
-        if test_plan and not test_used:
-            keyboard.append([InlineKeyboardButton(
-                "🔍 Попробовать бесплатно", 
-                callback_data="test_period"
-            )])
-            
-        # Сортируем тарифы по длительности
-        sorted_plans = sorted(regular_plans.items(), key=lambda x: x[1]['duration'])
-        
-        # Add regular plans
-        for plan_id, plan in sorted_plans:
-            # Добавляем информацию о скидке, если она есть
-            discount_text = f" (-{plan.get('discount')})" if plan.get('discount') else ""
-            keyboard.append([InlineKeyboardButton(
-                f"{plan['name']} - {plan['price']} руб.{discount_text}", 
-                callback_data=f"buy_{plan_id}"
-            )])
-        
-        keyboard.append([InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_main")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            message,
-            reply_markup=reply_markup,
-            parse_mode="Markdown"
-        )
-        return
+    user_context = get_user_context(context, update)
+    catalog = get_catalog()
+    view = catalog.plans_views[catalog.test_available(await user_context.get_user())]
+    await query.edit_message_text(**view.as_kwargs())
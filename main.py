@@ -1,8 +1,10 @@
 import os
 import logging
 import asyncio
+from telegram import Update
 from telegram.ext import (
     Application,
+    ContextTypes,
     CommandHandler,
     CallbackQueryHandler,
     ConversationHandler
@@ -14,34 +16,43 @@ from app import app
 
 from handlers.user_handlers import (
     start_command, 
-    button_handler, 
     status_command,
     plans_command,
-    help_command,
-    buy_handler,
-    payment_handler
-)
-from handlers.outline_handlers import (
-    keys_command,
-    check_subscription_expiry
+    help_command
 )
+from handlers.outline_handlers import keys_command
 from services.sync_service import sync_outline_keys, start_sync_scheduler
+from services.reconcile_service import start_reconcile_scheduler
+from services.notification_service import run_notification_sender
+from services.expiry_service import run_expiry_scheduler
+from services.broadcast_service import resume_broadcast_jobs
+from services.bulk_service import resume_admin_jobs
+from services.plan_catalog import load_catalog, start_catalog_refresher
+from handlers.context import BotContext
 from handlers.admin_handlers import (
     admin_command,
     add_user_command,
     delete_user_command,
     list_users_command,
+    find_command,
     broadcast_command,
-    admin_button_handler
+    bulk_command,
+    plan_command
 )
+from handlers.callbacks import callback_router
 
 # Import database services
-from config import USE_SQL_DATABASE
-if USE_SQL_DATABASE:
-    from services.database_service_sql import init_database
-    from models import init_db
-else:
-    from services.database_service import init_database
+from config import (
+    DATABASE_BACKEND, PAYMENT_RECONCILE_INTERVAL,
+    BOT_MODE, BOT_WORKER_ID, BOT_CONCURRENT_UPDATES,
+    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN, WEBHOOK_MAX_CONNECTIONS
+)
+from web_server import start_web_server
+from utils.concurrency import UserSerializingUpdateProcessor
+from utils.throttle import UpdateThrottle
+from utils.outbound import OutboundLimiter
+from utils.persistence import UserDataPersistence, start_user_data_evictor
+from services.repository import repository, use_backend
 
 # Load environment variables
 load_dotenv()
@@ -55,16 +66,13 @@ logger = logging.getLogger(__name__)
 
 async def init():
     """Initialize database connection"""
-    if USE_SQL_DATABASE:
-        # Initialize SQLAlchemy models
-        try:
-            init_db()
-            logger.info("SQL database initialized")
-        except Exception as e:
-            logger.error(f"Error initializing SQL database: {e}")
+    # Схема SQL создается в init_database() выбранного бэкенда
+    use_backend(DATABASE_BACKEND)
+    if not await repository.init_database():
+        logger.error(f"Database backend {DATABASE_BACKEND} is not available")
     
-    # Initialize database connection
-    await init_database()
+    # Тарифы читаются из базы, при первом запуске туда переносится VPN_PLANS
+    await load_catalog()
 
 async def main():
     """Start the bot."""
@@ -73,11 +81,30 @@ async def main():
     if not token:
         logger.error("BOT_TOKEN environment variable is not set")
         return
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        logger.error("WEBHOOK_URL environment variable is required in webhook mode")
+        return
         
     # Run database initialization
     await init()
         
-    application = Application.builder().token(token).build()
+    # Разные пользователи обрабатываются параллельно, один пользователь - по очереди,
+    # повторные нажатия сверх лимита отсекаются до вызова обработчиков
+    builder = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(UserSerializingUpdateProcessor(BOT_CONCURRENT_UPDATES, UpdateThrottle()))
+        # Все запросы к Telegram идут через общий лимит с приоритетами
+        .rate_limiter(OutboundLimiter())
+        # Данные пользователя загружаются один раз на обновление
+        .context_types(ContextTypes(context=BotContext))
+    )
+    if BOT_MODE == "webhook":
+        # Обновления приходят через веб-сервер, getUpdates не нужен
+        builder = builder.updater(None)
+    # context.user_data хранится в базе и переживает перезапуск
+    builder = builder.persistence(UserDataPersistence())
+    application = builder.build()
     
     # User command handlers
     application.add_handler(CommandHandler("start", start_command))
@@ -91,13 +118,14 @@ async def main():
     application.add_handler(CommandHandler("add_user", add_user_command))
     application.add_handler(CommandHandler("delete_user", delete_user_command))
     application.add_handler(CommandHandler("list_users", list_users_command))
+    application.add_handler(CommandHandler("find", find_command))
     application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("bulk", bulk_command))
+    application.add_handler(CommandHandler("plan", plan_command))
     
     # Callback query handlers
-    application.add_handler(CallbackQueryHandler(admin_button_handler, pattern="^admin_"))
-    application.add_handler(CallbackQueryHandler(buy_handler, pattern="^buy_"))
-    application.add_handler(CallbackQueryHandler(payment_handler, pattern="^pay_"))  # Упрощаем паттерн
-    application.add_handler(CallbackQueryHandler(button_handler))
+    # Все кнопки обслуживает один маршрутизатор
+    application.add_handler(CallbackQueryHandler(callback_router.dispatch))
     
     # Логируем все обработчики для отладки
     logger.info("Telegram bot handlers registered successfully")
@@ -105,16 +133,46 @@ async def main():
     # Start the Bot
     await application.initialize()
     await application.start()
-    await application.updater.start_polling()
+    web_runner = await start_web_server(application)
     
-    logger.info("Bot started and polling for updates...")
+    if BOT_MODE == "webhook":
+        if BOT_WORKER_ID == 0:
+            await application.bot.set_webhook(
+                url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET_TOKEN,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS
+            )
+        logger.info(f"Bot worker {BOT_WORKER_ID} started in webhook mode")
+    else:
+        await application.updater.start_polling()
+        logger.info("Bot started and polling for updates...")
     
-    # Запускаем первичную синхронизацию ключей
-    logger.info("Starting initial key synchronization...")
-    await sync_outline_keys()
+    # Каждый процесс следит за версией каталога тарифов и выгружает состояния неактивных пользователей
+    asyncio.create_task(start_catalog_refresher())
+    asyncio.create_task(start_user_data_evictor(application))
     
-    # Запускаем задачу периодической синхронизации
-    asyncio.create_task(start_sync_scheduler(300))  # Синхронизация каждые 5 минут
+    # Фоновые задачи выполняет только основной воркер
+    if BOT_WORKER_ID == 0:
+        # Запускаем первичную синхронизацию ключей
+        logger.info("Starting initial key synchronization...")
+        await sync_outline_keys()
+        
+        # Запускаем задачу периодической синхронизации
+        asyncio.create_task(start_sync_scheduler(300))  # Синхронизация каждые 5 минут
+        
+        # Отправщик уведомлений из outbox использует общий экземпляр бота приложения
+        asyncio.create_task(run_notification_sender(application.bot))
+        
+        # Окончание подписок: уведомления в тот же outbox, отключение и отзыв ключей
+        asyncio.create_task(run_expiry_scheduler())
+        
+        # Запускаем сверку зависших платежей с ЮKassa
+        asyncio.create_task(start_reconcile_scheduler(PAYMENT_RECONCILE_INTERVAL))
+        
+        # Продолжаем рассылки и массовые операции, прерванные перезапуском
+        await resume_broadcast_jobs(application.bot)
+        await resume_admin_jobs(application.bot)
     
     # Keep the bot running
     try:
@@ -125,7 +183,11 @@ async def main():
         pass
     finally:
         # Stop the application when finished
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        await web_runner.cleanup()
         await application.stop()
+        await application.shutdown()
 
 if __name__ == "__main__":
     # Use asyncio.run() to properly handle the event loop
@@ -1,9 +1,12 @@
 import os
 from datetime import datetime
-from sqlalchemy import Column, Integer, BigInteger, String, Float, DateTime, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, String, Text, Float, DateTime, Boolean, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, func, inspect, text
+from sqlalchemy.schema import CreateIndex
+
+from services.state_machine import PAYMENT_TRANSITIONS, sources_for
 
 # Создаем базовый класс для моделей
 Base = declarative_base()
@@ -17,6 +20,17 @@ class User(Base):
     username = Column(String(255), nullable=True)
     first_name = Column(String(255), nullable=True)
     last_name = Column(String(255), nullable=True)
+    
+    __table_args__ = (
+        # Поиск администратором без учета регистра и по префиксу;
+        # text_pattern_ops позволяет PostgreSQL использовать индекс для LIKE 'abc%'
+        Index('ix_users_username_lower', func.lower(username).label('username_lower'),
+              postgresql_ops={'username_lower': 'text_pattern_ops'}),
+        Index('ix_users_first_name_lower', func.lower(first_name).label('first_name_lower'),
+              postgresql_ops={'first_name_lower': 'text_pattern_ops'}),
+        Index('ix_users_last_name_lower', func.lower(last_name).label('last_name_lower'),
+              postgresql_ops={'last_name_lower': 'text_pattern_ops'}),
+    )
     created_at = Column(DateTime, default=datetime.now)
     is_premium = Column(Boolean, default=False)
     test_used = Column(Boolean, default=False)
@@ -32,6 +46,10 @@ class User(Base):
 class Subscription(Base):
     """Модель подписки"""
     __tablename__ = 'subscriptions'
+    __table_args__ = (
+        # Уведомления об окончании выбирают активные подписки по окнам expires_at
+        Index('ix_subscriptions_status_expires_at', 'status', 'expires_at'),
+    )
     
     id = Column(Integer, primary_key=True)
     subscription_id = Column(String(255), unique=True, nullable=False)
@@ -41,6 +59,11 @@ class Subscription(Base):
     created_at = Column(DateTime, default=datetime.now)
     expires_at = Column(DateTime, nullable=True)
     price_paid = Column(Float, default=0.0)
+    # Последнее отправленное уведомление об окончании (окно в днях до окончания)
+    # и срок, о котором оно было; после продления срок меняется и уведомления
+    # приходят снова
+    expiry_notice_days = Column(Integer, nullable=True)
+    expiry_notice_for = Column(DateTime, nullable=True)
     
     # Отношения
     user = relationship("User", back_populates="subscriptions")
@@ -89,20 +112,218 @@ class Payment(Base):
     def __repr__(self):
         return f"<Payment(payment_id='{self.payment_id}', status='{self.status}')>"
 
+# Сверка зависших платежей: страницы по (created_at, id) среди платежей,
+# которые ещё могут быть проведены (pending, waiting_for_capture, expired)
+_unsettled_payment = Payment.status.in_(sources_for(PAYMENT_TRANSITIONS, "succeeded"))
+Index(
+    'ix_payments_unsettled_created_at', Payment.created_at, Payment.id,
+    postgresql_where=_unsettled_payment, sqlite_where=_unsettled_payment
+)
+
+class ProcessedEvent(Base):
+    """Модель обработанного события вебхука (для дедупликации)"""
+    __tablename__ = 'processed_events'
+    
+    id = Column(Integer, primary_key=True)
+    event_id = Column(String(255), unique=True, nullable=False)
+    event_type = Column(String(50), nullable=True)
+    created_at = Column(DateTime, default=datetime.now)
+    
+    def __repr__(self):
+        return f"<ProcessedEvent(event_id='{self.event_id}')>"
+
+class Notification(Base):
+    """Модель исходящего уведомления (outbox)"""
+    __tablename__ = 'notifications'
+    __table_args__ = (
+        # Отправщик выбирает ожидающие уведомления, срок которых наступил
+        Index('ix_notifications_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(BigInteger, nullable=False)
+    text = Column(Text, nullable=False)
+    parse_mode = Column(String(20), nullable=True)
+    reply_markup = Column(Text, nullable=True)  # JSON клавиатуры
+    status = Column(String(20), default='pending')
+    attempts = Column(Integer, default=0)
+    lease_id = Column(String(32), nullable=True)
+    created_at = Column(DateTime, default=datetime.now)
+    next_attempt_at = Column(DateTime, default=datetime.now)
+    sent_at = Column(DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f"<Notification(id={self.id}, chat_id={self.chat_id}, status='{self.status}')>"
+
+class BroadcastJob(Base):
+    """Модель задачи рассылки"""
+    __tablename__ = 'broadcast_jobs'
+    
+    id = Column(Integer, primary_key=True)
+    text = Column(Text, nullable=False)
+    parse_mode = Column(String(20), nullable=True)
+    status = Column(String(20), default='running')
+    created_by = Column(BigInteger, nullable=True)
+    created_at = Column(DateTime, default=datetime.now)
+    finished_at = Column(DateTime, nullable=True)
+    cursor_user_id = Column(Integer, default=0)  # последний обработанный users.id
+    total = Column(Integer, default=0)
+    sent_count = Column(Integer, default=0)
+    failed_count = Column(Integer, default=0)
+    status_chat_id = Column(BigInteger, nullable=True)  # сообщение с прогрессом
+    status_message_id = Column(Integer, nullable=True)
+    
+    def __repr__(self):
+        return f"<BroadcastJob(id={self.id}, status='{self.status}')>"
+
+class BroadcastRecipient(Base):
+    """Модель статуса доставки рассылки одному получателю"""
+    __tablename__ = 'broadcast_recipients'
+    
+    job_id = Column(Integer, ForeignKey('broadcast_jobs.id'), primary_key=True)
+    telegram_id = Column(BigInteger, primary_key=True)
+    status = Column(String(20), nullable=False)
+    error = Column(String(255), nullable=True)
+    updated_at = Column(DateTime, default=datetime.now)
+    
+    def __repr__(self):
+        return f"<BroadcastRecipient(job_id={self.job_id}, telegram_id={self.telegram_id}, status='{self.status}')>"
+
+class AdminJob(Base):
+    """Модель массовой операции администратора (/bulk)"""
+    __tablename__ = 'admin_jobs'
+    
+    id = Column(Integer, primary_key=True)
+    action = Column(String(20), nullable=False)  # extend, revoke, migrate
+    params = Column(Text, nullable=True)  # JSON: days, server
+    status = Column(String(20), default='running')
+    created_by = Column(BigInteger, nullable=True)
+    created_at = Column(DateTime, default=datetime.now)
+    finished_at = Column(DateTime, nullable=True)
+    cursor_user_id = Column(Integer, default=0)  # последний обработанный users.id
+    total = Column(Integer, default=0)
+    done_count = Column(Integer, default=0)
+    failed_count = Column(Integer, default=0)
+    status_chat_id = Column(BigInteger, nullable=True)  # сообщение с прогрессом
+    status_message_id = Column(Integer, nullable=True)
+    
+    def __repr__(self):
+        return f"<AdminJob(id={self.id}, action='{self.action}', status='{self.status}')>"
+
+class AdminJobTarget(Base):
+    """Модель пользователя, выбранного для массовой операции"""
+    __tablename__ = 'admin_job_targets'
+    
+    job_id = Column(Integer, ForeignKey('admin_jobs.id'), primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    
+    def __repr__(self):
+        return f"<AdminJobTarget(job_id={self.job_id}, user_id={self.user_id})>"
+
+class TariffPlan(Base):
+    """Модель тарифного плана"""
+    __tablename__ = 'plans'
+    
+    id = Column(String(50), primary_key=True)
+    name = Column(String(255), nullable=False)
+    duration = Column(Integer, nullable=False)  # days
+    price = Column(Float, nullable=False)  # rubles
+    devices = Column(Integer, default=1)
+    discount = Column(String(20), nullable=True)
+    description = Column(Text, nullable=True)
+    active = Column(Boolean, default=True)
+    updated_at = Column(DateTime, default=datetime.now)
+    
+    def __repr__(self):
+        return f"<TariffPlan(id='{self.id}', price={self.price})>"
+
+class PlanCatalogVersion(Base):
+    """Версия каталога тарифов: увеличивается при каждом изменении планов"""
+    __tablename__ = 'plan_catalog_version'
+    
+    id = Column(Integer, primary_key=True)  # единственная строка с id=1
+    version = Column(Integer, nullable=False, default=1)
+    updated_at = Column(DateTime, default=datetime.now)
+
+class UserState(Base):
+    """Сохранённый context.user_data пользователя (JSON)"""
+    __tablename__ = 'user_states'
+    
+    telegram_id = Column(BigInteger, primary_key=True)
+    data = Column(Text, nullable=False)
+    updated_at = Column(DateTime, default=datetime.now)
+
+# Индексы прежних версий, замененные другими
+OBSOLETE_INDEXES = ("ix_payments_status_created_at",)
+
+# lower() в SQLite переводит в нижний регистр только ASCII, поэтому поиск по
+# кириллице использует эту функцию из Python (без индекса)
+SQLITE_UNICODE_LOWER = "unicode_lower"
+
+def _unicode_lower(value):
+    return value.lower() if isinstance(value, str) else value
+
+def _register_sqlite_functions(dbapi_connection, connection_record):
+    dbapi_connection.create_function(SQLITE_UNICODE_LOWER, 1, _unicode_lower, deterministic=True)
+
+# Движок и фабрика сессий создаются один раз на процесс
+_engine = None
+_Session = None
+
+def _ensure_indexes(engine):
+    """Создание индексов, добавленных после создания таблиц.
+    
+    create_all() не трогает уже существующие таблицы, поэтому новые индексы
+    для них создаются отдельно. IF NOT EXISTS вместо checkfirst: индексы по
+    выражениям (lower(...)) SQLAlchemy не во всех базах видит при отражении.
+    """
+    with engine.begin() as connection:
+        for name in OBSOLETE_INDEXES:
+            connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                connection.execute(CreateIndex(index, if_not_exists=True))
+
+def _ensure_columns(engine):
+    """Добавление колонок, появившихся после создания таблиц.
+    
+    Поддерживаются только nullable-колонки без значения по умолчанию:
+    существующие строки получают в них NULL.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
 # Инициализация базы данных
 def init_db():
     """Инициализация базы данных"""
+    global _engine, _Session
+    if _engine is not None:
+        return _engine
+    
     database_url = os.environ.get("DATABASE_URL")
     if not database_url:
         raise ValueError("DATABASE_URL environment variable is not set")
     
     engine = create_engine(database_url)
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", _register_sqlite_functions)
     Base.metadata.create_all(engine)
+    _ensure_columns(engine)
+    _ensure_indexes(engine)
+    
+    _engine = engine
+    _Session = sessionmaker(bind=engine)
     return engine
 
 # Создание сессии
 def get_session():
     """Создание сессии для работы с базой данных"""
-    engine = init_db()
-    Session = sessionmaker(bind=engine)
-    return Session()
\ No newline at end of file
+    init_db()
+    return _Session()
@@ -0,0 +1,175 @@
+"""
+Рассылки сообщений всем пользователям.
+
+Рассылка - это задача в таблице broadcast_jobs. Получатели читаются страницами
+по users.id (keyset), сообщения отправляются параллельно с низшим приоритетом
+общего ограничителя исходящих запросов (utils.outbound),
+а результат каждого получателя и курсор задачи сохраняются после каждой
+страницы. После перезапуска незавершённые задачи продолжаются с курсора.
+"""
+
+import asyncio
+import logging
+from datetime import datetime
+
+from telegram.error import RetryAfter, Forbidden, BadRequest
+
+from config import (
+    BROADCAST_CONCURRENCY, BROADCAST_PAGE_SIZE, BROADCAST_PROGRESS_INTERVAL
+)
+from services.repository import repository as db
+from utils.outbound import BULK
+from utils.progress import ProgressReporter
+
+logger = logging.getLogger(__name__)
+
+MAX_SEND_ATTEMPTS = 3
+
+# Задачи, выполняющиеся в этом процессе
+_running_jobs = {}
+
+def _progress_text(job, done=False):
+    """Текст сообщения с прогрессом рассылки"""
+    processed = job.sent_count + job.failed_count
+    if done:
+        return (
+            f"✅ Рассылка завершена!\n\n"
+            f"📊 Статистика:\n"
+            f"- Всего пользователей: {job.total}\n"
+            f"- Успешно отправлено: {job.sent_count}\n"
+            f"- Не удалось отправить: {job.failed_count}"
+        )
+    return (
+        f"📤 Рассылка сообщения...\n"
+        f"Обработано: {processed} из {job.total}\n"
+        f"Отправлено: {job.sent_count}, ошибок: {job.failed_count}"
+    )
+
+async def _send_one(bot, job, telegram_id, semaphore):
+    """
+    Отправляет сообщение одному получателю.
+    
+    Returns:
+        tuple: (telegram_id, status, error)
+    """
+    error = "retry limit"
+    async with semaphore:
+        for attempt in range(MAX_SEND_ATTEMPTS):
+            try:
+                # Лимиты, паузы и повторы на RetryAfter - в общем ограничителе,
+                # рассылка получает токены после ответов пользователям и уведомлений
+                await bot.send_message(
+                    chat_id=telegram_id,
+                    text=job.text,
+                    parse_mode=job.parse_mode,
+                    rate_limit_args=BULK
+                )
+                return telegram_id, "sent", None
+            except RetryAfter as e:
+                # Ограничитель уже исчерпал свои повторы - ещё круг их только умножит
+                logger.warning(f"Flood control при рассылке {job.id}: {e}")
+                return telegram_id, "failed", str(e)
+            except (Forbidden, BadRequest) as e:
+                # Бот заблокирован или чат недоступен - повтор не поможет
+                return telegram_id, "failed", str(e)
+            except Exception as e:
+                logger.error(f"Error sending broadcast to {telegram_id}: {e}")
+                error = str(e)
+        return telegram_id, "failed", error
+
+async def run_broadcast_job(bot, job_id):
+    """
+    Выполняет (или продолжает) задачу рассылки.
+    
+    Args:
+        bot: Экземпляр бота приложения
+        job_id (int): ID задачи рассылки
+    """
+    job = await db.get_broadcast_job(job_id)
+    if not job or job.status != "running":
+        return
+    
+    logger.info(f"Рассылка {job_id}: старт с курсора {job.cursor_user_id}")
+    
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    progress = ProgressReporter(
+        bot, job.status_chat_id, job.status_message_id, interval=BROADCAST_PROGRESS_INTERVAL
+    )
+    cursor = job.cursor_user_id
+    
+    try:
+        while True:
+            page = await db.get_users_page(after_id=cursor, limit=BROADCAST_PAGE_SIZE)
+            if not page:
+                break
+            
+            telegram_ids = [telegram_id for _, telegram_id in page if telegram_id]
+            
+            # Получатели, уже обработанные до перезапуска, пропускаются
+            done = await db.get_broadcast_recipient_statuses(job_id, telegram_ids)
+            pending = [telegram_id for telegram_id in telegram_ids if telegram_id not in done]
+            
+            results = await asyncio.gather(
+                *(_send_one(bot, job, telegram_id, semaphore) for telegram_id in pending)
+            )
+            
+            cursor = page[-1][0]
+            await db.record_broadcast_page(job_id, results, cursor)
+            
+            job = await db.get_broadcast_job(job_id)
+            progress.update(_progress_text(job))
+            
+            if len(page) < BROADCAST_PAGE_SIZE:
+                break
+        
+        await db.update_broadcast_job(job_id, {
+            "status": "done",
+            "finished_at": datetime.now()
+        })
+        job = await db.get_broadcast_job(job_id)
+        progress.finish(_progress_text(job, done=True))
+        logger.info(f"Рассылка {job_id} завершена: отправлено {job.sent_count}, ошибок {job.failed_count}")
+    except asyncio.CancelledError:
+        # Процесс останавливается - задача продолжится после перезапуска
+        logger.info(f"Рассылка {job_id} прервана на курсоре {cursor}")
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка рассылки {job_id}: {e}")
+    finally:
+        _running_jobs.pop(job_id, None)
+
+def start_broadcast_job(bot, job_id):
+    """Запускает задачу рассылки в фоне, если она ещё не выполняется в этом процессе"""
+    if job_id in _running_jobs:
+        return _running_jobs[job_id]
+    task = asyncio.create_task(run_broadcast_job(bot, job_id))
+    _running_jobs[job_id] = task
+    return task
+
+async def create_broadcast(bot, text, created_by=None, status_message=None, parse_mode="HTML"):
+    """
+    Создаёт задачу рассылки и запускает её.
+    
+    Returns:
+        int: ID задачи или None при ошибке
+    """
+    total = await db.count_users()
+    job_id = await db.create_broadcast_job({
+        "text": text,
+        "parse_mode": parse_mode,
+        "created_by": created_by,
+        "total": total,
+        "status_chat_id": status_message.chat_id if status_message else None,
+        "status_message_id": status_message.message_id if status_message else None
+    })
+    if job_id:
+        start_broadcast_job(bot, job_id)
+    return job_id
+
+async def resume_broadcast_jobs(bot):
+    """Продолжает рассылки, прерванные перезапуском процесса"""
+    jobs = await db.get_running_broadcast_jobs()
+    for job in jobs:
+        logger.info(f"Продолжаем рассылку {job.id}")
+        start_broadcast_job(bot, job.id)
+    return len(jobs)
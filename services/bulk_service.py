@@ -0,0 +1,247 @@
+"""
+Массовые операции администратора над пользователями (/bulk).
+
+Операция - это задача в таблице admin_jobs. Её пользователи выбираются при
+создании фильтром или списком Telegram ID (admin_job_targets) и
+обрабатываются страницами по users.id: ключи страницы читаются одним
+запросом, запросы к Outline идут параллельно не больше
+ADMIN_JOB_OUTLINE_CONCURRENCY одновременно, а изменения в базе и курсор
+задачи записываются одной транзакцией на страницу. После перезапуска
+незавершённые задачи продолжаются с курсора.
+
+- extend: продлить активные подписки на N дней (только база)
+- revoke: удалить ключи в Outline и закрыть подписки
+- migrate: перевыпустить ключи на другом сервере Outline, удалить старые
+  и отправить пользователям новые ключи через outbox уведомлений
+"""
+
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from datetime import datetime
+
+from config import ADMIN_JOB_PAGE_SIZE, ADMIN_JOB_OUTLINE_CONCURRENCY, ADMIN_JOB_PROGRESS_INTERVAL
+from services.repository import repository as db
+from services.outline_service import get_outline_service, split_key_id, join_key_id, delete_stored_key
+from utils.progress import ProgressReporter
+
+logger = logging.getLogger(__name__)
+
+ACTION_TITLES = {
+    "extend": "Продление подписок",
+    "revoke": "Отзыв доступа",
+    "migrate": "Перенос на другой сервер"
+}
+
+# Задачи, выполняющиеся в этом процессе
+_running_jobs = {}
+
+def _progress_text(job, done=False):
+    """Текст сообщения с прогрессом операции"""
+    title = ACTION_TITLES.get(job.action, job.action)
+    processed = job.done_count + job.failed_count
+    if done:
+        return (
+            f"✅ {title}: завершено!\n\n"
+            f"📊 Статистика:\n"
+            f"- Всего пользователей: {job.total}\n"
+            f"- Успешно: {job.done_count}\n"
+            f"- С ошибками: {job.failed_count}"
+        )
+    return (
+        f"⚙️ {title}...\n"
+        f"Обработано: {processed} из {job.total}\n"
+        f"Успешно: {job.done_count}, ошибок: {job.failed_count}"
+    )
+
+async def _delete_key(semaphore, key_id):
+    """
+    Удаляет ключ на его сервере Outline.
+
+    Returns:
+        bool: True, если ключа на сервере больше нет
+    """
+    async with semaphore:
+        try:
+            return await delete_stored_key(key_id)
+        except Exception as e:
+            logger.error(f"Error deleting key {key_id}: {e}")
+            return False
+
+async def _extend_page(job, params, page, semaphore, cursor):
+    user_ids = [user_id for user_id, _ in page]
+    extended = await db.extend_active_subscriptions(
+        user_ids, params["days"], job_id=job.id, cursor_user_id=cursor
+    )
+    return extended is not None
+
+async def _revoke_page(job, params, page, semaphore, cursor):
+    user_ids = [user_id for user_id, _ in page]
+    keys = await db.get_users_live_keys(user_ids)
+    results = await asyncio.gather(*(_delete_key(semaphore, key["key_id"]) for key in keys))
+
+    deleted_key_ids = {key["key_id"] for key, deleted in zip(keys, results) if deleted}
+    # Пользователь с неудаленным ключом остается с доступом и считается ошибкой
+    failed_users = {key["user_id"] for key, deleted in zip(keys, results) if not deleted}
+    revoked = [user_id for user_id in user_ids if user_id not in failed_users]
+    return await db.revoke_users_access(
+        revoked, deleted_key_ids, job_id=job.id, cursor_user_id=cursor, failed=len(failed_users)
+    )
+
+async def _migrate_key(semaphore, key, server):
+    """
+    Выпускает ключ на сервере `server` и удаляет старый.
+
+    Returns:
+        tuple: (новый key_id, access_url) или None при ошибке
+    """
+    async with semaphore:
+        try:
+            created = await get_outline_service(server).create_key(key["name"])
+        except Exception as e:
+            logger.error(f"Error creating key on {server or 'main'} server: {e}")
+            return None
+    if "error" in created:
+        return None
+
+    if not await _delete_key(semaphore, key["key_id"]):
+        # Новый ключ уже выпущен: пользователь переходит на него, старый нужно удалить вручную
+        logger.warning(f"Старый ключ {key['key_id']} не удален после переноса")
+    return join_key_id(server, created["id"]), created["accessUrl"]
+
+async def _migrate_page(job, params, page, semaphore, cursor):
+    server = params.get("server")
+    keys = [
+        key for key in await db.get_users_live_keys([user_id for user_id, _ in page])
+        # Ключи, уже перенесенные до перезапуска, пропускаются
+        if split_key_id(key["key_id"])[0] != server
+    ]
+    results = await asyncio.gather(*(_migrate_key(semaphore, key, server) for key in keys))
+
+    replacements = []
+    new_urls = defaultdict(list)
+    failed_users = set()
+    for key, result in zip(keys, results):
+        if result is None:
+            failed_users.add(key["user_id"])
+            continue
+        new_key_id, access_url = result
+        replacements.append((key["key_id"], new_key_id, access_url))
+        new_urls[key["telegram_id"]].append(access_url)
+
+    notifications = [
+        {
+            "chat_id": telegram_id,
+            "text": (
+                "🔄 Ваш VPN перенесен на новый сервер.\n\n"
+                "Новый ключ доступа:\n" + "\n".join(f"<code>{url}</code>" for url in urls) +
+                "\n\nЗамените ключ в приложении Outline, старый больше не работает."
+            ),
+            "parse_mode": "HTML"
+        }
+        for telegram_id, urls in new_urls.items()
+    ]
+    return await db.replace_access_keys(
+        replacements, notifications, job_id=job.id, cursor_user_id=cursor,
+        done=len(page) - len(failed_users), failed=len(failed_users)
+    )
+
+PAGE_HANDLERS = {
+    "extend": _extend_page,
+    "revoke": _revoke_page,
+    "migrate": _migrate_page
+}
+
+async def run_admin_job(bot, job_id):
+    """
+    Выполняет (или продолжает) массовую операцию.
+
+    Args:
+        bot: Экземпляр бота приложения
+        job_id (int): ID задачи
+    """
+    job = await db.get_admin_job(job_id)
+    if not job or job.status != "running":
+        return
+
+    handle_page = PAGE_HANDLERS[job.action]
+    params = json.loads(job.params or "{}")
+    logger.info(f"Операция {job_id} ({job.action}): старт с курсора {job.cursor_user_id}")
+
+    semaphore = asyncio.Semaphore(ADMIN_JOB_OUTLINE_CONCURRENCY)
+    progress = ProgressReporter(
+        bot, job.status_chat_id, job.status_message_id, interval=ADMIN_JOB_PROGRESS_INTERVAL
+    )
+    cursor = job.cursor_user_id
+
+    try:
+        while True:
+            page = await db.get_admin_job_targets(job_id, after_user_id=cursor, limit=ADMIN_JOB_PAGE_SIZE)
+            if not page:
+                break
+
+            cursor = page[-1][0]
+            if not await handle_page(job, params, page, semaphore, cursor):
+                # Изменения страницы не записались - считаем её пользователей ошибками
+                await db.record_admin_job_page(job_id, cursor, 0, len(page))
+
+            job = await db.get_admin_job(job_id)
+            progress.update(_progress_text(job))
+
+            if len(page) < ADMIN_JOB_PAGE_SIZE:
+                break
+
+        await db.update_admin_job(job_id, {
+            "status": "done",
+            "finished_at": datetime.now()
+        })
+        job = await db.get_admin_job(job_id)
+        progress.finish(_progress_text(job, done=True))
+        logger.info(f"Операция {job_id} завершена: успешно {job.done_count}, ошибок {job.failed_count}")
+    except asyncio.CancelledError:
+        # Процесс останавливается - задача продолжится после перезапуска
+        logger.info(f"Операция {job_id} прервана на курсоре {cursor}")
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка операции {job_id}: {e}")
+    finally:
+        _running_jobs.pop(job_id, None)
+
+def start_admin_job(bot, job_id):
+    """Запускает операцию в фоне, если она ещё не выполняется в этом процессе"""
+    if job_id in _running_jobs:
+        return _running_jobs[job_id]
+    task = asyncio.create_task(run_admin_job(bot, job_id))
+    _running_jobs[job_id] = task
+    return task
+
+async def create_admin_job(bot, action, params, user_filter="all", telegram_ids=None,
+                           created_by=None, status_message=None):
+    """
+    Создаёт массовую операцию и запускает её.
+
+    Returns:
+        AdminJob: Созданная задача или None при ошибке
+    """
+    if action not in PAGE_HANDLERS:
+        raise ValueError(f"Unknown bulk action: {action}")
+    job_id = await db.create_admin_job({
+        "action": action,
+        "params": json.dumps(params),
+        "created_by": created_by,
+        "status_chat_id": status_message.chat_id if status_message else None,
+        "status_message_id": status_message.message_id if status_message else None
+    }, user_filter=user_filter, telegram_ids=telegram_ids)
+    if not job_id:
+        return None
+    start_admin_job(bot, job_id)
+    return await db.get_admin_job(job_id)
+
+async def resume_admin_jobs(bot):
+    """Продолжает операции, прерванные перезапуском процесса"""
+    jobs = await db.get_running_admin_jobs()
+    for job in jobs:
+        logger.info(f"Продолжаем операцию {job.id} ({job.action})")
+        start_admin_job(bot, job.id)
+    return len(jobs)
@@ -1,35 +1,68 @@
 import os
+import uuid
 import logging
 from datetime import datetime, timedelta
-from pymongo import MongoClient, ASCENDING, DESCENDING
-from pymongo.errors import ConnectionFailure
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
 from bson.objectid import ObjectId
 
+from config import (
+    MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, MONGO_MAX_IDLE_TIME_MS,
+    MONGO_WAIT_QUEUE_TIMEOUT_MS, MONGO_CURSOR_BATCH_SIZE
+)
+from services.rows import (
+    UserRow, SubscriptionRow, KeyRow, PaymentRow, NotificationRow, BroadcastJobRow, AdminJobRow
+)
+from services.state_machine import PAYMENT_TRANSITIONS, SUBSCRIPTION_TRANSITIONS, sources_for
+
 # MongoDB configuration
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "users-outline")
 
+# Сравнение username и имен без учета регистра (strength 2 - без учета регистра, с учетом диакритики)
+USERNAME_COLLATION = {"locale": "en", "strength": 2}
+
+# Индексы прежних версий, которые покрыты составными индексами или больше не нужны
+OBSOLETE_INDEXES = {
+    "users": ["users_text"],
+    "subscriptions": ["user_id_1", "status_1", "expires_at_1"],
+    "access_keys": ["user_id_1", "subscription_id_1"],
+    "payments": ["user_id_1", "subscription_id_1", "status_1_created_at_1"],
+    "notifications": ["status_1_next_attempt_at_1"]
+}
+
 logger = logging.getLogger(__name__)
 
+# Слушатели изменения срока подписок (планировщик окончаний)
+_expiry_listeners = []
+
+def add_expiry_listener(listener):
+    """Call listener(subscription_db_id, expires_at) after an active subscription's term is set or changed"""
+    _expiry_listeners.append(listener)
+
+def _expiry_changed(subscription_id, expires_at):
+    for listener in _expiry_listeners:
+        try:
+            listener(subscription_id, expires_at)
+        except Exception as e:
+            logger.error(f"Error in expiry listener: {e}")
+
+def _after_id(field, after_id):
+    """Keyset condition `field > after_id` for string ObjectIds; a falsy cursor means the first page"""
+    return {field: {"$gt": ObjectId(after_id)}} if after_id else {}
+
 # MongoDB client
 client = None
 db = None
 
-# In-memory mockup database for testing
-mock_db = {
-    "users": [],
-    "subscriptions": [],
-    "access_keys": [],
-    "payments": []
-}
-
 async def init_database():
     """Initialize the MongoDB connection"""
     global client, db
     try:
         # Use MongoDB Atlas URI with timeout settings and TLS/SSL options
         # Обновленные параметры для исправления проблем с TLS
-        client = MongoClient(
+        client = AsyncIOMotorClient(
             MONGO_URI,
             serverSelectionTimeoutMS=10000,
             tlsInsecure=True,  # Использовать вместо tlsAllowInvalidCertificates
@@ -37,10 +70,16 @@ async def init_database():
             retryWrites=True,
             connectTimeoutMS=10000,
             socketTimeoutMS=10000,
+            # Пул соединений на процесс: запросы обработчиков и фоновых задач ждут
+            # свободное соединение не дольше waitQueueTimeoutMS
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+            waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
             appName="VPNBot"  # Добавляем имя приложения для отслеживания
         )
         # Test connection
-        client.admin.command('ping')
+        await client.admin.command('ping')
         db = client[MONGO_DB_NAME]
         
         # Create indexes for better performance
@@ -48,149 +87,505 @@ async def init_database():
         
         logger.info(f"Connected to MongoDB: {MONGO_DB_NAME}")
     except Exception as e:
+        # Без подключения работать нельзя: для тестов есть бэкенд в памяти
         logger.error(f"MongoDB connection failed: {e}")
-        # Create mock db for testing if MongoDB is unavailable
-        from unittest.mock import MagicMock
-        db = MagicMock()
-        logger.warning("Using mock database for testing")
-        # Don't raise the exception to allow testing without MongoDB
+        db = None
+        return False
+    return True
 
 async def ensure_indexes():
     """Ensure all necessary indexes exist"""
-    if not db:
+    if db is None:
         logger.warning("Cannot create indexes: No database connection")
         return
     
     try:
+        for collection, names in OBSOLETE_INDEXES.items():
+            for name in names:
+                try:
+                    await db[collection].drop_index(name)
+                except OperationFailure:
+                    # Индекса нет (новая база или уже удален)
+                    pass
+        
         # Users collection
-        db.users.create_index("telegram_id", unique=True)
+        await db.users.create_index("telegram_id", unique=True)
+        # Поиск администратором по префиксу username и имени без учета регистра
+        for field in ("username", "first_name", "last_name"):
+            await db.users.create_index(field, collation=USERNAME_COLLATION)
         
         # Subscriptions collection
-        db.subscriptions.create_index("user_id")
-        db.subscriptions.create_index("status")
-        db.subscriptions.create_index("expires_at")
+        await db.subscriptions.create_index("subscription_id", unique=True)
+        # Активная подписка пользователя и подписки пользователя по статусу
+        await db.subscriptions.create_index(
+            [("user_id", ASCENDING), ("status", ASCENDING), ("expires_at", DESCENDING)]
+        )
+        # Истекающие подписки
+        await db.subscriptions.create_index([("status", ASCENDING), ("expires_at", ASCENDING)])
         
         # Access keys collection
-        db.access_keys.create_index("key_id", unique=True)
-        db.access_keys.create_index("user_id")
-        db.access_keys.create_index("subscription_id")
+        await db.access_keys.create_index("key_id", unique=True)
+        await db.access_keys.create_index([("user_id", ASCENDING), ("deleted", ASCENDING)])
+        await db.access_keys.create_index([("subscription_id", ASCENDING), ("deleted", ASCENDING)])
         
         # Payments collection
-        db.payments.create_index("payment_id", unique=True)
-        db.payments.create_index("user_id")
-        db.payments.create_index("subscription_id")
+        await db.payments.create_index("payment_id", unique=True)
+        await db.payments.create_index(
+            [("user_id", ASCENDING), ("status", ASCENDING), ("created_at", DESCENDING)]
+        )
+        # Сверка зависших платежей: страницы по (created_at, _id)
+        await db.payments.create_index(
+            [("status", ASCENDING), ("created_at", ASCENDING), ("_id", ASCENDING)]
+        )
+        
+        # Processed webhook events collection
+        await db.processed_events.create_index("event_id", unique=True)
+        
+        # Notifications outbox collection
+        await db.notifications.create_index(
+            [("status", ASCENDING), ("next_attempt_at", ASCENDING), ("_id", ASCENDING)]
+        )
+        await db.notifications.create_index("lease_id")
+        
+        # Broadcast collections
+        await db.broadcast_jobs.create_index("status")
+        await db.broadcast_recipients.create_index([("job_id", ASCENDING), ("telegram_id", ASCENDING)], unique=True)
+        
+        # Admin job collections ($merge целей задачи требует уникального индекса по on-полям)
+        await db.admin_jobs.create_index("status")
+        await db.admin_job_targets.create_index([("job_id", ASCENDING), ("user_id", ASCENDING)], unique=True)
         
         logger.info("Database indexes created successfully")
     except Exception as e:
         logger.error(f"Error creating indexes: {e}")
 
+async def _read(cursor, row=None):
+    """Reads an async cursor in batches of MONGO_CURSOR_BATCH_SIZE, optionally into rows"""
+    cursor.batch_size(MONGO_CURSOR_BATCH_SIZE)
+    if row is None:
+        return [document async for document in cursor]
+    return [row.from_document(document) async for document in cursor]
+
 # User operations
 async def create_user(user_data):
     """Create a new user in the database"""
-    if not db:
+    if db is None:
         await init_database()
     
     try:
-        result = db.users.insert_one(user_data)
-        return result.inserted_id
+        existing_user = await db.users.find_one({"telegram_id": user_data["telegram_id"]}, UserRow.projection())
+        if existing_user:
+            logger.info(f"User {user_data['telegram_id']} already exists")
+            return UserRow.from_document(existing_user)
+        
+        user_data = {"created_at": datetime.now(), "is_premium": False, "test_used": False, **user_data}
+        result = await db.users.insert_one(user_data)
+        user_data["_id"] = result.inserted_id
+        return UserRow.from_document(user_data)
     except Exception as e:
         logger.error(f"Error creating user: {e}")
         raise
 
+async def upsert_user(user_data):
+    """
+    Register a user unless they already exist, in a single statement.
+    
+    Returns:
+        bool: True if the user was created, False if it already existed, None on error
+    """
+    if db is None:
+        await init_database()
+    
+    try:
+        result = await db.users.update_one(
+            {"telegram_id": user_data["telegram_id"]},
+            {"$setOnInsert": user_data},
+            upsert=True
+        )
+        return result.upserted_id is not None
+    except Exception as e:
+        logger.error(f"Error upserting user: {e}")
+        return None
+
 async def get_user(telegram_id):
     """Get user by Telegram ID"""
-    if not db:
+    if db is None:
         await init_database()
     
     try:
-        return db.users.find_one({"telegram_id": telegram_id})
+        return UserRow.from_document(await db.users.find_one({"telegram_id": telegram_id}, UserRow.projection()))
     except Exception as e:
         logger.error(f"Error getting user: {e}")
         raise
 
+async def get_user_by_id(user_id):
+    """Get user by internal database ID"""
+    if db is None:
+        await init_database()
+    
+    try:
+        return UserRow.from_document(await db.users.find_one({"_id": ObjectId(user_id)}, UserRow.projection()))
+    except Exception as e:
+        logger.error(f"Error getting user by id: {e}")
+        return None
+
+async def get_user_by_username(username):
+    """Get user by exact username, case-insensitively (uses the collation index)"""
+    if db is None:
+        await init_database()
+    
+    name = username.strip().lstrip("@")
+    if not name:
+        return None
+    
+    try:
+        return UserRow.from_document(await db.users.find_one(
+            {"username": name}, UserRow.projection(),
+            collation=USERNAME_COLLATION, sort=[("_id", ASCENDING)]
+        ))
+    except Exception as e:
+        logger.error(f"Error getting user by username: {e}")
+        return None
+
 async def update_user(telegram_id, update_data):
     """Update user data"""
-    if not db:
+    if db is None:
         await init_database()
     
     try:
-        result = db.users.update_one(
+        result = await db.users.update_one(
             {"telegram_id": telegram_id},
             {"$set": update_data}
         )
-        return result.modified_count > 0
+        return result.matched_count > 0
     except Exception as e:
         logger.error(f"Error updating user: {e}")
         raise
 
+async def claim_test_period(telegram_id):
+    """Mark the user's test period as used if it is still free (see the SQL backend)"""
+    if db is None:
+        await init_database()
+    
+    try:
+        result = await db.users.update_one(
+            {"telegram_id": telegram_id, "test_used": {"$ne": True}},
+            {"$set": {"test_used": True}}
+        )
+        return result.modified_count == 1
+    except Exception as e:
+        logger.error(f"Error claiming test period: {e}")
+        return False
+
 async def get_all_users():
     """Get all users"""
-    if not db:
+    if db is None:
         await init_database()
     
     try:
-        return list(db.users.find())
+        return await _read(db.users.find({}, UserRow.projection()), UserRow)
     except Exception as e:
         logger.error(f"Error getting all users: {e}")
         raise
 
+async def count_users():
+    """Count all users"""
+    if db is None:
+        await init_database()
+    
+    try:
+        return await db.users.estimated_document_count()
+    except Exception as e:
+        logger.error(f"Error counting users: {e}")
+        return 0
+
+async def get_users_page(after_id=None, limit=200):
+    """Get a page of (_id, telegram_id) pairs ordered by _id, starting after `after_id`"""
+    if db is None:
+        await init_database()
+    
+    try:
+        query = {"_id": {"$gt": after_id}} if after_id else {}
+        cursor = db.users.find(query, {"telegram_id": 1}).sort("_id", ASCENDING).limit(limit)
+        return [(doc["_id"], doc.get("telegram_id")) async for doc in cursor]
+    except Exception as e:
+        logger.error(f"Error getting users page: {e}")
+        return []
+
+async def search_users(query, limit=10):
+    """
+    Search users by telegram id, username or first/last name prefix, case-insensitively.
+    
+    Prefixes are matched as ranges on the case-insensitive collation indexes;
+    exact telegram id and username matches are ranked first, then username
+    prefixes, then name prefixes.
+    
+    Returns:
+        list: Dicts with id, telegram_id, username, first_name, last_name
+    """
+    if db is None:
+        await init_database()
+    
+    text = query.strip().lstrip("@")
+    if not text:
+        return []
+    
+    try:
+        projection = {"telegram_id": 1, "username": 1, "first_name": 1, "last_name": 1}
+        # U+FFFF сортируется после любого символа, так что диапазон - это все строки с префиксом
+        prefix = {"$gte": text, "$lt": text + "\uffff"}
+        queries = [
+            {"username": prefix},
+            {"$or": [{"first_name": prefix}, {"last_name": prefix}]}
+        ]
+        if text.isdigit() and len(text) < 19:
+            queries.insert(0, {"telegram_id": int(text)})
+        
+        results = {}
+        for condition in queries:
+            # Точное совпадение username - наименьшая строка с этим префиксом
+            cursor = db.users.find(
+                condition, projection, collation=USERNAME_COLLATION
+            ).sort("username", ASCENDING).limit(limit)
+            async for user in cursor:
+                results.setdefault(user["_id"], {
+                    "id": str(user["_id"]),
+                    "telegram_id": user.get("telegram_id"),
+                    "username": user.get("username"),
+                    "first_name": user.get("first_name"),
+                    "last_name": user.get("last_name")
+                })
+            if len(results) >= limit:
+                break
+        return list(results.values())[:limit]
+    except Exception as e:
+        logger.error(f"Error searching users: {e}")
+        return []
+
+async def get_admin_users_page(after_id=None, before_id=None, limit=10):
+    """
+    Get a page of users for the admin list in one aggregation.
+    
+    Pages are keyset-based on _id (see the SQL backend); the latest active
+    subscription and live keys of each user are joined with let-based $lookup
+    subqueries, which MongoDB 4.2 supports.
+    
+    Returns:
+        tuple: (list of dicts with user fields, plan_id and expires_at of the
+        latest active subscription and key_ids of live keys, whether there are
+        more users in the paging direction)
+    """
+    if db is None:
+        await init_database()
+    
+    try:
+        now = datetime.now()
+        if before_id is not None:
+            match, order = {"_id": {"$lt": ObjectId(before_id)}}, DESCENDING
+        else:
+            match, order = ({"_id": {"$gt": ObjectId(after_id)}} if after_id else {}), ASCENDING
+        
+        rows = await db.users.aggregate([
+            {"$match": match},
+            {"$sort": {"_id": order}},
+            # Лишний документ показывает, есть ли следующая страница
+            {"$limit": limit + 1},
+            {"$project": {"telegram_id": 1, "username": 1, "first_name": 1, "uid": {"$toString": "$_id"}}},
+            {"$lookup": {
+                "from": "subscriptions",
+                "let": {"uid": "$uid"},
+                "pipeline": [
+                    {"$match": {
+                        "$expr": {"$eq": ["$user_id", "$$uid"]},
+                        "status": "active",
+                        "$or": [{"expires_at": {"$gt": now}}, {"expires_at": None}]
+                    }},
+                    {"$sort": {"expires_at": -1}},
+                    {"$limit": 1},
+                    {"$project": {"_id": 0, "plan_id": 1, "expires_at": 1}}
+                ],
+                "as": "subscription"
+            }},
+            {"$lookup": {
+                "from": "access_keys",
+                "let": {"uid": "$uid"},
+                "pipeline": [
+                    {"$match": {
+                        "$expr": {"$eq": ["$user_id", "$$uid"]},
+                        "deleted": {"$ne": True}
+                    }},
+                    {"$project": {"_id": 0, "key_id": 1}}
+                ],
+                "as": "keys"
+            }},
+            {"$sort": {"_id": ASCENDING}}
+        ]).to_list(length=None)
+        
+        users = []
+        for row in rows:
+            subscription = row["subscription"][0] if row["subscription"] else {}
+            users.append({
+                "id": row["uid"],
+                "telegram_id": row.get("telegram_id"),
+                "username": row.get("username"),
+                "first_name": row.get("first_name"),
+                "plan_id": subscription.get("plan_id"),
+                "expires_at": subscription.get("expires_at"),
+                "key_ids": [key["key_id"] for key in row["keys"]]
+            })
+        
+        has_more = len(users) > limit
+        if has_more:
+            users = users[1:] if before_id is not None else users[:limit]
+        return users, has_more
+    except Exception as e:
+        logger.error(f"Error getting admin users page: {e}")
+        return [], False
+
+async def get_user_stats():
+    """
+    Count users, active subscriptions and live access keys in one aggregation.
+    
+    $facet counts the users and, from a single seed user document, runs
+    uncorrelated $lookup subpipelines that count subscriptions and keys
+    after their own $match (MongoDB 4.2 has no $unionWith).
+    
+    Returns:
+        dict: users_count, active_subscriptions_count, active_keys_count (None on error)
+    """
+    if db is None:
+        await init_database()
+    
+    try:
+        now = datetime.now()
+        documents = await db.users.aggregate([
+            {"$facet": {
+                "users": [{"$count": "count"}],
+                "others": [
+                    {"$limit": 1},
+                    {"$lookup": {"from": "subscriptions", "pipeline": [
+                        {"$match": {"status": "active", "expires_at": {"$gt": now}}},
+                        {"$count": "count"}
+                    ], "as": "subscriptions"}},
+                    {"$lookup": {"from": "access_keys", "pipeline": [
+                        {"$match": {"deleted": {"$ne": True}}},
+                        {"$count": "count"}
+                    ], "as": "keys"}},
+                    {"$project": {"_id": 0, "subscriptions": 1, "keys": 1}}
+                ]
+            }}
+        ]).to_list(length=1)
+        
+        # $count ничего не возвращает для пустой выборки, счетчик остается нулем;
+        # без пользователей нет и затравки, но без них нет и подписок с ключами
+        def count(counts):
+            return counts[0]["count"] if counts else 0
+        
+        facets = documents[0]
+        others = facets["others"][0] if facets["others"] else {}
+        return {
+            "users_count": count(facets["users"]),
+            "active_subscriptions_count": count(others.get("subscriptions")),
+            "active_keys_count": count(others.get("keys"))
+        }
+    except Exception as e:
+        logger.error(f"Error getting user stats: {e}")
+        return None
+
 # Subscription operations
 async def create_subscription(subscription_data):
     """Create a new subscription in the database"""
-    if not db:
+    if db is None:
         await init_database()
     
+    if not subscription_data.get("subscription_id"):
+        subscription_data["subscription_id"] = str(uuid.uuid4())
+    subscription_data = {"status": "active", "created_at": datetime.now(), "price_paid": 0.0, **subscription_data}
+    
     try:
-        result = db.subscriptions.insert_one(subscription_data)
+        # Как и в SQL, новая активная подписка закрывает предыдущие
+        if subscription_data.get("status", "active") == "active":
+            await db.subscriptions.update_many(
+                {"user_id": subscription_data["user_id"], "status": "active"},
+                {"$set": {"status": "inactive"}}
+            )
+        
+        result = await db.subscriptions.insert_one(subscription_data)
         subscription_id = result.inserted_id
         
         # Add subscription ID to the data and return full object
         subscription_data["_id"] = subscription_id
-        return subscription_data
+        subscription = SubscriptionRow.from_document(subscription_data)
+        if subscription.status == "active":
+            _expiry_changed(subscription.id, subscription.expires_at)
+        return subscription
     except Exception as e:
         logger.error(f"Error creating subscription: {e}")
-        # For mock testing
-        subscription_data["_id"] = ObjectId()
-        return subscription_data
+        return None
 
 async def get_subscription(subscription_id):
     """Get subscription by ID"""
-    if not db:
+    if db is None:
         await init_database()
     
     try:
-        return db.subscriptions.find_one({"_id": ObjectId(subscription_id)})
+        return SubscriptionRow.from_document(
+            await db.subscriptions.find_one({"subscription_id": subscription_id}, SubscriptionRow.projection())
+        )
     except Exception as e:
         logger.error(f"Error getting subscription: {e}")
-        # For mock testing
-        for subscription in mock_db["subscriptions"]:
-            if str(subscription.get("_id")) == str(subscription_id):
-                return subscription
         return None
 
 async def update_subscription(subscription_id, update_data):
     """Update subscription data"""
-    if not db:
+    if db is None:
         await init_database()
     
     try:
-        result = db.subscriptions.update_one(
-            {"_id": ObjectId(subscription_id)},
-            {"$set": update_data}
+        subscription = await db.subscriptions.find_one_and_update(
+            {"subscription_id": subscription_id},
+            {"$set": update_data},
+            projection={"status": 1, "expires_at": 1},
+            return_document=ReturnDocument.AFTER
         )
-        return result.modified_count > 0
+        if subscription is None:
+            return False
+        if "expires_at" in update_data and subscription.get("status") == "active":
+            _expiry_changed(str(subscription["_id"]), subscription["expires_at"])
+        return True
     except Exception as e:
         logger.error(f"Error updating subscription: {e}")
-        # For mock testing
-        for subscription in mock_db["subscriptions"]:
-            if str(subscription.get("_id")) == str(subscription_id):
-                subscription.update(update_data)
-                return True
+        return False
+
+async def transition_subscription(subscription_id, to_status, update_data=None):
+    """Atomically move a subscription to `to_status` if its current status allows it"""
+    if db is None:
+        await init_database()
+    
+    expected = list(sources_for(SUBSCRIPTION_TRANSITIONS, to_status))
+    values = dict(update_data or {})
+    values["status"] = to_status
+    
+    try:
+        # Условное обновление: документ меняется, только если статус всё ещё ожидаемый
+        subscription = await db.subscriptions.find_one_and_update(
+            {"subscription_id": subscription_id, "status": {"$in": expected}},
+            {"$set": values},
+            projection={"expires_at": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if subscription is None:
+            return False
+        if to_status == "active":
+            _expiry_changed(str(subscription["_id"]), subscription.get("expires_at"))
+        return True
+    except Exception as e:
+        logger.error(f"Error changing subscription status: {e}")
         return False
 
 async def get_user_subscriptions(user_id, status=None):
     """Get all subscriptions for a user, optionally filtered by status"""
-    if not db:
+    if db is None:
         await init_database()
     
     try:
@@ -198,201 +593,603 @@ async def get_user_subscriptions(user_id, status=None):
         if status:
             query["status"] = status
         
-        return list(db.subscriptions.find(query).sort("created_at", -1))
+        cursor = db.subscriptions.find(query, SubscriptionRow.projection()).sort("created_at", DESCENDING)
+        return await _read(cursor, SubscriptionRow)
     except Exception as e:
         logger.error(f"Error getting user subscriptions: {e}")
-        # For mock testing
-        return [s for s in mock_db["subscriptions"] 
-                if s.get("user_id") == user_id and 
-                (status is None or s.get("status") == status)]
+        return []
 
 async def get_active_subscription(user_id):
     """Get user's active subscription"""
-    if not db:
+    if db is None:
         await init_database()
     
     try:
         current_time = datetime.now()
         
         # Find active subscription that hasn't expired
-        subscription = db.subscriptions.find_one({
+        subscription = await db.subscriptions.find_one({
             "user_id": user_id,
             "status": "active",
             "expires_at": {"$gt": current_time}
-        }, sort=[("expires_at", -1)])
+        }, SubscriptionRow.projection(), sort=[("expires_at", DESCENDING)])
         
-        return subscription
+        return SubscriptionRow.from_document(subscription)
     except Exception as e:
         logger.error(f"Error getting active subscription: {e}")
-        # For mock testing
-        current_time = datetime.now()
-        active_subs = [s for s in mock_db["subscriptions"] 
-                if s.get("user_id") == user_id and 
-                s.get("status") == "active" and
-                s.get("expires_at", current_time) > current_time]
-        return active_subs[0] if active_subs else None
+        return None
 
 async def get_expiring_subscriptions(days=1):
     """Get subscriptions expiring in the specified number of days"""
-    if not db:
+    if db is None:
         await init_database()
     
     try:
         now = datetime.now()
-        expiry_start = now + timedelta(days=days)
-        expiry_end = now + timedelta(days=days+1)
+        target_date = now + timedelta(days=days)
         
         # Find active subscriptions with expiry in the target range
-        return list(db.subscriptions.find({
+        cursor = db.subscriptions.find({
             "status": "active",
             "expires_at": {
-                "$gte": expiry_start,
-                "$lt": expiry_end
+                "$gte": now,
+                "$lte": target_date
             }
-        }))
+        }, SubscriptionRow.projection())
+        return await _read(cursor, SubscriptionRow)
     except Exception as e:
         logger.error(f"Error getting expiring subscriptions: {e}")
-        # For mock testing
-        now = datetime.now()
-        expiry_start = now + timedelta(days=days)
-        expiry_end = now + timedelta(days=days+1)
+        return []
+
+# Получатель: telegram_id владельца (user_id подписки и ключа хранит str(_id) пользователя).
+# Подзапрос через let работает и на серверах старше 5.0
+_OWNER_LOOKUP = [
+    {"$lookup": {
+        "from": "users",
+        "let": {"user_id": {"$toObjectId": "$user_id"}},
+        "pipeline": [
+            {"$match": {"$expr": {"$eq": ["$_id", "$$user_id"]}}},
+            {"$project": {"_id": 0, "telegram_id": 1}}
+        ],
+        "as": "owner"
+    }},
+    {"$unwind": "$owner"}
+]
+
+def _expiry_notice_dict(document, *fields):
+    row = {
+        "id": str(document["_id"]),
+        "expires_at": document.get("expires_at"),
+        "plan_id": document.get("plan_id"),
+        "telegram_id": document["owner"]["telegram_id"]
+    }
+    row.update({field: document.get(field) for field in fields})
+    return row
+
+async def get_expiry_notice_page(days, window_start, window_end, after=None, limit=200):
+    """
+    Get active subscriptions expiring in (window_start, window_end] that were
+    not yet notified for this window or a later one.
+    
+    Pages are keyset-based on (expires_at, _id): pass the last row as `after`.
+    
+    Returns:
+        list: Dicts with id, expires_at, plan_id, telegram_id
+    """
+    if db is None:
+        await init_database()
+    
+    try:
+        match = {
+            "status": "active",
+            "expires_at": {"$gt": window_start, "$lte": window_end},
+            # Уведомление о текущем сроке в этом или более позднем окне уже отправлено
+            "$or": [
+                {"expiry_notice_for": None},
+                {"$expr": {"$ne": ["$expiry_notice_for", "$expires_at"]}},
+                {"expiry_notice_days": {"$gt": days}}
+            ]
+        }
+        if after is not None:
+            match = {"$and": [match, {"$or": [
+                {"expires_at": {"$gt": after["expires_at"]}},
+                {"expires_at": after["expires_at"], "_id": {"$gt": ObjectId(after["id"])}}
+            ]}]}
         
-        return [s for s in mock_db["subscriptions"] 
-                if s.get("status") == "active" and 
-                s.get("expires_at", now) >= expiry_start and
-                s.get("expires_at", now) < expiry_end]
+        documents = await db.subscriptions.aggregate([
+            {"$match": match},
+            {"$sort": {"expires_at": ASCENDING, "_id": ASCENDING}},
+            *_OWNER_LOOKUP,
+            {"$limit": limit}
+        ]).to_list(length=limit)
+        return [_expiry_notice_dict(document) for document in documents]
+    except Exception as e:
+        logger.error(f"Error getting expiry notice page: {e}")
+        return []
+
+async def record_expiry_notices(days, subscriptions, notifications):
+    """
+    Mark subscriptions as notified for the `days` window and add the
+    notifications to the outbox.
+    
+    Without a transaction the notifications are stored first: a failure in
+    between repeats a notice rather than losing it.
+    """
+    if db is None:
+        await init_database()
+    
+    try:
+        now = datetime.now()
+        if notifications:
+            await db.notifications.insert_many([
+                _notification_document(notification, now) for notification in notifications
+            ])
+        if subscriptions:
+            await db.subscriptions.bulk_write([
+                UpdateOne(
+                    {"_id": ObjectId(subscription["id"])},
+                    {"$set": {
+                        "expiry_notice_days": days,
+                        "expiry_notice_for": subscription["expires_at"]
+                    }}
+                )
+                for subscription in subscriptions
+            ], ordered=False)
+        return True
+    except Exception as e:
+        logger.error(f"Error recording expiry notices: {e}")
+        return False
+
+async def get_subscription_expiries(after, until):
+    """Get (id, expires_at) of active subscriptions expiring in (after, until]"""
+    if db is None:
+        await init_database()
+    
+    try:
+        cursor = db.subscriptions.find(
+            {"status": "active", "expires_at": {"$gt": after, "$lte": until}},
+            {"expires_at": 1}
+        )
+        return [(str(document["_id"]), document["expires_at"]) for document in await _read(cursor)]
+    except Exception as e:
+        logger.error(f"Error getting subscription expiries: {e}")
+        return []
+
+async def get_expiry_notice_rows(subscription_ids):
+    """
+    Get active subscriptions by database ID with their recipient and notice marker.
+    
+    Returns:
+        list: Dicts with id, expires_at, plan_id, telegram_id, expiry_notice_days, expiry_notice_for
+    """
+    if not subscription_ids:
+        return []
+    if db is None:
+        await init_database()
+    
+    try:
+        documents = await db.subscriptions.aggregate([
+            {"$match": {
+                "_id": {"$in": [ObjectId(subscription_id) for subscription_id in subscription_ids]},
+                "status": "active"
+            }},
+            *_OWNER_LOOKUP
+        ]).to_list(length=len(subscription_ids))
+        return [
+            _expiry_notice_dict(document, "expiry_notice_days", "expiry_notice_for")
+            for document in documents
+        ]
+    except Exception as e:
+        logger.error(f"Error getting expiry notice rows: {e}")
+        return []
+
+async def get_expired_active_subscriptions(now, after_id=0, limit=200):
+    """Get a page of (id, expires_at) of subscriptions still active after expiring, ordered by _id"""
+    if db is None:
+        await init_database()
+    
+    try:
+        cursor = db.subscriptions.find(
+            {"status": "active", "expires_at": {"$lte": now}, **_after_id("_id", after_id)},
+            {"expires_at": 1}
+        ).sort("_id", ASCENDING).limit(limit)
+        return [(str(document["_id"]), document["expires_at"]) for document in await _read(cursor)]
+    except Exception as e:
+        logger.error(f"Error getting expired subscriptions: {e}")
+        return []
+
+async def expire_subscriptions(subscription_ids, now):
+    """
+    Переводит истекшие активные подписки в inactive.
+    
+    Returns:
+        tuple: (ID переведенных подписок, key_id их неудаленных ключей)
+    """
+    if db is None:
+        await init_database()
+    
+    try:
+        condition = {
+            "_id": {"$in": [ObjectId(subscription_id) for subscription_id in subscription_ids]},
+            "status": {"$in": list(sources_for(SUBSCRIPTION_TRANSITIONS, "inactive"))},
+            "expires_at": {"$lte": now}
+        }
+        expired = [document["_id"] for document in await _read(db.subscriptions.find(condition, {"_id": 1}))]
+        if not expired:
+            return [], []
+        await db.subscriptions.update_many(
+            {**condition, "_id": {"$in": expired}}, {"$set": {"status": "inactive"}}
+        )
+        expired = [str(subscription_id) for subscription_id in expired]
+        key_ids = [
+            document["key_id"] for document in await _read(db.access_keys.find(
+                {"subscription_id": {"$in": expired}, "deleted": {"$ne": True}}, {"key_id": 1}
+            ))
+        ]
+        return expired, key_ids
+    except Exception as e:
+        logger.error(f"Error expiring subscriptions: {e}")
+        return [], []
+
+async def mark_access_keys_deleted(key_ids):
+    """Mark many access keys as deleted"""
+    if db is None:
+        await init_database()
+    
+    try:
+        await db.access_keys.update_many({"key_id": {"$in": list(key_ids)}}, {"$set": {"deleted": True}})
+        return True
+    except Exception as e:
+        logger.error(f"Error marking access keys deleted: {e}")
+        return False
 
 # Access key operations
 async def create_access_key(key_data):
     """Create a new access key in the database"""
-    if not db:
+    if db is None:
         await init_database()
     
     try:
-        result = db.access_keys.insert_one(key_data)
+        key_data = {"deleted": False, "created_at": datetime.now(), **key_data}
+        result = await db.access_keys.insert_one(key_data)
         key_data["_id"] = result.inserted_id
-        return key_data
+        return KeyRow.from_document(key_data)
     except Exception as e:
         logger.error(f"Error creating access key: {e}")
-        # For mock testing
-        key_data["_id"] = ObjectId()
-        mock_db["access_keys"].append(key_data)
-        return key_data
+        return None
 
 async def get_access_key(key_id):
     """Get access key by Outline key ID"""
-    if not db:
+    if db is None:
         await init_database()
     
     try:
-        return db.access_keys.find_one({"key_id": key_id})
+        return KeyRow.from_document(await db.access_keys.find_one({"key_id": key_id}, KeyRow.projection()))
     except Exception as e:
         logger.error(f"Error getting access key: {e}")
-        # For mock testing
-        for key in mock_db["access_keys"]:
-            if key.get("key_id") == key_id:
-                return key
         return None
 
 async def update_access_key(key_id, update_data):
     """Update access key data"""
-    if not db:
+    if db is None:
         await init_database()
     
     try:
-        result = db.access_keys.update_one(
+        result = await db.access_keys.update_one(
             {"key_id": key_id},
             {"$set": update_data}
         )
-        return result.modified_count > 0
+        return result.matched_count > 0
     except Exception as e:
         logger.error(f"Error updating access key: {e}")
-        # For mock testing
-        for key in mock_db["access_keys"]:
-            if key.get("key_id") == key_id:
-                key.update(update_data)
-                return True
         return False
 
 async def get_user_access_keys(user_id):
     """Get all access keys for a user"""
-    if not db:
+    if db is None:
         await init_database()
     
     try:
-        return list(db.access_keys.find({"user_id": user_id}))
+        cursor = db.access_keys.find({"user_id": user_id, "deleted": {"$ne": True}}, KeyRow.projection())
+        return await _read(cursor, KeyRow)
     except Exception as e:
         logger.error(f"Error getting user access keys: {e}")
-        # For mock testing
-        return [k for k in mock_db["access_keys"] if k.get("user_id") == user_id]
+        return []
+
+async def deactivate_user_access_keys(user_id):
+    """Деактивировать все ключи доступа пользователя"""
+    if db is None:
+        await init_database()
+    
+    try:
+        await db.access_keys.update_many(
+            {"user_id": user_id, "deleted": {"$ne": True}},
+            {"$set": {"deleted": True}}
+        )
+        return True
+    except Exception as e:
+        logger.error(f"Error deactivating access keys: {e}")
+        return False
+
+async def get_user_context(telegram_id):
+    """
+    Get a user together with their active subscription and active keys in one query.
+    
+    Returns:
+        tuple: (user or None, active subscription or None, list of active keys)
+    """
+    if db is None:
+        await init_database()
+    
+    try:
+        current_time = datetime.now()
+        users = await db.users.aggregate([
+            {"$match": {"telegram_id": telegram_id}},
+            {"$limit": 1},
+            {"$project": UserRow.projection()},
+            {"$lookup": {
+                "from": "subscriptions",
+                "let": {"uid": {"$toString": "$_id"}},
+                "pipeline": [
+                    {"$match": {
+                        "$expr": {"$eq": ["$user_id", "$$uid"]},
+                        "status": "active",
+                        "$or": [{"expires_at": {"$gt": current_time}}, {"expires_at": None}]
+                    }},
+                    {"$sort": {"expires_at": -1}},
+                    {"$limit": 1},
+                    {"$project": SubscriptionRow.projection()}
+                ],
+                "as": "active_subscription"
+            }},
+            {"$lookup": {
+                "from": "access_keys",
+                "let": {"uid": {"$toString": "$_id"}},
+                "pipeline": [
+                    {"$match": {
+                        "$expr": {"$eq": ["$user_id", "$$uid"]},
+                        "deleted": {"$ne": True}
+                    }},
+                    {"$project": KeyRow.projection()}
+                ],
+                "as": "active_keys"
+            }}
+        ]).to_list(length=1)
+        if not users:
+            return None, None, []
+        
+        user = users[0]
+        subscriptions = user.pop("active_subscription")
+        keys = user.pop("active_keys")
+        return (
+            UserRow.from_document(user),
+            SubscriptionRow.from_document(subscriptions[0]) if subscriptions else None,
+            [KeyRow.from_document(key) for key in keys]
+        )
+    except Exception as e:
+        logger.error(f"Error getting user context: {e}")
+        return None, None, []
+
+async def count_user_active_keys(user_id):
+    """Count non-deleted access keys of a user"""
+    if db is None:
+        await init_database()
+    
+    try:
+        return await db.access_keys.count_documents({"user_id": user_id, "deleted": {"$ne": True}})
+    except Exception as e:
+        logger.error(f"Error counting user access keys: {e}")
+        return 0
 
 async def get_subscription_access_keys(subscription_id):
     """Get all access keys for a subscription"""
-    if not db:
+    if db is None:
         await init_database()
     
     try:
-        return list(db.access_keys.find({"subscription_id": subscription_id}))
+        cursor = db.access_keys.find(
+            {"subscription_id": subscription_id, "deleted": {"$ne": True}}, KeyRow.projection()
+        )
+        return await _read(cursor, KeyRow)
     except Exception as e:
         logger.error(f"Error getting subscription access keys: {e}")
-        # For mock testing
-        return [k for k in mock_db["access_keys"] if k.get("subscription_id") == subscription_id]
+        return []
+
+async def get_sync_candidate_keys(known_key_ids):
+    """
+    Get live access keys of existing users whose key_id is not in `known_key_ids`.
+    
+    Returns:
+        list: Keys ordered by _id
+    """
+    if db is None:
+        await init_database()
+    
+    try:
+        cursor = db.access_keys.aggregate([
+            {"$match": {"deleted": {"$ne": True}, "key_id": {"$nin": list(known_key_ids)}}},
+            {"$sort": {"_id": ASCENDING}},
+            {"$addFields": {
+                "uid": {"$convert": {"input": "$user_id", "to": "objectId", "onError": None, "onNull": None}}
+            }},
+            {"$lookup": {
+                "from": "users",
+                "let": {"uid": "$uid"},
+                "pipeline": [
+                    {"$match": {"$expr": {"$eq": ["$_id", "$$uid"]}}},
+                    {"$project": {"_id": 1}}
+                ],
+                "as": "user"
+            }},
+            # Ключи удаленных пользователей не сверяются
+            {"$match": {"user": {"$ne": []}}},
+            {"$project": KeyRow.projection()}
+        ])
+        return await _read(cursor, KeyRow)
+    except Exception as e:
+        logger.error(f"Error getting sync candidate keys: {e}")
+        return []
 
 # Payment operations
 async def create_payment(payment_data):
     """Create a new payment record in the database"""
-    if not db:
+    if db is None:
         await init_database()
     
     try:
-        result = db.payments.insert_one(payment_data)
+        if not payment_data.get("payment_id"):
+            payment_data["payment_id"] = str(uuid.uuid4())
+        payment_data = {"currency": "RUB", "status": "pending", "created_at": datetime.now(), **payment_data}
+        result = await db.payments.insert_one(payment_data)
         payment_data["_id"] = result.inserted_id
-        return payment_data
+        return PaymentRow.from_document(payment_data)
     except Exception as e:
         logger.error(f"Error creating payment: {e}")
-        # For mock testing
-        payment_data["_id"] = ObjectId()
-        mock_db["payments"].append(payment_data)
-        return payment_data
+        return None
 
 async def get_payment(payment_id):
     """Get payment by payment ID"""
-    if not db:
+    if db is None:
         await init_database()
     
     try:
-        return db.payments.find_one({"payment_id": payment_id})
+        return PaymentRow.from_document(await db.payments.find_one({"payment_id": payment_id}, PaymentRow.projection()))
     except Exception as e:
         logger.error(f"Error getting payment: {e}")
-        # For mock testing
-        for payment in mock_db["payments"]:
-            if payment.get("payment_id") == payment_id:
-                return payment
         return None
 
 async def update_payment(payment_id, update_data):
     """Update payment data"""
-    if not db:
+    if db is None:
         await init_database()
     
     try:
-        result = db.payments.update_one(
+        result = await db.payments.update_one(
             {"payment_id": payment_id},
             {"$set": update_data}
         )
-        return result.modified_count > 0
+        return result.matched_count > 0
     except Exception as e:
         logger.error(f"Error updating payment: {e}")
-        # For mock testing
-        for payment in mock_db["payments"]:
-            if payment.get("payment_id") == payment_id:
-                payment.update(update_data)
-                return True
         return False
 
+async def transition_payment(payment_id, to_status, update_data=None):
+    """Atomically move a payment to `to_status` if its current status allows it"""
+    if db is None:
+        await init_database()
+    
+    expected = list(sources_for(PAYMENT_TRANSITIONS, to_status))
+    values = dict(update_data or {})
+    values["status"] = to_status
+    
+    try:
+        result = await db.payments.update_one(
+            {"payment_id": payment_id, "status": {"$in": expected}},
+            {"$set": values}
+        )
+        return result.modified_count == 1
+    except Exception as e:
+        logger.error(f"Error changing payment status: {e}")
+        return False
+
+async def complete_payment(payment_id, payment_values, subscription_values, notification=None):
+    """
+    Проводит оплаченный платеж: активирует его подписку, ставит уведомление
+    в outbox и переводит платеж в succeeded.
+    
+    Без транзакции платеж захватывается последним: пока он не succeeded,
+    сверка зависших платежей повторит проведение. Подписка помечается
+    платежом, который её активировал, поэтому повтор не активирует её дважды.
+    
+    Returns:
+        bool: True, если подписку активировал этот вызов; False, если платеж
+        нельзя провести или всё уже сделано; None при ошибке
+    """
+    if db is None:
+        await init_database()
+    
+    payment_sources = list(sources_for(PAYMENT_TRANSITIONS, "succeeded"))
+    try:
+        payment = await db.payments.find_one({"payment_id": payment_id}, {"status": 1, "subscription_id": 1})
+        if payment is None or payment["status"] not in payment_sources + ["succeeded"]:
+            return False
+        
+        subscription = await db.subscriptions.find_one_and_update(
+            {
+                "subscription_id": payment["subscription_id"],
+                "status": {"$in": list(sources_for(SUBSCRIPTION_TRANSITIONS, "active"))}
+            },
+            {"$set": {**subscription_values, "status": "active", "activated_by_payment": payment_id}},
+            projection={"expires_at": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if subscription is not None and notification:
+            await db.notifications.insert_one(_notification_document(notification, datetime.now()))
+        
+        await db.payments.update_one(
+            {"payment_id": payment_id, "status": {"$in": payment_sources}},
+            {"$set": {**payment_values, "status": "succeeded"}}
+        )
+        if subscription is None:
+            return False
+        logger.info(f"Payment {payment_id} completed, subscription {payment['subscription_id']} activated")
+        _expiry_changed(str(subscription["_id"]), subscription.get("expires_at"))
+        return True
+    except Exception as e:
+        logger.error(f"Error completing payment: {e}")
+        return None
+
+async def get_stale_pending_payments(created_before, after=None, limit=100):
+    """Get a page of unsettled payments (pending, waiting_for_capture, expired)
+    created before `created_before`.
+    
+    Pages are keyset-paginated by (created_at, _id), `after` is the
+    (created_at, _id) of the last payment of the previous page. The
+    (status, created_at, _id) index serves each status in order and the
+    server merges them.
+    """
+    if db is None:
+        await init_database()
+    
+    try:
+        query = {
+            "status": {"$in": list(sources_for(PAYMENT_TRANSITIONS, "succeeded"))},
+            "created_at": {"$lt": created_before}
+        }
+        if after:
+            last_created_at, last_id = after
+            query["$or"] = [
+                {"created_at": {"$gt": last_created_at}},
+                {"created_at": last_created_at, "_id": {"$gt": ObjectId(last_id)}}
+            ]
+        
+        cursor = db.payments.find(query, PaymentRow.projection()).sort(
+            [("created_at", ASCENDING), ("_id", ASCENDING)]
+        ).limit(limit)
+        return await _read(cursor, PaymentRow)
+    except Exception as e:
+        logger.error(f"Error getting stale pending payments: {e}")
+        return []
+
+async def get_oldest_pending_payment_time():
+    """Get creation time of the oldest unsettled payment (None if there are none)"""
+    if db is None:
+        await init_database()
+    
+    try:
+        payment = await db.payments.find_one(
+            {"status": {"$in": list(sources_for(PAYMENT_TRANSITIONS, "succeeded"))}},
+            {"created_at": 1},
+            sort=[("created_at", ASCENDING)]
+        )
+        return payment.get("created_at") if payment else None
+    except Exception as e:
+        logger.error(f"Error getting oldest pending payment: {e}")
+        return None
+
 async def get_user_payments(user_id, status=None):
     """Get all payments for a user, optionally filtered by status"""
-    if not db:
+    if db is None:
         await init_database()
     
     try:
@@ -400,10 +1197,676 @@ async def get_user_payments(user_id, status=None):
         if status:
             query["status"] = status
         
-        return list(db.payments.find(query).sort("created_at", -1))
+        cursor = db.payments.find(query, PaymentRow.projection()).sort("created_at", DESCENDING)
+        return await _read(cursor, PaymentRow)
     except Exception as e:
         logger.error(f"Error getting user payments: {e}")
-        # For mock testing
-        return [p for p in mock_db["payments"] 
-                if p.get("user_id") == user_id and 
-                (status is None or p.get("status") == status)]
+        return []
+
+# Webhook event deduplication
+async def is_event_processed(event_id):
+    """Check whether a webhook event has already been processed"""
+    if db is None:
+        await init_database()
+    
+    try:
+        return await db.processed_events.find_one({"event_id": event_id}, {"_id": 1}) is not None
+    except Exception as e:
+        logger.error(f"Error checking processed event: {e}")
+        return False
+
+async def mark_event_processed(event_id, event_type=None):
+    """Record a processed webhook event, returns False if it was already recorded"""
+    if db is None:
+        await init_database()
+    
+    try:
+        await db.processed_events.insert_one({
+            "event_id": event_id,
+            "event_type": event_type,
+            "created_at": datetime.now()
+        })
+        return True
+    except DuplicateKeyError:
+        logger.info(f"Event {event_id} already recorded")
+        return False
+    except Exception as e:
+        logger.error(f"Error recording processed event: {e}")
+        return False
+
+# Notifications outbox
+def _notification_document(notification_data, now):
+    return {
+        "chat_id": notification_data["chat_id"],
+        "text": notification_data["text"],
+        "parse_mode": notification_data.get("parse_mode"),
+        "reply_markup": notification_data.get("reply_markup"),
+        "status": "pending",
+        "attempts": 0,
+        "created_at": now,
+        "next_attempt_at": notification_data.get("next_attempt_at", now)
+    }
+
+async def enqueue_notification(notification_data):
+    """Add a notification to the outbox, returns its ID"""
+    if db is None:
+        await init_database()
+    
+    try:
+        result = await db.notifications.insert_one(_notification_document(notification_data, datetime.now()))
+        return str(result.inserted_id)
+    except Exception as e:
+        logger.error(f"Error enqueuing notification: {e}")
+        return None
+
+async def claim_due_notifications(limit=50, lease_seconds=60):
+    """Claim a batch of due notifications for sending (see the SQL backend)"""
+    if db is None:
+        await init_database()
+    
+    try:
+        now = datetime.now()
+        lease_id = uuid.uuid4().hex
+        due = {"status": "pending", "next_attempt_at": {"$lte": now}}
+        
+        cursor = db.notifications.find(due, {"_id": 1}).sort(
+            [("next_attempt_at", ASCENDING), ("_id", ASCENDING)]
+        ).limit(limit)
+        ids = [doc["_id"] async for doc in cursor]
+        if not ids:
+            return []
+        
+        await db.notifications.update_many(
+            {"_id": {"$in": ids}, **due},
+            {"$set": {"lease_id": lease_id, "next_attempt_at": now + timedelta(seconds=lease_seconds)}}
+        )
+        return await _read(
+            db.notifications.find({"lease_id": lease_id}, NotificationRow.projection()).sort("_id", ASCENDING),
+            NotificationRow
+        )
+    except Exception as e:
+        logger.error(f"Error claiming notifications: {e}")
+        return []
+
+async def mark_notifications_sent(notification_ids):
+    """Mark a batch of notifications as sent"""
+    if not notification_ids:
+        return True
+    if db is None:
+        await init_database()
+    
+    try:
+        await db.notifications.update_many(
+            {"_id": {"$in": [ObjectId(notification_id) for notification_id in notification_ids]}},
+            {"$set": {"status": "sent", "sent_at": datetime.now()}}
+        )
+        return True
+    except Exception as e:
+        logger.error(f"Error marking notifications as sent: {e}")
+        return False
+
+async def reschedule_notification(notification_id, next_attempt_at, failed=False, count_attempt=False):
+    """Schedule another delivery attempt, or give up if `failed` is set.
+    
+    `count_attempt` adds a failed delivery to attempts; a postponement
+    (flood control) does not use one up.
+    """
+    if db is None:
+        await init_database()
+    
+    try:
+        update_data = {"next_attempt_at": next_attempt_at}
+        if failed:
+            update_data["status"] = "failed"
+        update = {"$set": update_data}
+        if count_attempt:
+            update["$inc"] = {"attempts": 1}
+        await db.notifications.update_one({"_id": ObjectId(notification_id)}, update)
+        return True
+    except Exception as e:
+        logger.error(f"Error rescheduling notification: {e}")
+        return False
+
+# Broadcast jobs
+async def create_broadcast_job(job_data):
+    """Create a broadcast job, returns its ID"""
+    if db is None:
+        await init_database()
+    
+    try:
+        result = await db.broadcast_jobs.insert_one({
+            "text": job_data["text"],
+            "parse_mode": job_data.get("parse_mode"),
+            "status": "running",
+            "created_by": job_data.get("created_by"),
+            "created_at": datetime.now(),
+            "cursor_user_id": None,
+            "total": job_data.get("total", 0),
+            "sent_count": 0,
+            "failed_count": 0,
+            "status_chat_id": job_data.get("status_chat_id"),
+            "status_message_id": job_data.get("status_message_id")
+        })
+        return str(result.inserted_id)
+    except Exception as e:
+        logger.error(f"Error creating broadcast job: {e}")
+        return None
+
+async def get_broadcast_job(job_id):
+    """Get broadcast job by ID"""
+    if db is None:
+        await init_database()
+    
+    try:
+        return BroadcastJobRow.from_document(
+            await db.broadcast_jobs.find_one({"_id": ObjectId(job_id)}, BroadcastJobRow.projection())
+        )
+    except Exception as e:
+        logger.error(f"Error getting broadcast job: {e}")
+        return None
+
+async def get_running_broadcast_jobs():
+    """Get all unfinished broadcast jobs"""
+    if db is None:
+        await init_database()
+    
+    try:
+        cursor = db.broadcast_jobs.find({"status": "running"}, BroadcastJobRow.projection()).sort("_id", ASCENDING)
+        return await _read(cursor, BroadcastJobRow)
+    except Exception as e:
+        logger.error(f"Error getting running broadcast jobs: {e}")
+        return []
+
+async def update_broadcast_job(job_id, update_data):
+    """Update broadcast job data"""
+    if db is None:
+        await init_database()
+    
+    try:
+        await db.broadcast_jobs.update_one({"_id": ObjectId(job_id)}, {"$set": update_data})
+        return True
+    except Exception as e:
+        logger.error(f"Error updating broadcast job: {e}")
+        return False
+
+async def get_broadcast_recipient_statuses(job_id, telegram_ids):
+    """Get {telegram_id: status} for recipients of a job already recorded"""
+    if not telegram_ids:
+        return {}
+    if db is None:
+        await init_database()
+    
+    try:
+        cursor = db.broadcast_recipients.find(
+            {"job_id": ObjectId(job_id), "telegram_id": {"$in": list(telegram_ids)}},
+            {"telegram_id": 1, "status": 1}
+        )
+        cursor.batch_size(MONGO_CURSOR_BATCH_SIZE)
+        return {doc["telegram_id"]: doc["status"] async for doc in cursor}
+    except Exception as e:
+        logger.error(f"Error getting broadcast recipients: {e}")
+        return {}
+
+async def record_broadcast_page(job_id, results, cursor_user_id):
+    """Record delivery results of one page and advance the job cursor"""
+    if db is None:
+        await init_database()
+    
+    try:
+        now = datetime.now()
+        if results:
+            await db.broadcast_recipients.insert_many([
+                {
+                    "job_id": ObjectId(job_id),
+                    "telegram_id": telegram_id,
+                    "status": status,
+                    "error": error,
+                    "updated_at": now
+                }
+                for telegram_id, status, error in results
+            ], ordered=False)
+        
+        sent = sum(1 for _, status, _ in results if status == "sent")
+        await db.broadcast_jobs.update_one(
+            {"_id": ObjectId(job_id)},
+            {
+                "$set": {"cursor_user_id": cursor_user_id},
+                "$inc": {"sent_count": sent, "failed_count": len(results) - sent}
+            }
+        )
+        return True
+    except Exception as e:
+        logger.error(f"Error recording broadcast page: {e}")
+        return False
+
+# Admin jobs (bulk operations)
+ADMIN_JOB_ID_CHUNK = 500  # telegram_id в одном $in при выборе целей
+
+async def _active_subscription_users(now, plan_id=None):
+    """_id of users having an active, not expired subscription"""
+    query = {
+        "status": "active",
+        "$or": [{"expires_at": {"$gt": now}}, {"expires_at": None}]
+    }
+    if plan_id is not None:
+        query["plan_id"] = plan_id
+    return [ObjectId(user_id) for user_id in await db.subscriptions.distinct("user_id", query)]
+
+async def create_admin_job(job_data, user_filter="all", telegram_ids=None):
+    """
+    Create a bulk admin job together with its target users, returns its ID.
+    
+    Targets are the users with the given telegram ids, or the users matching
+    `user_filter`: "all", "active", "inactive" or "plan:<plan_id>"
+    (active subscribers of the plan). They are copied on the server with $merge.
+    """
+    if db is None:
+        await init_database()
+    
+    now = datetime.now()
+    if telegram_ids is not None:
+        telegram_ids = sorted(set(telegram_ids))
+        selections = [
+            {"telegram_id": {"$in": telegram_ids[start:start + ADMIN_JOB_ID_CHUNK]}}
+            for start in range(0, len(telegram_ids), ADMIN_JOB_ID_CHUNK)
+        ]
+    elif user_filter == "all":
+        selections = [{}]
+    elif user_filter in ("active", "inactive") or user_filter.startswith("plan:"):
+        selections = None
+    else:
+        raise ValueError(f"Unknown user filter: {user_filter}")
+    
+    try:
+        if selections is None:
+            plan_id = user_filter[len("plan:"):] if user_filter.startswith("plan:") else None
+            user_ids = await _active_subscription_users(now, plan_id)
+            operator = "$nin" if user_filter == "inactive" else "$in"
+            selections = [{"_id": {operator: user_ids}}]
+        
+        result = await db.admin_jobs.insert_one({
+            "action": job_data["action"],
+            "params": job_data.get("params"),
+            "status": "running",
+            "created_by": job_data.get("created_by"),
+            "created_at": now,
+            "cursor_user_id": None,
+            "total": 0,
+            "done_count": 0,
+            "failed_count": 0,
+            "status_chat_id": job_data.get("status_chat_id"),
+            "status_message_id": job_data.get("status_message_id")
+        })
+        job_id = result.inserted_id
+        
+        for selection in selections:
+            await db.users.aggregate([
+                {"$match": selection},
+                {"$project": {"_id": 0, "job_id": {"$literal": job_id}, "user_id": "$_id", "telegram_id": 1}},
+                {"$merge": {
+                    "into": "admin_job_targets",
+                    "on": ["job_id", "user_id"],
+                    "whenMatched": "keepExisting",
+                    "whenNotMatched": "insert"
+                }}
+            ]).to_list(length=None)
+        
+        total = await db.admin_job_targets.count_documents({"job_id": job_id})
+        await db.admin_jobs.update_one({"_id": job_id}, {"$set": {"total": total}})
+        logger.info(f"Admin job {job_id} ({job_data['action']}) created for {total} users")
+        return str(job_id)
+    except Exception as e:
+        logger.error(f"Error creating admin job: {e}")
+        return None
+
+async def get_admin_job(job_id):
+    """Get admin job by ID"""
+    if db is None:
+        await init_database()
+    
+    try:
+        return AdminJobRow.from_document(
+            await db.admin_jobs.find_one({"_id": ObjectId(job_id)}, AdminJobRow.projection())
+        )
+    except Exception as e:
+        logger.error(f"Error getting admin job: {e}")
+        return None
+
+async def get_running_admin_jobs():
+    """Get all unfinished admin jobs"""
+    if db is None:
+        await init_database()
+    
+    try:
+        cursor = db.admin_jobs.find({"status": "running"}, AdminJobRow.projection()).sort("_id", ASCENDING)
+        return await _read(cursor, AdminJobRow)
+    except Exception as e:
+        logger.error(f"Error getting running admin jobs: {e}")
+        return []
+
+async def update_admin_job(job_id, update_data):
+    """Update admin job data"""
+    if db is None:
+        await init_database()
+    
+    try:
+        await db.admin_jobs.update_one({"_id": ObjectId(job_id)}, {"$set": update_data})
+        return True
+    except Exception as e:
+        logger.error(f"Error updating admin job: {e}")
+        return False
+
+async def get_admin_job_targets(job_id, after_user_id=0, limit=200):
+    """Get a page of (user _id, telegram_id) targets of a job ordered by user _id"""
+    if db is None:
+        await init_database()
+    
+    try:
+        cursor = db.admin_job_targets.find(
+            {"job_id": ObjectId(job_id), **_after_id("user_id", after_user_id)},
+            {"user_id": 1, "telegram_id": 1}
+        ).sort("user_id", ASCENDING).limit(limit)
+        return [(str(document["user_id"]), document["telegram_id"]) for document in await _read(cursor)]
+    except Exception as e:
+        logger.error(f"Error getting admin job targets: {e}")
+        return []
+
+async def _advance_admin_job(job_id, cursor_user_id, done, failed):
+    """Move the job cursor past a page and add its counters"""
+    await db.admin_jobs.update_one(
+        {"_id": ObjectId(job_id)},
+        {
+            "$set": {"cursor_user_id": cursor_user_id},
+            "$inc": {"done_count": done, "failed_count": failed}
+        }
+    )
+
+async def record_admin_job_page(job_id, cursor_user_id, done, failed):
+    """Advance the job cursor and counters after a page without other changes"""
+    if db is None:
+        await init_database()
+    
+    try:
+        await _advance_admin_job(job_id, cursor_user_id, done, failed)
+        return True
+    except Exception as e:
+        logger.error(f"Error recording admin job page: {e}")
+        return False
+
+async def get_users_live_keys(user_ids):
+    """
+    Get non-deleted access keys of many users in one query.
+    
+    Returns:
+        list: Dicts with user_id (str user _id), telegram_id, key_id, name, access_url
+    """
+    if not user_ids:
+        return []
+    if db is None:
+        await init_database()
+    
+    try:
+        documents = await db.access_keys.aggregate([
+            {"$match": {"user_id": {"$in": list(user_ids)}, "deleted": {"$ne": True}}},
+            {"$sort": {"user_id": ASCENDING, "_id": ASCENDING}},
+            *_OWNER_LOOKUP
+        ]).to_list(length=None)
+        return [
+            {
+                "user_id": document["user_id"],
+                "telegram_id": document["owner"]["telegram_id"],
+                "key_id": document["key_id"],
+                "name": document.get("name"),
+                "access_url": document.get("access_url")
+            }
+            for document in documents
+        ]
+    except Exception as e:
+        logger.error(f"Error getting users live keys: {e}")
+        return []
+
+async def extend_active_subscriptions(user_ids, days, job_id=None, cursor_user_id=None):
+    """
+    Продлевает активные подписки пользователей на `days` дней.
+    
+    Истекшие, но не закрытые подписки продлеваются от текущего момента,
+    бессрочные не меняются. Без транзакции подписка помечается ID задачи
+    вместе с продлением, поэтому после перезапуска она не продлевается повторно.
+    
+    Returns:
+        set: str(_id) пользователей, у которых есть активная подписка, или None при ошибке
+    """
+    if db is None:
+        await init_database()
+    
+    try:
+        now = datetime.now()
+        documents = await _read(db.subscriptions.find(
+            {"user_id": {"$in": list(user_ids)}, "status": "active"},
+            {"user_id": 1, "expires_at": 1}
+        ))
+        
+        changes = [
+            (document["_id"], max(document["expires_at"], now) + timedelta(days=days))
+            for document in documents
+            if document.get("expires_at") is not None
+        ]
+        applied = []
+        for subscription_id, expires_at in changes:
+            condition = {"_id": subscription_id}
+            update = {"$set": {"expires_at": expires_at}}
+            if job_id is not None:
+                condition["admin_jobs"] = {"$ne": job_id}
+                update["$addToSet"] = {"admin_jobs": job_id}
+            result = await db.subscriptions.update_one(condition, update)
+            if result.modified_count:
+                applied.append((str(subscription_id), expires_at))
+        
+        extended = {document["user_id"] for document in documents}
+        if job_id is not None:
+            await _advance_admin_job(job_id, cursor_user_id, len(extended), len(user_ids) - len(extended))
+        for subscription_id, expires_at in applied:
+            _expiry_changed(subscription_id, expires_at)
+        return extended
+    except Exception as e:
+        logger.error(f"Error extending subscriptions: {e}")
+        return None
+
+async def revoke_users_access(user_ids, deleted_key_ids, job_id=None, cursor_user_id=None, failed=0):
+    """
+    Закрывает доступ пользователей: помечает ключи удаленными,
+    переводит активные подписки в inactive и снимает is_premium.
+    
+    Каждый шаг можно повторить, поэтому после перезапуска страница
+    просто обрабатывается заново.
+    """
+    if db is None:
+        await init_database()
+    
+    try:
+        if deleted_key_ids:
+            await db.access_keys.update_many(
+                {"key_id": {"$in": list(deleted_key_ids)}}, {"$set": {"deleted": True}}
+            )
+        if user_ids:
+            await db.subscriptions.update_many(
+                {
+                    "user_id": {"$in": list(user_ids)},
+                    "status": {"$in": list(sources_for(SUBSCRIPTION_TRANSITIONS, "inactive"))}
+                },
+                {"$set": {"status": "inactive"}}
+            )
+            await db.users.update_many(
+                {"_id": {"$in": [ObjectId(user_id) for user_id in user_ids]}},
+                {"$set": {"is_premium": False}}
+            )
+        if job_id is not None:
+            await _advance_admin_job(job_id, cursor_user_id, len(user_ids), failed)
+        logger.info(f"Revoked access of {len(user_ids)} users, {len(deleted_key_ids)} keys deleted")
+        return True
+    except Exception as e:
+        logger.error(f"Error revoking users access: {e}")
+        return False
+
+async def replace_access_keys(replacements, notifications=(), job_id=None, cursor_user_id=None,
+                              done=0, failed=0):
+    """
+    Заменяет ключи на перенесенные и ставит уведомления в outbox.
+    
+    Args:
+        replacements: Список (старый key_id, новый key_id, новый access_url)
+        notifications: Уведомления в формате enqueue_notification
+        job_id: Задача, чей курсор и счетчики продвигаются после изменений
+    """
+    if db is None:
+        await init_database()
+    
+    try:
+        now = datetime.now()
+        if replacements:
+            await db.access_keys.bulk_write([
+                UpdateOne({"key_id": old_key_id}, {"$set": {"key_id": new_key_id, "access_url": access_url}})
+                for old_key_id, new_key_id, access_url in replacements
+            ], ordered=False)
+        if notifications:
+            await db.notifications.insert_many([
+                _notification_document(notification, now) for notification in notifications
+            ])
+        if job_id is not None:
+            await _advance_admin_job(job_id, cursor_user_id, done, failed)
+        return True
+    except Exception as e:
+        logger.error(f"Error replacing access keys: {e}")
+        return False
+
+# Plan catalog operations
+PLAN_FIELDS = ("name", "duration", "price", "devices", "discount", "description", "active")
+
+async def seed_plans(plans_config):
+    """Fill the plans collection from config if the catalog has never been stored"""
+    if db is None:
+        await init_database()
+    
+    try:
+        if await db.plan_catalog_version.find_one({"_id": 1}):
+            return False
+        
+        for plan_id, plan in plans_config.items():
+            document = {field: plan.get(field) for field in PLAN_FIELDS}
+            document["devices"] = plan.get("devices", 1)
+            document["active"] = True
+            document["updated_at"] = datetime.now()
+            await db.plans.update_one({"_id": plan_id}, {"$setOnInsert": document}, upsert=True)
+        await db.plan_catalog_version.insert_one({"_id": 1, "version": 1, "updated_at": datetime.now()})
+        logger.info(f"Plan catalog seeded with {len(plans_config)} plans")
+        return True
+    except DuplicateKeyError:
+        # Каталог уже заполнил другой процесс
+        return False
+    except Exception as e:
+        logger.error(f"Error seeding plans: {e}")
+        return False
+
+async def get_plan_catalog_version():
+    """Get the current plan catalog version (one-document lookup)"""
+    if db is None:
+        await init_database()
+    
+    try:
+        document = await db.plan_catalog_version.find_one({"_id": 1}, {"version": 1})
+        return document["version"] if document else None
+    except Exception as e:
+        logger.error(f"Error getting plan catalog version: {e}")
+        return None
+
+async def get_plan_catalog():
+    """
+    Get all plans with the catalog version they belong to.
+    
+    Returns:
+        tuple: (version, {plan_id: plan dict}) or (None, {}) on error
+    """
+    if db is None:
+        await init_database()
+    
+    try:
+        for _ in range(3):
+            version = await get_plan_catalog_version()
+            plans = {
+                plan["_id"]: {field: plan.get(field) for field in PLAN_FIELDS}
+                for plan in await _read(db.plans.find())
+            }
+            if await get_plan_catalog_version() == version:
+                return version, plans
+        logger.warning("Plan catalog kept changing while being read")
+        return None, {}
+    except Exception as e:
+        logger.error(f"Error getting plan catalog: {e}")
+        return None, {}
+
+async def update_plan(plan_id, update_data):
+    """
+    Update a plan and bump the catalog version.
+    
+    Returns:
+        int: New catalog version or None if the plan was not found or on error
+    """
+    if db is None:
+        await init_database()
+    
+    try:
+        values = {field: value for field, value in update_data.items() if field in PLAN_FIELDS}
+        values["updated_at"] = datetime.now()
+        result = await db.plans.update_one({"_id": plan_id}, {"$set": values})
+        if not result.matched_count:
+            return None
+        
+        document = await db.plan_catalog_version.find_one_and_update(
+            {"_id": 1},
+            {"$inc": {"version": 1}, "$set": {"updated_at": datetime.now()}},
+            return_document=ReturnDocument.AFTER
+        )
+        return document["version"] if document else None
+    except Exception as e:
+        logger.error(f"Error updating plan: {e}")
+        return None
+
+# User state (context.user_data) operations
+async def get_user_state(telegram_id):
+    """
+    Get the stored user_data of a user.
+    
+    Returns:
+        str: JSON of the state, "" if nothing is stored, None on error
+    """
+    if db is None:
+        await init_database()
+    
+    try:
+        document = await db.user_states.find_one({"_id": telegram_id}, {"data": 1})
+        return document["data"] if document else ""
+    except Exception as e:
+        logger.error(f"Error getting user state: {e}")
+        return None
+
+async def save_user_states(states, deleted_ids=()):
+    """Write changed user states and delete dropped ones.
+    
+    `states` maps telegram_id to the JSON of its state.
+    """
+    if db is None:
+        await init_database()
+    
+    try:
+        if states:
+            now = datetime.now()
+            await db.user_states.bulk_write([
+                UpdateOne({"_id": telegram_id}, {"$set": {"data": data, "updated_at": now}}, upsert=True)
+                for telegram_id, data in states.items()
+            ], ordered=False)
+        if deleted_ids:
+            await db.user_states.delete_many({"_id": {"$in": list(deleted_ids)}})
+        return True
+    except Exception as e:
+        logger.error(f"Error saving user states: {e}")
+        return False
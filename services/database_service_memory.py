@@ -0,0 +1,1022 @@
+"""
+Хранилище в памяти процесса.
+
+Реализует тот же интерфейс репозитория, что и SQL и MongoDB (см.
+services.repository): записи лежат в словарях по первичному ключу, а
+уникальные и внешние ключи, по которым идут запросы, проиндексированы
+отдельными словарями. Ввода-вывода нет, поэтому бэкенд подходит для тестов
+и для замеров накладных расходов самих обработчиков.
+
+Данные живут до перезапуска процесса; reset_database() очищает их.
+"""
+
+import itertools
+import logging
+import uuid
+from collections import defaultdict
+from dataclasses import fields
+from datetime import datetime, timedelta
+
+from services.rows import (
+    UserRow, SubscriptionRow, KeyRow, PaymentRow, NotificationRow, BroadcastJobRow, AdminJobRow
+)
+from services.state_machine import PAYMENT_TRANSITIONS, SUBSCRIPTION_TRANSITIONS, sources_for
+
+logger = logging.getLogger(__name__)
+
+_FIELDS = {
+    row_type: tuple(field.name for field in fields(row_type))
+    for row_type in (UserRow, SubscriptionRow, KeyRow, PaymentRow, NotificationRow, BroadcastJobRow, AdminJobRow)
+}
+
+# Слушатели изменения срока подписок (планировщик окончаний)
+_expiry_listeners = []
+
+def add_expiry_listener(listener):
+    """Call listener(subscription_db_id, expires_at) after an active subscription's term is set or changed"""
+    _expiry_listeners.append(listener)
+
+def _expiry_changed(subscription_id, expires_at):
+    for listener in _expiry_listeners:
+        try:
+            listener(subscription_id, expires_at)
+        except Exception as e:
+            logger.error(f"Error in expiry listener: {e}")
+
+
+class _Table:
+    """Records of one row type by id, with unique and grouping indexes"""
+
+    __slots__ = ("row_type", "records", "unique", "groups", "_ids")
+
+    def __init__(self, row_type, unique, groups=()):
+        self.row_type = row_type
+        self.records = {}
+        # поле -> {значение: id}
+        self.unique = {field: {} for field in unique}
+        # поле -> {значение: {id, ...}}
+        self.groups = {field: defaultdict(set) for field in groups}
+        self._ids = itertools.count(1)
+
+    def insert(self, values):
+        for field, index in self.unique.items():
+            if values.get(field) in index:
+                raise KeyError(f"Duplicate {field}: {values[field]}")
+        record = {name: values.get(name) for name in _FIELDS[self.row_type]}
+        record["id"] = next(self._ids)
+        self.records[record["id"]] = record
+        for field, index in self.unique.items():
+            index[record[field]] = record["id"]
+        for field, index in self.groups.items():
+            index[record[field]].add(record["id"])
+        return record
+
+    def update(self, record, values):
+        for field, value in values.items():
+            if field == "id" or field not in record:
+                continue
+            if field in self.groups:
+                self.groups[field][record[field]].discard(record["id"])
+                self.groups[field][value].add(record["id"])
+            if field in self.unique:
+                del self.unique[field][record[field]]
+                self.unique[field][value] = record["id"]
+            record[field] = value
+
+    def by(self, field, value):
+        record_id = self.unique[field].get(value)
+        return self.records.get(record_id)
+
+    def group(self, field, value):
+        return [self.records[record_id] for record_id in sorted(self.groups[field].get(value, ()))]
+
+    def row(self, record):
+        return self.row_type(**record) if record is not None else None
+
+
+_users = _subscriptions = _access_keys = _payments = None
+_notifications = _broadcast_jobs = _admin_jobs = None
+_processed_events = set()
+# id подписки -> (expiry_notice_days, expiry_notice_for)
+_expiry_notices = {}
+# (id рассылки, telegram_id) -> статус доставки
+_broadcast_recipients = {}
+# id задачи -> отсортированные users.id целей
+_admin_job_targets = {}
+# plan_id -> план; версия каталога хранится рядом
+_plans = {}
+_plan_catalog = {"version": None}
+# telegram_id -> JSON context.user_data
+_user_states = {}
+
+def reset_database():
+    """Drop all stored data"""
+    global _users, _subscriptions, _access_keys, _payments, _notifications, _broadcast_jobs, _admin_jobs
+    _users = _Table(UserRow, unique=("telegram_id",))
+    _subscriptions = _Table(SubscriptionRow, unique=("subscription_id",), groups=("user_id", "status"))
+    _access_keys = _Table(KeyRow, unique=("key_id",), groups=("user_id", "subscription_id"))
+    _payments = _Table(PaymentRow, unique=("payment_id",), groups=("user_id", "status"))
+    _notifications = _Table(NotificationRow, unique=(), groups=("status",))
+    _broadcast_jobs = _Table(BroadcastJobRow, unique=(), groups=("status",))
+    _admin_jobs = _Table(AdminJobRow, unique=(), groups=("status",))
+    for storage in (_processed_events, _expiry_notices, _broadcast_recipients, _admin_job_targets,
+                    _plans, _user_states):
+        storage.clear()
+    _plan_catalog["version"] = None
+
+reset_database()
+
+async def init_database():
+    """Initialize the database connection"""
+    logger.info("In-memory database initialized")
+    return True
+
+def _resolve_user_id(user_id):
+    # Как и SQL-бэкенд, принимает telegram_id вместо внутреннего ID
+    if isinstance(user_id, int) and user_id > 1000000:
+        user = _users.by("telegram_id", user_id)
+        return user["id"] if user else None
+    return user_id
+
+# Пользователи
+async def create_user(user_data):
+    """Create a new user in the database"""
+    existing_user = _users.by("telegram_id", user_data["telegram_id"])
+    if existing_user:
+        logger.info(f"User {user_data['telegram_id']} already exists")
+        return _users.row(existing_user)
+
+    user = _users.insert({
+        "is_premium": False,
+        "test_used": False,
+        "created_at": datetime.now(),
+        **user_data
+    })
+    return _users.row(user)
+
+async def upsert_user(user_data):
+    """
+    Register a user unless they already exist.
+
+    Returns:
+        bool: True if the user was created, False if it already existed
+    """
+    if _users.by("telegram_id", user_data["telegram_id"]):
+        return False
+    await create_user(user_data)
+    return True
+
+async def get_user(telegram_id):
+    """Get user by Telegram ID"""
+    return _users.row(_users.by("telegram_id", telegram_id))
+
+async def get_user_by_id(user_id):
+    """Get user by internal database ID"""
+    return _users.row(_users.records.get(user_id))
+
+async def get_user_by_username(username):
+    """Get user by exact username, case-insensitively"""
+    name = username.strip().lstrip("@").lower()
+    if not name:
+        return None
+    matches = [user for user in _users.records.values() if (user["username"] or "").lower() == name]
+    return _users.row(min(matches, key=lambda user: user["id"])) if matches else None
+
+async def update_user(telegram_id, update_data):
+    """Update user data"""
+    user = _users.by("telegram_id", telegram_id)
+    if not user:
+        logger.error(f"User {telegram_id} not found")
+        return False
+    _users.update(user, update_data)
+    return True
+
+async def claim_test_period(telegram_id):
+    """Mark the user's test period as used if it is still free"""
+    user = _users.by("telegram_id", telegram_id)
+    if not user or user["test_used"]:
+        return False
+    _users.update(user, {"test_used": True})
+    return True
+
+async def get_all_users():
+    """Get all users"""
+    return [_users.row(user) for user in _users.records.values()]
+
+async def count_users():
+    """Count all users"""
+    return len(_users.records)
+
+async def get_users_page(after_id=0, limit=200):
+    """Get a page of (id, telegram_id) pairs ordered by id, starting after `after_id`"""
+    # Записи добавляются с растущими ID, словарь хранит порядок вставки
+    page = []
+    for user_id, user in _users.records.items():
+        if user_id > after_id:
+            page.append((user_id, user["telegram_id"]))
+            if len(page) >= limit:
+                break
+    return page
+
+async def get_admin_users_page(after_id=None, before_id=None, limit=10):
+    """
+    Get a page of users for the admin list (see the SQL backend).
+
+    Returns:
+        tuple: (list of dicts with user fields, plan_id, expires_at and key_ids,
+        whether there are more users in the paging direction)
+    """
+    if before_id is not None:
+        ids = [user_id for user_id in reversed(_users.records) if user_id < before_id][:limit + 1]
+        ids.reverse()
+    else:
+        ids = [user_id for user_id in _users.records if user_id > (after_id or 0)][:limit + 1]
+
+    has_more = len(ids) > limit
+    if has_more:
+        ids = ids[1:] if before_id is not None else ids[:limit]
+
+    now = datetime.now()
+    users = []
+    for user_id in ids:
+        user = _users.records[user_id]
+        subscription = _active_subscription(user_id, now) or {}
+        users.append({
+            "id": user_id,
+            "telegram_id": user["telegram_id"],
+            "username": user["username"],
+            "first_name": user["first_name"],
+            "plan_id": subscription.get("plan_id"),
+            "expires_at": subscription.get("expires_at"),
+            "key_ids": [key["key_id"] for key in _live_keys("user_id", user_id)]
+        })
+    return users, has_more
+
+async def get_user_stats():
+    """
+    Count users, active subscriptions and live access keys.
+
+    Returns:
+        dict: users_count, active_subscriptions_count, active_keys_count
+    """
+    now = datetime.now()
+    return {
+        "users_count": len(_users.records),
+        "active_subscriptions_count": sum(
+            1 for subscription in _subscriptions.group("status", "active")
+            if subscription["expires_at"] is not None and subscription["expires_at"] > now
+        ),
+        "active_keys_count": sum(1 for key in _access_keys.records.values() if not key["deleted"])
+    }
+
+async def search_users(query, limit=10):
+    """
+    Search users by telegram id, username or first/last name prefix, case-insensitively.
+
+    Returns:
+        list: Dicts with id, telegram_id, username, first_name, last_name
+    """
+    text = query.strip().lstrip("@").lower()
+    if not text:
+        return []
+
+    telegram_id = int(text) if text.isdigit() and len(text) < 19 else None
+    found = []
+    for user in _users.records.values():
+        username = (user["username"] or "").lower()
+        if telegram_id is not None and user["telegram_id"] == telegram_id:
+            rank = 0
+        elif username == text:
+            rank = 1
+        elif username.startswith(text):
+            rank = 2
+        elif any((user[name] or "").lower().startswith(text) for name in ("first_name", "last_name")):
+            rank = 3
+        else:
+            continue
+        found.append((rank, user["username"] is None, username, user["id"], user))
+
+    found.sort(key=lambda item: item[:4])
+    return [
+        {name: user[name] for name in ("id", "telegram_id", "username", "first_name", "last_name")}
+        for *_, user in found[:limit]
+    ]
+
+# Подписки
+def _deactivate_user_subscriptions(user_id):
+    for subscription in _subscriptions.group("user_id", user_id):
+        if subscription["status"] == "active":
+            _subscriptions.update(subscription, {"status": "inactive"})
+
+async def create_subscription(subscription_data):
+    """Create a new subscription in the database"""
+    if not subscription_data.get("subscription_id"):
+        subscription_data["subscription_id"] = str(uuid.uuid4())
+
+    if "user_id" not in subscription_data and "telegram_id" in subscription_data:
+        user = _users.by("telegram_id", subscription_data["telegram_id"])
+        if not user:
+            logger.error(f"User with telegram_id {subscription_data['telegram_id']} not found")
+            return None
+        subscription_data["user_id"] = user["id"]
+
+    status = subscription_data.get("status", "active")
+    if status == "active":
+        _deactivate_user_subscriptions(subscription_data["user_id"])
+
+    try:
+        subscription = _subscriptions.insert({
+            "subscription_id": subscription_data["subscription_id"],
+            "user_id": subscription_data["user_id"],
+            "plan_id": subscription_data["plan_id"],
+            "status": status,
+            "created_at": subscription_data.get("created_at", datetime.now()),
+            "expires_at": subscription_data.get("expires_at", subscription_data.get("expiry_date")),
+            "price_paid": subscription_data.get("price_paid", 0.0)
+        })
+    except KeyError as e:
+        logger.error(f"Error creating subscription: {e}")
+        return None
+    if status == "active":
+        _expiry_changed(subscription["id"], subscription["expires_at"])
+    return _subscriptions.row(subscription)
+
+async def get_subscription(subscription_id):
+    """Get subscription by ID"""
+    return _subscriptions.row(_subscriptions.by("subscription_id", subscription_id))
+
+async def update_subscription(subscription_id, update_data):
+    """Update subscription data"""
+    subscription = _subscriptions.by("subscription_id", subscription_id)
+    if not subscription:
+        logger.error(f"Subscription {subscription_id} not found")
+        return False
+    _subscriptions.update(subscription, update_data)
+    if "expires_at" in update_data and subscription["status"] == "active":
+        _expiry_changed(subscription["id"], subscription["expires_at"])
+    return True
+
+async def transition_subscription(subscription_id, to_status, update_data=None):
+    """Atomically move a subscription to `to_status` if its current status allows it"""
+    subscription = _subscriptions.by("subscription_id", subscription_id)
+    if not subscription or subscription["status"] not in sources_for(SUBSCRIPTION_TRANSITIONS, to_status):
+        return False
+    _subscriptions.update(subscription, {**(update_data or {}), "status": to_status})
+    if to_status == "active":
+        _expiry_changed(subscription["id"], subscription["expires_at"])
+    return True
+
+async def get_user_subscriptions(user_id, status=None):
+    """Get all subscriptions for a user, optionally filtered by status"""
+    return [
+        _subscriptions.row(subscription)
+        for subscription in _subscriptions.group("user_id", _resolve_user_id(user_id))
+        if status is None or subscription["status"] == status
+    ]
+
+def _active_subscription(user_id, now):
+    active = [
+        subscription for subscription in _subscriptions.group("user_id", user_id)
+        if subscription["status"] == "active"
+        and (subscription["expires_at"] is None or subscription["expires_at"] > now)
+    ]
+    return max(active, key=lambda subscription: subscription["expires_at"] or datetime.max, default=None)
+
+async def get_active_subscription(user_id):
+    """Get user's active subscription"""
+    return _subscriptions.row(_active_subscription(_resolve_user_id(user_id), datetime.now()))
+
+async def get_expiring_subscriptions(days=1):
+    """Get subscriptions expiring in the specified number of days"""
+    now = datetime.now()
+    target_date = now + timedelta(days=days)
+    return [
+        _subscriptions.row(subscription)
+        for subscription in _subscriptions.group("status", "active")
+        if subscription["expires_at"] is not None and now <= subscription["expires_at"] <= target_date
+    ]
+
+def _expiry_notice_dict(subscription, *fields):
+    days, notice_for = _expiry_notices.get(subscription["id"], (None, None))
+    row = {
+        "id": subscription["id"],
+        "expires_at": subscription["expires_at"],
+        "plan_id": subscription["plan_id"],
+        "telegram_id": _users.records[subscription["user_id"]]["telegram_id"]
+    }
+    markers = {"expiry_notice_days": days, "expiry_notice_for": notice_for}
+    row.update({field: markers[field] for field in fields})
+    return row
+
+async def get_expiry_notice_page(days, window_start, window_end, after=None, limit=200):
+    """
+    Get active subscriptions expiring in (window_start, window_end] that were
+    not yet notified for this window or a later one (see the SQL backend).
+
+    Returns:
+        list: Dicts with id, expires_at, plan_id, telegram_id
+    """
+    def notified(subscription):
+        notice_days, notice_for = _expiry_notices.get(subscription["id"], (None, None))
+        return notice_for == subscription["expires_at"] and notice_days <= days
+
+    found = sorted(
+        (subscription["expires_at"], subscription["id"])
+        for subscription in _subscriptions.group("status", "active")
+        if subscription["expires_at"] is not None
+        and window_start < subscription["expires_at"] <= window_end
+        and subscription["user_id"] in _users.records
+        and not notified(subscription)
+    )
+    if after is not None:
+        found = [position for position in found if position > (after["expires_at"], after["id"])]
+    return [_expiry_notice_dict(_subscriptions.records[subscription_id]) for _, subscription_id in found[:limit]]
+
+async def record_expiry_notices(days, subscriptions, notifications):
+    """Mark subscriptions as notified for the `days` window and add the notifications to the outbox"""
+    for subscription in subscriptions:
+        _expiry_notices[subscription["id"]] = (days, subscription["expires_at"])
+    for notification in notifications:
+        _insert_notification(notification)
+    return True
+
+async def get_subscription_expiries(after, until):
+    """Get (id, expires_at) of active subscriptions expiring in (after, until]"""
+    return [
+        (subscription["id"], subscription["expires_at"])
+        for subscription in _subscriptions.group("status", "active")
+        if subscription["expires_at"] is not None and after < subscription["expires_at"] <= until
+    ]
+
+async def get_expiry_notice_rows(subscription_ids):
+    """
+    Get active subscriptions by database ID with their recipient and notice marker.
+
+    Returns:
+        list: Dicts with id, expires_at, plan_id, telegram_id, expiry_notice_days, expiry_notice_for
+    """
+    subscriptions = (_subscriptions.records.get(subscription_id) for subscription_id in subscription_ids)
+    return [
+        _expiry_notice_dict(subscription, "expiry_notice_days", "expiry_notice_for")
+        for subscription in subscriptions
+        if subscription is not None and subscription["status"] == "active"
+        and subscription["user_id"] in _users.records
+    ]
+
+async def get_expired_active_subscriptions(now, after_id=0, limit=200):
+    """Get a page of (id, expires_at) of subscriptions still active after expiring, ordered by id"""
+    return [
+        (subscription["id"], subscription["expires_at"])
+        for subscription in _subscriptions.group("status", "active")
+        if subscription["expires_at"] is not None and subscription["expires_at"] <= now
+        and subscription["id"] > after_id
+    ][:limit]
+
+async def expire_subscriptions(subscription_ids, now):
+    """
+    Переводит истекшие активные подписки в inactive.
+
+    Returns:
+        tuple: (ID переведенных подписок, key_id их неудаленных ключей)
+    """
+    sources = sources_for(SUBSCRIPTION_TRANSITIONS, "inactive")
+    expired = []
+    for subscription_id in subscription_ids:
+        subscription = _subscriptions.records.get(subscription_id)
+        if subscription and subscription["status"] in sources and subscription["expires_at"] <= now:
+            _subscriptions.update(subscription, {"status": "inactive"})
+            expired.append(subscription_id)
+    key_ids = [key["key_id"] for subscription_id in expired for key in _live_keys("subscription_id", subscription_id)]
+    return expired, key_ids
+
+async def mark_access_keys_deleted(key_ids):
+    """Mark many access keys as deleted"""
+    for key_id in key_ids:
+        key = _access_keys.by("key_id", key_id)
+        if key:
+            key["deleted"] = True
+    return True
+
+# Ключи доступа
+async def create_access_key(key_data):
+    """Create a new access key in the database"""
+    if "user_id" not in key_data and "telegram_id" in key_data:
+        user = _users.by("telegram_id", key_data["telegram_id"])
+        if not user:
+            logger.error(f"User with telegram_id {key_data['telegram_id']} not found")
+            return None
+        key_data["user_id"] = user["id"]
+
+    try:
+        key = _access_keys.insert({
+            "deleted": False,
+            "created_at": datetime.now(),
+            **key_data
+        })
+    except KeyError as e:
+        logger.error(f"Error creating access key: {e}")
+        return None
+    return _access_keys.row(key)
+
+async def get_access_key(key_id):
+    """Get access key by Outline key ID"""
+    return _access_keys.row(_access_keys.by("key_id", key_id))
+
+async def update_access_key(key_id, update_data):
+    """Update access key data"""
+    key = _access_keys.by("key_id", key_id)
+    if not key:
+        logger.error(f"Access key {key_id} not found")
+        return False
+    _access_keys.update(key, update_data)
+    return True
+
+async def deactivate_user_access_keys(user_id):
+    """Деактивировать все ключи доступа пользователя"""
+    for key in _access_keys.group("user_id", _resolve_user_id(user_id)):
+        key["deleted"] = True
+    return True
+
+def _live_keys(field, value):
+    return [key for key in _access_keys.group(field, value) if not key["deleted"]]
+
+async def get_user_access_keys(user_id):
+    """Get all access keys for a user"""
+    return [_access_keys.row(key) for key in _live_keys("user_id", _resolve_user_id(user_id))]
+
+async def get_user_context(telegram_id):
+    """
+    Get a user together with their active subscription and active keys.
+
+    Returns:
+        tuple: (user or None, active subscription or None, list of active keys)
+    """
+    user = _users.by("telegram_id", telegram_id)
+    if not user:
+        return None, None, []
+    return (
+        _users.row(user),
+        _subscriptions.row(_active_subscription(user["id"], datetime.now())),
+        [_access_keys.row(key) for key in _live_keys("user_id", user["id"])]
+    )
+
+async def count_user_active_keys(user_id):
+    """Count non-deleted access keys of a user by internal database ID"""
+    return len(_live_keys("user_id", user_id))
+
+async def get_subscription_access_keys(subscription_id):
+    """Get all access keys for a subscription"""
+    return [_access_keys.row(key) for key in _live_keys("subscription_id", subscription_id)]
+
+async def get_sync_candidate_keys(known_key_ids):
+    """Get live access keys of existing users whose key_id is not in `known_key_ids`"""
+    known_key_ids = set(known_key_ids)
+    return [
+        _access_keys.row(key) for key in _access_keys.records.values()
+        if not key["deleted"] and key["key_id"] not in known_key_ids and key["user_id"] in _users.records
+    ]
+
+# Платежи
+async def create_payment(payment_data):
+    """Create a new payment record in the database"""
+    if not payment_data.get("payment_id"):
+        payment_data["payment_id"] = str(uuid.uuid4())
+
+    if "user_id" not in payment_data and "telegram_id" in payment_data:
+        user = _users.by("telegram_id", payment_data["telegram_id"])
+        if not user:
+            logger.error(f"User with telegram_id {payment_data['telegram_id']} not found")
+            return None
+        payment_data["user_id"] = user["id"]
+
+    try:
+        payment = _payments.insert({
+            "currency": "RUB",
+            "status": "pending",
+            "created_at": datetime.now(),
+            **payment_data
+        })
+    except KeyError as e:
+        logger.error(f"Error creating payment: {e}")
+        return None
+    return _payments.row(payment)
+
+async def get_payment(payment_id):
+    """Get payment by payment ID"""
+    return _payments.row(_payments.by("payment_id", payment_id))
+
+async def update_payment(payment_id, update_data):
+    """Update payment data"""
+    payment = _payments.by("payment_id", payment_id)
+    if not payment:
+        logger.error(f"Payment {payment_id} not found")
+        return False
+    _payments.update(payment, update_data)
+    return True
+
+async def transition_payment(payment_id, to_status, update_data=None):
+    """Atomically move a payment to `to_status` if its current status allows it"""
+    payment = _payments.by("payment_id", payment_id)
+    if not payment or payment["status"] not in sources_for(PAYMENT_TRANSITIONS, to_status):
+        return False
+    _payments.update(payment, {**(update_data or {}), "status": to_status})
+    return True
+
+async def complete_payment(payment_id, payment_values, subscription_values, notification=None):
+    """
+    Move a paid payment to succeeded, activate its subscription and queue
+    the notification (see the SQL backend).
+
+    Returns:
+        bool: True if this call activated the subscription
+    """
+    payment = _payments.by("payment_id", payment_id)
+    if not payment:
+        return False
+    if payment["status"] in sources_for(PAYMENT_TRANSITIONS, "succeeded"):
+        _payments.update(payment, {**payment_values, "status": "succeeded"})
+    if payment["status"] != "succeeded":
+        return False
+
+    subscription = _subscriptions.by("subscription_id", payment["subscription_id"])
+    if not subscription or subscription["status"] not in sources_for(SUBSCRIPTION_TRANSITIONS, "active"):
+        return False
+    _subscriptions.update(subscription, {**subscription_values, "status": "active"})
+    if notification:
+        _insert_notification(notification)
+    _expiry_changed(subscription["id"], subscription["expires_at"])
+    return True
+
+def _unsettled_payments():
+    # Платежи, которые ещё могут стать succeeded
+    for status in sources_for(PAYMENT_TRANSITIONS, "succeeded"):
+        yield from _payments.group("status", status)
+
+async def get_stale_pending_payments(created_before, after=None, limit=100):
+    """Get a page of unsettled payments (pending, waiting_for_capture, expired)
+    created before `created_before`.
+
+    Pages are keyset-paginated by (created_at, id), `after` is the
+    (created_at, id) of the last payment of the previous page.
+    """
+    stale = sorted(
+        (payment["created_at"], payment["id"])
+        for payment in _unsettled_payments()
+        if payment["created_at"] < created_before
+    )
+    if after:
+        stale = [position for position in stale if position > tuple(after)]
+    return [_payments.row(_payments.records[payment_id]) for _, payment_id in stale[:limit]]
+
+async def get_oldest_pending_payment_time():
+    """Get creation time of the oldest unsettled payment (None if there are none)"""
+    return min((payment["created_at"] for payment in _unsettled_payments()), default=None)
+
+async def get_user_payments(user_id, status=None):
+    """Get all payments for a user, optionally filtered by status"""
+    return [
+        _payments.row(payment)
+        for payment in _payments.group("user_id", _resolve_user_id(user_id))
+        if status is None or payment["status"] == status
+    ]
+
+# Дедупликация вебхуков
+async def is_event_processed(event_id):
+    """Check whether a webhook event has already been processed"""
+    return event_id in _processed_events
+
+async def mark_event_processed(event_id, event_type=None):
+    """Record a processed webhook event, returns False if it was already recorded"""
+    if event_id in _processed_events:
+        logger.info(f"Event {event_id} already recorded")
+        return False
+    _processed_events.add(event_id)
+    return True
+
+# Уведомления (outbox)
+def _insert_notification(notification_data):
+    now = datetime.now()
+    return _notifications.insert({
+        "chat_id": notification_data["chat_id"],
+        "text": notification_data["text"],
+        "parse_mode": notification_data.get("parse_mode"),
+        "reply_markup": notification_data.get("reply_markup"),
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt_at": notification_data.get("next_attempt_at", now)
+    })
+
+async def enqueue_notification(notification_data):
+    """Add a notification to the outbox, returns its ID"""
+    return _insert_notification(notification_data)["id"]
+
+async def claim_due_notifications(limit=50, lease_seconds=60):
+    """Claim a batch of due notifications for sending (see the SQL backend)"""
+    now = datetime.now()
+    due = sorted(
+        (notification["next_attempt_at"], notification["id"])
+        for notification in _notifications.group("status", "pending")
+        if notification["next_attempt_at"] <= now
+    )[:limit]
+    claimed = []
+    for _, notification_id in sorted(due, key=lambda position: position[1]):
+        notification = _notifications.records[notification_id]
+        _notifications.update(notification, {"next_attempt_at": now + timedelta(seconds=lease_seconds)})
+        claimed.append(_notifications.row(notification))
+    return claimed
+
+async def mark_notifications_sent(notification_ids):
+    """Mark a batch of notifications as sent"""
+    for notification_id in notification_ids:
+        notification = _notifications.records.get(notification_id)
+        if notification:
+            _notifications.update(notification, {"status": "sent"})
+    return True
+
+async def reschedule_notification(notification_id, next_attempt_at, failed=False, count_attempt=False):
+    """Schedule another delivery attempt, or give up if `failed` is set.
+
+    `count_attempt` adds a failed delivery to attempts; a postponement
+    (flood control) does not use one up.
+    """
+    notification = _notifications.records.get(notification_id)
+    if notification:
+        update_data = {"next_attempt_at": next_attempt_at}
+        if count_attempt:
+            update_data["attempts"] = notification["attempts"] + 1
+        if failed:
+            update_data["status"] = "failed"
+        _notifications.update(notification, update_data)
+    return True
+
+# Рассылки
+async def create_broadcast_job(job_data):
+    """Create a broadcast job, returns its ID"""
+    return _broadcast_jobs.insert({
+        "text": job_data["text"],
+        "parse_mode": job_data.get("parse_mode"),
+        "status": "running",
+        "created_by": job_data.get("created_by"),
+        "created_at": datetime.now(),
+        "cursor_user_id": 0,
+        "total": job_data.get("total", 0),
+        "sent_count": 0,
+        "failed_count": 0,
+        "status_chat_id": job_data.get("status_chat_id"),
+        "status_message_id": job_data.get("status_message_id")
+    })["id"]
+
+async def get_broadcast_job(job_id):
+    """Get broadcast job by ID"""
+    return _broadcast_jobs.row(_broadcast_jobs.records.get(job_id))
+
+async def get_running_broadcast_jobs():
+    """Get all unfinished broadcast jobs"""
+    return [_broadcast_jobs.row(job) for job in _broadcast_jobs.group("status", "running")]
+
+async def update_broadcast_job(job_id, update_data):
+    """Update broadcast job data"""
+    job = _broadcast_jobs.records.get(job_id)
+    if job:
+        _broadcast_jobs.update(job, update_data)
+    return True
+
+async def get_broadcast_recipient_statuses(job_id, telegram_ids):
+    """Get {telegram_id: status} for recipients of a job already recorded"""
+    return {
+        telegram_id: _broadcast_recipients[job_id, telegram_id]
+        for telegram_id in telegram_ids
+        if (job_id, telegram_id) in _broadcast_recipients
+    }
+
+async def record_broadcast_page(job_id, results, cursor_user_id):
+    """Record delivery results of one page and advance the job cursor"""
+    for telegram_id, status, _ in results:
+        _broadcast_recipients[job_id, telegram_id] = status
+    sent = sum(1 for _, status, _ in results if status == "sent")
+    job = _broadcast_jobs.records[job_id]
+    _broadcast_jobs.update(job, {
+        "cursor_user_id": cursor_user_id,
+        "sent_count": job["sent_count"] + sent,
+        "failed_count": job["failed_count"] + len(results) - sent
+    })
+    return True
+
+# Массовые операции администратора
+def _active_subscription_users(now, plan_id=None):
+    return {
+        subscription["user_id"] for subscription in _subscriptions.group("status", "active")
+        if (subscription["expires_at"] is None or subscription["expires_at"] > now)
+        and (plan_id is None or subscription["plan_id"] == plan_id)
+    }
+
+async def create_admin_job(job_data, user_filter="all", telegram_ids=None):
+    """
+    Create a bulk admin job together with its target users, returns its ID.
+
+    Targets are the users with the given telegram ids, or the users matching
+    `user_filter`: "all", "active", "inactive" or "plan:<plan_id>".
+    """
+    now = datetime.now()
+    if telegram_ids is not None:
+        targets = {_users.unique["telegram_id"].get(telegram_id) for telegram_id in telegram_ids} - {None}
+    elif user_filter == "all":
+        targets = set(_users.records)
+    elif user_filter == "active":
+        targets = _active_subscription_users(now) & set(_users.records)
+    elif user_filter == "inactive":
+        targets = set(_users.records) - _active_subscription_users(now)
+    elif user_filter.startswith("plan:"):
+        targets = _active_subscription_users(now, user_filter[len("plan:"):]) & set(_users.records)
+    else:
+        raise ValueError(f"Unknown user filter: {user_filter}")
+
+    job = _admin_jobs.insert({
+        "action": job_data["action"],
+        "params": job_data.get("params"),
+        "status": "running",
+        "created_by": job_data.get("created_by"),
+        "created_at": now,
+        "cursor_user_id": 0,
+        "total": len(targets),
+        "done_count": 0,
+        "failed_count": 0,
+        "status_chat_id": job_data.get("status_chat_id"),
+        "status_message_id": job_data.get("status_message_id")
+    })
+    _admin_job_targets[job["id"]] = sorted(targets)
+    return job["id"]
+
+async def get_admin_job(job_id):
+    """Get admin job by ID"""
+    return _admin_jobs.row(_admin_jobs.records.get(job_id))
+
+async def get_running_admin_jobs():
+    """Get all unfinished admin jobs"""
+    return [_admin_jobs.row(job) for job in _admin_jobs.group("status", "running")]
+
+async def update_admin_job(job_id, update_data):
+    """Update admin job data"""
+    job = _admin_jobs.records.get(job_id)
+    if job:
+        _admin_jobs.update(job, update_data)
+    return True
+
+async def get_admin_job_targets(job_id, after_user_id=0, limit=200):
+    """Get a page of (users.id, telegram_id) targets of a job ordered by users.id"""
+    return [
+        (user_id, _users.records[user_id]["telegram_id"])
+        for user_id in _admin_job_targets.get(job_id, ())
+        if user_id > after_user_id and user_id in _users.records
+    ][:limit]
+
+def _advance_admin_job(job_id, cursor_user_id, done, failed):
+    job = _admin_jobs.records[job_id]
+    _admin_jobs.update(job, {
+        "cursor_user_id": cursor_user_id,
+        "done_count": job["done_count"] + done,
+        "failed_count": job["failed_count"] + failed
+    })
+
+async def record_admin_job_page(job_id, cursor_user_id, done, failed):
+    """Advance the job cursor and counters after a page without other changes"""
+    _advance_admin_job(job_id, cursor_user_id, done, failed)
+    return True
+
+async def get_users_live_keys(user_ids):
+    """
+    Get non-deleted access keys of many users.
+
+    Returns:
+        list: Dicts with user_id (users.id), telegram_id, key_id, name, access_url
+    """
+    return [
+        {
+            "user_id": user_id,
+            "telegram_id": _users.records[user_id]["telegram_id"],
+            "key_id": key["key_id"],
+            "name": key["name"],
+            "access_url": key["access_url"]
+        }
+        for user_id in sorted(set(user_ids)) if user_id in _users.records
+        for key in _live_keys("user_id", user_id)
+    ]
+
+async def extend_active_subscriptions(user_ids, days, job_id=None, cursor_user_id=None):
+    """
+    Продлевает активные подписки пользователей на `days` дней (см. SQL-бэкенд).
+
+    Returns:
+        set: users.id пользователей, у которых есть активная подписка
+    """
+    now = datetime.now()
+    extended = set()
+    for user_id in user_ids:
+        for subscription in _subscriptions.group("user_id", user_id):
+            if subscription["status"] != "active":
+                continue
+            extended.add(user_id)
+            if subscription["expires_at"] is not None:
+                expires_at = max(subscription["expires_at"], now) + timedelta(days=days)
+                _subscriptions.update(subscription, {"expires_at": expires_at})
+                _expiry_changed(subscription["id"], expires_at)
+    if job_id is not None:
+        _advance_admin_job(job_id, cursor_user_id, len(extended), len(user_ids) - len(extended))
+    return extended
+
+async def revoke_users_access(user_ids, deleted_key_ids, job_id=None, cursor_user_id=None, failed=0):
+    """
+    Закрывает доступ пользователей: помечает ключи удаленными,
+    переводит активные подписки в inactive и снимает is_premium.
+    """
+    await mark_access_keys_deleted(deleted_key_ids)
+    sources = sources_for(SUBSCRIPTION_TRANSITIONS, "inactive")
+    for user_id in user_ids:
+        for subscription in _subscriptions.group("user_id", user_id):
+            if subscription["status"] in sources:
+                _subscriptions.update(subscription, {"status": "inactive"})
+        user = _users.records.get(user_id)
+        if user:
+            _users.update(user, {"is_premium": False})
+    if job_id is not None:
+        _advance_admin_job(job_id, cursor_user_id, len(user_ids), failed)
+    return True
+
+async def replace_access_keys(replacements, notifications=(), job_id=None, cursor_user_id=None,
+                              done=0, failed=0):
+    """
+    Заменяет ключи на перенесенные и ставит уведомления в outbox.
+
+    Args:
+        replacements: Список (старый key_id, новый key_id, новый access_url)
+        notifications: Уведомления в формате enqueue_notification
+        job_id: Задача, чей курсор и счетчики продвигаются вместе с заменой
+    """
+    for old_key_id, new_key_id, access_url in replacements:
+        key = _access_keys.by("key_id", old_key_id)
+        if key:
+            _access_keys.update(key, {"key_id": new_key_id, "access_url": access_url})
+    for notification in notifications:
+        _insert_notification(notification)
+    if job_id is not None:
+        _advance_admin_job(job_id, cursor_user_id, done, failed)
+    return True
+
+# Каталог тарифов
+PLAN_FIELDS = ("name", "duration", "price", "devices", "discount", "description", "active")
+
+async def seed_plans(plans_config):
+    """Fill the plan catalog from config if it has never been stored"""
+    if _plan_catalog["version"] is not None:
+        return False
+    for plan_id, plan in plans_config.items():
+        _plans[plan_id] = {field: plan.get(field) for field in PLAN_FIELDS}
+        _plans[plan_id].update({"devices": plan.get("devices", 1), "active": True})
+    _plan_catalog["version"] = 1
+    return True
+
+async def get_plan_catalog_version():
+    """Get the current plan catalog version"""
+    return _plan_catalog["version"]
+
+async def get_plan_catalog():
+    """
+    Get all plans with the catalog version they belong to.
+
+    Returns:
+        tuple: (version, {plan_id: plan dict})
+    """
+    return _plan_catalog["version"], {plan_id: dict(plan) for plan_id, plan in _plans.items()}
+
+async def update_plan(plan_id, update_data):
+    """
+    Update a plan and bump the catalog version.
+
+    Returns:
+        int: New catalog version or None if the plan was not found
+    """
+    if plan_id not in _plans:
+        return None
+    _plans[plan_id].update({field: value for field, value in update_data.items() if field in PLAN_FIELDS})
+    _plan_catalog["version"] += 1
+    return _plan_catalog["version"]
+
+# Состояние пользователей (context.user_data)
+async def get_user_state(telegram_id):
+    """
+    Get the stored user_data of a user.
+
+    Returns:
+        str: JSON of the state, "" if nothing is stored
+    """
+    return _user_states.get(telegram_id, "")
+
+async def save_user_states(states, deleted_ids=()):
+    """Write changed user states and delete dropped ones.
+
+    `states` maps telegram_id to the JSON of its state.
+    """
+    _user_states.update(states)
+    for telegram_id in deleted_ids:
+        _user_states.pop(telegram_id, None)
+    return True
@@ -2,10 +2,19 @@ import os
 import uuid
 import logging
 from datetime import datetime, timedelta
-from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import and_, or_
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from sqlalchemy import and_, or_, func, case, insert, select, literal, true
+from sqlalchemy.dialects import postgresql, sqlite
 
-from models import get_session, User, Subscription, AccessKey, Payment
+from models import (
+    get_session, User, Subscription, AccessKey, Payment, ProcessedEvent, Notification,
+    BroadcastJob, BroadcastRecipient, AdminJob, AdminJobTarget, TariffPlan, PlanCatalogVersion,
+    UserState, SQLITE_UNICODE_LOWER
+)
+from services.rows import (
+    UserRow, SubscriptionRow, KeyRow, PaymentRow, NotificationRow, BroadcastJobRow, AdminJobRow
+)
+from services.state_machine import PAYMENT_TRANSITIONS, SUBSCRIPTION_TRANSITIONS, sources_for
 
 # Настройка логирования
 logging.basicConfig(
@@ -13,6 +22,20 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Слушатели изменения срока подписок (планировщик окончаний)
+_expiry_listeners = []
+
+def add_expiry_listener(listener):
+    """Call listener(subscription_db_id, expires_at) after an active subscription's term is set or changed"""
+    _expiry_listeners.append(listener)
+
+def _expiry_changed(subscription_id, expires_at):
+    for listener in _expiry_listeners:
+        try:
+            listener(subscription_id, expires_at)
+        except Exception as e:
+            logger.error(f"Error in expiry listener: {e}")
+
 async def init_database():
     """Initialize the database connection"""
     try:
@@ -29,13 +52,13 @@ async def create_user(user_data):
     session = get_session()
     try:
         # Проверяем, существует ли пользователь
-        existing_user = session.query(User).filter_by(
+        existing_user = session.query(*UserRow.columns(User)).filter_by(
             telegram_id=user_data["telegram_id"]
         ).first()
         
         if existing_user:
             logger.info(f"User {user_data['telegram_id']} already exists")
-            return existing_user
+            return UserRow.from_row(existing_user)
         
         # Создаем нового пользователя
         new_user = User(
@@ -51,7 +74,7 @@ async def create_user(user_data):
         session.add(new_user)
         session.commit()
         logger.info(f"User {user_data['telegram_id']} created successfully")
-        return new_user
+        return UserRow.from_object(new_user)
     except SQLAlchemyError as e:
         session.rollback()
         logger.error(f"Error creating user: {e}")
@@ -59,18 +82,86 @@ async def create_user(user_data):
     finally:
         session.close()
 
+async def upsert_user(user_data):
+    """
+    Register a user unless they already exist, in a single statement.
+    
+    Returns:
+        bool: True if the user was created, False if it already existed, None on error
+    """
+    session = get_session()
+    try:
+        values = {
+            "telegram_id": user_data["telegram_id"],
+            "username": user_data.get("username"),
+            "first_name": user_data.get("first_name"),
+            "last_name": user_data.get("last_name"),
+            "created_at": user_data.get("created_at", datetime.now()),
+            "is_premium": user_data.get("is_premium", False),
+            "test_used": user_data.get("test_used", False)
+        }
+        dialect = postgresql if session.get_bind().dialect.name == "postgresql" else sqlite
+        stmt = dialect.insert(User).values(**values).on_conflict_do_nothing(
+            index_elements=["telegram_id"]
+        ).returning(User.id)
+        
+        created = session.execute(stmt).first() is not None
+        session.commit()
+        if created:
+            logger.info(f"User {user_data['telegram_id']} created successfully")
+        return created
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error upserting user: {e}")
+        return None
+    finally:
+        session.close()
+
 async def get_user(telegram_id):
     """Get user by Telegram ID"""
     session = get_session()
     try:
-        user = session.query(User).filter_by(telegram_id=telegram_id).first()
-        return user
+        return UserRow.from_row(
+            session.query(*UserRow.columns(User)).filter_by(telegram_id=telegram_id).first()
+        )
     except SQLAlchemyError as e:
         logger.error(f"Error getting user: {e}")
         return None
     finally:
         session.close()
 
+async def get_user_by_id(user_id):
+    """Get user by internal database ID"""
+    session = get_session()
+    try:
+        return UserRow.from_row(
+            session.query(*UserRow.columns(User)).filter(User.id == user_id).first()
+        )
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting user by id: {e}")
+        return None
+    finally:
+        session.close()
+
+async def get_user_by_username(username):
+    """Get user by exact username, case-insensitively (uses the lower(username) index)"""
+    name = username.strip().lstrip("@").lower()
+    if not name:
+        return None
+    
+    session = get_session()
+    try:
+        return UserRow.from_row(
+            session.query(*UserRow.columns(User)).filter(
+                func.lower(User.username) == name
+            ).order_by(User.id).first()
+        )
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting user by username: {e}")
+        return None
+    finally:
+        session.close()
+
 async def update_user(telegram_id, update_data):
     """Update user data"""
     session = get_session()
@@ -95,18 +186,222 @@ async def update_user(telegram_id, update_data):
     finally:
         session.close()
 
+async def claim_test_period(telegram_id):
+    """
+    Mark the user's test period as used if it is still free.
+    
+    The conditional UPDATE guards the test period across worker processes:
+    of concurrent claims exactly one gets True.
+    """
+    session = get_session()
+    try:
+        updated = session.query(User).filter(
+            User.telegram_id == telegram_id,
+            or_(User.test_used == False, User.test_used == None)
+        ).update({"test_used": True}, synchronize_session=False)
+        session.commit()
+        return updated == 1
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error claiming test period: {e}")
+        return False
+    finally:
+        session.close()
+
 async def get_all_users():
     """Get all users"""
     session = get_session()
     try:
-        users = session.query(User).all()
-        return users
+        return [UserRow.from_row(row) for row in session.query(*UserRow.columns(User))]
     except SQLAlchemyError as e:
         logger.error(f"Error getting all users: {e}")
         return []
     finally:
         session.close()
 
+async def count_users():
+    """Count all users"""
+    session = get_session()
+    try:
+        return session.query(func.count(User.id)).scalar() or 0
+    except SQLAlchemyError as e:
+        logger.error(f"Error counting users: {e}")
+        return 0
+    finally:
+        session.close()
+
+async def get_users_page(after_id=0, limit=200):
+    """Get a page of (id, telegram_id) pairs ordered by id, starting after `after_id`"""
+    session = get_session()
+    try:
+        rows = session.query(User.id, User.telegram_id).filter(
+            User.id > after_id
+        ).order_by(User.id).limit(limit).all()
+        return [(row.id, row.telegram_id) for row in rows]
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting users page: {e}")
+        return []
+    finally:
+        session.close()
+
+async def get_admin_users_page(after_id=None, before_id=None, limit=10):
+    """
+    Get a page of users for the admin list in one query.
+    
+    Pages are keyset-based on User.id: users after `after_id`, or, when
+    `before_id` is set, the last `limit` users before it.
+    
+    Returns:
+        tuple: (list of dicts with user fields, plan_id and expires_at of the
+        latest active subscription and key_ids of live keys, whether there are
+        more users in the paging direction)
+    """
+    session = get_session()
+    try:
+        now = datetime.now()
+        page = session.query(User.id)
+        if before_id is not None:
+            page = page.filter(User.id < before_id).order_by(User.id.desc())
+        else:
+            page = page.filter(User.id > (after_id or 0)).order_by(User.id)
+        # Лишняя строка показывает, есть ли следующая страница
+        page = page.limit(limit + 1).subquery()
+        
+        latest_subscription = session.query(Subscription.id).filter(
+            Subscription.user_id == User.id,
+            Subscription.status == "active",
+            or_(
+                Subscription.expires_at > now,
+                Subscription.expires_at == None
+            )
+        ).order_by(Subscription.expires_at.desc()).limit(1).correlate(User).scalar_subquery()
+        
+        rows = session.query(
+            User.id, User.telegram_id, User.username, User.first_name,
+            Subscription.plan_id, Subscription.expires_at, AccessKey.key_id
+        ).filter(
+            User.id.in_(session.query(page.c.id))
+        ).outerjoin(
+            Subscription, Subscription.id == latest_subscription
+        ).outerjoin(
+            AccessKey,
+            and_(
+                AccessKey.user_id == User.id,
+                AccessKey.deleted == False
+            )
+        ).order_by(User.id).all()
+        
+        users = {}
+        for row in rows:
+            user = users.get(row.id)
+            if user is None:
+                user = users[row.id] = {
+                    "id": row.id,
+                    "telegram_id": row.telegram_id,
+                    "username": row.username,
+                    "first_name": row.first_name,
+                    "plan_id": row.plan_id,
+                    "expires_at": row.expires_at,
+                    "key_ids": []
+                }
+            if row.key_id is not None:
+                user["key_ids"].append(row.key_id)
+        
+        users = list(users.values())
+        has_more = len(users) > limit
+        if has_more:
+            users = users[1:] if before_id is not None else users[:limit]
+        return users, has_more
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting admin users page: {e}")
+        return [], False
+    finally:
+        session.close()
+
+async def get_user_stats():
+    """
+    Count users, active subscriptions and live access keys in one query.
+    
+    Returns:
+        dict: users_count, active_subscriptions_count, active_keys_count (None on error)
+    """
+    session = get_session()
+    try:
+        now = datetime.now()
+        row = session.query(
+            select(func.count(User.id)).scalar_subquery().label("users_count"),
+            select(func.count(Subscription.id)).where(
+                Subscription.status == "active",
+                Subscription.expires_at > now
+            ).scalar_subquery().label("active_subscriptions_count"),
+            select(func.count(AccessKey.id)).where(
+                AccessKey.deleted == False
+            ).scalar_subquery().label("active_keys_count")
+        ).one()
+        return dict(row._mapping)
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting user stats: {e}")
+        return None
+    finally:
+        session.close()
+
+def _like_prefix(text):
+    """LIKE pattern matching strings that start with `text` literally"""
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"{escaped}%"
+
+async def search_users(query, limit=10):
+    """
+    Search users by telegram id, username or first/last name prefix, case-insensitively.
+    
+    Uses the lower() indexes on users; exact telegram id and username matches
+    are ranked first, then username prefixes, then name prefixes. On SQLite a
+    non-ASCII query is folded by a Python function instead, without the indexes.
+    
+    Returns:
+        list: Dicts with id, telegram_id, username, first_name, last_name
+    """
+    text = query.strip().lstrip("@").lower()
+    if not text:
+        return []
+    
+    session = get_session()
+    try:
+        pattern = _like_prefix(text)
+        lower = func.lower
+        if not text.isascii() and session.get_bind().dialect.name == "sqlite":
+            lower = getattr(func, SQLITE_UNICODE_LOWER)
+        username = lower(User.username)
+        conditions = [
+            username.like(pattern, escape="\\"),
+            lower(User.first_name).like(pattern, escape="\\"),
+            lower(User.last_name).like(pattern, escape="\\")
+        ]
+        ranks = [(username == text, 1), (username.like(pattern, escape="\\"), 2)]
+        if text.isdigit() and len(text) < 19:
+            conditions.append(User.telegram_id == int(text))
+            ranks.insert(0, (User.telegram_id == int(text), 0))
+        rank = case(*ranks, else_=3)
+        
+        rows = session.query(
+            User.id, User.telegram_id, User.username, User.first_name, User.last_name
+        ).filter(or_(*conditions)).order_by(rank, username, User.id).limit(limit).all()
+        return [
+            {
+                "id": row.id,
+                "telegram_id": row.telegram_id,
+                "username": row.username,
+                "first_name": row.first_name,
+                "last_name": row.last_name
+            }
+            for row in rows
+        ]
+    except SQLAlchemyError as e:
+        logger.error(f"Error searching users: {e}")
+        return []
+    finally:
+        session.close()
+
 async def deactivate_user_subscriptions(user_id):
     """Деактивировать все активные подписки пользователя"""
     session = get_session()
@@ -169,7 +464,10 @@ async def create_subscription(subscription_data):
         session.add(new_subscription)
         session.commit()
         logger.info(f"Subscription {new_subscription.subscription_id} created successfully")
-        return new_subscription
+        subscription = SubscriptionRow.from_object(new_subscription)
+        if subscription.status == "active":
+            _expiry_changed(subscription.id, subscription.expires_at)
+        return subscription
     except SQLAlchemyError as e:
         session.rollback()
         logger.error(f"Error creating subscription: {e}")
@@ -181,8 +479,11 @@ async def get_subscription(subscription_id):
     """Get subscription by ID"""
     session = get_session()
     try:
-        subscription = session.query(Subscription).filter_by(subscription_id=subscription_id).first()
-        return subscription
+        return SubscriptionRow.from_row(
+            session.query(*SubscriptionRow.columns(Subscription)).filter_by(
+                subscription_id=subscription_id
+            ).first()
+        )
     except SQLAlchemyError as e:
         logger.error(f"Error getting subscription: {e}")
         return None
@@ -205,6 +506,8 @@ async def update_subscription(subscription_id, update_data):
         
         session.commit()
         logger.info(f"Subscription {subscription_id} updated successfully")
+        if "expires_at" in update_data and subscription.status == "active":
+            _expiry_changed(subscription.id, subscription.expires_at)
         return True
     except SQLAlchemyError as e:
         session.rollback()
@@ -213,6 +516,38 @@ async def update_subscription(subscription_id, update_data):
     finally:
         session.close()
 
+async def transition_subscription(subscription_id, to_status, update_data=None):
+    """Atomically move a subscription to `to_status` if its current status allows it"""
+    expected = sources_for(SUBSCRIPTION_TRANSITIONS, to_status)
+    session = get_session()
+    try:
+        values = dict(update_data or {})
+        values["status"] = to_status
+        
+        # Условный UPDATE: строка меняется, только если статус всё ещё ожидаемый
+        updated = session.query(Subscription).filter(
+            and_(
+                Subscription.subscription_id == subscription_id,
+                Subscription.status.in_(expected)
+            )
+        ).update(values, synchronize_session=False)
+        
+        session.commit()
+        if updated:
+            logger.info(f"Subscription {subscription_id} moved to {to_status}")
+            if to_status == "active":
+                row = session.query(Subscription.id, Subscription.expires_at).filter_by(
+                    subscription_id=subscription_id
+                ).first()
+                _expiry_changed(row.id, row.expires_at)
+        return updated == 1
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error changing subscription status: {e}")
+        return False
+    finally:
+        session.close()
+
 async def get_user_subscriptions(user_id, status=None):
     """Get all subscriptions for a user, optionally filtered by status"""
     session = get_session()
@@ -227,12 +562,11 @@ async def get_user_subscriptions(user_id, status=None):
                 return []
         
         # Формируем запрос в зависимости от статуса
-        query = session.query(Subscription).filter_by(user_id=user_id)
+        query = session.query(*SubscriptionRow.columns(Subscription)).filter_by(user_id=user_id)
         if status:
             query = query.filter_by(status=status)
             
-        subscriptions = query.all()
-        return subscriptions
+        return [SubscriptionRow.from_row(row) for row in query]
     except SQLAlchemyError as e:
         logger.error(f"Error getting user subscriptions: {e}")
         return []
@@ -254,7 +588,7 @@ async def get_active_subscription(user_id):
         
         # Ищем активную подписку с неистекшим сроком
         now = datetime.now()
-        subscription = session.query(Subscription).filter(
+        subscription = session.query(*SubscriptionRow.columns(Subscription)).filter(
             and_(
                 Subscription.user_id == user_id,
                 Subscription.status == "active",
@@ -265,7 +599,7 @@ async def get_active_subscription(user_id):
             )
         ).order_by(Subscription.expires_at.desc()).first()
         
-        return subscription
+        return SubscriptionRow.from_row(subscription)
     except SQLAlchemyError as e:
         logger.error(f"Error getting active subscription: {e}")
         return None
@@ -281,21 +615,206 @@ async def get_expiring_subscriptions(days=1):
         target_date = now + timedelta(days=days)
         
         # Ищем активные подписки, истекающие в указанный период
-        subscriptions = session.query(Subscription).filter(
+        rows = session.query(*SubscriptionRow.columns(Subscription)).filter(
             and_(
                 Subscription.status == "active",
                 Subscription.expires_at >= now,
                 Subscription.expires_at <= target_date
             )
-        ).all()
+        )
         
-        return subscriptions
+        return [SubscriptionRow.from_row(row) for row in rows]
     except SQLAlchemyError as e:
         logger.error(f"Error getting expiring subscriptions: {e}")
         return []
     finally:
         session.close()
 
+async def get_expiry_notice_page(days, window_start, window_end, after=None, limit=200):
+    """
+    Get active subscriptions expiring in (window_start, window_end] that were
+    not yet notified for this window or a later one.
+    
+    Pages are keyset-based on (expires_at, id): pass the last row as `after`.
+    
+    Returns:
+        list: Dicts with id, expires_at, plan_id, telegram_id
+    """
+    session = get_session()
+    try:
+        query = session.query(
+            Subscription.id, Subscription.expires_at, Subscription.plan_id, User.telegram_id
+        ).join(User, User.id == Subscription.user_id).filter(
+            Subscription.status == "active",
+            Subscription.expires_at > window_start,
+            Subscription.expires_at <= window_end,
+            # Уведомление о текущем сроке в этом или более позднем окне уже отправлено
+            or_(
+                Subscription.expiry_notice_for == None,
+                Subscription.expiry_notice_for != Subscription.expires_at,
+                Subscription.expiry_notice_days > days
+            )
+        )
+        if after is not None:
+            query = query.filter(or_(
+                Subscription.expires_at > after["expires_at"],
+                and_(
+                    Subscription.expires_at == after["expires_at"],
+                    Subscription.id > after["id"]
+                )
+            ))
+        rows = query.order_by(Subscription.expires_at, Subscription.id).limit(limit).all()
+        return [row._asdict() for row in rows]
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting expiry notice page: {e}")
+        return []
+    finally:
+        session.close()
+
+async def record_expiry_notices(days, subscriptions, notifications):
+    """
+    Mark subscriptions as notified for the `days` window and add the
+    notifications to the outbox in one transaction.
+    """
+    session = get_session()
+    try:
+        now = datetime.now()
+        session.bulk_update_mappings(Subscription, [
+            {
+                "id": subscription["id"],
+                "expiry_notice_days": days,
+                "expiry_notice_for": subscription["expires_at"]
+            }
+            for subscription in subscriptions
+        ])
+        session.add_all([
+            Notification(
+                chat_id=notification["chat_id"],
+                text=notification["text"],
+                parse_mode=notification.get("parse_mode"),
+                reply_markup=notification.get("reply_markup"),
+                status="pending",
+                attempts=0,
+                created_at=now,
+                next_attempt_at=now
+            )
+            for notification in notifications
+        ])
+        session.commit()
+        return True
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error recording expiry notices: {e}")
+        return False
+    finally:
+        session.close()
+
+async def get_subscription_expiries(after, until):
+    """Get (id, expires_at) of active subscriptions expiring in (after, until]"""
+    session = get_session()
+    try:
+        rows = session.query(Subscription.id, Subscription.expires_at).filter(
+            Subscription.status == "active",
+            Subscription.expires_at > after,
+            Subscription.expires_at <= until
+        ).all()
+        return [(row.id, row.expires_at) for row in rows]
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting subscription expiries: {e}")
+        return []
+    finally:
+        session.close()
+
+async def get_expiry_notice_rows(subscription_ids):
+    """
+    Get active subscriptions by database ID with their recipient and notice marker.
+    
+    Returns:
+        list: Dicts with id, expires_at, plan_id, telegram_id, expiry_notice_days, expiry_notice_for
+    """
+    session = get_session()
+    try:
+        rows = session.query(
+            Subscription.id, Subscription.expires_at, Subscription.plan_id, User.telegram_id,
+            Subscription.expiry_notice_days, Subscription.expiry_notice_for
+        ).join(User, User.id == Subscription.user_id).filter(
+            Subscription.id.in_(subscription_ids),
+            Subscription.status == "active"
+        ).all()
+        return [row._asdict() for row in rows]
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting expiry notice rows: {e}")
+        return []
+    finally:
+        session.close()
+
+async def get_expired_active_subscriptions(now, after_id=0, limit=200):
+    """Get a page of (id, expires_at) of subscriptions still active after expiring, ordered by id"""
+    session = get_session()
+    try:
+        rows = session.query(Subscription.id, Subscription.expires_at).filter(
+            Subscription.status == "active",
+            Subscription.expires_at <= now,
+            Subscription.id > after_id
+        ).order_by(Subscription.id).limit(limit).all()
+        return [(row.id, row.expires_at) for row in rows]
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting expired subscriptions: {e}")
+        return []
+    finally:
+        session.close()
+
+async def expire_subscriptions(subscription_ids, now):
+    """
+    Переводит истекшие активные подписки в inactive одной транзакцией.
+    
+    Returns:
+        tuple: (ID переведенных подписок, key_id их неудаленных ключей)
+    """
+    session = get_session()
+    try:
+        condition = and_(
+            Subscription.id.in_(subscription_ids),
+            Subscription.status.in_(sources_for(SUBSCRIPTION_TRANSITIONS, "inactive")),
+            Subscription.expires_at <= now
+        )
+        expired = [row.id for row in session.query(Subscription.id).filter(condition)]
+        if not expired:
+            return [], []
+        session.query(Subscription).filter(
+            condition, Subscription.id.in_(expired)
+        ).update({"status": "inactive"}, synchronize_session=False)
+        key_ids = [
+            row.key_id for row in session.query(AccessKey.key_id).filter(
+                AccessKey.subscription_id.in_(expired),
+                AccessKey.deleted == False
+            )
+        ]
+        session.commit()
+        return expired, key_ids
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error expiring subscriptions: {e}")
+        return [], []
+    finally:
+        session.close()
+
+async def mark_access_keys_deleted(key_ids):
+    """Mark many access keys as deleted"""
+    session = get_session()
+    try:
+        session.query(AccessKey).filter(AccessKey.key_id.in_(list(key_ids))).update(
+            {"deleted": True}, synchronize_session=False
+        )
+        session.commit()
+        return True
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error marking access keys deleted: {e}")
+        return False
+    finally:
+        session.close()
+
 async def create_access_key(key_data):
     """Create a new access key in the database"""
     session = get_session()
@@ -323,7 +842,7 @@ async def create_access_key(key_data):
         session.add(new_key)
         session.commit()
         logger.info(f"Access key {new_key.key_id} created successfully")
-        return new_key
+        return KeyRow.from_object(new_key)
     except SQLAlchemyError as e:
         session.rollback()
         logger.error(f"Error creating access key: {e}")
@@ -335,8 +854,9 @@ async def get_access_key(key_id):
     """Get access key by Outline key ID"""
     session = get_session()
     try:
-        key = session.query(AccessKey).filter_by(key_id=key_id).first()
-        return key
+        return KeyRow.from_row(
+            session.query(*KeyRow.columns(AccessKey)).filter_by(key_id=key_id).first()
+        )
     except SQLAlchemyError as e:
         logger.error(f"Error getting access key: {e}")
         return None
@@ -416,39 +936,149 @@ async def get_user_access_keys(user_id):
                 return []
         
         # Получаем ключи доступа пользователя, которые не удалены
-        keys = session.query(AccessKey).filter(
+        keys = session.query(*KeyRow.columns(AccessKey)).filter(
             and_(
                 AccessKey.user_id == user_id,
                 AccessKey.deleted == False
             )
-        ).all()
+        )
         
-        return keys
+        return [KeyRow.from_row(row) for row in keys]
     except SQLAlchemyError as e:
         logger.error(f"Error getting user access keys: {e}")
         return []
     finally:
         session.close()
 
+async def get_user_context(telegram_id):
+    """
+    Get a user together with their active subscription and active keys in one query.
+    
+    Returns:
+        tuple: (user or None, active subscription or None, list of active keys)
+    """
+    session = get_session()
+    try:
+        now = datetime.now()
+        rows = session.query(
+            *UserRow.columns(User), *SubscriptionRow.columns(Subscription), *KeyRow.columns(AccessKey)
+        ).outerjoin(
+            Subscription,
+            and_(
+                Subscription.user_id == User.id,
+                Subscription.status == "active",
+                or_(
+                    Subscription.expires_at > now,
+                    Subscription.expires_at == None
+                )
+            )
+        ).outerjoin(
+            AccessKey,
+            and_(
+                AccessKey.user_id == User.id,
+                AccessKey.deleted == False
+            )
+        ).filter(User.telegram_id == telegram_id).all()
+        
+        if not rows:
+            return None, None, []
+        
+        # Строки - произведение подписок на ключи, убираем повторы
+        key_offset = UserRow.width() + SubscriptionRow.width()
+        subscriptions = {}
+        keys = {}
+        for row in rows:
+            sub = SubscriptionRow.from_row(row, UserRow.width())
+            if sub is not None:
+                subscriptions[sub.id] = sub
+            key = KeyRow.from_row(row, key_offset)
+            if key is not None:
+                keys[key.id] = key
+        subscription = max(
+            subscriptions.values(),
+            key=lambda sub: sub.expires_at or datetime.max,
+            default=None
+        )
+        return UserRow.from_row(rows[0]), subscription, list(keys.values())
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting user context: {e}")
+        return None, None, []
+    finally:
+        session.close()
+
+async def count_user_active_keys(user_id):
+    """Count non-deleted access keys of a user by internal database ID"""
+    session = get_session()
+    try:
+        return session.query(func.count(AccessKey.id)).filter(
+            and_(
+                AccessKey.user_id == user_id,
+                AccessKey.deleted == False
+            )
+        ).scalar() or 0
+    except SQLAlchemyError as e:
+        logger.error(f"Error counting user access keys: {e}")
+        return 0
+    finally:
+        session.close()
+
 async def get_subscription_access_keys(subscription_id):
     """Get all access keys for a subscription"""
     session = get_session()
     try:
         # Получаем ключи доступа для подписки, которые не удалены
-        keys = session.query(AccessKey).filter(
+        keys = session.query(*KeyRow.columns(AccessKey)).filter(
             and_(
                 AccessKey.subscription_id == subscription_id,
                 AccessKey.deleted == False
             )
-        ).all()
+        )
         
-        return keys
+        return [KeyRow.from_row(row) for row in keys]
     except SQLAlchemyError as e:
         logger.error(f"Error getting subscription access keys: {e}")
         return []
     finally:
         session.close()
 
+SYNC_KEY_CHUNK = 500  # ключей за один запрос при сверке с Outline
+
+async def get_sync_candidate_keys(known_key_ids):
+    """
+    Get live access keys of existing users whose key_id is not in `known_key_ids`.
+    
+    Returns:
+        list: Keys ordered by id
+    """
+    # Ключей на сервере Outline могут быть тысячи - в NOT IN (...) их не передаём,
+    # а читаем живые ключи страницами и отсеиваем известные здесь
+    known_key_ids = set(known_key_ids)
+    session = get_session()
+    try:
+        candidates = []
+        last_id = 0
+        while True:
+            page = session.query(*KeyRow.columns(AccessKey)).join(
+                User, User.id == AccessKey.user_id
+            ).filter(
+                AccessKey.deleted == False,
+                AccessKey.id > last_id
+            ).order_by(AccessKey.id).limit(SYNC_KEY_CHUNK).all()
+            if not page:
+                break
+            
+            candidates.extend(
+                KeyRow.from_row(row) for row in page if row.key_id not in known_key_ids
+            )
+            last_id = page[-1].id
+        
+        return candidates
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting sync candidate keys: {e}")
+        return []
+    finally:
+        session.close()
+
 async def create_payment(payment_data):
     """Create a new payment record in the database"""
     session = get_session()
@@ -481,7 +1111,7 @@ async def create_payment(payment_data):
         session.add(new_payment)
         session.commit()
         logger.info(f"Payment {new_payment.payment_id} created successfully")
-        return new_payment
+        return PaymentRow.from_object(new_payment)
     except SQLAlchemyError as e:
         session.rollback()
         logger.error(f"Error creating payment: {e}")
@@ -493,8 +1123,9 @@ async def get_payment(payment_id):
     """Get payment by payment ID"""
     session = get_session()
     try:
-        payment = session.query(Payment).filter_by(payment_id=payment_id).first()
-        return payment
+        return PaymentRow.from_row(
+            session.query(*PaymentRow.columns(Payment)).filter_by(payment_id=payment_id).first()
+        )
     except SQLAlchemyError as e:
         logger.error(f"Error getting payment: {e}")
         return None
@@ -525,28 +1156,890 @@ async def update_payment(payment_id, update_data):
     finally:
         session.close()
 
-async def get_user_payments(user_id, status=None):
-    """Get all payments for a user, optionally filtered by status"""
+async def transition_payment(payment_id, to_status, update_data=None):
+    """Atomically move a payment to `to_status` if its current status allows it"""
+    expected = sources_for(PAYMENT_TRANSITIONS, to_status)
     session = get_session()
     try:
-        # Находим пользователя по telegram_id, если передан telegram_id вместо user_id
-        if isinstance(user_id, int) and user_id > 1000000:  # Предполагаем, что это telegram_id
-            user = session.query(User).filter_by(telegram_id=user_id).first()
-            if user:
-                user_id = user.id
-            else:
-                logger.error(f"User with telegram_id {user_id} not found")
-                return []
+        values = dict(update_data or {})
+        values["status"] = to_status
         
-        # Формируем запрос в зависимости от статуса
-        query = session.query(Payment).filter_by(user_id=user_id)
-        if status:
-            query = query.filter_by(status=status)
-            
-        payments = query.all()
-        return payments
+        # Условный UPDATE: при конкурентной обработке выигрывает только один процесс
+        updated = session.query(Payment).filter(
+            and_(
+                Payment.payment_id == payment_id,
+                Payment.status.in_(expected)
+            )
+        ).update(values, synchronize_session=False)
+        
+        session.commit()
+        if updated:
+            logger.info(f"Payment {payment_id} moved to {to_status}")
+        return updated == 1
     except SQLAlchemyError as e:
-        logger.error(f"Error getting user payments: {e}")
-        return []
+        session.rollback()
+        logger.error(f"Error changing payment status: {e}")
+        return False
     finally:
-        session.close()
\ No newline at end of file
+        session.close()
+
+async def complete_payment(payment_id, payment_values, subscription_values, notification=None):
+    """
+    Проводит оплаченный платеж одной транзакцией: переводит платеж в succeeded,
+    активирует его подписку и ставит уведомление в outbox.
+    
+    Если платеж уже succeeded, а подписка еще ждет активации (сбой между
+    шагами в прежних версиях), повторный вызов активирует её.
+    
+    Returns:
+        bool: True, если подписку активировал этот вызов; False, если платеж
+        нельзя провести или всё уже сделано; None при ошибке
+    """
+    session = get_session()
+    try:
+        now = datetime.now()
+        # Условные UPDATE: при конкурентной обработке подписку активирует один процесс
+        claimed = session.query(Payment).filter(
+            Payment.payment_id == payment_id,
+            Payment.status.in_(sources_for(PAYMENT_TRANSITIONS, "succeeded"))
+        ).update({**payment_values, "status": "succeeded"}, synchronize_session=False)
+        payment = session.query(Payment.status, Payment.subscription_id).filter_by(
+            payment_id=payment_id
+        ).first()
+        if payment is None or payment.status != "succeeded":
+            session.rollback()
+            return False
+        
+        activated = session.query(Subscription).filter(
+            Subscription.subscription_id == payment.subscription_id,
+            Subscription.status.in_(sources_for(SUBSCRIPTION_TRANSITIONS, "active"))
+        ).update({**subscription_values, "status": "active"}, synchronize_session=False)
+        if activated and notification:
+            session.add(Notification(
+                chat_id=notification["chat_id"],
+                text=notification["text"],
+                parse_mode=notification.get("parse_mode"),
+                reply_markup=notification.get("reply_markup"),
+                status="pending",
+                attempts=0,
+                created_at=now,
+                next_attempt_at=now
+            ))
+        session.commit()
+        
+        if not activated:
+            if claimed:
+                # Деньги получены, платеж остается succeeded
+                logger.error(f"Subscription {payment.subscription_id} of payment {payment_id} could not be activated")
+            return False
+        logger.info(f"Payment {payment_id} completed, subscription {payment.subscription_id} activated")
+        row = session.query(Subscription.id, Subscription.expires_at).filter_by(
+            subscription_id=payment.subscription_id
+        ).first()
+        _expiry_changed(row.id, row.expires_at)
+        return True
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error completing payment: {e}")
+        return None
+    finally:
+        session.close()
+
+async def get_stale_pending_payments(created_before, after=None, limit=100):
+    """Get a page of unsettled payments created before `created_before`.
+    
+    Unsettled are the statuses that can still move to succeeded: pending,
+    waiting_for_capture and expired. Pages are keyset-paginated by
+    (created_at, id) and read through the partial ix_payments_unsettled_created_at
+    index, `after` is the (created_at, id) of the last payment of the previous page.
+    """
+    session = get_session()
+    try:
+        query = session.query(*PaymentRow.columns(Payment)).filter(
+            and_(
+                Payment.status.in_(sources_for(PAYMENT_TRANSITIONS, "succeeded")),
+                Payment.created_at < created_before
+            )
+        )
+        
+        if after:
+            last_created_at, last_id = after
+            query = query.filter(
+                or_(
+                    Payment.created_at > last_created_at,
+                    and_(
+                        Payment.created_at == last_created_at,
+                        Payment.id > last_id
+                    )
+                )
+            )
+        
+        return [
+            PaymentRow.from_row(row)
+            for row in query.order_by(Payment.created_at, Payment.id).limit(limit)
+        ]
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting stale pending payments: {e}")
+        return []
+    finally:
+        session.close()
+
+async def get_oldest_pending_payment_time():
+    """Get creation time of the oldest unsettled payment (None if there are none)"""
+    session = get_session()
+    try:
+        return session.query(func.min(Payment.created_at)).filter(
+            Payment.status.in_(sources_for(PAYMENT_TRANSITIONS, "succeeded"))
+        ).scalar()
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting oldest pending payment: {e}")
+        return None
+    finally:
+        session.close()
+
+async def get_user_payments(user_id, status=None):
+    """Get all payments for a user, optionally filtered by status"""
+    session = get_session()
+    try:
+        # Находим пользователя по telegram_id, если передан telegram_id вместо user_id
+        if isinstance(user_id, int) and user_id > 1000000:  # Предполагаем, что это telegram_id
+            user = session.query(User).filter_by(telegram_id=user_id).first()
+            if user:
+                user_id = user.id
+            else:
+                logger.error(f"User with telegram_id {user_id} not found")
+                return []
+        
+        # Формируем запрос в зависимости от статуса
+        query = session.query(*PaymentRow.columns(Payment)).filter_by(user_id=user_id)
+        if status:
+            query = query.filter_by(status=status)
+            
+        return [PaymentRow.from_row(row) for row in query]
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting user payments: {e}")
+        return []
+    finally:
+        session.close()
+
+async def is_event_processed(event_id):
+    """Check whether a webhook event has already been processed"""
+    session = get_session()
+    try:
+        return session.query(ProcessedEvent.id).filter_by(event_id=event_id).first() is not None
+    except SQLAlchemyError as e:
+        logger.error(f"Error checking processed event: {e}")
+        return False
+    finally:
+        session.close()
+
+async def mark_event_processed(event_id, event_type=None):
+    """Record a processed webhook event, returns False if it was already recorded"""
+    session = get_session()
+    try:
+        session.add(ProcessedEvent(
+            event_id=event_id,
+            event_type=event_type,
+            created_at=datetime.now()
+        ))
+        session.commit()
+        return True
+    except IntegrityError:
+        session.rollback()
+        logger.info(f"Event {event_id} already recorded")
+        return False
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error recording processed event: {e}")
+        return False
+    finally:
+        session.close()
+
+async def enqueue_notification(notification_data):
+    """Add a notification to the outbox, returns its ID"""
+    session = get_session()
+    try:
+        now = datetime.now()
+        notification = Notification(
+            chat_id=notification_data["chat_id"],
+            text=notification_data["text"],
+            parse_mode=notification_data.get("parse_mode"),
+            reply_markup=notification_data.get("reply_markup"),
+            status="pending",
+            attempts=0,
+            created_at=now,
+            next_attempt_at=notification_data.get("next_attempt_at", now)
+        )
+        session.add(notification)
+        session.commit()
+        return notification.id
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error enqueuing notification: {e}")
+        return None
+    finally:
+        session.close()
+
+async def claim_due_notifications(limit=50, lease_seconds=60):
+    """Claim a batch of due notifications for sending.
+    
+    Claimed rows are leased: their next_attempt_at moves `lease_seconds` ahead,
+    so other senders skip them, and a crashed sender's rows become due again.
+    """
+    session = get_session()
+    try:
+        now = datetime.now()
+        lease_id = uuid.uuid4().hex
+        
+        due = and_(
+            Notification.status == "pending",
+            Notification.next_attempt_at <= now
+        )
+        ids = [row.id for row in session.query(Notification.id).filter(due).order_by(
+            Notification.next_attempt_at, Notification.id
+        ).limit(limit)]
+        if not ids:
+            return []
+        
+        # Условие повторяется в UPDATE: строки, уже занятые другим отправщиком, пропускаются
+        session.query(Notification).filter(
+            and_(Notification.id.in_(ids), due)
+        ).update({
+            "lease_id": lease_id,
+            "next_attempt_at": now + timedelta(seconds=lease_seconds)
+        }, synchronize_session=False)
+        session.commit()
+        
+        rows = session.query(*NotificationRow.columns(Notification)).filter_by(
+            lease_id=lease_id
+        ).order_by(Notification.id).all()
+        return [NotificationRow.from_row(row) for row in rows]
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error claiming notifications: {e}")
+        return []
+    finally:
+        session.close()
+
+async def mark_notifications_sent(notification_ids):
+    """Mark a batch of notifications as sent"""
+    if not notification_ids:
+        return True
+    
+    session = get_session()
+    try:
+        session.query(Notification).filter(
+            Notification.id.in_(notification_ids)
+        ).update({
+            "status": "sent",
+            "sent_at": datetime.now()
+        }, synchronize_session=False)
+        session.commit()
+        return True
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error marking notifications as sent: {e}")
+        return False
+    finally:
+        session.close()
+
+async def reschedule_notification(notification_id, next_attempt_at, failed=False, count_attempt=False):
+    """Schedule another delivery attempt, or give up if `failed` is set.
+    
+    `count_attempt` adds a failed delivery to attempts; a postponement
+    (flood control) does not use one up.
+    """
+    session = get_session()
+    try:
+        update_data = {"next_attempt_at": next_attempt_at}
+        if count_attempt:
+            update_data["attempts"] = Notification.attempts + 1
+        if failed:
+            update_data["status"] = "failed"
+        
+        session.query(Notification).filter(
+            Notification.id == notification_id
+        ).update(update_data, synchronize_session=False)
+        session.commit()
+        return True
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error rescheduling notification: {e}")
+        return False
+    finally:
+        session.close()
+
+async def create_broadcast_job(job_data):
+    """Create a broadcast job, returns its ID"""
+    session = get_session()
+    try:
+        job = BroadcastJob(
+            text=job_data["text"],
+            parse_mode=job_data.get("parse_mode"),
+            status="running",
+            created_by=job_data.get("created_by"),
+            created_at=datetime.now(),
+            cursor_user_id=0,
+            total=job_data.get("total", 0),
+            sent_count=0,
+            failed_count=0,
+            status_chat_id=job_data.get("status_chat_id"),
+            status_message_id=job_data.get("status_message_id")
+        )
+        session.add(job)
+        session.commit()
+        logger.info(f"Broadcast job {job.id} created successfully")
+        return job.id
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error creating broadcast job: {e}")
+        return None
+    finally:
+        session.close()
+
+async def get_broadcast_job(job_id):
+    """Get broadcast job by ID"""
+    session = get_session()
+    try:
+        return BroadcastJobRow.from_row(
+            session.query(*BroadcastJobRow.columns(BroadcastJob)).filter_by(id=job_id).first()
+        )
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting broadcast job: {e}")
+        return None
+    finally:
+        session.close()
+
+async def get_running_broadcast_jobs():
+    """Get all unfinished broadcast jobs"""
+    session = get_session()
+    try:
+        rows = session.query(*BroadcastJobRow.columns(BroadcastJob)).filter_by(
+            status="running"
+        ).order_by(BroadcastJob.id).all()
+        return [BroadcastJobRow.from_row(row) for row in rows]
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting running broadcast jobs: {e}")
+        return []
+    finally:
+        session.close()
+
+async def update_broadcast_job(job_id, update_data):
+    """Update broadcast job data"""
+    session = get_session()
+    try:
+        session.query(BroadcastJob).filter_by(id=job_id).update(update_data, synchronize_session=False)
+        session.commit()
+        return True
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error updating broadcast job: {e}")
+        return False
+    finally:
+        session.close()
+
+async def get_broadcast_recipient_statuses(job_id, telegram_ids):
+    """Get {telegram_id: status} for recipients of a job already recorded"""
+    if not telegram_ids:
+        return {}
+    
+    session = get_session()
+    try:
+        rows = session.query(BroadcastRecipient.telegram_id, BroadcastRecipient.status).filter(
+            and_(
+                BroadcastRecipient.job_id == job_id,
+                BroadcastRecipient.telegram_id.in_(telegram_ids)
+            )
+        ).all()
+        return {row.telegram_id: row.status for row in rows}
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting broadcast recipients: {e}")
+        return {}
+    finally:
+        session.close()
+
+async def record_broadcast_page(job_id, results, cursor_user_id):
+    """Record delivery results of one page and advance the job cursor in one transaction.
+    
+    `results` is a list of (telegram_id, status, error) tuples.
+    """
+    session = get_session()
+    try:
+        now = datetime.now()
+        session.add_all([
+            BroadcastRecipient(
+                job_id=job_id,
+                telegram_id=telegram_id,
+                status=status,
+                error=(error or "")[:255] or None,
+                updated_at=now
+            )
+            for telegram_id, status, error in results
+        ])
+        
+        sent = sum(1 for _, status, _ in results if status == "sent")
+        session.query(BroadcastJob).filter_by(id=job_id).update({
+            "cursor_user_id": cursor_user_id,
+            "sent_count": BroadcastJob.sent_count + sent,
+            "failed_count": BroadcastJob.failed_count + (len(results) - sent)
+        }, synchronize_session=False)
+        
+        session.commit()
+        return True
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error recording broadcast page: {e}")
+        return False
+    finally:
+        session.close()
+
+# Admin job operations
+ADMIN_JOB_ID_CHUNK = 500  # telegram_id в одном IN (...) при выборе целей
+
+def _active_subscription_users(session, now, plan_id=None):
+    """Subquery of users.id having an active, not expired subscription"""
+    query = session.query(Subscription.user_id).filter(
+        Subscription.status == "active",
+        or_(
+            Subscription.expires_at > now,
+            Subscription.expires_at == None
+        )
+    )
+    if plan_id is not None:
+        query = query.filter(Subscription.plan_id == plan_id)
+    return query
+
+async def create_admin_job(job_data, user_filter="all", telegram_ids=None):
+    """
+    Create a bulk admin job together with its target users, returns its ID.
+    
+    Targets are the users with the given telegram ids, or the users matching
+    `user_filter`: "all", "active", "inactive" or "plan:<plan_id>"
+    (active subscribers of the plan). They are selected with INSERT ... SELECT.
+    """
+    session = get_session()
+    try:
+        job = AdminJob(
+            action=job_data["action"],
+            params=job_data.get("params"),
+            status="running",
+            created_by=job_data.get("created_by"),
+            created_at=datetime.now(),
+            cursor_user_id=0,
+            total=0,
+            done_count=0,
+            failed_count=0,
+            status_chat_id=job_data.get("status_chat_id"),
+            status_message_id=job_data.get("status_message_id")
+        )
+        session.add(job)
+        session.flush()
+        
+        now = datetime.now()
+        if telegram_ids is not None:
+            telegram_ids = sorted(set(telegram_ids))
+            selections = [
+                User.telegram_id.in_(telegram_ids[start:start + ADMIN_JOB_ID_CHUNK])
+                for start in range(0, len(telegram_ids), ADMIN_JOB_ID_CHUNK)
+            ]
+        elif user_filter == "all":
+            selections = [true()]
+        elif user_filter == "active":
+            selections = [User.id.in_(_active_subscription_users(session, now))]
+        elif user_filter == "inactive":
+            selections = [~User.id.in_(_active_subscription_users(session, now))]
+        elif user_filter.startswith("plan:"):
+            plan_id = user_filter[len("plan:"):]
+            selections = [User.id.in_(_active_subscription_users(session, now, plan_id))]
+        else:
+            raise ValueError(f"Unknown user filter: {user_filter}")
+        
+        for selection in selections:
+            session.execute(insert(AdminJobTarget).from_select(
+                ["job_id", "user_id"],
+                select(literal(job.id), User.id).where(selection)
+            ))
+        
+        job.total = session.query(func.count()).filter(AdminJobTarget.job_id == job.id).scalar()
+        session.commit()
+        logger.info(f"Admin job {job.id} ({job.action}) created for {job.total} users")
+        return job.id
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error creating admin job: {e}")
+        return None
+    finally:
+        session.close()
+
+async def get_admin_job(job_id):
+    """Get admin job by ID"""
+    session = get_session()
+    try:
+        return AdminJobRow.from_row(
+            session.query(*AdminJobRow.columns(AdminJob)).filter_by(id=job_id).first()
+        )
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting admin job: {e}")
+        return None
+    finally:
+        session.close()
+
+async def get_running_admin_jobs():
+    """Get all unfinished admin jobs"""
+    session = get_session()
+    try:
+        rows = session.query(*AdminJobRow.columns(AdminJob)).filter_by(
+            status="running"
+        ).order_by(AdminJob.id).all()
+        return [AdminJobRow.from_row(row) for row in rows]
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting running admin jobs: {e}")
+        return []
+    finally:
+        session.close()
+
+async def update_admin_job(job_id, update_data):
+    """Update admin job data"""
+    session = get_session()
+    try:
+        session.query(AdminJob).filter_by(id=job_id).update(update_data, synchronize_session=False)
+        session.commit()
+        return True
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error updating admin job: {e}")
+        return False
+    finally:
+        session.close()
+
+async def get_admin_job_targets(job_id, after_user_id=0, limit=200):
+    """Get a page of (users.id, telegram_id) targets of a job ordered by users.id"""
+    session = get_session()
+    try:
+        rows = session.query(User.id, User.telegram_id).join(
+            AdminJobTarget, AdminJobTarget.user_id == User.id
+        ).filter(
+            AdminJobTarget.job_id == job_id,
+            User.id > after_user_id
+        ).order_by(User.id).limit(limit).all()
+        return [(row.id, row.telegram_id) for row in rows]
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting admin job targets: {e}")
+        return []
+    finally:
+        session.close()
+
+def _advance_admin_job(session, job_id, cursor_user_id, done, failed):
+    """Move the job cursor past a page and add its counters, in the caller's transaction"""
+    session.query(AdminJob).filter_by(id=job_id).update({
+        "cursor_user_id": cursor_user_id,
+        "done_count": AdminJob.done_count + done,
+        "failed_count": AdminJob.failed_count + failed
+    }, synchronize_session=False)
+
+async def record_admin_job_page(job_id, cursor_user_id, done, failed):
+    """Advance the job cursor and counters after a page without other changes"""
+    session = get_session()
+    try:
+        _advance_admin_job(session, job_id, cursor_user_id, done, failed)
+        session.commit()
+        return True
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error recording admin job page: {e}")
+        return False
+    finally:
+        session.close()
+
+async def get_users_live_keys(user_ids):
+    """
+    Get non-deleted access keys of many users in one query.
+    
+    Returns:
+        list: Dicts with user_id (users.id), telegram_id, key_id, name, access_url
+    """
+    session = get_session()
+    try:
+        rows = session.query(
+            AccessKey.user_id, User.telegram_id, AccessKey.key_id, AccessKey.name, AccessKey.access_url
+        ).join(User, User.id == AccessKey.user_id).filter(
+            AccessKey.user_id.in_(user_ids),
+            AccessKey.deleted == False
+        ).order_by(AccessKey.user_id, AccessKey.id).all()
+        return [row._asdict() for row in rows]
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting users live keys: {e}")
+        return []
+    finally:
+        session.close()
+
+async def extend_active_subscriptions(user_ids, days, job_id=None, cursor_user_id=None):
+    """
+    Продлевает активные подписки пользователей на `days` дней одной транзакцией.
+    
+    Истекшие, но не закрытые подписки продлеваются от текущего момента,
+    бессрочные не меняются. С job_id в той же транзакции продвигается курсор
+    задачи, поэтому после перезапуска страница не продлевается повторно.
+    
+    Returns:
+        set: users.id пользователей, у которых есть активная подписка, или None при ошибке
+    """
+    session = get_session()
+    try:
+        now = datetime.now()
+        rows = session.query(Subscription.id, Subscription.user_id, Subscription.expires_at).filter(
+            Subscription.user_id.in_(user_ids),
+            Subscription.status == "active"
+        ).all()
+        
+        changes = [
+            {"id": row.id, "expires_at": max(row.expires_at, now) + timedelta(days=days)}
+            for row in rows
+            if row.expires_at is not None
+        ]
+        session.bulk_update_mappings(Subscription, changes)
+        extended = {row.user_id for row in rows}
+        if job_id is not None:
+            _advance_admin_job(session, job_id, cursor_user_id, len(extended), len(user_ids) - len(extended))
+        session.commit()
+        for change in changes:
+            _expiry_changed(change["id"], change["expires_at"])
+        return extended
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error extending subscriptions: {e}")
+        return None
+    finally:
+        session.close()
+
+async def revoke_users_access(user_ids, deleted_key_ids, job_id=None, cursor_user_id=None, failed=0):
+    """
+    Закрывает доступ пользователей одной транзакцией: помечает ключи удаленными,
+    переводит активные подписки в inactive и снимает is_premium.
+    
+    С job_id в той же транзакции продвигается курсор задачи: user_ids
+    считаются обработанными, `failed` - пользователями с ошибкой.
+    """
+    session = get_session()
+    try:
+        if deleted_key_ids:
+            session.query(AccessKey).filter(
+                AccessKey.key_id.in_(list(deleted_key_ids))
+            ).update({"deleted": True}, synchronize_session=False)
+        if user_ids:
+            session.query(Subscription).filter(
+                Subscription.user_id.in_(user_ids),
+                Subscription.status.in_(sources_for(SUBSCRIPTION_TRANSITIONS, "inactive"))
+            ).update({"status": "inactive"}, synchronize_session=False)
+            session.query(User).filter(User.id.in_(user_ids)).update(
+                {"is_premium": False}, synchronize_session=False
+            )
+        if job_id is not None:
+            _advance_admin_job(session, job_id, cursor_user_id, len(user_ids), failed)
+        session.commit()
+        logger.info(f"Revoked access of {len(user_ids)} users, {len(deleted_key_ids)} keys deleted")
+        return True
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error revoking users access: {e}")
+        return False
+    finally:
+        session.close()
+
+async def replace_access_keys(replacements, notifications=(), job_id=None, cursor_user_id=None,
+                              done=0, failed=0):
+    """
+    Заменяет ключи на перенесенные и ставит уведомления в outbox одной транзакцией.
+    
+    Args:
+        replacements: Список (старый key_id, новый key_id, новый access_url)
+        notifications: Уведомления в формате enqueue_notification
+        job_id: Задача, чей курсор и счетчики продвигаются в той же транзакции
+    """
+    session = get_session()
+    try:
+        now = datetime.now()
+        for old_key_id, new_key_id, access_url in replacements:
+            session.query(AccessKey).filter_by(key_id=old_key_id).update(
+                {"key_id": new_key_id, "access_url": access_url}, synchronize_session=False
+            )
+        session.add_all([
+            Notification(
+                chat_id=notification["chat_id"],
+                text=notification["text"],
+                parse_mode=notification.get("parse_mode"),
+                status="pending",
+                attempts=0,
+                created_at=now,
+                next_attempt_at=now
+            )
+            for notification in notifications
+        ])
+        if job_id is not None:
+            _advance_admin_job(session, job_id, cursor_user_id, done, failed)
+        session.commit()
+        return True
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error replacing access keys: {e}")
+        return False
+    finally:
+        session.close()
+
+# Plan catalog operations
+PLAN_FIELDS = ("name", "duration", "price", "devices", "discount", "description", "active")
+
+def _plan_to_dict(plan):
+    return {field: getattr(plan, field) for field in PLAN_FIELDS}
+
+async def seed_plans(plans_config):
+    """Fill the plans table from config if the catalog has never been stored"""
+    session = get_session()
+    try:
+        if session.get(PlanCatalogVersion, 1):
+            return False
+        
+        for plan_id, plan in plans_config.items():
+            session.add(TariffPlan(
+                id=plan_id,
+                name=plan["name"],
+                duration=plan["duration"],
+                price=plan["price"],
+                devices=plan.get("devices", 1),
+                discount=plan.get("discount"),
+                description=plan.get("description"),
+                active=True
+            ))
+        session.add(PlanCatalogVersion(id=1, version=1))
+        session.commit()
+        logger.info(f"Plan catalog seeded with {len(plans_config)} plans")
+        return True
+    except IntegrityError:
+        # Каталог уже заполнил другой процесс
+        session.rollback()
+        return False
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error seeding plans: {e}")
+        return False
+    finally:
+        session.close()
+
+async def get_plan_catalog_version():
+    """Get the current plan catalog version (one-row lookup)"""
+    session = get_session()
+    try:
+        return session.query(PlanCatalogVersion.version).filter_by(id=1).scalar()
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting plan catalog version: {e}")
+        return None
+    finally:
+        session.close()
+
+async def get_plan_catalog():
+    """
+    Get all plans with the catalog version they belong to.
+    
+    The version is read before and after the plans; if an edit slipped in
+    between, the read is repeated, so the plans always match the version.
+    
+    Returns:
+        tuple: (version, {plan_id: plan dict}) or (None, {}) on error
+    """
+    session = get_session()
+    try:
+        for _ in range(3):
+            version = session.query(PlanCatalogVersion.version).filter_by(id=1).scalar()
+            plans = {plan.id: _plan_to_dict(plan) for plan in session.query(TariffPlan).all()}
+            # Новая транзакция, чтобы увидеть правки, закоммиченные во время чтения
+            session.rollback()
+            if session.query(PlanCatalogVersion.version).filter_by(id=1).scalar() == version:
+                return version, plans
+        logger.warning("Plan catalog kept changing while being read")
+        return None, {}
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting plan catalog: {e}")
+        return None, {}
+    finally:
+        session.close()
+
+async def update_plan(plan_id, update_data):
+    """
+    Update a plan and bump the catalog version in one transaction.
+    
+    Returns:
+        int: New catalog version or None if the plan was not found or on error
+    """
+    session = get_session()
+    try:
+        values = {field: value for field, value in update_data.items() if field in PLAN_FIELDS}
+        values["updated_at"] = datetime.now()
+        updated = session.query(TariffPlan).filter_by(id=plan_id).update(
+            values, synchronize_session=False
+        )
+        if not updated:
+            session.rollback()
+            return None
+        
+        session.query(PlanCatalogVersion).filter_by(id=1).update({
+            "version": PlanCatalogVersion.version + 1,
+            "updated_at": datetime.now()
+        }, synchronize_session=False)
+        session.commit()
+        return session.query(PlanCatalogVersion.version).filter_by(id=1).scalar()
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error updating plan: {e}")
+        return None
+    finally:
+        session.close()
+
+# User state (context.user_data) operations
+async def get_user_state(telegram_id):
+    """
+    Get the stored user_data of a user.
+    
+    Returns:
+        str: JSON of the state, "" if nothing is stored, None on error
+    """
+    session = get_session()
+    try:
+        state = session.query(UserState.data).filter_by(telegram_id=telegram_id).scalar()
+        return state or ""
+    except SQLAlchemyError as e:
+        logger.error(f"Error getting user state: {e}")
+        return None
+    finally:
+        session.close()
+
+async def save_user_states(states, deleted_ids=()):
+    """Write changed user states and delete dropped ones in one transaction.
+    
+    `states` maps telegram_id to the JSON of its state.
+    """
+    session = get_session()
+    try:
+        if states:
+            now = datetime.now()
+            dialect = postgresql if session.get_bind().dialect.name == "postgresql" else sqlite
+            stmt = dialect.insert(UserState).values([
+                {"telegram_id": telegram_id, "data": data, "updated_at": now}
+                for telegram_id, data in states.items()
+            ])
+            session.execute(stmt.on_conflict_do_update(
+                index_elements=["telegram_id"],
+                set_={"data": stmt.excluded.data, "updated_at": stmt.excluded.updated_at}
+            ))
+        if deleted_ids:
+            session.query(UserState).filter(
+                UserState.telegram_id.in_(list(deleted_ids))
+            ).delete(synchronize_session=False)
+        
+        session.commit()
+        return True
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Error saving user states: {e}")
+        return False
+    finally:
+        session.close()
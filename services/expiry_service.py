@@ -0,0 +1,345 @@
+"""
+Окончание подписок: уведомления, отключение и отзыв ключей.
+
+События окончания держатся в памяти процесса в min-heap: для каждой активной
+подписки, срок которой наступает в ближайшие EXPIRY_SCHEDULER_HORIZON секунд,
+- уведомления за EXPIRY_NOTICE_WINDOWS дней (например, за 3 дня и за 1 день)
+и само окончание. Планировщик спит до ближайшего события; при создании или
+продлении подписки база сообщает новый срок (add_expiry_listener), и события
+добавляются сразу. Раз в EXPIRY_SCHEDULER_RELOAD_INTERVAL горизонт
+перечитывается по индексу (status, expires_at) - так подхватываются подписки,
+измененные другими процессами. Событие проверяется по базе в момент
+срабатывания: устаревшие (подписку продлили или закрыли) пропускаются.
+
+В момент окончания подписка переводится в inactive, ее ключи удаляются в
+Outline, пользователь получает уведомление. Подписка помечается окном и
+сроком, о котором пользователь уже предупрежден, поэтому повторно уведомление
+не уходит, а после продления срок меняется и уведомления приходят снова.
+Подписки одного пользователя собираются в одно сообщение. Сообщения ставятся
+в outbox вместе с отметкой одной транзакцией, доставляет их отправщик
+уведомлений с общим ограничением частоты.
+
+После запуска один проход по окнам (страницами, по тому же индексу) догоняет
+то, что наступило, пока бот был остановлен.
+"""
+
+import asyncio
+import functools
+import heapq
+import json
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from config import (
+    EXPIRY_NOTICE_WINDOWS, EXPIRY_NOTICE_PAGE_SIZE, EXPIRY_SCHEDULER_HORIZON,
+    EXPIRY_SCHEDULER_RELOAD_INTERVAL, EXPIRY_REVOKE_CONCURRENCY
+)
+from services.repository import repository as db
+from services.outline_service import delete_stored_key
+from services.plan_catalog import get_catalog
+from utils import metrics
+from utils.helpers import format_expiry_date
+
+logger = logging.getLogger(__name__)
+
+# Окно "после окончания" охватывает подписки, истекшие не раньше этого срока
+EXPIRED_LOOKBACK = timedelta(days=1)
+
+EXPIRY_TEMPLATES = {
+    0: (
+        "⌛ <b>Подписка закончилась</b>\n\n"
+        "{subscriptions}\n\n"
+        "Продлите подписку, чтобы VPN снова заработал."
+    ),
+    1: (
+        "⏰ <b>Подписка заканчивается завтра</b>\n\n"
+        "{subscriptions}\n\n"
+        "Продлите её заранее, чтобы не остаться без VPN."
+    ),
+}
+DEFAULT_TEMPLATE = (
+    "🔔 <b>Подписка заканчивается через {days} дн.</b>\n\n"
+    "{subscriptions}\n\n"
+    "Продлить подписку можно в меню бота."
+)
+SUBSCRIPTION_LINE = "🔑 {plan_name} - до {expires}"
+
+@functools.lru_cache(maxsize=None)
+def _template(days):
+    """Шаблон сообщения окна с подставленным числом дней"""
+    return EXPIRY_TEMPLATES.get(days, DEFAULT_TEMPLATE).replace("{days}", str(days))
+
+@functools.lru_cache(maxsize=1)
+def _renew_markup():
+    """Клавиатура с кнопкой продления, сериализованная для outbox"""
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("💳 Продлить подписку", callback_data="buy")]])
+    return json.dumps(keyboard.to_dict(), ensure_ascii=False)
+
+def _render(days, subscriptions):
+    """Текст уведомления об окончании для подписок одного пользователя"""
+    catalog = get_catalog()
+    lines = [
+        SUBSCRIPTION_LINE.format(
+            plan_name=(catalog.get(subscription["plan_id"]) or {}).get("name", subscription["plan_id"]),
+            expires=subscription["expires_at"].strftime("%d.%m.%Y %H:%M") if days == 0
+            else format_expiry_date(subscription["expires_at"])
+        )
+        for subscription in subscriptions
+    ]
+    return _template(days).format(subscriptions="\n".join(lines))
+
+def _window_bounds(windows, index, now):
+    """Границы (начало, конец] окна windows[index]; окна идут от раннего к позднему"""
+    days = windows[index]
+    window_end = now + timedelta(days=days)
+    if index + 1 < len(windows):
+        window_start = now + timedelta(days=windows[index + 1])
+    else:
+        window_start = now - EXPIRED_LOOKBACK if days == 0 else now
+    return window_start, window_end
+
+async def _record_notices(days, subscriptions):
+    """
+    Ставит в outbox уведомления окна, по одному на пользователя, и отмечает подписки.
+
+    Returns:
+        bool: True, если записано
+    """
+    if not subscriptions:
+        return True
+    by_user = defaultdict(list)
+    for subscription in subscriptions:
+        by_user[subscription["telegram_id"]].append(subscription)
+    notifications = [
+        {
+            "chat_id": telegram_id,
+            "text": _render(days, user_subscriptions),
+            "parse_mode": "HTML",
+            "reply_markup": _renew_markup()
+        }
+        for telegram_id, user_subscriptions in by_user.items()
+    ]
+    if not await db.record_expiry_notices(days, subscriptions, notifications):
+        return False
+    metrics.inc(f"expiry.notices.{days}d", len(notifications))
+    return True
+
+def _already_notified(subscription, days):
+    """Уведомление о текущем сроке в этом или более позднем окне уже отправлено"""
+    return (
+        subscription["expiry_notice_for"] == subscription["expires_at"]
+        and subscription["expiry_notice_days"] is not None
+        and subscription["expiry_notice_days"] <= days
+    )
+
+async def _notify_window(days, window_start, window_end, page_size):
+    """
+    Ставит в outbox уведомления одного окна.
+
+    Returns:
+        int: Количество уведомленных подписок
+    """
+    notified = 0
+    after = None
+    while True:
+        page = await db.get_expiry_notice_page(days, window_start, window_end, after=after, limit=page_size)
+        if not page:
+            break
+
+        if await _record_notices(days, page):
+            notified += len(page)
+
+        after = page[-1]
+        if len(page) < page_size:
+            break
+    return notified
+
+async def send_expiry_notices(now=None, windows=EXPIRY_NOTICE_WINDOWS, page_size=EXPIRY_NOTICE_PAGE_SIZE):
+    """
+    Один проход по всем окнам.
+
+    Returns:
+        int: Количество уведомленных подписок
+    """
+    now = now or datetime.now()
+    windows = sorted(windows, reverse=True)
+    total = 0
+    for index, days in enumerate(windows):
+        window_start, window_end = _window_bounds(windows, index, now)
+        notified = await _notify_window(days, window_start, window_end, page_size)
+        if notified:
+            logger.info(f"Уведомления об окончании (окно {days} дн.): {notified} подписок")
+        total += notified
+    return total
+
+async def _revoke_key(semaphore, key_id):
+    async with semaphore:
+        try:
+            return await delete_stored_key(key_id)
+        except Exception as e:
+            logger.error(f"Error deleting key {key_id}: {e}")
+            return False
+
+async def expire_subscriptions(subscription_ids, now=None):
+    """
+    Отключает истекшие подписки, удаляет их ключи и уведомляет пользователей.
+
+    Returns:
+        int: Количество отключенных подписок
+    """
+    now = now or datetime.now()
+    # Получателей читаем до перевода в inactive
+    subscriptions = await db.get_expiry_notice_rows(subscription_ids)
+    expired, key_ids = await db.expire_subscriptions(subscription_ids, now)
+    if not expired:
+        return 0
+
+    semaphore = asyncio.Semaphore(EXPIRY_REVOKE_CONCURRENCY)
+    results = await asyncio.gather(*(_revoke_key(semaphore, key_id) for key_id in key_ids))
+    revoked = [key_id for key_id, deleted in zip(key_ids, results) if deleted]
+    if revoked:
+        await db.mark_access_keys_deleted(revoked)
+    if len(revoked) < len(key_ids):
+        logger.warning(f"Не удалось удалить {len(key_ids) - len(revoked)} ключей истекших подписок")
+
+    expired = set(expired)
+    await _record_notices(0, [
+        subscription for subscription in subscriptions
+        if subscription["id"] in expired
+        # О давно истекших подписках (бот был остановлен) не уведомляем
+        and now - subscription["expires_at"] <= EXPIRED_LOOKBACK
+        and not _already_notified(subscription, 0)
+    ])
+    metrics.inc("expiry.deactivated", len(expired))
+    metrics.inc("expiry.keys_revoked", len(revoked))
+    logger.info(f"Отключено истекших подписок: {len(expired)}, удалено ключей: {len(revoked)}")
+    return len(expired)
+
+async def expire_overdue_subscriptions(now=None, page_size=EXPIRY_NOTICE_PAGE_SIZE):
+    """
+    Отключает все подписки, которые истекли, но еще активны.
+
+    Returns:
+        int: Количество отключенных подписок
+    """
+    now = now or datetime.now()
+    total = 0
+    after_id = 0
+    while True:
+        page = await db.get_expired_active_subscriptions(now, after_id=after_id, limit=page_size)
+        if not page:
+            break
+        total += await expire_subscriptions([subscription_id for subscription_id, _ in page], now)
+        after_id = page[-1][0]
+        if len(page) < page_size:
+            break
+    return total
+
+class ExpiryScheduler:
+    """In-process min-heap of upcoming expiry notices and deactivations"""
+
+    def __init__(self, windows=EXPIRY_NOTICE_WINDOWS, horizon=EXPIRY_SCHEDULER_HORIZON,
+                 reload_interval=EXPIRY_SCHEDULER_RELOAD_INTERVAL):
+        # Окна от раннего к позднему; окно 0 - само окончание
+        self.windows = sorted(set(windows) | {0}, reverse=True)
+        self.horizon = timedelta(seconds=horizon)
+        self.reload_interval = reload_interval
+        # (время срабатывания, ID подписки, окно в днях, срок подписки)
+        self._heap = []
+        self._scheduled = set()
+        self._loaded_until = None
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, subscription_id, expires_at):
+        """Add the events of a subscription term that fall within the loaded horizon"""
+        if self._loaded_until is None or not isinstance(expires_at, datetime):
+            return
+        now = datetime.now()
+        for index, days in enumerate(self.windows):
+            fire_at = expires_at - timedelta(days=days)
+            if fire_at > self._loaded_until:
+                continue
+            # Окно уже закрылось - его уведомление опоздало
+            if days and expires_at - timedelta(days=self.windows[index + 1]) <= now:
+                continue
+            event = (subscription_id, days, expires_at)
+            if event in self._scheduled:
+                continue
+            self._scheduled.add(event)
+            entry = (fire_at, subscription_id, days, expires_at)
+            heapq.heappush(self._heap, entry)
+            if self._heap[0] is entry:
+                self._wakeup.set()
+
+    async def reload(self, now=None):
+        """Отключает просроченные подписки и загружает события горизонта"""
+        now = now or datetime.now()
+        await expire_overdue_subscriptions(now)
+        self._loaded_until = now + self.horizon
+        for subscription_id, expires_at in await db.get_subscription_expiries(
+            now, self._loaded_until + timedelta(days=self.windows[0])
+        ):
+            self.schedule(subscription_id, expires_at)
+        logger.info(f"Планировщик окончаний: {len(self._heap)} событий до {self._loaded_until}")
+
+    def _pop_due(self, now):
+        due = defaultdict(dict)
+        while self._heap and self._heap[0][0] <= now:
+            _, subscription_id, days, expires_at = heapq.heappop(self._heap)
+            self._scheduled.discard((subscription_id, days, expires_at))
+            due[days][subscription_id] = expires_at
+        return due
+
+    async def _fire(self, due, now):
+        for days, scheduled in due.items():
+            if days == 0:
+                await expire_subscriptions(list(scheduled), now)
+                continue
+            subscriptions = [
+                subscription for subscription in await db.get_expiry_notice_rows(list(scheduled))
+                # Срок изменился после постановки события - для нового срока есть свое событие
+                if subscription["expires_at"] == scheduled[subscription["id"]]
+                and not _already_notified(subscription, days)
+            ]
+            await _record_notices(days, subscriptions)
+
+    async def run(self):
+        """Обрабатывает события до остановки процесса"""
+        db.add_expiry_listener(self.schedule)
+        now = datetime.now()
+        await self.reload(now)
+        # Догоняем уведомления, окна которых открылись, пока бот был остановлен
+        await send_expiry_notices(now, windows=[days for days in self.windows if days])
+        next_reload = time.monotonic() + self.reload_interval
+
+        while True:
+            try:
+                now = datetime.now()
+                due = self._pop_due(now)
+                if due:
+                    await self._fire(due, now)
+                if time.monotonic() >= next_reload:
+                    next_reload = time.monotonic() + self.reload_interval
+                    await self.reload()
+            except Exception as e:
+                logger.error(f"Error processing expiry events: {e}")
+
+            self._wakeup.clear()
+            timeout = next_reload - time.monotonic()
+            if self._heap:
+                timeout = min(timeout, (self._heap[0][0] - datetime.now()).total_seconds())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
+
+async def run_expiry_scheduler():
+    """Запускает планировщик окончаний подписок"""
+    await ExpiryScheduler().run()
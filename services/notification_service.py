@@ -0,0 +1,156 @@
+"""
+Outbox уведомлений пользователям.
+
+Платежи и другие фоновые процессы не ходят в Telegram сами: они добавляют
+запись в таблицу notifications, а отправщик, работающий в процессе бота,
+доставляет её через общий экземпляр бота приложения; лимиты Telegram соблюдает
+общий ограничитель исходящих запросов (приоритет выше рассылок, ниже ответов).
+"""
+
+import asyncio
+import json
+import logging
+from datetime import datetime, timedelta
+
+from telegram import InlineKeyboardMarkup
+from telegram.error import RetryAfter, Forbidden, BadRequest
+
+from config import (
+    NOTIFICATION_BATCH_SIZE, NOTIFICATION_POLL_INTERVAL, NOTIFICATION_MAX_ATTEMPTS
+)
+from services.repository import repository as db
+from utils.rate_limit import retry_after_seconds
+from utils.outbound import NOTIFICATION
+
+logger = logging.getLogger(__name__)
+
+# Будит отправщика, когда уведомление добавлено в этом же процессе
+_wakeup = asyncio.Event()
+
+def build_notification(chat_id, text, parse_mode=None, reply_markup=None):
+    """
+    Собирает запись уведомления для outbox.
+    
+    Её можно передать в функции репозитория, которые ставят уведомление
+    в той же транзакции, что и другие изменения; после них вызывается wake_sender().
+    
+    Args:
+        chat_id (int): Telegram ID получателя
+        text (str): Текст сообщения
+        parse_mode (str, optional): Режим разметки (HTML, Markdown)
+        reply_markup (InlineKeyboardMarkup, optional): Клавиатура
+    """
+    return {
+        "chat_id": chat_id,
+        "text": text,
+        "parse_mode": parse_mode,
+        "reply_markup": json.dumps(reply_markup.to_dict(), ensure_ascii=False) if reply_markup else None
+    }
+
+def wake_sender():
+    """Будит отправщика этого процесса после записи уведомлений в outbox"""
+    _wakeup.set()
+
+async def enqueue_notification(chat_id, text, parse_mode=None, reply_markup=None):
+    """
+    Добавляет уведомление в outbox (аргументы как у build_notification).
+        
+    Returns:
+        ID уведомления или None при ошибке
+    """
+    notification_id = await db.enqueue_notification(
+        build_notification(chat_id, text, parse_mode=parse_mode, reply_markup=reply_markup)
+    )
+    wake_sender()
+    return notification_id
+
+def _retry_delay(attempts):
+    """Экспоненциальная задержка перед повторной попыткой"""
+    return timedelta(seconds=min(30 * 2 ** attempts, 3600))
+
+async def _deliver(bot, notification):
+    """
+    Отправляет одно уведомление.
+    
+    Returns:
+        bool: True, если сообщение доставлено
+    """
+    reply_markup = None
+    if notification.reply_markup:
+        reply_markup = InlineKeyboardMarkup.de_json(json.loads(notification.reply_markup), bot)
+    
+    try:
+        await bot.send_message(
+            chat_id=notification.chat_id,
+            text=notification.text,
+            parse_mode=notification.parse_mode,
+            reply_markup=reply_markup,
+            rate_limit_args=NOTIFICATION
+        )
+        return True
+    except RetryAfter as e:
+        # Ограничитель уже исчерпал повторы: откладываем уведомление без траты попытки доставки
+        delay = retry_after_seconds(e)
+        logger.warning(f"Flood control, уведомление {notification.id} отложено на {delay} с")
+        await db.reschedule_notification(notification.id, datetime.now() + timedelta(seconds=delay))
+    except (Forbidden, BadRequest) as e:
+        # Пользователь заблокировал бота или сообщение некорректно - повтор не поможет
+        logger.error(f"Уведомление {notification.id} не может быть доставлено: {e}")
+        await db.reschedule_notification(notification.id, datetime.now(), failed=True, count_attempt=True)
+    except Exception as e:
+        attempts = (notification.attempts or 0) + 1
+        failed = attempts >= NOTIFICATION_MAX_ATTEMPTS
+        logger.error(f"Ошибка отправки уведомления {notification.id} (попытка {attempts}): {e}")
+        await db.reschedule_notification(
+            notification.id, datetime.now() + _retry_delay(attempts), failed=failed, count_attempt=True
+        )
+    return False
+
+async def send_due_notifications(bot, batch_size=NOTIFICATION_BATCH_SIZE):
+    """
+    Отправляет одну пачку наступивших уведомлений.
+    
+    Returns:
+        int: Количество выбранных уведомлений
+    """
+    notifications = await db.claim_due_notifications(limit=batch_size)
+    if not notifications:
+        return 0
+    
+    results = await asyncio.gather(
+        *(_deliver(bot, notification) for notification in notifications)
+    )
+    
+    # Доставленные уведомления отмечаются одним запросом
+    sent_ids = [n.id for n, delivered in zip(notifications, results) if delivered]
+    await db.mark_notifications_sent(sent_ids)
+    
+    logger.info(f"Отправлено уведомлений: {len(sent_ids)} из {len(notifications)}")
+    return len(notifications)
+
+async def run_notification_sender(bot, interval_seconds=NOTIFICATION_POLL_INTERVAL):
+    """
+    Запускает отправщик уведомлений из outbox.
+    
+    Args:
+        bot: Общий экземпляр бота приложения (application.bot)
+        interval_seconds (int): Интервал проверки outbox, если его не разбудили раньше
+    """
+    logger.info(f"Запуск отправщика уведомлений с интервалом {interval_seconds} секунд")
+    
+    while True:
+        _wakeup.clear()
+        try:
+            claimed = await send_due_notifications(bot)
+        except Exception as e:
+            logger.error(f"Ошибка отправщика уведомлений: {e}")
+            claimed = 0
+        
+        # Полная пачка - вероятно, есть ещё, продолжаем сразу
+        if claimed >= NOTIFICATION_BATCH_SIZE:
+            continue
+        
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=interval_seconds)
+        except asyncio.TimeoutError:
+            pass
@@ -1,10 +1,13 @@
 import os
 import json
 import logging
+import time
 import aiohttp
 import certifi
 from datetime import datetime, timedelta
 
+from config import OUTLINE_METRICS_TTL, OUTLINE_SERVERS
+
 # Configure logging
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -14,15 +17,18 @@ logger = logging.getLogger(__name__)
 class OutlineService:
     """Service for interacting with Outline VPN API"""
     
-    def __init__(self):
-        """Initialize the Outline service with API URL"""
-        self.api_url = os.environ.get("OUTLINE_API_URL")
+    def __init__(self, api_url=None):
+        """Initialize the Outline service with API URL (OUTLINE_API_URL by default)"""
+        self.api_url = api_url or os.environ.get("OUTLINE_API_URL")
         if not self.api_url:
             logger.error("OUTLINE_API_URL environment variable is not set")
             raise ValueError("OUTLINE_API_URL environment variable is not set")
         
         # For SSL verification
         self.ssl_context = certifi.where()
+        # Снимок трафика по ключам и время его получения
+        self._traffic = None
+        self._traffic_at = 0.0
         logger.info(f"Outline API URL: {self.api_url}")
     
     async def _make_request(self, method, endpoint, data=None):
@@ -102,6 +108,33 @@ class OutlineService:
         """
         return await self._make_request("GET", "metrics")
     
+    async def get_transfer_metrics(self):
+        """Get traffic per access key
+        
+        Returns:
+            dict: Server response with bytesTransferredByUserId
+        """
+        return await self._make_request("GET", "metrics/transfer")
+    
+    async def get_traffic_by_key(self, max_age=OUTLINE_METRICS_TTL):
+        """Get traffic per access key, cached for `max_age` seconds
+        
+        Returns:
+            dict: key_id (str) -> bytes transferred
+        """
+        now = time.monotonic()
+        if self._traffic is None or now - self._traffic_at > max_age:
+            response = await self.get_transfer_metrics()
+            if not response or "error" in response:
+                # Устаревший снимок лучше, чем никакого
+                return self._traffic or {}
+            self._traffic = {
+                str(key_id): transferred
+                for key_id, transferred in response.get("bytesTransferredByUserId", {}).items()
+            }
+            self._traffic_at = now
+        return self._traffic
+    
     async def get_keys(self):
         """Get all access keys
         
@@ -268,4 +301,48 @@ class OutlineService:
         """
         # Implement this when integrating with database service
         # This functionality should be implemented in database service
-        return []
\ No newline at end of file
+        return []
+
+# Ключи основного сервера (OUTLINE_API_URL) хранятся в базе с id Outline как есть,
+# ключи серверов из OUTLINE_SERVERS - как "<сервер>:<id>"
+KEY_SERVER_SEPARATOR = ":"
+
+_services = {}
+
+def get_outline_service(server=None):
+    """Get the OutlineService of a server from OUTLINE_SERVERS, or of the main server for None"""
+    if server is not None and server not in OUTLINE_SERVERS:
+        raise ValueError(f"Unknown Outline server: {server}")
+    if server not in _services:
+        _services[server] = OutlineService(OUTLINE_SERVERS.get(server))
+    return _services[server]
+
+def split_key_id(key_id):
+    """Split a stored key_id into (server or None, id on that server)"""
+    server, separator, outline_id = str(key_id).rpartition(KEY_SERVER_SEPARATOR)
+    return (server if separator else None), outline_id
+
+def join_key_id(server, outline_id):
+    """Stored key_id of key `outline_id` on `server` (None - the main server)"""
+    return f"{server}{KEY_SERVER_SEPARATOR}{outline_id}" if server else str(outline_id)
+
+def service_for_key(key_id):
+    """
+    Сервис Outline, на котором живёт ключ, и id ключа на нём.
+    
+    Returns:
+        tuple: (OutlineService, id ключа в Outline)
+    """
+    server, outline_id = split_key_id(key_id)
+    return get_outline_service(server), outline_id
+
+async def delete_stored_key(key_id):
+    """
+    Удаляет ключ, сохраненный в базе, на его сервере Outline.
+    
+    Returns:
+        bool: True, если ключа на сервере больше нет (в том числе если его уже не было)
+    """
+    key_service, outline_id = service_for_key(key_id)
+    result = await key_service.delete_key(outline_id)
+    return bool(result.get("success")) or "status 404" in str(result.get("error", ""))
@@ -1,14 +1,19 @@
 import os
+import asyncio
 import logging
 import uuid
 import json
 from datetime import datetime, timedelta
 
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from yookassa import Configuration, Payment
 from yookassa.domain.notification import WebhookNotification, WebhookNotificationEventType
 
-from config import YUKASSA_SHOP_ID, YUKASSA_SECRET_KEY, VPN_PLANS
-import services.database_service_sql as db
+from config import YUKASSA_SHOP_ID, YUKASSA_SECRET_KEY
+from services.repository import repository as db
+from services.state_machine import PAYMENT_TRANSITIONS, SUBSCRIPTION_TRANSITIONS, can_transition
+from services.notification_service import build_notification, wake_sender
+from services.plan_catalog import get_catalog
 
 logger = logging.getLogger(__name__)
 
@@ -19,17 +24,23 @@ try:
 except Exception as e:
     logger.error(f"Failed to configure YooKassa: {e}")
 
-async def create_payment(user_id, plan_id, return_url=None):
-    """Create a payment with YooKassa"""
+async def create_payment(user_id, plan_id, return_url=None, plan=None):
+    """Create a payment with YooKassa
+    
+    `plan` is the plan from the caller's catalog snapshot; without it the
+    current catalog is used.
+    """
     try:
         logger.info(f"Starting payment creation for user_id: {user_id}, plan_id: {plan_id}")
         
         # Validate plan_id
-        if plan_id not in VPN_PLANS:
-            raise ValueError(f"Invalid plan ID: {plan_id}")
+        if plan is None:
+            catalog = get_catalog()
+            if plan_id not in catalog:
+                raise ValueError(f"Invalid plan ID: {plan_id}")
+            plan = catalog.get(plan_id)
         
         # Get plan details
-        plan = VPN_PLANS[plan_id]
         amount = plan.get("price", 0)
         logger.info(f"Plan details: {plan['name']}, price: {amount}")
         
@@ -83,12 +94,7 @@ async def create_payment(user_id, plan_id, return_url=None):
                 logger.error(f"Failed to create subscription record for free plan")
                 raise ValueError("Failed to create subscription record for free plan")
                 
-            # Получаем ID подписки (может отличаться от subscription_id)
-            if hasattr(subscription, 'subscription_id'):
-                subscription_id = subscription.subscription_id
-            else:
-                # В случае с SQLAlchemy может вернуться объект с другим атрибутом
-                subscription_id = subscription_external_id
+            subscription_id = subscription.subscription_id
             
             # Create a test payment record so we have a consistent database structure
             test_payment_id = f"test_payment_{str(uuid.uuid4())[:8]}"
@@ -202,8 +208,8 @@ async def check_payment_status(payment_id):
             logger.info(f"Test payment check for {payment_id}")
             return "succeeded"
             
-        # Get payment from YooKassa
-        payment = Payment.find_one(payment_id)
+        # Get payment from YooKassa (the SDK is synchronous, keep it off the event loop)
+        payment = await asyncio.to_thread(Payment.find_one, payment_id)
         if not payment:
             logger.error(f"Payment {payment_id} not found in YooKassa")
             return "not_found"
@@ -215,10 +221,12 @@ async def check_payment_status(payment_id):
         logger.error(f"Error checking payment status: {e}")
         return "error"
 
-async def process_payment(payment_id):
-    """Process a successful payment"""
-    from datetime import timedelta
+async def process_payment(payment_id, status=None):
+    """Process a successful payment
     
+    `status` is the YooKassa status if the caller already knows it,
+    otherwise it is requested from YooKassa.
+    """
     try:
         # Get payment from database
         payment = await db.get_payment(payment_id)
@@ -226,84 +234,115 @@ async def process_payment(payment_id):
             logger.error(f"Payment {payment_id} not found in database")
             return False
             
-        # If payment already processed
-        if payment.status == "succeeded":
-            logger.info(f"Payment {payment_id} already processed")
-            return True
-            
-        # Get payment status from YooKassa
-        status = await check_payment_status(payment_id)
+        # Get subscription
+        subscription = await db.get_subscription(payment.subscription_id)
+        if not subscription:
+            logger.error(f"Subscription {payment.subscription_id} not found")
+            return False
         
-        # For test payments, always succeed
-        if str(payment_id).startswith("test_") or status == "succeeded":
-            # Get subscription
-            subscription = await db.get_subscription(payment.subscription_id)
-            if not subscription:
-                logger.error(f"Subscription {payment.subscription_id} not found")
-                return False
-                
-            # Get plan details
-            plan = VPN_PLANS.get(subscription.plan_id)
-            if not plan:
-                logger.error(f"Plan {subscription.plan_id} not found")
+        if payment.status == "succeeded":
+            # Платёж проведён; если подписка ещё ждёт активации (сбой между
+            # шагами), проведение повторяется без запроса к ЮKassa
+            if not can_transition(SUBSCRIPTION_TRANSITIONS, subscription.status, "active"):
+                logger.info(f"Payment {payment_id} already processed")
+                return True
+            logger.warning(f"Payment {payment_id} succeeded but subscription is {subscription.status}, completing")
+        else:
+            # Платёж в конечном статусе (например, canceled) уже нельзя провести
+            if not can_transition(PAYMENT_TRANSITIONS, payment.status, "succeeded"):
+                logger.info(f"Payment {payment_id} is {payment.status}, not processing")
                 return False
-                
-            # Calculate expiry date
-            expires_at = datetime.now() + timedelta(days=plan.get("duration", 30))
             
-            # Update subscription
-            await db.update_subscription(subscription.subscription_id, {
-                "status": "active",
-                "expires_at": expires_at,
-                "price_paid": float(payment.amount)
-            })
+            # Get payment status from YooKassa
+            if status is None:
+                status = await check_payment_status(payment_id)
             
-            # Update payment
-            await db.update_payment(payment_id, {
-                "status": "succeeded",
-                "completed_at": datetime.now()
-            })
+            # For test payments, always succeed
+            if not (str(payment_id).startswith("test_") or status == "succeeded"):
+                logger.info(f"Payment {payment_id} status is {status}, not processing")
+                return False
             
+        # Get plan details
+        plan = get_catalog().get(subscription.plan_id)
+        if not plan:
+            logger.error(f"Plan {subscription.plan_id} not found")
+            return False
+        
+        # Calculate expiry date
+        expires_at = datetime.now() + timedelta(days=plan.get("duration", 30))
+        notification = await build_payment_success_notification(payment.user_id, subscription.plan_id)
+        
+        # Платёж, подписка и уведомление меняются вместе: условные UPDATE внутри
+        # complete_payment гарантируют, что при повторных вебхуках и ручных
+        # проверках подписку активирует только один обработчик
+        completed = await db.complete_payment(
+            payment_id,
+            {"completed_at": datetime.now()},
+            {"expires_at": expires_at, "price_paid": float(payment.amount)},
+            notification
+        )
+        if completed is None:
+            return False
+        if completed:
             logger.info(f"Payment {payment_id} processed successfully")
-            
-            # Send notification to user about successful payment
-            await send_payment_success_notification(payment.user_id, subscription.plan_id, payment_id)
-            
-            return True
+            wake_sender()
         else:
-            logger.info(f"Payment {payment_id} status is {status}, not processing")
-            return False
+            logger.info(f"Payment {payment_id} already processed by another worker")
+        return True
     
     except Exception as e:
         logger.error(f"Error processing payment: {e}")
         return False
 
-async def send_payment_success_notification(user_id, plan_id, payment_id):
-    """Send notification to user about successful payment"""
+async def cancel_payment(payment_id):
+    """Mark a payment and its pending subscription as canceled"""
+    if not await db.transition_payment(payment_id, "canceled", {"completed_at": datetime.now()}):
+        return False
+    
+    # Get subscription for this payment
+    db_payment = await db.get_payment(payment_id)
+    if db_payment and db_payment.subscription_id:
+        await db.transition_subscription(db_payment.subscription_id, "canceled")
+    
+    logger.info(f"Payment {payment_id} marked as canceled")
+    return True
+
+async def expire_payment(payment_id):
+    """Mark an abandoned pending payment and its subscription as expired"""
+    if not await db.transition_payment(payment_id, "expired"):
+        return False
+    
+    db_payment = await db.get_payment(payment_id)
+    if db_payment and db_payment.subscription_id:
+        await db.transition_subscription(db_payment.subscription_id, "expired")
+    
+    logger.info(f"Payment {payment_id} marked as expired")
+    return True
+
+async def build_payment_success_notification(user_id, plan_id):
+    """Build the notification to the user about successful payment.
+    
+    The message goes to the notifications outbox together with the payment
+    completion, the bot process delivers it, so the payment path never waits
+    on Telegram. Returns None if it cannot be built.
+    """
     try:
-        import telegram
-        from config import BOT_TOKEN
-        from handlers.outline_handlers import get_user_active_keys
-        
-        # Создаем экземпляр бота
-        bot = telegram.Bot(token=BOT_TOKEN)
-        
-        # Получаем пользователя
-        user = await db.get_user(user_id)
+        # Получаем пользователя по внутреннему ID
+        user = await db.get_user_by_id(user_id)
         if not user:
             logger.error(f"User {user_id} not found")
-            return False
+            return None
             
         # Получаем telegram_id пользователя
         telegram_id = user.telegram_id
         
         # Получаем план
-        plan_name = VPN_PLANS.get(plan_id, {}).get('name', 'Неизвестный')
-        plan_duration = VPN_PLANS.get(plan_id, {}).get('duration', 30)
+        plan = get_catalog().get(plan_id) or {}
+        plan_name = plan.get('name', 'Неизвестный')
+        plan_duration = plan.get('duration', 30)
         
-        # Получаем ключи пользователя
-        active_keys = await get_user_active_keys(telegram_id)
-        keys_count = len(active_keys) if active_keys else 0
+        # Количество ключей пользователя считается одним запросом
+        keys_count = await db.count_user_active_keys(user_id)
         
         # Формируем сообщение об успешной оплате
         message = (
@@ -328,30 +367,29 @@ async def send_payment_success_notification(user_id, plan_id, payment_id):
         # Создаем клавиатуру с кнопками для быстрого доступа
         keyboard = [
             [
-                telegram.InlineKeyboardButton("📊 Статус подписки", callback_data="status"),
-                telegram.InlineKeyboardButton("🔑 Мои ключи", callback_data="my_keys")
+                InlineKeyboardButton("📊 Статус подписки", callback_data="status"),
+                InlineKeyboardButton("🔑 Мои ключи", callback_data="my_keys")
             ],
             [
-                telegram.InlineKeyboardButton("❓ Инструкции", callback_data="help"),
-                telegram.InlineKeyboardButton("📝 Тарифы", callback_data="plans")
+                InlineKeyboardButton("❓ Инструкции", callback_data="help"),
+                InlineKeyboardButton("📝 Тарифы", callback_data="plans")
             ]
         ]
-        reply_markup = telegram.InlineKeyboardMarkup(keyboard)
-        
-        # Отправляем уведомление с клавиатурой
-        await bot.send_message(
-            chat_id=telegram_id,
-            text=message,
-            parse_mode="HTML",
-            reply_markup=reply_markup
-        )
+        reply_markup = InlineKeyboardMarkup(keyboard)
         
-        logger.info(f"Payment success notification sent to user {telegram_id}")
-        return True
+        return build_notification(telegram_id, message, parse_mode="HTML", reply_markup=reply_markup)
     except Exception as e:
-        logger.error(f"Error sending payment success notification: {e}")
+        logger.error(f"Error building payment success notification: {e}")
         logger.exception(e)
-        return False
+        return None
+
+def _event_id(event, payment_id):
+    """Build a deduplication key for a webhook event.
+    
+    ЮKassa не передаёт идентификатор уведомления, но каждое событие
+    (payment.succeeded, payment.canceled, ...) случается с платежом один раз.
+    """
+    return f"{event}:{payment_id}"
 
 async def process_webhook(payload):
     """Process YooKassa webhook notification"""
@@ -366,11 +404,17 @@ async def process_webhook(payload):
         event = notification.event
         logger.info(f"Event type: {event}")
         
+        payment = notification.object
+        payment_id = payment.id
+        event_id = _event_id(event, payment_id)
+        
+        # Повторная доставка того же события стоит одного индексного поиска
+        if await db.is_event_processed(event_id):
+            logger.info(f"Duplicate webhook event {event_id}, skipping")
+            return True
+        
         # Handle payment.succeeded event
         if event == WebhookNotificationEventType.PAYMENT_SUCCEEDED:
-            payment = notification.object
-            payment_id = payment.id
-            
             logger.info(f"Payment succeeded: {payment_id}")
             
             # Get payment from database
@@ -384,14 +428,15 @@ async def process_webhook(payload):
                 subscription_id = metadata.get("subscription_id")
                 
                 if user_id and subscription_id:
-                    # Create payment record
+                    # Create payment record in the initial state, the state
+                    # machine moves it to succeeded in process_payment
                     await db.create_payment({
                         "payment_id": payment_id,
                         "user_id": user_id,
                         "subscription_id": subscription_id,
                         "amount": float(payment.amount.value),
                         "currency": payment.amount.currency,
-                        "status": payment.status,
+                        "status": "pending",
                         "created_at": datetime.now()
                     })
                     logger.info(f"Created payment record for {payment_id}")
@@ -403,6 +448,7 @@ async def process_webhook(payload):
             result = await process_payment(payment_id)
             
             if result:
+                await db.mark_event_processed(event_id, event)
                 logger.info(f"Webhook payment {payment_id} processed successfully")
                 return True
             else:
@@ -411,46 +457,21 @@ async def process_webhook(payload):
         
         # Handle payment.waiting_for_capture event
         elif event == WebhookNotificationEventType.PAYMENT_WAITING_FOR_CAPTURE:
-            payment = notification.object
-            payment_id = payment.id
-            
             logger.info(f"Payment waiting for capture: {payment_id}")
             
-            # Update payment status in database
-            db_payment = await db.get_payment(payment_id)
-            if db_payment:
-                await db.update_payment(payment_id, {
-                    "status": "waiting_for_capture"
-                })
+            if await db.transition_payment(payment_id, "waiting_for_capture"):
                 logger.info(f"Payment {payment_id} marked as waiting_for_capture")
             
+            await db.mark_event_processed(event_id, event)
             return True
         
         # Handle payment.canceled event
         elif event == WebhookNotificationEventType.PAYMENT_CANCELED:
-            payment = notification.object
-            payment_id = payment.id
-            
             logger.info(f"Payment canceled: {payment_id}")
             
-            # Update payment status in database
-            db_payment = await db.get_payment(payment_id)
-            if db_payment:
-                await db.update_payment(payment_id, {
-                    "status": "canceled",
-                    "completed_at": datetime.now()
-                })
-                
-                # Get subscription for this payment
-                subscription_id = db_payment.subscription_id
-                if subscription_id:
-                    # Update subscription status
-                    await db.update_subscription(subscription_id, {
-                        "status": "canceled"
-                    })
-                    
-                logger.info(f"Payment {payment_id} marked as canceled")
+            await cancel_payment(payment_id)
             
+            await db.mark_event_processed(event_id, event)
             return True
                 
         # Unknown event
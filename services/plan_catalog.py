@@ -0,0 +1,329 @@
+"""
+Каталог тарифных планов.
+
+Каталог собирается один раз из описания планов: планы превращаются в
+неизменяемые объекты, списки сортируются, а тексты сообщений и клавиатуры
+меню тарифов рендерятся заранее для каждого варианта (с кнопкой тестового
+периода и без неё). Обработчики только выбирают готовое представление.
+
+Планы хранятся в базе вместе со счётчиком версии. Каждый процесс раз в
+интервал сверяет версию одним запросом и пересобирает каталог только при её
+изменении. Каталог не изменяется после сборки, поэтому код, взявший его через
+get_catalog(), работает с согласованным снимком до конца операции.
+"""
+
+import asyncio
+import logging
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from config import VPN_PLANS, PLAN_CATALOG_REFRESH_INTERVAL
+from services.repository import repository as db
+
+logger = logging.getLogger(__name__)
+
+TEST_PLAN_ID = "test"
+
+
+class Plan:
+    """Immutable tariff plan.
+
+    Supports attribute access and read-only dict-style access (plan["name"],
+    plan.get("discount")) for code written against the VPN_PLANS dicts.
+    """
+
+    __slots__ = ("id", "name", "duration", "price", "devices", "discount", "description", "active")
+
+    def __init__(self, plan_id, data):
+        values = {
+            "id": plan_id,
+            "name": data["name"],
+            "duration": int(data["duration"]),
+            "price": float(data["price"]),
+            "devices": int(data.get("devices", 1)),
+            "discount": data.get("discount"),
+            "description": data.get("description") or "",
+            "active": data.get("active", True),
+        }
+        for field, value in values.items():
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Plan is immutable")
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    @property
+    def is_test(self):
+        return self.id == TEST_PLAN_ID
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__ if field != "id"}
+
+
+class PlanView:
+    """Pre-rendered message: text, keyboard and parse mode"""
+
+    __slots__ = ("text", "reply_markup", "parse_mode")
+
+    def __init__(self, text, keyboard, parse_mode):
+        object.__setattr__(self, "text", text)
+        object.__setattr__(self, "reply_markup", InlineKeyboardMarkup(keyboard))
+        object.__setattr__(self, "parse_mode", parse_mode)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PlanView is immutable")
+
+    def as_kwargs(self):
+        """Keyword arguments for reply_text/edit_message_text"""
+        return {"text": self.text, "reply_markup": self.reply_markup, "parse_mode": self.parse_mode}
+
+
+class PlanCatalog:
+    """Compiled, read-only set of plans with their pre-rendered views"""
+
+    __slots__ = (
+        "version", "plans", "paid_plans", "test_plan",
+        "buy_view", "info_view", "confirm_views", "plans_views", "keys_views"
+    )
+
+    def __init__(self, plans_config, version=0):
+        plans = {plan_id: Plan(plan_id, data) for plan_id, data in plans_config.items()}
+        paid_plans = tuple(sorted(
+            (plan for plan in plans.values() if plan.active and not plan.is_test),
+            key=lambda plan: plan.duration
+        ))
+        test_plan = plans.get(TEST_PLAN_ID)
+
+        self.version = version
+        self.plans = plans
+        self.paid_plans = paid_plans
+        self.test_plan = test_plan if test_plan and test_plan.active else None
+        self.buy_view = self._render_buy()
+        self.info_view = self._render_info()
+        self.confirm_views = {plan.id: self._render_confirm(plan) for plan in plans.values() if plan.active}
+        self.plans_views = {available: self._render_plans(available) for available in (True, False)}
+        self.keys_views = {available: self._render_keys(available) for available in (True, False)}
+
+    def __contains__(self, plan_id):
+        """Whether the plan exists and can be bought"""
+        plan = self.plans.get(plan_id)
+        return plan is not None and plan.active
+
+    def get(self, plan_id):
+        """Get a plan by ID (including disabled ones, for display) or None"""
+        return self.plans.get(plan_id)
+
+    def test_available(self, user):
+        """Whether the test plan button should be shown to `user`"""
+        if self.test_plan is None:
+            return False
+        return not (user and user.test_used)
+
+    def _render_buy(self):
+        keyboard = []
+        for plan in self.paid_plans:
+            discount_text = f" (-{plan.discount})" if plan.discount else ""
+            keyboard.append([InlineKeyboardButton(
+                f"{plan.name} ({plan.duration} дней) - {plan.price} ₽{discount_text}",
+                callback_data=f"buy_{plan.id}"
+            )])
+        keyboard.append([InlineKeyboardButton("↩️ Назад", callback_data="back_to_main")])
+
+        return PlanView(
+            "💰 <b>Выберите тарифный план:</b>\n\n"
+            "Выберите подходящий вам вариант для подключения к сервису VPN.\n"
+            "Вы можете выбрать тариф в зависимости от срока использования и количества устройств:",
+            keyboard,
+            "HTML"
+        )
+
+    def _render_info(self):
+        plans_info = ""
+        for plan in self.plans.values():
+            if not plan.active:
+                continue
+            if plan.is_test:
+                plans_info += f"📌 *Тестовый период*: {plan.duration} дня бесплатно\n"
+            else:
+                plans_info += f"📌 *{plan.name}*: {plan.duration} дней за {plan.price} ₽\n"
+
+        keyboard = [
+            [InlineKeyboardButton("🔍 Тестовый период", callback_data="buy_test")],
+            [InlineKeyboardButton("💰 Купить доступ", callback_data="buy")],
+            [InlineKeyboardButton("↩️ Вернуться в главное меню", callback_data="back_to_main")]
+        ]
+        return PlanView(
+            "ℹ️ *Информация о тарифах*\n\n"
+            f"{plans_info}\n"
+            "Попробуйте бесплатно: нажмите кнопку 'Тестовый период'.\n"
+            "Или выберите платный тариф через кнопку 'Купить доступ'.\n\n"
+            "Наш VPN сервис предоставляет:\n"
+            "✅ Стабильное соединение\n"
+            "✅ Высокую скорость\n"
+            "✅ Анонимность и безопасность\n"
+            "✅ Поддержку всех устройств\n"
+            "✅ Простую настройку",
+            keyboard,
+            "Markdown"
+        )
+
+    def _render_confirm(self, plan):
+        devices_text = f"Подключение до {plan.devices} устройств"
+        discount_text = f", скидка {plan.discount}" if plan.discount else ""
+
+        # Разные кнопки и тексты для тестового тарифа и платных тарифов
+        if plan.is_test:
+            keyboard = [
+                [InlineKeyboardButton("🔑 Получить ключ", callback_data=f"pay_{plan.id}")],
+                [InlineKeyboardButton("↩️ Назад", callback_data="buy")]
+            ]
+            button_text = "Для получения тестового ключа нажмите кнопку ниже:"
+            title = "📝 <b>Активация тестового периода</b>"
+        else:
+            keyboard = [
+                [InlineKeyboardButton("💳 Перейти к оплате", callback_data=f"pay_{plan.id}")],
+                [InlineKeyboardButton("↩️ Назад", callback_data="buy")]
+            ]
+            button_text = "Для оплаты нажмите кнопку ниже:"
+            title = "📝 <b>Подтверждение заказа</b>"
+
+        return PlanView(
+            f"{title}\n\n"
+            f"🔹 Тариф: <b>{plan.name}</b>\n"
+            f"⏳ Срок действия: {plan.duration} дней\n"
+            f"📱 {devices_text}{discount_text}\n"
+            f"💰 Стоимость: {plan.price} ₽\n\n"
+            f"{button_text}",
+            keyboard,
+            "HTML"
+        )
+
+    def _test_button(self, test_available):
+        if test_available and self.test_plan:
+            return [[InlineKeyboardButton("🔍 Попробовать бесплатно", callback_data="test_period")]]
+        return []
+
+    def _render_plans(self, test_available):
+        message = "*Доступные тарифные планы:*\n\n"
+
+        # Display test plan first (if available)
+        test_plan = self.test_plan
+        if test_plan:
+            message += (
+                f"*{test_plan.name}*\n"
+                f"Стоимость: *Бесплатно*\n"
+                f"Срок действия: {test_plan.duration} дня\n"
+                f"Устройств: до {test_plan.devices}\n"
+                f"Пробный доступ ко всем функциям VPN. По истечении тестового периода требуется оплата.\n\n"
+            )
+
+        for plan in self.paid_plans:
+            discount = f" (скидка {plan.discount})" if plan.discount else ""
+            message += (
+                f"*{plan.name}*{discount}\n"
+                f"Стоимость: *{plan.price} руб.*\n"
+                f"Срок действия: {plan.duration} дней\n"
+                f"Устройств: до {plan.devices}\n"
+                f"{plan.description}\n\n"
+            )
+
+        keyboard = self._test_button(test_available)
+        for plan in self.paid_plans:
+            discount_text = f" (-{plan.discount})" if plan.discount else ""
+            keyboard.append([InlineKeyboardButton(
+                f"{plan.name} - {plan.price} руб.{discount_text}",
+                callback_data=f"buy_{plan.id}"
+            )])
+        keyboard.append([InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_main")])
+
+        return PlanView(message, keyboard, "Markdown")
+
+    def _render_keys(self, test_available):
+        keyboard = self._test_button(test_available)
+        for plan in self.paid_plans:
+            keyboard.append([InlineKeyboardButton(
+                f"{plan.name} - {plan.price} руб.",
+                callback_data=f"buy_{plan.id}"
+            )])
+        keyboard.append([InlineKeyboardButton("↩️ В главное меню", callback_data="back_to_main")])
+
+        return PlanView(
+            "Для получения ключа VPN выберите тарифный план:\n\n"
+            "После выбора тарифа и оплаты вы получите доступ к VPN.",
+            keyboard,
+            None
+        )
+
+
+# До загрузки из базы (или если база недоступна) используется каталог из конфига
+_catalog = PlanCatalog(VPN_PLANS)
+
+
+def get_catalog():
+    """Get the current plan catalog snapshot"""
+    return _catalog
+
+
+async def refresh_catalog(force=False):
+    """
+    Пересобирает каталог, если версия в базе изменилась.
+    
+    Returns:
+        PlanCatalog: Актуальный каталог
+    """
+    global _catalog
+    if not force:
+        version = await db.get_plan_catalog_version()
+        if version is None or version == _catalog.version:
+            return _catalog
+    
+    version, plans = await db.get_plan_catalog()
+    if version is None or not plans:
+        return _catalog
+    
+    try:
+        _catalog = PlanCatalog(plans, version)
+        logger.info(f"Plan catalog loaded, version {version}")
+    except (KeyError, TypeError, ValueError) as e:
+        logger.error(f"Invalid plan catalog version {version}: {e}")
+    return _catalog
+
+
+async def load_catalog():
+    """Загружает каталог при старте, при первом запуске переносит VPN_PLANS в базу"""
+    await db.seed_plans(VPN_PLANS)
+    return await refresh_catalog(force=True)
+
+
+async def update_plan(plan_id, update_data):
+    """
+    Изменяет план и сразу обновляет каталог этого процесса.
+    
+    Остальные процессы увидят изменение при следующей проверке версии.
+    
+    Returns:
+        int: Новая версия каталога или None при ошибке
+    """
+    version = await db.update_plan(plan_id, update_data)
+    if version is not None:
+        await refresh_catalog(force=True)
+    return version
+
+
+async def start_catalog_refresher(interval_seconds=PLAN_CATALOG_REFRESH_INTERVAL):
+    """Периодически проверяет версию каталога"""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await refresh_catalog()
+        except Exception as e:
+            logger.error(f"Error refreshing plan catalog: {e}")
@@ -0,0 +1,145 @@
+"""
+Сверка зависших платежей с ЮKassa.
+
+Если вебхук потерялся, платеж остаётся незавершенным: pending,
+waiting_for_capture или expired (поздняя оплата брошенного платежа).
+Планировщик периодически выбирает такие платежи страницами по (created_at, id),
+запрашивает их статус в ЮKassa с ограниченной параллельностью и доводит через
+тот же конечный автомат, что и вебхук.
+"""
+
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from config import (
+    PAYMENT_RECONCILE_MIN_AGE, PAYMENT_PENDING_TIMEOUT,
+    PAYMENT_RECONCILE_PAGE_SIZE, PAYMENT_RECONCILE_CONCURRENCY
+)
+from services.repository import repository as db
+from services.payment_service import (
+    check_payment_status, process_payment, cancel_payment, expire_payment
+)
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+async def _reconcile_payment(payment, expire_before, semaphore):
+    """
+    Сверяет один платеж и возвращает итог: succeeded, canceled, expired или pending.
+    """
+    payment_id = payment.payment_id
+    
+    async with semaphore:
+        status = await check_payment_status(payment_id)
+    
+    if status == "succeeded":
+        if await process_payment(payment_id, status=status):
+            return "succeeded"
+        return "pending"
+    
+    if status == "canceled":
+        await cancel_payment(payment_id)
+        return "canceled"
+    
+    if status == "waiting_for_capture":
+        await db.transition_payment(payment_id, "waiting_for_capture")
+        return "pending"
+    
+    # Просроченный платеж, неизвестный ЮKassa, оплатить уже нельзя - он закрывается
+    if status == "not_found" and payment.status == "expired":
+        await cancel_payment(payment_id)
+        return "canceled"
+    
+    # Платеж так и не оплачен (или неизвестен ЮKassa) слишком долго - он брошен.
+    # При ошибке связи с ЮKassa ничего не делаем и попробуем в следующий раз.
+    if status in ("pending", "not_found") and payment.status == "pending" and payment.created_at < expire_before:
+        await expire_payment(payment_id)
+        return "expired"
+    
+    return "pending"
+
+async def reconcile_pending_payments(
+    min_age_seconds=PAYMENT_RECONCILE_MIN_AGE,
+    expire_after_seconds=PAYMENT_PENDING_TIMEOUT,
+    page_size=PAYMENT_RECONCILE_PAGE_SIZE,
+    concurrency=PAYMENT_RECONCILE_CONCURRENCY
+):
+    """
+    Сверяет зависшие платежи с ЮKassa.
+    
+    Args:
+        min_age_seconds (int): Платежи моложе этого возраста не трогаем, для них ещё придёт вебхук
+        expire_after_seconds (int): Неоплаченные платежи старше этого возраста помечаются expired
+        page_size (int): Размер страницы выборки
+        concurrency (int): Максимум одновременных запросов к ЮKassa
+        
+    Returns:
+        dict: Количество платежей по итогам сверки
+    """
+    now = datetime.now()
+    created_before = now - timedelta(seconds=min_age_seconds)
+    expire_before = now - timedelta(seconds=expire_after_seconds)
+    
+    # Лаг сверки: возраст самого старого неоплаченного платежа
+    oldest = await db.get_oldest_pending_payment_time()
+    lag = (now - oldest).total_seconds() if oldest else 0
+    metrics.set_gauge("payments.pending_oldest_age_seconds", lag)
+    
+    stats = {"checked": 0, "succeeded": 0, "canceled": 0, "expired": 0, "pending": 0}
+    if not oldest or oldest >= created_before:
+        return stats
+    
+    semaphore = asyncio.Semaphore(concurrency)
+    cursor = None
+    
+    while True:
+        page = await db.get_stale_pending_payments(created_before, after=cursor, limit=page_size)
+        if not page:
+            break
+        
+        results = await asyncio.gather(
+            *(_reconcile_payment(payment, expire_before, semaphore) for payment in page),
+            return_exceptions=True
+        )
+        
+        for payment, result in zip(page, results):
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка при сверке платежа {payment.payment_id}: {result}")
+                result = "pending"
+            stats[result] += 1
+        stats["checked"] += len(page)
+        
+        # Курсор по (created_at, id): обработанные строки повторно не читаются
+        last = page[-1]
+        cursor = (last.created_at, last.id)
+        
+        if len(page) < page_size:
+            break
+    
+    for result in ("succeeded", "canceled", "expired"):
+        if stats[result]:
+            metrics.inc(f"payments.reconciled.{result}", stats[result])
+    
+    logger.info(
+        f"Сверка платежей завершена: проверено {stats['checked']}, "
+        f"проведено {stats['succeeded']}, отменено {stats['canceled']}, "
+        f"просрочено {stats['expired']}, лаг {int(lag)} с"
+    )
+    return stats
+
+async def start_reconcile_scheduler(interval_seconds=600):
+    """
+    Запускает планировщик регулярной сверки платежей.
+    
+    Args:
+        interval_seconds (int): Интервал между проходами в секундах
+    """
+    logger.info(f"Запуск сверки платежей с интервалом {interval_seconds} секунд")
+    
+    while True:
+        try:
+            await reconcile_pending_payments()
+        except Exception as e:
+            logger.error(f"Ошибка при сверке платежей: {e}")
+        await asyncio.sleep(interval_seconds)
@@ -0,0 +1,187 @@
+"""
+Интерфейс репозитория: пользователи, подписки, ключи доступа, платежи и
+фоновые задачи (outbox уведомлений, рассылки, массовые операции, каталог
+тарифов, состояние диалогов).
+
+Repository описывает функции, которые одинаково реализуют все бэкенды:
+services.database_service_sql (SQLAlchemy), services.database_service
+(MongoDB) и services.database_service_memory (в памяти процесса). Бэкенд -
+это модуль с такими функциями; он выбирается один раз при запуске
+(use_backend, по умолчанию DATABASE_BACKEND), и код обращается к нему через
+repository:
+
+    from services.repository import repository as db
+    user = await db.get_user(telegram_id)
+
+Функции возвращают строки из services.rows. Соответствие бэкендов
+интерфейсу проверяет test_repository.py.
+"""
+
+import importlib
+import logging
+from typing import Protocol
+
+from config import DATABASE_BACKEND
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = {
+    "sql": "services.database_service_sql",
+    "mongo": "services.database_service",
+    "memory": "services.database_service_memory",
+}
+
+
+class Repository(Protocol):
+    """Storage API shared by all backends"""
+
+    async def init_database(self): ...
+
+    # Пользователи
+    async def create_user(self, user_data): ...
+    async def upsert_user(self, user_data): ...
+    async def get_user(self, telegram_id): ...
+    async def get_user_by_id(self, user_id): ...
+    async def get_user_by_username(self, username): ...
+    async def update_user(self, telegram_id, update_data): ...
+    async def claim_test_period(self, telegram_id): ...
+    async def get_all_users(self): ...
+    async def count_users(self): ...
+    async def get_users_page(self, after_id=None, limit=200): ...
+    async def search_users(self, query, limit=10): ...
+    async def get_admin_users_page(self, after_id=None, before_id=None, limit=10): ...
+    async def get_user_stats(self): ...
+
+    # Подписки
+    async def create_subscription(self, subscription_data): ...
+    async def get_subscription(self, subscription_id): ...
+    async def update_subscription(self, subscription_id, update_data): ...
+    async def transition_subscription(self, subscription_id, to_status, update_data=None): ...
+    async def get_user_subscriptions(self, user_id, status=None): ...
+    async def get_active_subscription(self, user_id): ...
+    async def get_expiring_subscriptions(self, days=1): ...
+
+    # Окончание подписок
+    def add_expiry_listener(self, listener): ...
+    async def get_expiry_notice_page(self, days, window_start, window_end, after=None, limit=200): ...
+    async def record_expiry_notices(self, days, subscriptions, notifications): ...
+    async def get_subscription_expiries(self, after, until): ...
+    async def get_expiry_notice_rows(self, subscription_ids): ...
+    async def get_expired_active_subscriptions(self, now, after_id=0, limit=200): ...
+    async def expire_subscriptions(self, subscription_ids, now): ...
+    async def mark_access_keys_deleted(self, key_ids): ...
+
+    # Ключи доступа
+    async def create_access_key(self, key_data): ...
+    async def get_access_key(self, key_id): ...
+    async def update_access_key(self, key_id, update_data): ...
+    async def deactivate_user_access_keys(self, user_id): ...
+    async def get_user_access_keys(self, user_id): ...
+    async def get_user_context(self, telegram_id): ...
+    async def count_user_active_keys(self, user_id): ...
+    async def get_subscription_access_keys(self, subscription_id): ...
+    async def get_sync_candidate_keys(self, known_key_ids): ...
+
+    # Платежи
+    async def create_payment(self, payment_data): ...
+    async def get_payment(self, payment_id): ...
+    async def update_payment(self, payment_id, update_data): ...
+    async def transition_payment(self, payment_id, to_status, update_data=None): ...
+    async def complete_payment(self, payment_id, payment_values, subscription_values, notification=None): ...
+    async def get_stale_pending_payments(self, created_before, after=None, limit=100): ...
+    async def get_oldest_pending_payment_time(self): ...
+    async def get_user_payments(self, user_id, status=None): ...
+
+    # Дедупликация вебхуков
+    async def is_event_processed(self, event_id): ...
+    async def mark_event_processed(self, event_id, event_type=None): ...
+
+    # Outbox уведомлений
+    async def enqueue_notification(self, notification_data): ...
+    async def claim_due_notifications(self, limit=50, lease_seconds=60): ...
+    async def mark_notifications_sent(self, notification_ids): ...
+    async def reschedule_notification(self, notification_id, next_attempt_at, failed=False,
+                                      count_attempt=False): ...
+
+    # Рассылки
+    async def create_broadcast_job(self, job_data): ...
+    async def get_broadcast_job(self, job_id): ...
+    async def get_running_broadcast_jobs(self): ...
+    async def update_broadcast_job(self, job_id, update_data): ...
+    async def get_broadcast_recipient_statuses(self, job_id, telegram_ids): ...
+    async def record_broadcast_page(self, job_id, results, cursor_user_id): ...
+
+    # Массовые операции администратора
+    async def create_admin_job(self, job_data, user_filter="all", telegram_ids=None): ...
+    async def get_admin_job(self, job_id): ...
+    async def get_running_admin_jobs(self): ...
+    async def update_admin_job(self, job_id, update_data): ...
+    async def get_admin_job_targets(self, job_id, after_user_id=0, limit=200): ...
+    async def record_admin_job_page(self, job_id, cursor_user_id, done, failed): ...
+    async def get_users_live_keys(self, user_ids): ...
+    async def extend_active_subscriptions(self, user_ids, days, job_id=None, cursor_user_id=None): ...
+    async def revoke_users_access(self, user_ids, deleted_key_ids, job_id=None, cursor_user_id=None,
+                                  failed=0): ...
+    async def replace_access_keys(self, replacements, notifications=(), job_id=None, cursor_user_id=None,
+                                  done=0, failed=0): ...
+
+    # Каталог тарифов
+    async def seed_plans(self, plans_config): ...
+    async def get_plan_catalog_version(self): ...
+    async def get_plan_catalog(self): ...
+    async def update_plan(self, plan_id, update_data): ...
+
+    # Состояние диалогов (context.user_data)
+    async def get_user_state(self, telegram_id): ...
+    async def save_user_states(self, states, deleted_ids=()): ...
+
+
+REPOSITORY_FUNCTIONS = tuple(
+    name for name, value in vars(Repository).items()
+    if not name.startswith("_") and callable(value)
+)
+
+def load_backend(name):
+    """
+    Imports a backend module and checks that it implements Repository.
+
+    Raises:
+        ValueError: Unknown backend or a missing function
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown database backend: {name}")
+    backend = importlib.import_module(BACKENDS[name])
+    missing = [function for function in REPOSITORY_FUNCTIONS if not callable(getattr(backend, function, None))]
+    if missing:
+        raise ValueError(f"Backend {name} does not implement: {', '.join(missing)}")
+    return backend
+
+
+class _SelectedRepository:
+    """Forwards Repository calls to the selected backend module"""
+
+    __slots__ = ("name", "backend")
+
+    def __init__(self):
+        self.name = None
+        self.backend = None
+
+    def use(self, name):
+        self.backend = load_backend(name)
+        self.name = name
+        logger.info(f"Database backend: {name}")
+        return self.backend
+
+    def __getattr__(self, function):
+        if function not in REPOSITORY_FUNCTIONS:
+            raise AttributeError(f"{function} is not part of the repository interface")
+        if self.backend is None:
+            self.use(DATABASE_BACKEND)
+        return getattr(self.backend, function)
+
+
+repository = _SelectedRepository()
+
+def use_backend(name=DATABASE_BACKEND):
+    """Selects the backend for `repository`, returns its module"""
+    return repository.use(name)
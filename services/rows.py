@@ -0,0 +1,171 @@
+"""
+Строки, которые возвращает слой доступа к данным.
+
+Функции базы возвращают не ORM-объекты и не документы MongoDB, а неизменяемые
+объекты с __slots__: SQL-бэкенд строит их из выборки нужных колонок (без
+identity map и ленивых загрузок после закрытия сессии), MongoDB - из
+документа. У обоих бэкендов одна форма: атрибуты с именами колонок, id -
+первичный ключ (для MongoDB - строка _id).
+
+Для кода, написанного под документы MongoDB, поддерживается доступ на чтение
+как к словарю: row["plan_id"], row.get("expires_at").
+"""
+
+from dataclasses import dataclass, fields
+
+
+class _Row:
+    __slots__ = ()
+
+    @classmethod
+    def columns(cls, model):
+        """Columns of `model` to select, in field order"""
+        return [getattr(model, field.name) for field in fields(cls)]
+
+    @classmethod
+    def projection(cls):
+        """Fields of a MongoDB document to fetch (_id is always returned)"""
+        return {field.name: 1 for field in fields(cls) if field.name != "id"}
+
+    @classmethod
+    def width(cls):
+        return len(fields(cls))
+
+    @classmethod
+    def from_row(cls, row, offset=0):
+        """
+        Builds a row from a result row of `columns()`, starting at `offset`.
+
+        Returns None for a missing row and for an outer-joined row without
+        a match (its id is NULL).
+        """
+        if row is None:
+            return None
+        values = tuple(row[offset:offset + cls.width()])
+        if values[0] is None:
+            return None
+        return cls(*values)
+
+    @classmethod
+    def from_object(cls, obj):
+        """Builds a row from the attributes of an ORM instance"""
+        if obj is None:
+            return None
+        return cls(*(getattr(obj, field.name) for field in fields(cls)))
+
+    @classmethod
+    def from_document(cls, document):
+        """Builds a row from a MongoDB document; missing fields become None"""
+        if document is None:
+            return None
+        values = {field.name: document.get(field.name) for field in fields(cls)}
+        values["id"] = str(document["_id"]) if "_id" in document else None
+        return cls(**values)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def to_dict(self):
+        return {field.name: getattr(self, field.name) for field in fields(self)}
+
+
+@dataclass(frozen=True, slots=True)
+class UserRow(_Row):
+    id: object
+    telegram_id: int
+    username: str = None
+    first_name: str = None
+    last_name: str = None
+    created_at: object = None
+    is_premium: bool = False
+    test_used: bool = False
+
+
+@dataclass(frozen=True, slots=True)
+class SubscriptionRow(_Row):
+    id: object
+    subscription_id: str
+    user_id: object
+    plan_id: str
+    status: str = None
+    created_at: object = None
+    expires_at: object = None
+    price_paid: float = 0.0
+
+
+@dataclass(frozen=True, slots=True)
+class KeyRow(_Row):
+    id: object
+    key_id: str
+    name: str = None
+    access_url: str = None
+    user_id: object = None
+    subscription_id: object = None
+    created_at: object = None
+    deleted: bool = False
+
+
+@dataclass(frozen=True, slots=True)
+class PaymentRow(_Row):
+    id: object
+    payment_id: str
+    user_id: object
+    subscription_id: str = None
+    amount: float = 0.0
+    currency: str = "RUB"
+    status: str = None
+    created_at: object = None
+    completed_at: object = None
+
+
+@dataclass(frozen=True, slots=True)
+class NotificationRow(_Row):
+    id: object
+    chat_id: int
+    text: str
+    parse_mode: str = None
+    reply_markup: str = None
+    status: str = None
+    attempts: int = 0
+    next_attempt_at: object = None
+
+
+@dataclass(frozen=True, slots=True)
+class BroadcastJobRow(_Row):
+    id: object
+    text: str
+    parse_mode: str = None
+    status: str = None
+    created_by: int = None
+    created_at: object = None
+    finished_at: object = None
+    cursor_user_id: object = None
+    total: int = 0
+    sent_count: int = 0
+    failed_count: int = 0
+    status_chat_id: int = None
+    status_message_id: int = None
+
+
+@dataclass(frozen=True, slots=True)
+class AdminJobRow(_Row):
+    id: object
+    action: str
+    params: str = None
+    status: str = None
+    created_by: int = None
+    created_at: object = None
+    finished_at: object = None
+    cursor_user_id: object = None
+    total: int = 0
+    done_count: int = 0
+    failed_count: int = 0
+    status_chat_id: int = None
+    status_message_id: int = None
@@ -0,0 +1,37 @@
+"""
+Конечные автоматы статусов платежей и подписок.
+
+Статус меняется только по разрешённым переходам. База данных применяет переход
+условным UPDATE ... WHERE status IN (<допустимые исходные статусы>), поэтому
+при конкурентной обработке одного платежа выигрывает ровно один обработчик.
+"""
+
+# Платежи ЮKassa: pending -> waiting_for_capture -> succeeded / canceled.
+# Брошенные платежи сверка переводит в expired, но поздняя оплата всё ещё
+# может их провести, пока ЮKassa не отменит платеж.
+PAYMENT_TRANSITIONS = {
+    "pending": ("waiting_for_capture", "succeeded", "canceled", "expired"),
+    "waiting_for_capture": ("succeeded", "canceled"),
+    "expired": ("succeeded", "canceled"),
+    "succeeded": (),
+    "canceled": (),
+}
+
+# Подписки: pending (ждёт оплаты) -> active -> inactive
+SUBSCRIPTION_TRANSITIONS = {
+    "pending": ("active", "canceled", "expired"),
+    "active": ("inactive",),
+    "expired": ("active",),
+    "inactive": (),
+    "canceled": (),
+}
+
+
+def can_transition(transitions, current, target):
+    """Check whether `current` status may move to `target`"""
+    return target in transitions.get(current, ())
+
+
+def sources_for(transitions, target):
+    """Get all statuses from which `target` is reachable in one step"""
+    return tuple(status for status, targets in transitions.items() if target in targets)
@@ -6,11 +6,8 @@ import asyncio
 import logging
 from datetime import datetime
 
-from services.database_service_sql import (
-    get_all_users, get_user_access_keys, update_access_key,
-    get_access_key, get_user_subscriptions
-)
-from services.outline_service import OutlineService
+from services.repository import repository as db
+from services.outline_service import OutlineService, split_key_id
 
 logger = logging.getLogger(__name__)
 outline_service = OutlineService()
@@ -29,42 +26,27 @@ async def sync_outline_keys():
             logger.error("Не удалось получить ключи с сервера Outline")
             return False
             
-        # Создаем словарь ключей Outline для быстрого поиска
-        outline_keys = {key["id"]: key for key in outline_keys_resp["accessKeys"]}
+        outline_key_ids = {key["id"] for key in outline_keys_resp["accessKeys"]}
         
-        # Получаем всех пользователей из базы данных
-        users = await get_all_users()
+        # Живые ключи пользователей, которых нет на сервере Outline - одним запросом
+        missing_keys = await db.get_sync_candidate_keys(outline_key_ids)
         
-        for user in users:
+        for key in missing_keys:
+            key_id = key.key_id
+            
+            # Ключи перенесенных на другие серверы пользователей здесь не сверяются
+            if split_key_id(key_id)[0] is not None:
+                continue
+            
             try:
-                # Получаем ID пользователя (поддержка как словарей, так и объектов)
-                if hasattr(user, 'id'):
-                    user_id = user.id
-                else:
-                    user_id = user["id"]
-                
-                # Получаем все ключи пользователя из базы данных
-                user_keys = await get_user_access_keys(user_id)
-                
-                for key in user_keys:
-                    # Получаем key_id (поддержка как словарей, так и объектов)
-                    if hasattr(key, 'key_id'):
-                        key_id = key.key_id
-                        is_deleted = getattr(key, 'deleted', False)
-                    else:
-                        key_id = key.get("key_id")
-                        is_deleted = key.get("deleted", False)
-                    
-                    # Проверяем, существует ли ключ на сервере Outline
-                    if key_id not in outline_keys and not is_deleted:
-                        # Ключ удален на сервере Outline, но не в базе данных
-                        logger.info(f"Ключ {key_id} не существует на сервере Outline, помечаем как удаленный")
-                        await update_access_key(key_id, {
-                            "deleted": True,
-                            "updated_at": datetime.now()
-                        })
+                # Ключ удален на сервере Outline, но не в базе данных
+                logger.info(f"Ключ {key_id} не существует на сервере Outline, помечаем как удаленный")
+                await db.update_access_key(key_id, {
+                    "deleted": True,
+                    "updated_at": datetime.now()
+                })
             except Exception as e:
-                logger.error(f"Ошибка при обработке пользователя: {e}")
+                logger.error(f"Ошибка при обработке ключа {key_id}: {e}")
                 continue
         
         logger.info("Синхронизация ключей завершена успешно")
@@ -80,6 +62,7 @@ async def get_server_stats():
     try:
         stats = {
             "users_count": 0,
+            "active_subscriptions_count": 0,
             "active_keys_count": 0,
             "total_keys_count": 0,
             "data_usage": 0,
@@ -101,41 +84,10 @@ async def get_server_stats():
         if keys_resp and "accessKeys" in keys_resp:
             stats["total_keys_count"] = len(keys_resp["accessKeys"])
         
-        # Получаем статистику пользователей
-        users = await get_all_users()
-        
-        # Проверяем, что users не None
-        if users:
-            stats["users_count"] = len(users)
-            
-            # Считаем активные ключи
-            active_keys = 0
-            for user in users:
-                try:
-                    # Получаем ID пользователя (поддержка как словарей, так и объектов)
-                    if hasattr(user, 'id'):
-                        user_id = user.id
-                    else:
-                        user_id = user["id"]
-                    
-                    # Получаем ключи пользователя
-                    user_keys = await get_user_access_keys(user_id)
-                    
-                    if user_keys:
-                        for key in user_keys:
-                            # Проверяем статус удаления ключа (поддержка как словарей, так и объектов)
-                            if hasattr(key, 'deleted'):
-                                is_deleted = key.deleted
-                            else:
-                                is_deleted = key.get("deleted", False)
-                                
-                            if not is_deleted:
-                                active_keys += 1
-                except Exception as e:
-                    logger.error(f"Ошибка при обработке пользователя для статистики: {e}")
-                    continue
-            
-            stats["active_keys_count"] = active_keys
+        # Пользователи, активные подписки и ключи - одним запросом к базе
+        user_stats = await db.get_user_stats()
+        if user_stats:
+            stats.update(user_stats)
         
         return stats
     except Exception as e:
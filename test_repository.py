@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+"""
+Проверка соответствия бэкендов хранилища интерфейсу репозитория.
+
+Один и тот же набор проверок выполняется для каждого бэкенда: в памяти -
+всегда, SQL - на временной базе SQLite, MongoDB - на отдельной базе, если
+сервер доступен по MONGO_URI. Имена бэкендов можно передать аргументами:
+
+    python test_repository.py memory sql
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+# Проверки не должны трогать рабочие базы
+_sqlite_dir = tempfile.mkdtemp(prefix="repository-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_sqlite_dir, 'conformance.db')}"
+os.environ["MONGO_DB_NAME"] = "users-outline-conformance"
+
+from services.repository import BACKENDS, load_backend
+from services.rows import (
+    UserRow, SubscriptionRow, KeyRow, PaymentRow, NotificationRow, BroadcastJobRow, AdminJobRow
+)
+
+# Настройка логирования
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.WARNING
+)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+TELEGRAM_ID = 7000000001
+
+# Пользователи
+async def test_users(db):
+    """create/upsert/get/update/count/page/search"""
+    user = await db.create_user({"telegram_id": TELEGRAM_ID, "username": "Alice", "first_name": "Алиса"})
+    assert isinstance(user, UserRow) and user.telegram_id == TELEGRAM_ID
+    assert (await db.create_user({"telegram_id": TELEGRAM_ID})).id == user.id
+    assert await db.upsert_user({"telegram_id": TELEGRAM_ID}) is False
+    assert await db.upsert_user({"telegram_id": TELEGRAM_ID + 1, "username": "alice_2"}) is True
+    await db.create_user({"telegram_id": TELEGRAM_ID + 2, "username": "bob", "last_name": "Alibekov"})
+
+    assert (await db.get_user(TELEGRAM_ID)).username == "Alice"
+    assert (await db.get_user_by_id(user.id)).telegram_id == TELEGRAM_ID
+    assert (await db.get_user_by_username("@ALICE")).telegram_id == TELEGRAM_ID
+    assert await db.get_user_by_username("ali") is None
+    assert await db.get_user(TELEGRAM_ID + 100) is None
+
+    assert await db.update_user(TELEGRAM_ID, {"test_used": True}) is True
+    assert (await db.get_user(TELEGRAM_ID)).test_used is True
+    assert await db.update_user(TELEGRAM_ID + 100, {"test_used": True}) is False
+    assert await db.claim_test_period(TELEGRAM_ID) is False
+    assert await db.claim_test_period(TELEGRAM_ID + 1) is True
+    assert await db.claim_test_period(TELEGRAM_ID + 1) is False
+    assert await db.claim_test_period(TELEGRAM_ID + 100) is False
+
+    assert await db.count_users() == 3
+    assert len(await db.get_all_users()) == 3
+    first = await db.get_users_page(limit=2)
+    rest = await db.get_users_page(after_id=first[-1][0], limit=2)
+    assert [telegram_id for _, telegram_id in first + rest] == [TELEGRAM_ID, TELEGRAM_ID + 1, TELEGRAM_ID + 2]
+
+    found = [match["telegram_id"] for match in await db.search_users("@ALICE")]
+    assert found[:2] == [TELEGRAM_ID, TELEGRAM_ID + 1], found
+    assert [match["telegram_id"] for match in await db.search_users(str(TELEGRAM_ID + 2))] == [TELEGRAM_ID + 2]
+    assert [match["telegram_id"] for match in await db.search_users("алис")] == [TELEGRAM_ID]
+    return user
+
+# Подписки
+async def test_subscriptions(db, user):
+    """Only one active subscription, conditional transitions"""
+    now = datetime.now()
+    first = await db.create_subscription({
+        "user_id": user.id, "plan_id": "monthly", "expires_at": now + timedelta(days=10)
+    })
+    assert isinstance(first, SubscriptionRow) and first.status == "active" and first.subscription_id
+    second = await db.create_subscription({
+        "user_id": user.id, "plan_id": "quarterly", "status": "active", "expires_at": now + timedelta(days=2)
+    })
+    pending = await db.create_subscription({
+        "user_id": user.id, "plan_id": "monthly", "status": "pending", "expires_at": now + timedelta(days=30)
+    })
+
+    # Новая активная подписка закрывает предыдущую
+    assert (await db.get_subscription(first.subscription_id)).status == "inactive"
+    assert (await db.get_active_subscription(user.id)).subscription_id == second.subscription_id
+    assert [s.subscription_id for s in await db.get_user_subscriptions(user.id, "active")] == [second.subscription_id]
+    assert len(await db.get_user_subscriptions(user.id)) == 3
+    assert [s.subscription_id for s in await db.get_expiring_subscriptions(3)] == [second.subscription_id]
+
+    assert await db.update_subscription(second.subscription_id, {"price_paid": 150.0}) is True
+    assert (await db.get_subscription(second.subscription_id)).price_paid == 150.0
+    assert await db.update_subscription("missing", {"price_paid": 1.0}) is False
+
+    assert await db.transition_subscription(pending.subscription_id, "active") is True
+    assert await db.transition_subscription(pending.subscription_id, "active") is False
+    assert await db.transition_subscription(first.subscription_id, "active") is False
+    return await db.get_subscription(pending.subscription_id)
+
+# Ключи доступа
+async def test_access_keys(db, user, subscription):
+    """Deleted keys are hidden from every key query"""
+    key = await db.create_access_key({
+        "key_id": "conformance-1", "access_url": "ss://one", "user_id": user.id,
+        "subscription_id": subscription.id
+    })
+    assert isinstance(key, KeyRow) and key.deleted is False
+    await db.create_access_key({
+        "key_id": "conformance-2", "access_url": "ss://two", "user_id": user.id,
+        "subscription_id": subscription.id
+    })
+
+    assert await db.update_access_key("conformance-2", {"deleted": True}) is True
+    assert (await db.get_access_key("conformance-2")).deleted is True
+    assert [k.key_id for k in await db.get_user_access_keys(user.id)] == ["conformance-1"]
+    assert [k.key_id for k in await db.get_subscription_access_keys(subscription.id)] == ["conformance-1"]
+    assert await db.count_user_active_keys(user.id) == 1
+
+    context_user, active, keys = await db.get_user_context(TELEGRAM_ID)
+    assert context_user.id == user.id
+    assert active.subscription_id == subscription.subscription_id
+    assert [k.key_id for k in keys] == ["conformance-1"]
+    assert await db.get_user_context(TELEGRAM_ID + 100) == (None, None, [])
+
+    assert await db.deactivate_user_access_keys(user.id) is True
+    assert await db.count_user_active_keys(user.id) == 0
+
+# Платежи
+async def test_payments(db, user):
+    """Conditional transitions and keyset pages of stale payments"""
+    started = datetime.now() - timedelta(hours=3)
+    payments = []
+    for minutes in (0, 10, 10, 20):
+        payment = await db.create_payment({
+            "user_id": user.id, "amount": 150.0, "created_at": started + timedelta(minutes=minutes)
+        })
+        assert isinstance(payment, PaymentRow) and payment.status == "pending" and payment.currency == "RUB"
+        payments.append(payment)
+
+    assert await db.transition_payment(payments[3].payment_id, "succeeded") is True
+    assert await db.transition_payment(payments[3].payment_id, "canceled") is False
+    assert (await db.get_payment(payments[3].payment_id)).status == "succeeded"
+    assert await db.update_payment(payments[0].payment_id, {"amount": 99.0}) is True
+    assert (await db.get_payment(payments[0].payment_id)).amount == 99.0
+    # Сверка видит все платежи, которые ещё могут стать succeeded
+    assert await db.transition_payment(payments[1].payment_id, "waiting_for_capture") is True
+    assert await db.transition_payment(payments[2].payment_id, "expired") is True
+
+    stale = []
+    after = None
+    while True:
+        page = await db.get_stale_pending_payments(datetime.now(), after=after, limit=2)
+        stale.extend(page)
+        if len(page) < 2:
+            break
+        after = (page[-1].created_at, page[-1].id)
+    assert [p.payment_id for p in stale] == [p.payment_id for p in payments[:3]]
+    assert await db.get_oldest_pending_payment_time() == started
+    assert len(await db.get_user_payments(user.id, "pending")) == 1
+
+# Дедупликация вебхуков
+async def test_events(db):
+    assert await db.is_event_processed("conformance-event") is False
+    assert await db.mark_event_processed("conformance-event", "payment.succeeded") is True
+    assert await db.mark_event_processed("conformance-event") is False
+    assert await db.is_event_processed("conformance-event") is True
+
+# Сводки для администратора и синхронизации ключей
+async def test_admin_views(db, user, subscription):
+    """Admin user pages, dashboard counts and sync candidates"""
+    await db.create_access_key({
+        "key_id": "conformance-3", "access_url": "ss://three", "user_id": user.id,
+        "subscription_id": subscription.id
+    })
+
+    first, has_more = await db.get_admin_users_page(limit=2)
+    assert has_more and [u["telegram_id"] for u in first] == [TELEGRAM_ID, TELEGRAM_ID + 1]
+    # Последней стала активной pending-подписка на 30 дней
+    assert first[0]["plan_id"] == "monthly" and first[0]["key_ids"] == ["conformance-3"]
+    assert first[1]["plan_id"] is None and first[1]["key_ids"] == []
+    rest, has_more = await db.get_admin_users_page(after_id=first[-1]["id"], limit=2)
+    assert not has_more and [u["telegram_id"] for u in rest] == [TELEGRAM_ID + 2]
+    back, has_more = await db.get_admin_users_page(before_id=rest[0]["id"], limit=2)
+    assert not has_more and [u["id"] for u in back] == [u["id"] for u in first]
+
+    assert await db.get_user_stats() == {
+        "users_count": 3, "active_subscriptions_count": 2, "active_keys_count": 1
+    }
+
+    assert [k.key_id for k in await db.get_sync_candidate_keys(set())] == ["conformance-3"]
+    assert await db.get_sync_candidate_keys({"conformance-3"}) == []
+
+# Outbox уведомлений
+async def test_notifications(db):
+    """Due notifications are leased to one sender, sent ones are not claimed again"""
+    due = await db.enqueue_notification({"chat_id": TELEGRAM_ID, "text": "due", "parse_mode": "HTML"})
+    await db.enqueue_notification({
+        "chat_id": TELEGRAM_ID, "text": "later", "next_attempt_at": datetime.now() + timedelta(hours=1)
+    })
+
+    claimed = await db.claim_due_notifications(limit=10)
+    assert all(isinstance(n, NotificationRow) for n in claimed)
+    assert [(n.id, n.text, n.parse_mode, n.attempts) for n in claimed] == [(due, "due", "HTML", 0)]
+    # Занятое уведомление не выдается повторно до конца аренды
+    assert await db.claim_due_notifications(limit=10) == []
+
+    # Отсрочка из-за flood control не тратит попытку, ошибка доставки - тратит
+    assert await db.reschedule_notification(due, datetime.now() - timedelta(seconds=1)) is True
+    assert [(n.id, n.attempts) for n in await db.claim_due_notifications(limit=10)] == [(due, 0)]
+    assert await db.reschedule_notification(due, datetime.now() - timedelta(seconds=1), count_attempt=True) is True
+    assert [(n.id, n.attempts) for n in await db.claim_due_notifications(limit=10)] == [(due, 1)]
+    assert await db.mark_notifications_sent([due]) is True
+    await db.reschedule_notification(due, datetime.now() - timedelta(seconds=1))
+    assert await db.claim_due_notifications(limit=10) == []
+
+# Рассылки
+async def test_broadcasts(db):
+    """Recipient statuses and the cursor of a broadcast job"""
+    job_id = await db.create_broadcast_job({"text": "news", "total": 3, "created_by": TELEGRAM_ID})
+    job = await db.get_broadcast_job(job_id)
+    assert isinstance(job, BroadcastJobRow) and job.status == "running" and job.text == "news"
+    assert [j.id for j in await db.get_running_broadcast_jobs()] == [job_id]
+
+    page = await db.get_users_page(limit=2)
+    results = [(page[0][1], "sent", None), (page[1][1], "failed", "blocked")]
+    assert await db.record_broadcast_page(job_id, results, page[-1][0]) is True
+    statuses = await db.get_broadcast_recipient_statuses(job_id, [t for _, t in page] + [TELEGRAM_ID + 2])
+    assert statuses == {page[0][1]: "sent", page[1][1]: "failed"}
+    job = await db.get_broadcast_job(job_id)
+    assert (job.cursor_user_id, job.sent_count, job.failed_count) == (page[-1][0], 1, 1)
+
+    assert await db.update_broadcast_job(job_id, {"status": "done"}) is True
+    assert await db.get_running_broadcast_jobs() == []
+
+# Каталог тарифов
+async def test_plans(db):
+    """Seeding once and version bumps on edits"""
+    plans = {"monthly": {"name": "Месяц", "duration": 30, "price": 150.0}}
+    assert await db.seed_plans(plans) is True
+    assert await db.seed_plans(plans) is False
+
+    version, catalog = await db.get_plan_catalog()
+    assert version == 1 == await db.get_plan_catalog_version()
+    assert catalog["monthly"]["price"] == 150.0
+    assert catalog["monthly"]["devices"] == 1 and catalog["monthly"]["active"] is True
+
+    assert await db.update_plan("monthly", {"price": 199.0, "unknown": 1}) == 2
+    assert (await db.get_plan_catalog())[1]["monthly"]["price"] == 199.0
+    assert await db.update_plan("missing", {"price": 1.0}) is None
+
+# Окончание подписок
+async def test_expiry(db, subscription):
+    """Expiry listeners, notice windows and closing expired subscriptions"""
+    changes = []
+    db.add_expiry_listener(lambda subscription_id, expires_at: changes.append((subscription_id, expires_at)))
+    # MongoDB хранит время с точностью до миллисекунд
+    now = datetime.now().replace(microsecond=0)
+    expires_at = now + timedelta(days=20)
+    assert await db.update_subscription(subscription.subscription_id, {"expires_at": expires_at}) is True
+    assert changes == [(subscription.id, expires_at)]
+    # Окно не захватывает вторую активную подписку, истекающую через 2 дня
+    window = (now + timedelta(days=17), now + timedelta(days=21))
+    assert await db.get_subscription_expiries(*window) == [(subscription.id, expires_at)]
+
+    page = await db.get_expiry_notice_page(3, *window)
+    assert page == [{"id": subscription.id, "expires_at": expires_at, "plan_id": "monthly", "telegram_id": TELEGRAM_ID}]
+    assert await db.record_expiry_notices(3, page, [{"chat_id": TELEGRAM_ID, "text": "expires soon"}]) is True
+    assert await db.get_expiry_notice_page(3, *window) == []
+    # Более близкое окно ещё не уведомлено
+    assert [row["id"] for row in await db.get_expiry_notice_page(1, *window)] == [subscription.id]
+    rows = await db.get_expiry_notice_rows([subscription.id])
+    assert (rows[0]["expiry_notice_days"], rows[0]["expiry_notice_for"]) == (3, expires_at)
+    assert [n.text for n in await db.claim_due_notifications(limit=10)] == ["expires soon"]
+
+    past = now - timedelta(minutes=1)
+    await db.update_subscription(subscription.subscription_id, {"expires_at": past})
+    assert await db.get_expired_active_subscriptions(now) == [(subscription.id, past)]
+    expired, key_ids = await db.expire_subscriptions([subscription.id], now)
+    assert expired == [subscription.id] and key_ids == ["conformance-3"]
+    assert await db.mark_access_keys_deleted(key_ids) is True
+    assert await db.get_expired_active_subscriptions(now) == []
+    assert await db.count_user_active_keys(subscription.user_id) == 0
+
+# Массовые операции администратора
+async def test_admin_jobs(db, user):
+    """Job targets by filter and the page operations that advance a job"""
+    other = await db.get_user(TELEGRAM_ID + 1)
+    now = datetime.now().replace(microsecond=0)
+    subscription = await db.create_subscription({
+        "user_id": other.id, "plan_id": "yearly", "expires_at": now + timedelta(days=5)
+    })
+    await db.create_access_key({
+        "key_id": "conformance-4", "access_url": "ss://four", "user_id": other.id,
+        "subscription_id": subscription.id
+    })
+
+    extend_id = await db.create_admin_job({"action": "extend", "params": '{"days": 3}'}, "active")
+    job = await db.get_admin_job(extend_id)
+    # Активны вторая подписка пользователя и новая подписка другого пользователя
+    assert isinstance(job, AdminJobRow) and job.action == "extend" and job.total == 2
+    assert await db.get_admin_job_targets(extend_id, limit=1) == [(user.id, TELEGRAM_ID)]
+    assert await db.get_admin_job_targets(extend_id, after_user_id=user.id) == [(other.id, TELEGRAM_ID + 1)]
+    assert (await db.get_admin_job(await db.create_admin_job({"action": "revoke"}, "inactive"))).total == 1
+    assert (await db.get_admin_job(await db.create_admin_job({"action": "revoke"}, "plan:yearly"))).total == 1
+    migrate_id = await db.create_admin_job(
+        {"action": "migrate"}, telegram_ids=[TELEGRAM_ID + 1, TELEGRAM_ID + 1, TELEGRAM_ID + 100]
+    )
+    assert (await db.get_admin_job(migrate_id)).total == 1
+    assert len(await db.get_running_admin_jobs()) == 4
+
+    extended = await db.extend_active_subscriptions([other.id], 3, job_id=extend_id, cursor_user_id=other.id)
+    assert extended == {other.id}
+    assert (await db.get_subscription(subscription.subscription_id)).expires_at == now + timedelta(days=8)
+    job = await db.get_admin_job(extend_id)
+    assert (job.cursor_user_id, job.done_count, job.failed_count) == (other.id, 1, 0)
+
+    assert await db.get_users_live_keys([other.id]) == [{
+        "user_id": other.id, "telegram_id": TELEGRAM_ID + 1, "key_id": "conformance-4",
+        "name": None, "access_url": "ss://four"
+    }]
+    assert await db.replace_access_keys(
+        [("conformance-4", "conformance-5", "ss://five")], [{"chat_id": TELEGRAM_ID + 1, "text": "moved"}],
+        job_id=migrate_id, cursor_user_id=other.id, done=1
+    ) is True
+    assert (await db.get_access_key("conformance-5")).access_url == "ss://five"
+    assert [n.text for n in await db.claim_due_notifications(limit=10)] == ["moved"]
+    assert (await db.get_admin_job(migrate_id)).done_count == 1
+
+    assert await db.revoke_users_access([other.id], ["conformance-5"]) is True
+    assert await db.get_active_subscription(other.id) is None
+    assert await db.count_user_active_keys(other.id) == 0
+    assert (await db.get_user(TELEGRAM_ID + 1)).is_premium is False
+
+    assert await db.record_admin_job_page(extend_id, other.id, 0, 2) is True
+    assert (await db.get_admin_job(extend_id)).failed_count == 2
+    assert await db.update_admin_job(extend_id, {"status": "done"}) is True
+    assert extend_id not in [j.id for j in await db.get_running_admin_jobs()]
+
+# Состояние диалогов
+async def test_user_states(db):
+    assert await db.get_user_state(TELEGRAM_ID) == ""
+    assert await db.save_user_states({TELEGRAM_ID: '{"step": 1}', TELEGRAM_ID + 1: "{}"}) is True
+    assert await db.save_user_states({TELEGRAM_ID: '{"step": 2}'}, deleted_ids=[TELEGRAM_ID + 1]) is True
+    assert await db.get_user_state(TELEGRAM_ID) == '{"step": 2}'
+    assert await db.get_user_state(TELEGRAM_ID + 1) == ""
+
+# Проведение платежа
+async def test_complete_payment(db):
+    """Payment, subscription and notification change together; a repeat changes nothing"""
+    user = await db.get_user(TELEGRAM_ID + 2)
+    expires_at = datetime.now().replace(microsecond=0) + timedelta(days=30)
+    values = {"expires_at": expires_at, "price_paid": 150.0}
+    notification = {"chat_id": TELEGRAM_ID + 2, "text": "paid"}
+
+    async def pending_payment():
+        subscription = await db.create_subscription({
+            "user_id": user.id, "plan_id": "monthly", "status": "pending", "expires_at": expires_at
+        })
+        payment = await db.create_payment({
+            "user_id": user.id, "amount": 150.0, "subscription_id": subscription.subscription_id
+        })
+        return subscription, payment
+
+    subscription, payment = await pending_payment()
+    _, canceled = await pending_payment()
+    await db.transition_payment(canceled.payment_id, "canceled")
+    assert await db.complete_payment(canceled.payment_id, {}, values, notification) is False
+
+    assert await db.complete_payment(payment.payment_id, {"completed_at": datetime.now()}, values, notification) is True
+    assert (await db.get_payment(payment.payment_id)).status == "succeeded"
+    active = await db.get_active_subscription(user.id)
+    assert (active.subscription_id, active.price_paid) == (subscription.subscription_id, 150.0)
+    assert await db.complete_payment(payment.payment_id, {}, values, notification) is False
+    assert [n.text for n in await db.claim_due_notifications(limit=10)] == ["paid"]
+
+    # Платеж проведен, а подписка не активирована (сбой между шагами): повтор её активирует
+    stuck, stuck_payment = await pending_payment()
+    await db.transition_payment(stuck_payment.payment_id, "succeeded")
+    assert await db.complete_payment(stuck_payment.payment_id, {}, values) is True
+    assert (await db.get_subscription(stuck.subscription_id)).status == "active"
+
+async def check_backend(name):
+    """Runs all checks on a fresh backend; False if it is unavailable"""
+    db = load_backend(name)
+    if not await db.init_database():
+        return False
+    if name == "memory":
+        db.reset_database()
+    elif name == "mongo":
+        await db.client.drop_database(os.environ["MONGO_DB_NAME"])
+        await db.ensure_indexes()
+
+    try:
+        user = await test_users(db)
+        subscription = await test_subscriptions(db, user)
+        await test_access_keys(db, user, subscription)
+        await test_payments(db, user)
+        await test_events(db)
+        await test_admin_views(db, user, subscription)
+        await test_notifications(db)
+        await test_broadcasts(db)
+        await test_plans(db)
+        await test_expiry(db, subscription)
+        await test_admin_jobs(db, user)
+        await test_user_states(db)
+        await test_complete_payment(db)
+    finally:
+        if name == "mongo":
+            await db.client.drop_database(os.environ["MONGO_DB_NAME"])
+    return True
+
+async def run_tests(names):
+    """Запуск проверок для выбранных бэкендов"""
+    failed = False
+    for name in names:
+        try:
+            if await check_backend(name):
+                logger.info(f"✅ {name}: backend conforms to the repository interface")
+            else:
+                logger.warning(f"⏭️ {name}: backend is not available, skipped")
+        except AssertionError:
+            failed = True
+            logger.exception(f"❌ {name}: conformance check failed")
+    return not failed
+
+# Запуск тестов
+if __name__ == "__main__":
+    ok = asyncio.run(run_tests(sys.argv[1:] or list(BACKENDS)))
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,160 @@
+"""
+Компактные данные inline-кнопок.
+
+Telegram ограничивает callback_data 64 байтами, поэтому аргументы кнопок
+упаковываются в короткую строку: байт версии схемы, затем поля (целые числа
+в zigzag-varint, строки с длиной), всё в base64url без выравнивания. Кнопки
+со старой версией схемы не разбираются и считаются устаревшими.
+
+Большие значения (например, ссылки на ключи) в кнопку не кладутся: они
+хранятся в памяти процесса в PayloadStore, а кнопка несёт короткий токен.
+Записи живут ограниченное время, их количество ограничено, и каждая
+привязана к пользователю, так что чужой токен ничего не вернёт.
+"""
+
+import base64
+import binascii
+import itertools
+import time
+from collections import OrderedDict
+
+from telegram.constants import InlineKeyboardButtonLimit
+
+from config import CALLBACK_PAYLOAD_TTL, CALLBACK_PAYLOAD_MAX_ENTRIES
+
+SCHEMA_VERSION = 1
+MAX_CALLBACK_DATA = InlineKeyboardButtonLimit.MAX_CALLBACK_DATA
+
+_TAG_INT = 0
+_TAG_STR = 1
+
+
+def _write_varint(out, value):
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+
+def _read_varint(raw, pos):
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(raw):
+            raise ValueError("Truncated callback payload")
+        byte = raw[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def pack(*values):
+    """Pack ints and strings into a compact versioned base64url string"""
+    out = bytearray((SCHEMA_VERSION,))
+    for value in values:
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise TypeError(f"Cannot pack {type(value).__name__} into callback data")
+        if isinstance(value, int):
+            out.append(_TAG_INT)
+            _write_varint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+        else:
+            encoded = value.encode("utf-8")
+            out.append(_TAG_STR)
+            _write_varint(out, len(encoded))
+            out += encoded
+    return base64.urlsafe_b64encode(bytes(out)).rstrip(b"=").decode("ascii")
+
+
+def unpack(payload):
+    """
+    Распаковывает строку, собранную pack().
+
+    Raises:
+        ValueError: Строка повреждена или собрана другой версией схемы
+    """
+    try:
+        raw = base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+    except (binascii.Error, ValueError):
+        raise ValueError("Invalid callback payload encoding") from None
+    if not raw or raw[0] != SCHEMA_VERSION:
+        raise ValueError("Unsupported callback payload version")
+
+    values = []
+    pos = 1
+    while pos < len(raw):
+        tag = raw[pos]
+        value, pos = _read_varint(raw, pos + 1)
+        if tag == _TAG_INT:
+            values.append(value >> 1 if not value & 1 else -((value + 1) >> 1))
+        elif tag == _TAG_STR:
+            if pos + value > len(raw):
+                raise ValueError("Truncated callback payload")
+            try:
+                values.append(raw[pos:pos + value].decode("utf-8"))
+            except UnicodeDecodeError:
+                raise ValueError("Invalid callback payload string") from None
+            pos += value
+        else:
+            raise ValueError(f"Unknown callback payload tag {tag}")
+    return tuple(values)
+
+
+def build(prefix, *values):
+    """
+    Собирает callback_data из префикса маршрута и упакованных аргументов.
+
+    Raises:
+        ValueError: Результат длиннее лимита Telegram
+    """
+    data = prefix + pack(*values)
+    if len(data.encode("utf-8")) > MAX_CALLBACK_DATA:
+        raise ValueError(f"Callback data {data!r} exceeds {MAX_CALLBACK_DATA} bytes")
+    return data
+
+
+class PayloadStore:
+    """Bounded in-memory TTL store for button payloads, keyed by small int tokens"""
+
+    def __init__(self, ttl=CALLBACK_PAYLOAD_TTL, max_entries=CALLBACK_PAYLOAD_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # token -> (owner, expires_at, value); порядок вставки = порядок истечения
+        self._entries = OrderedDict()
+        self._tokens = itertools.count(1)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expire(self, now):
+        while self._entries:
+            token, (_, expires_at, _) = next(iter(self._entries.items()))
+            if expires_at > now and len(self._entries) <= self.max_entries:
+                return
+            del self._entries[token]
+
+    def put(self, owner, value):
+        """Store `value` for user `owner` and return its token"""
+        now = time.monotonic()
+        token = next(self._tokens)
+        self._entries[token] = (owner, now + self.ttl, value)
+        self._expire(now)
+        return token
+
+    def get(self, owner, token):
+        """Get the value stored under `token` for `owner`, None if missing or expired"""
+        entry = self._entries.get(token)
+        if entry is None:
+            return None
+        entry_owner, expires_at, value = entry
+        if entry_owner != owner or expires_at <= time.monotonic():
+            return None
+        return value
+
+
+payload_store = PayloadStore()
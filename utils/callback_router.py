@@ -0,0 +1,114 @@
+"""
+Маршрутизация нажатий inline-кнопок.
+
+Данные кнопки (callback_data) имеют вид "действие" или "префикс_аргумент".
+Точные действия ищутся в словаре, префиксные - по частям строки до каждого
+символа "_", поэтому стоимость поиска зависит только от длины callback_data,
+а не от количества кнопок в меню. Аргумент разбирается функцией, указанной
+при регистрации, и передаётся обработчику третьим параметром; аргументы,
+упакованные utils.callback_data.pack(), передаются отдельными параметрами.
+Кнопки, чьи аргументы не разбираются (например, старой версии схемы),
+получают ответ "кнопка устарела".
+
+Для каждого действия собираются количество вызовов, ошибки и время обработки.
+"""
+
+import logging
+import time
+
+from utils import metrics
+from utils.callback_data import unpack
+
+logger = logging.getLogger(__name__)
+
+SEPARATOR = "_"
+STALE_ANSWER = "⌛ Кнопка устарела, откройте меню заново"
+
+
+class CallbackRouter:
+    """Dispatch table from callback data to handlers"""
+
+    def __init__(self, metric_prefix="callbacks"):
+        self.metric_prefix = metric_prefix
+        # data -> handler
+        self._exact = {}
+        # prefix (ending with SEPARATOR) -> (handler, payload -> args)
+        self._prefixes = {}
+
+    def __len__(self):
+        return len(self._exact) + len(self._prefixes)
+
+    def add(self, data, handler):
+        """Route callback data equal to `data` to handler(update, context)"""
+        if data in self._exact:
+            raise ValueError(f"Callback action {data!r} is already registered")
+        self._exact[data] = handler
+
+    def _add_route(self, prefix, handler, to_args):
+        if not prefix.endswith(SEPARATOR):
+            raise ValueError(f"Callback prefix {prefix!r} must end with {SEPARATOR!r}")
+        if prefix in self._prefixes:
+            raise ValueError(f"Callback prefix {prefix!r} is already registered")
+        self._prefixes[prefix] = (handler, to_args)
+
+    def add_prefix(self, prefix, handler, parse=str):
+        """Route "<prefix><payload>" to handler(update, context, parse(payload))"""
+        self._add_route(prefix, handler, lambda payload: (parse(payload),))
+
+    def add_packed(self, prefix, handler):
+        """Route "<prefix><pack(*values)>" to handler(update, context, *values)"""
+        self._add_route(prefix, handler, unpack)
+
+    def resolve(self, data):
+        """
+        Находит обработчик для callback_data.
+
+        Точное совпадение важнее префикса, длинный префикс важнее короткого.
+
+        Returns:
+            tuple: (действие, обработчик, аргументы) или None; аргументы
+            равны None, если префикс известен, но аргумент не разобрался
+        """
+        handler = self._exact.get(data)
+        if handler is not None:
+            return data, handler, ()
+
+        end = data.rfind(SEPARATOR)
+        while end > 0:
+            prefix = data[:end + 1]
+            route = self._prefixes.get(prefix)
+            if route is not None:
+                handler, to_args = route
+                try:
+                    return prefix, handler, to_args(data[end + 1:])
+                except (TypeError, ValueError):
+                    return prefix, handler, None
+            end = data.rfind(SEPARATOR, 0, end)
+        return None
+
+    async def dispatch(self, update, context):
+        """CallbackQueryHandler callback: route the query and record metrics"""
+        query = update.callback_query
+        route = self.resolve(query.data or "")
+        if route is None:
+            metrics.inc(f"{self.metric_prefix}.unknown")
+            logger.warning(f"Unknown callback data: {query.data!r}")
+            await query.answer()
+            return
+
+        action, handler, args = route
+        name = f"{self.metric_prefix}.{action}"
+        if args is None:
+            metrics.inc(f"{name}.stale")
+            await query.answer(STALE_ANSWER)
+            return
+
+        metrics.inc(name)
+        started = time.monotonic()
+        try:
+            await handler(update, context, *args)
+        except Exception:
+            metrics.inc(f"{name}.errors")
+            raise
+        finally:
+            metrics.observe(name, time.monotonic() - started)
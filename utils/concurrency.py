@@ -0,0 +1,111 @@
+"""
+Параллельная обработка обновлений Telegram.
+
+Обновления разных пользователей обрабатываются одновременно, а обновления
+одного пользователя - строго по очереди, чтобы покупка, тестовый период и
+создание ключей не гонялись за test_used и ключи.
+
+Блокировки живут в памяти одного процесса. При нескольких воркерах вебхука
+(BOT_WORKER_ID, WEB_SERVER_REUSE_PORT) обновления одного пользователя могут
+прийти в разные процессы, поэтому общие инварианты защищает база: условные
+UPDATE в claim_test_period, transition_payment и complete_payment.
+"""
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from utils import metrics
+from utils.throttle import answer_throttled
+
+
+class UserLockRegistry:
+    """Registry of per-user asyncio locks.
+
+    An entry lives only while somebody holds or waits for the lock and is
+    evicted as soon as the last holder leaves, so the registry never grows
+    beyond the number of updates in flight.
+
+    The locks serialize a user within this process only; they are not a
+    guard across workers (see the module docstring).
+    """
+
+    def __init__(self):
+        # user_id -> [lock, holders]
+        self._locks = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, user_id):
+        """Hold the lock of `user_id` for the duration of the block"""
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user_id]
+
+
+class UserSerializingUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently, one at a time per Telegram user.
+
+    `max_concurrent_updates` caps all updates in flight, including those
+    waiting for their user's lock. Producers can await wait_for_capacity()
+    before queueing new updates to get backpressure. With a `throttle`,
+    flooding updates are answered and dropped before they take a user lock.
+    """
+
+    def __init__(self, max_concurrent_updates, throttle=None):
+        super().__init__(max_concurrent_updates)
+        self.locks = UserLockRegistry()
+        self.throttle = throttle
+        self._capacity = asyncio.Condition()
+
+    async def wait_for_capacity(self):
+        """Wait until fewer than max_concurrent_updates updates are in flight"""
+        async with self._capacity:
+            await self._capacity.wait_for(
+                lambda: self.current_concurrent_updates < self.max_concurrent_updates
+            )
+
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        request_key = ()
+        if self.throttle is not None and user is not None:
+            request_key = self.throttle.acquire(update)
+            if request_key is None:
+                coroutine.close()
+                metrics.inc("updates.throttled")
+                await answer_throttled(update)
+                return
+        
+        started = time.monotonic()
+        try:
+            if user is None:
+                await coroutine
+            else:
+                async with self.locks.hold(user.id):
+                    await coroutine
+        finally:
+            if self.throttle is not None:
+                self.throttle.release(request_key)
+            metrics.observe("updates.processing", time.monotonic() - started)
+            metrics.set_gauge("updates.user_locks", len(self.locks))
+            async with self._capacity:
+                self._capacity.notify_all()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,47 @@
+"""
+Простой реестр метрик процесса: счётчики, текущие значения и тайминги.
+
+Метрики живут в памяти процесса бота и отдаются целиком через snapshot().
+"""
+
+_counters = {}
+_gauges = {}
+_timings = {}
+
+
+def inc(name, value=1):
+    """Increase a counter"""
+    _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name, value):
+    """Set the current value of a gauge"""
+    _gauges[name] = value
+
+
+def observe(name, seconds):
+    """Record a duration sample (count, total and max are kept)"""
+    timing = _timings.get(name)
+    if timing is None:
+        _timings[name] = [1, seconds, seconds]
+    else:
+        timing[0] += 1
+        timing[1] += seconds
+        if seconds > timing[2]:
+            timing[2] = seconds
+
+
+def snapshot():
+    """Get all metrics as a plain dict"""
+    return {
+        "counters": dict(_counters),
+        "gauges": dict(_gauges),
+        "timings": {
+            name: {
+                "count": count,
+                "avg": total / count if count else 0.0,
+                "max": max_value
+            }
+            for name, (count, total, max_value) in _timings.items()
+        }
+    }
@@ -0,0 +1,124 @@
+"""
+Общий ограничитель исходящих запросов к Telegram.
+
+Все запросы бота к Bot API проходят через OutboundLimiter (rate limiter PTB).
+Запросы, адресованные чату (сообщения, правки), получают токен из общего
+token bucket в порядке приоритета: ответы пользователям, затем уведомления,
+затем массовые рассылки. Уведомления и рассылки дополнительно соблюдают
+интервал между сообщениями в один чат; интерактивные ответы - нет, их частоту
+ограничивает защита от флуда на входе.
+
+На RetryAfter весь bucket встаёт на паузу, запрос повторяется сам. У каждого
+приоритета ограниченный буфер: когда он заполнен, отправители ждут
+(backpressure), а не копят запросы в памяти.
+
+Приоритет передаётся через rate_limit_args, например
+bot.send_message(..., rate_limit_args=BULK).
+
+Ограничитель живёт в памяти процесса: при нескольких воркерах каждый получает
+свою долю OUTBOUND_RATE (см. BOT_WORKERS в config).
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from config import OUTBOUND_RATE, OUTBOUND_BUFFER_SIZES, OUTBOUND_MAX_RETRIES
+from utils import metrics
+from utils.rate_limit import TokenBucket, ChatSpacing, retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+NOTIFICATION = 1
+BULK = 2
+PRIORITY_NAMES = ("interactive", "notification", "bulk")
+
+
+class OutboundLimiter(BaseRateLimiter):
+    """Priority-ordered global token bucket with per-chat spacing and RetryAfter retries"""
+
+    def __init__(self, rate=OUTBOUND_RATE, buffer_sizes=OUTBOUND_BUFFER_SIZES,
+                 max_retries=OUTBOUND_MAX_RETRIES):
+        # Доля воркера может быть меньше одного сообщения в секунду
+        self.bucket = TokenBucket(rate, capacity=max(rate, 1))
+        self.spacing = ChatSpacing()
+        self.max_retries = max_retries
+        self._buffers = [asyncio.Semaphore(size) for size in buffer_sizes]
+        self._depth = [0] * len(PRIORITY_NAMES)
+        # (priority, seq, future) - ожидающие токена
+        self._waiters = []
+        self._seq = itertools.count()
+        self._dispatcher = None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+        for _, _, future in self._waiters:
+            future.cancel()
+        self._waiters.clear()
+
+    async def _dispatch(self):
+        # Каждый токен достаётся самому приоритетному из ожидающих
+        while self._waiters:
+            await self.bucket.acquire()
+            while self._waiters:
+                _, _, future = heapq.heappop(self._waiters)
+                if not future.done():
+                    future.set_result(None)
+                    break
+
+    async def _take_token(self, priority):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        try:
+            await future
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+    def _set_depth(self, priority, delta):
+        self._depth[priority] += delta
+        metrics.set_gauge(f"outbound.depth.{PRIORITY_NAMES[priority]}", self._depth[priority])
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            # answerCallbackQuery, getUpdates и т.п. не расходуют лимит сообщений
+            return await callback(*args, **kwargs)
+
+        priority = rate_limit_args if rate_limit_args in (NOTIFICATION, BULK) else INTERACTIVE
+        name = PRIORITY_NAMES[priority]
+
+        async with self._buffers[priority]:
+            self._set_depth(priority, 1)
+            try:
+                for attempt in range(self.max_retries + 1):
+                    started = time.monotonic()
+                    if priority != INTERACTIVE:
+                        await self.spacing.wait(chat_id)
+                    await self._take_token(priority)
+                    metrics.observe(f"outbound.wait.{name}", time.monotonic() - started)
+
+                    try:
+                        return await callback(*args, **kwargs)
+                    except RetryAfter as e:
+                        # Flood control касается всего бота: останавливаем общий bucket
+                        delay = retry_after_seconds(e)
+                        self.bucket.pause(delay)
+                        metrics.inc("outbound.retry_after")
+                        if attempt >= self.max_retries:
+                            raise
+                        logger.warning(f"Flood control на {endpoint} ({name}), повтор через {delay} с")
+            finally:
+                self._set_depth(priority, -1)
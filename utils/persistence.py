@@ -0,0 +1,244 @@
+"""
+Хранение context.user_data в базе (через services.repository).
+
+Состояние пользователя (шаги админских диалогов и т.п.) переживает
+перезапуск бота. Оно загружается лениво - при первом обновлении от
+пользователя в этом процессе, через хук refresh_user_data, который PTB
+вызывает перед обработчиками. Изменённые состояния копятся в буфере и
+записываются одной транзакцией; неизменённые не пишутся вовсе. Состояния
+пользователей, давно не присылавших обновлений, выгружаются из памяти и
+при следующем обращении читаются снова.
+
+Если воркеров несколько (BOT_WORKERS > 1), обновления одного пользователя
+приходят в разные процессы, и память одного из них может отстать от базы.
+Тогда состояние перечитывается перед каждым обновлением: если другой воркер
+записал новое, оно заменяет копию в памяти.
+
+С SQLite в качестве DATABASE_URL это локальное встроенное хранилище,
+в MongoDB состояния лежат в коллекции user_states.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from config import (
+    BOT_WORKERS, USER_STATE_FLUSH_INTERVAL, USER_STATE_IDLE_TTL, USER_STATE_EVICT_INTERVAL
+)
+from services.repository import repository as db
+
+logger = logging.getLogger(__name__)
+
+
+class UserDataPersistence(BasePersistence):
+    """PTB persistence for user_data only, stored as JSON in the repository's user states.
+
+    `update_interval` is how often PTB hands changed user_data over for
+    writing. Users idle for `idle_ttl` seconds are evicted from memory by
+    evict_idle(); the TTL must cover a few update intervals so that their
+    last changes have been handed over before eviction. With `shared` set
+    (several workers) loaded states are re-read on every update.
+    """
+
+    def __init__(self, update_interval=USER_STATE_FLUSH_INTERVAL, idle_ttl=USER_STATE_IDLE_TTL,
+                 shared=BOT_WORKERS > 1):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        if idle_ttl < 2 * update_interval:
+            raise ValueError("idle_ttl must be at least twice the update interval")
+        self.idle_ttl = idle_ttl
+        self.shared = shared
+        # Пользователи, чьё состояние загружено в память этого процесса
+        self._loaded = set()
+        # telegram_id -> время последнего обращения, от старых к новым
+        self._last_seen = OrderedDict()
+        # telegram_id -> JSON, совпадающий с базой
+        self._saved = {}
+        # Ожидают записи
+        self._dirty = {}
+        self._deleted = set()
+        # Выгружены из памяти: удаление из user_data приложения не трогает базу
+        self._evicted = set()
+        # Вернулись до того, как PTB передал удаление: telegram_id -> их user_data
+        self._returned = {}
+        self._write_task = None
+
+    async def get_user_data(self):
+        # Состояния загружаются по одному в refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        self._last_seen[user_id] = time.monotonic()
+        self._last_seen.move_to_end(user_id)
+        if user_id in self._evicted:
+            self._returned[user_id] = user_data
+        if user_id in self._loaded:
+            if self.shared:
+                await self._reload_if_changed(user_id, user_data)
+            return
+
+        # Незаписанное состояние новее того, что лежит в базе
+        if user_id in self._dirty:
+            stored = self._dirty[user_id]
+        elif user_id in self._deleted:
+            stored = ""
+        else:
+            stored = await db.get_user_state(user_id)
+            if stored is None:
+                return
+            self._saved[user_id] = stored or "{}"
+
+        if stored:
+            for key, value in json.loads(stored).items():
+                user_data.setdefault(key, value)
+        self._loaded.add(user_id)
+
+    async def _reload_if_changed(self, user_id, user_data):
+        # Своя незаписанная правка новее базы
+        if user_id in self._dirty or user_id in self._deleted:
+            return
+        stored = await db.get_user_state(user_id)
+        if stored is None:
+            return
+        stored = stored or "{}"
+        if stored == self._saved.get(user_id):
+            return
+
+        # Состояние записал другой воркер
+        user_data.clear()
+        user_data.update(json.loads(stored))
+        self._saved[user_id] = stored
+
+    async def update_user_data(self, user_id, data):
+        # Состояние, которое не загружалось, не могло измениться - не затираем базу
+        if user_id not in self._loaded:
+            return
+        try:
+            encoded = json.dumps(data, ensure_ascii=False, sort_keys=True, default=str)
+        except (TypeError, ValueError) as e:
+            logger.error(f"Cannot serialize user_data of {user_id}: {e}")
+            return
+        if self._dirty.get(user_id, self._saved.get(user_id)) == encoded:
+            return
+
+        self._deleted.discard(user_id)
+        self._dirty[user_id] = encoded
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id):
+        if user_id in self._evicted:
+            # Данные выгружены evict_idle(), а не удалены - запись в базе остаётся
+            self._evicted.discard(user_id)
+            # PTB отбрасывает изменения пользователя, вернувшегося до этого
+            # прохода (update_ids -= delete_ids), поэтому записываем их сами
+            user_data = self._returned.pop(user_id, None)
+            if user_data is not None:
+                await self.update_user_data(user_id, user_data)
+            return
+        self._dirty.pop(user_id, None)
+        self._deleted.add(user_id)
+        self._schedule_write()
+
+    def _schedule_write(self):
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self):
+        # Даём остальным update_user_data этого прохода попасть в ту же пачку
+        await asyncio.sleep(0)
+        while self._dirty or self._deleted:
+            states, deleted = self._dirty, self._deleted
+            self._dirty, self._deleted = {}, set()
+
+            if not await db.save_user_states(states, deleted):
+                # Вернём в буфер, не затирая то, что успело измениться, и повторим позже
+                for user_id, encoded in states.items():
+                    self._dirty.setdefault(user_id, encoded)
+                self._deleted |= deleted - self._dirty.keys()
+                return
+
+            self._saved.update(states)
+            for user_id in deleted:
+                self._saved[user_id] = "{}"
+            logger.debug(f"Saved {len(states)} user states, deleted {len(deleted)}")
+
+    async def flush(self):
+        if self._write_task is not None:
+            await self._write_task
+        await self._write_pending()
+
+    def evict_idle(self, application):
+        """
+        Выгружает из памяти состояния пользователей, не присылавших обновлений
+        дольше idle_ttl.
+
+        Returns:
+            int: Количество выгруженных пользователей
+        """
+        deadline = time.monotonic() - self.idle_ttl
+        evicted = 0
+        while self._last_seen:
+            user_id, last_seen = next(iter(self._last_seen.items()))
+            if last_seen > deadline:
+                break
+            del self._last_seen[user_id]
+            self._loaded.discard(user_id)
+            self._saved.pop(user_id, None)
+            # Приложение передаст удаление в drop_user_data(), где оно будет пропущено
+            self._evicted.add(user_id)
+            self._returned.pop(user_id, None)
+            application.drop_user_data(user_id)
+            evicted += 1
+        return evicted
+
+    # Остальные данные не хранятся
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+
+async def start_user_data_evictor(application, interval_seconds=USER_STATE_EVICT_INTERVAL):
+    """Периодически выгружает из памяти состояния неактивных пользователей"""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            evicted = application.persistence.evict_idle(application)
+            if evicted:
+                logger.info(f"Evicted user_data of {evicted} idle users")
+        except Exception as e:
+            logger.error(f"Error evicting user_data: {e}")
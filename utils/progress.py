@@ -0,0 +1,98 @@
+"""
+Сообщение с прогрессом долгой операции.
+
+ProgressReporter запоминает только последний переданный текст и редактирует
+сообщение не чаще, чем раз в интервал: промежуточные состояния, пришедшие
+между правками, склеиваются. Текст, совпадающий с уже показанным, не
+отправляется, а ответ Telegram "message is not modified" не считается
+ошибкой. Итоговое состояние отправляется в фоне, вызывающий код его не ждёт.
+"""
+
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, RetryAfter
+
+from config import PROGRESS_EDIT_INTERVAL
+from utils.rate_limit import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+# Фоновые правки держатся здесь, чтобы задачи не собрал сборщик мусора
+_background_tasks = set()
+
+
+class ProgressReporter:
+    """Coalescing, rate-limited editor of one status message"""
+
+    def __init__(self, bot, chat_id, message_id, interval=PROGRESS_EDIT_INTERVAL, parse_mode=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.interval = interval
+        self.parse_mode = parse_mode
+        self._last_edit = float("-inf")
+        self._shown = None
+        self._pending = None
+        self._task = None
+
+    @classmethod
+    def for_message(cls, message, **kwargs):
+        """Reporter editing an already sent telegram.Message"""
+        return cls(message.get_bot(), message.chat_id, message.message_id, **kwargs)
+
+    def update(self, text, reply_markup=None, parse_mode=None):
+        """Show `text` on the next allowed edit; earlier pending text is dropped"""
+        if not self.chat_id or not self.message_id:
+            return
+        self._pending = (text, reply_markup, parse_mode or self.parse_mode)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            _background_tasks.add(self._task)
+            self._task.add_done_callback(_background_tasks.discard)
+
+    def finish(self, text, reply_markup=None, parse_mode=None):
+        """
+        Показывает итоговый текст, не дожидаясь отправки.
+
+        Returns:
+            asyncio.Task: Задача правки (можно дождаться) или None
+        """
+        self.update(text, reply_markup, parse_mode)
+        return self._task
+
+    async def _run(self):
+        while self._pending is not None:
+            wait = self._last_edit + self.interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            pending, self._pending = self._pending, None
+            await self._edit(pending)
+
+    async def _edit(self, pending):
+        if pending == self._shown:
+            return
+        text, reply_markup, parse_mode = pending
+        self._last_edit = time.monotonic()
+        try:
+            await self.bot.edit_message_text(
+                text,
+                chat_id=self.chat_id,
+                message_id=self.message_id,
+                parse_mode=parse_mode,
+                reply_markup=reply_markup
+            )
+            self._shown = pending
+        except RetryAfter as e:
+            # Повторим после паузы, если за это время не появилось более свежего текста
+            self._last_edit = time.monotonic() + retry_after_seconds(e)
+            if self._pending is None:
+                self._pending = pending
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                self._shown = pending
+            else:
+                logger.warning(f"Не удалось обновить сообщение с прогрессом: {e}")
+        except Exception as e:
+            logger.warning(f"Не удалось обновить сообщение с прогрессом: {e}")
@@ -0,0 +1,84 @@
+"""
+Ограничение частоты исходящих запросов к Telegram.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+# Лимиты Telegram Bot API: около 30 сообщений в секунду суммарно
+# и не больше одного сообщения в секунду в один чат
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_PER_CHAT_INTERVAL = 1.0
+
+
+class TokenBucket:
+    """Asyncio token bucket: `rate` tokens per second with bursts up to `capacity`"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds):
+        """Stop handing out tokens for `seconds` (e.g. after a flood-wait)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        async with self._lock:
+            while True:
+                paused_for = self._paused_until - time.monotonic()
+                if paused_for > 0:
+                    await asyncio.sleep(paused_for)
+                    continue
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ChatSpacing:
+    """Keeps at least `interval` seconds between sends to the same chat.
+
+    Only the most recently used `max_chats` chats are remembered, older
+    entries are long past their interval anyway.
+    """
+
+    def __init__(self, interval=TELEGRAM_PER_CHAT_INTERVAL, max_chats=10000):
+        self.interval = interval
+        self.max_chats = max_chats
+        self._next_allowed = OrderedDict()
+
+    async def wait(self, chat_id):
+        """Wait for the chat's turn and reserve the next slot"""
+        now = time.monotonic()
+        allowed_at = self._next_allowed.get(chat_id, 0.0)
+        slot = max(now, allowed_at)
+        
+        self._next_allowed[chat_id] = slot + self.interval
+        self._next_allowed.move_to_end(chat_id)
+        while len(self._next_allowed) > self.max_chats:
+            self._next_allowed.popitem(last=False)
+        
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+def retry_after_seconds(error):
+    """Get the flood-wait delay from a telegram.error.RetryAfter in seconds"""
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
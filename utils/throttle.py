@@ -0,0 +1,123 @@
+"""
+Защита от флуда кнопками и командами.
+
+Для каждой пары (пользователь, класс действия) хранится token bucket. Пока
+запрос пользователя выполняется, точно такой же запрос (та же кнопка или
+команда) не запускается повторно. Отклонённые обновления получают короткий
+ответ "подождите" без вызова обработчика.
+"""
+
+import time
+from collections import OrderedDict
+
+from telegram import Update
+
+from config import ADMIN_IDS, THROTTLE_LIMITS
+
+THROTTLE_ANSWER = "⏳ Подождите, запрос уже обрабатывается..."
+
+
+def action_class(update):
+    """
+    Определяет класс действия обновления.
+    
+    Returns:
+        tuple: (класс действия, ключ запроса для склейки дублей)
+    """
+    if update.callback_query:
+        data = update.callback_query.data or ""
+        if data == "buy" or data.startswith(("buy_", "pay_")):
+            return "buy", data
+        if data == "status":
+            return "status", data
+        if data.startswith("copy_key_"):
+            return "key", data
+        return "default", data
+    
+    message = update.effective_message
+    text = message.text if message and message.text else ""
+    if text.startswith("/"):
+        command = text.split()[0].split("@")[0]
+        if command == "/status":
+            return "status", command
+        if command == "/keys":
+            return "key", command
+        return "default", command
+    return "default", None
+
+
+class UpdateThrottle:
+    """Per-user, per-action token buckets plus in-flight request tracking.
+
+    Buckets idle long enough to refill completely are equivalent to new
+    ones, so they are dropped; the table only holds recently active users.
+    """
+
+    def __init__(self, limits=None, max_entries=50000):
+        self.limits = limits or THROTTLE_LIMITS
+        self.max_entries = max_entries
+        # (user_id, action) -> (tokens, updated_at)
+        self._buckets = OrderedDict()
+        self._in_flight = set()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _expire(self, now):
+        while self._buckets:
+            key, (tokens, updated) = next(iter(self._buckets.items()))
+            capacity, rate = self.limits[key[1]]
+            if len(self._buckets) <= self.max_entries and now - updated < capacity / rate:
+                break
+            del self._buckets[key]
+
+    def _take(self, user_id, action, now):
+        capacity, rate = self.limits[action]
+        key = (user_id, action)
+        tokens, updated = self._buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        return allowed
+
+    def acquire(self, update):
+        """
+        Проверяет, можно ли обработать обновление.
+        
+        Returns:
+            tuple | None: Ключ запроса для release() или None, если обновление отклонено
+        """
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None or user.id in ADMIN_IDS:
+            return ()
+        
+        action, request_key = action_class(update)
+        in_flight_key = (user.id, request_key)
+        if request_key is not None and in_flight_key in self._in_flight:
+            return None
+        
+        now = time.monotonic()
+        self._expire(now)
+        if not self._take(user.id, action, now):
+            return None
+        
+        if request_key is None:
+            return ()
+        self._in_flight.add(in_flight_key)
+        return in_flight_key
+
+    def release(self, in_flight_key):
+        """Mark the request returned by acquire() as finished"""
+        if in_flight_key:
+            self._in_flight.discard(in_flight_key)
+
+
+async def answer_throttled(update):
+    """Cheap answer for a rejected update: only callback queries get one"""
+    if update.callback_query:
+        try:
+            await update.callback_query.answer(THROTTLE_ANSWER)
+        except Exception:
+            pass
@@ -0,0 +1,136 @@
+"""
+Асинхронный веб-сервер бота.
+
+Обслуживает вебхук платежей ЮKassa и, в режиме BOT_MODE=webhook, вебхук
+Telegram на секретном пути. Обновления от Telegram кладутся в очередь
+приложения и обрабатываются параллельно, ответ Telegram отдаётся сразу.
+"""
+
+import hmac
+import ipaddress
+import json
+import logging
+
+from aiohttp import web
+from telegram import Update
+
+from config import (
+    BOT_MODE, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN, METRICS_TOKEN,
+    WEB_SERVER_HOST, WEB_SERVER_PORT, WEB_SERVER_REUSE_PORT
+)
+from services.payment_service import process_webhook
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+APPLICATION_KEY = web.AppKey("application", object)
+
+async def home(request):
+    """Home page"""
+    return web.json_response({
+        "status": "ok",
+        "message": "VPN management system"
+    })
+
+async def api_status(request):
+    """API endpoint to check system status"""
+    return web.json_response({
+        "status": "ok",
+        "bot_mode": BOT_MODE
+    })
+
+def _is_local_request(request):
+    """Запрос пришёл напрямую с этой машины, а не через прокси"""
+    if "X-Forwarded-For" in request.headers or "X-Real-IP" in request.headers:
+        return False
+    try:
+        return ipaddress.ip_address(request.remote or "").is_loopback
+    except ValueError:
+        return False
+
+async def api_metrics(request):
+    """Process metrics: counters, gauges and timings"""
+    if METRICS_TOKEN:
+        authorization = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(authorization, f"Bearer {METRICS_TOKEN}"):
+            return web.Response(status=403)
+    elif not _is_local_request(request):
+        return web.Response(status=403)
+    return web.json_response(metrics.snapshot())
+
+async def payment_webhook(request):
+    """Webhook for payment notifications from YooKassa"""
+    try:
+        webhook_data = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        logger.error("Failed to parse JSON from webhook data")
+        return web.json_response({"status": "error", "message": "Invalid data format"}, status=400)
+    
+    try:
+        result = await process_webhook(webhook_data)
+    except Exception as e:
+        logger.error(f"Error processing payment webhook: {e}")
+        return web.json_response({"status": "error", "message": str(e)}, status=500)
+    
+    if result:
+        return web.json_response({"status": "ok"})
+    return web.json_response({"status": "error", "message": "Failed to process webhook"}, status=500)
+
+async def telegram_webhook(request):
+    """Webhook for bot updates from Telegram"""
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if WEBHOOK_SECRET_TOKEN and not hmac.compare_digest(secret, WEBHOOK_SECRET_TOKEN):
+        logger.warning("Telegram webhook request with invalid secret token")
+        return web.Response(status=403)
+    
+    application = request.app[APPLICATION_KEY]
+    try:
+        update = Update.de_json(await request.json(), application.bot)
+    except (json.JSONDecodeError, UnicodeDecodeError, TypeError, KeyError) as e:
+        logger.error(f"Invalid Telegram update: {e}")
+        return web.Response(status=400)
+    
+    # Пока обработчики заняты, ответ задерживается и Telegram сбавляет темп
+    processor = application.update_processor
+    if hasattr(processor, "wait_for_capacity"):
+        await processor.wait_for_capacity()
+    
+    # Обработка идёт в фоне, Telegram получает ответ сразу
+    await application.update_queue.put(update)
+    return web.Response()
+
+def create_web_app(application):
+    """
+    Создаёт aiohttp-приложение с маршрутами вебхуков.
+    
+    Args:
+        application: Приложение python-telegram-bot
+    """
+    web_app = web.Application()
+    web_app[APPLICATION_KEY] = application
+    web_app.router.add_get("/", home)
+    web_app.router.add_get("/api/status", api_status)
+    web_app.router.add_get("/api/metrics", api_metrics)
+    web_app.router.add_post("/webhooks/payment", payment_webhook)
+    if BOT_MODE == "webhook":
+        web_app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    return web_app
+
+async def start_web_server(application):
+    """
+    Запускает веб-сервер.
+    
+    Returns:
+        web.AppRunner: Раннер для остановки сервера
+    """
+    runner = web.AppRunner(create_web_app(application), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(
+        runner,
+        WEB_SERVER_HOST,
+        WEB_SERVER_PORT,
+        reuse_port=WEB_SERVER_REUSE_PORT or None
+    )
+    await site.start()
+    logger.info(f"Web server listening on {WEB_SERVER_HOST}:{WEB_SERVER_PORT}")
+    return runner